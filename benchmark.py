@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+'''
+Measures the performance of the storage and execution layers.
+
+Usage: benchmark.py [name ...] [--rows N] [--snapshot-rows N]
+	[--sort-rows N] [--commits N] [--threads N] [--workers N]
+	[--connections N] [--queries N]
+'''
+
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import bufferpool
+import client
+import columnar
+import encoding
+import parallel
+import protocol
+import relation
+import repl
+import server
+import storage
+
+def timed(function, *args):
+	'Returns the result of calling function and the seconds it took.'
+	start = time.perf_counter()
+	result = function(*args)
+	return result, time.perf_counter() - start
+
+def report(label, seconds, rows=None):
+	if rows == None:
+		print('%-40s %10.3f s' % (label, seconds))
+	else:
+		print('%-40s %10.3f s %14.0f rows/s' % (label, seconds,
+												rows/max(seconds, 1e-9)))
+
+def sample_columns():
+	return [relation.Column('id', int, False), relation.Column('name', str),
+			relation.Column('score', float), relation.Column('active', bool)]
+
+def sample_rows(row_count):
+	for i in range(row_count):
+		yield (i, 'name %d' % (i % 1000), i*0.5, i % 3 == 0)
+
+def count_rows(table):
+	count = 0
+	for row in table:
+		count += 1
+	return count
+
+def filtered(table):
+	'Returns a selection of the rows of the sample table with a high score.'
+	return relation.Selection(table, relation.Comparison('>',
+		relation.Attribute(table.columns[2]), relation.Constant(0.0)))
+
+def benchmark_scan(arguments):
+	'Compares sequential scans of in memory and stored tables.'
+	row_count = arguments.rows
+	memory_table = relation.MaterialRelation(sample_columns(), 'memory')
+	for row in sample_rows(row_count):
+		memory_table.insert(row)
+	_, seconds = timed(count_rows, memory_table)
+	report('scan MaterialRelation', seconds, row_count)
+	_, seconds = timed(count_rows, filtered(memory_table))
+	report('filter MaterialRelation', seconds, row_count)
+
+	directory = tempfile.mkdtemp()
+	try:
+		path = os.path.join(directory, 'mapped.col')
+		columnar.write(path, memory_table)
+		mapped_table, seconds = timed(columnar.MappedRelation, path)
+		report('open MappedRelation', seconds)
+		_, seconds = timed(count_rows, mapped_table)
+		report('scan MappedRelation', seconds, row_count)
+		_, seconds = timed(count_rows, filtered(mapped_table))
+		report('filter MappedRelation', seconds, row_count)
+		mapped_table.close()
+	finally:
+		shutil.rmtree(directory)
+
+	directory = tempfile.mkdtemp()
+	try:
+		path = os.path.join(directory, 'disk.tbl')
+		disk_table = storage.DiskRelation.create(path, sample_columns(), 'disk')
+		_, seconds = timed(lambda: [disk_table.insert(row)
+									for row in sample_rows(row_count)])
+		disk_table.close()
+		report('insert DiskRelation', seconds, row_count)
+		disk_table, seconds = timed(storage.DiskRelation.open, path)
+		report('open DiskRelation', seconds)
+		_, seconds = timed(count_rows, disk_table)
+		report('scan DiskRelation', seconds, row_count)
+		_, seconds = timed(count_rows, filtered(disk_table))
+		report('filter DiskRelation', seconds, row_count)
+		disk_table.close()
+		# A pool large enough for scans of the file to be cached rather than
+		# use a ring, so the second scan only reads cached pages
+		pool = bufferpool.BufferPool(int(
+			os.path.getsize(path)/bufferpool.RING_THRESHOLD) + storage.PAGE_SIZE)
+		disk_table = storage.DiskRelation.open(path, pool)
+		_, seconds = timed(count_rows, disk_table)
+		report('cold buffered scan DiskRelation', seconds, row_count)
+		_, seconds = timed(count_rows, disk_table)
+		report('warm buffered scan DiskRelation', seconds, row_count)
+		print('buffer pool %(hits)d hits, %(misses)d misses, '
+			'%(evictions)d evictions' % pool.statistics())
+		disk_table.close()
+	finally:
+		shutil.rmtree(directory)
+
+def run_commits(db, thread_count, commit_count):
+	'Inserts commit_count rows from thread_count threads, one per statement.'
+	def insert_rows(thread_index):
+		for i in range(thread_index, commit_count, thread_count):
+			db.execute('insert into t values (%d);' % i)
+	threads = [threading.Thread(target=insert_rows, args=(i,))
+				for i in range(thread_count)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+def benchmark_commit(arguments):
+	'Compares durable inserts with an fsync per commit and group commit.'
+	for group_commit in (False, True):
+		directory = tempfile.mkdtemp()
+		try:
+			db = repl.Db(directory, group_commit=group_commit,
+							checkpoint_interval=None)
+			db.execute('create table t (a integer);')
+			_, seconds = timed(run_commits, db, arguments.threads,
+								arguments.commits)
+			label = 'group commit' if group_commit else 'sync per commit'
+			report('%s (%d syncs)' % (label, db.wal.sync_count - 1), seconds,
+					arguments.commits)
+			db.close()
+		finally:
+			shutil.rmtree(directory)
+
+def benchmark_snapshot(arguments):
+	'Measures saving and loading snapshots, with and without compression.'
+	row_count = arguments.snapshot_rows
+	db = repl.Db()
+	table = relation.MaterialRelation(sample_columns(), 'sample')
+	table.load(list(sample_rows(row_count)))
+	db.catalog['sample'] = table
+	directory = tempfile.mkdtemp()
+	try:
+		path = os.path.join(directory, 'snapshot')
+		for compress in (False, True):
+			label = 'compressed snapshot' if compress else 'snapshot'
+			_, seconds = timed(db.save_snapshot, path, compress)
+			report('save %s (%d MB)' % (label, os.path.getsize(path)//2**20),
+					seconds, row_count)
+			_, seconds = timed(repl.Db().load_snapshot, path)
+			report('load %s' % label, seconds, row_count)
+	finally:
+		shutil.rmtree(directory)
+
+def benchmark_encoding(arguments):
+	'Compares the memory and aggregation time of plain and encoded columns.'
+	row_count = arguments.rows
+	table = relation.MaterialRelation(sample_columns(), 'sample')
+	table.load(list(sample_rows(row_count)))
+	encoded, seconds = timed(encoding.EncodedRelation, table)
+	report('encode table', seconds, row_count)
+	for entry in encoded.memory_report():
+		print('%-12s %-20s %10d bytes %10d plain bytes' % (entry['column'],
+			entry['encoding'], entry['encoded_bytes'], entry['plain_bytes']))
+	_, seconds = timed(count_rows, encoded)
+	report('scan EncodedRelation', seconds, row_count)
+	aggregates = [relation.CountFactory(relation.Attribute(column))
+					for column in table.columns]
+	aggregates.append(relation.SumFactory(relation.Attribute(table.columns[0])))
+	_, seconds = timed(list, relation.GroupBy(table, [], aggregates))
+	report('aggregate MaterialRelation', seconds, row_count)
+	_, seconds = timed(list, encoding.RunAggregation(encoded, aggregates))
+	report('aggregate runs of EncodedRelation', seconds, row_count)
+
+def pipeline(table):
+	'Returns a filter and projection of the sample table.'
+	score = relation.Attribute(table.columns[2])
+	selection = relation.Selection(table, relation.Comparison('>',
+		relation.Arithmetic('*', score, relation.Constant(3.0)),
+		relation.Constant(10.0)))
+	return relation.GeneralizedProjection(selection, [
+		relation.Attribute(table.columns[0]),
+		relation.Arithmetic('+', score, relation.Constant(1.0)),
+		relation.Cast(relation.Attribute(table.columns[0]), str)])
+
+def benchmark_parallel(arguments):
+	'''
+	Measures the speedup of filtering and projecting tables in parallel with
+	1 to --workers worker processes.
+	'''
+	row_count = arguments.rows
+	table = relation.MaterialRelation(sample_columns(), 'sample')
+	table.load(list(sample_rows(row_count)))
+	directory = tempfile.mkdtemp()
+	try:
+		path = os.path.join(directory, 'sample.col')
+		columnar.write(path, table)
+		mapped_table = columnar.MappedRelation(path)
+		for source in (table, mapped_table):
+			name = type(source).__name__
+			_, serial_seconds = timed(count_rows, pipeline(source))
+			report('serial pipeline %s' % name, serial_seconds, row_count)
+			for workers in range(1, arguments.workers + 1):
+				executor = parallel.ParallelExecutor(workers)
+				# Workers are started before timing since they are reused
+				executor.get_pool().submit(int).result()
+				plan = parallel.ParallelPipeline(pipeline(source), executor)
+				_, seconds = timed(count_rows, plan)
+				report('%d workers %s (speedup %.2f)' % (workers, name,
+						serial_seconds/seconds), seconds, row_count)
+				executor.close()
+		mapped_table.close()
+	finally:
+		shutil.rmtree(directory)
+
+def benchmark_sort(arguments):
+	'''
+	Measures the speedup of sorting a table of --sort-rows rows read from a
+	columnar file in parallel with 1 to --workers worker processes.
+	'''
+	row_count = arguments.sort_rows
+	directory = tempfile.mkdtemp()
+	try:
+		path = os.path.join(directory, 'sample.col')
+		table = relation.MaterialRelation(sample_columns(), 'sample')
+		table.load(list(sample_rows(row_count)))
+		columnar.write(path, table)
+		del table
+		mapped_table = columnar.MappedRelation(path)
+		# Names repeat every thousand rows, so the rows are not in order
+		sort = relation.Sort(mapped_table, [mapped_table.columns[1]])
+		_, serial_seconds = timed(count_rows, sort)
+		report('serial sort', serial_seconds, row_count)
+		del sort
+		for workers in range(1, arguments.workers + 1):
+			executor = parallel.ParallelExecutor(workers)
+			executor.get_pool().submit(int).result()
+			plan = parallel.ParallelSort(relation.Sort(mapped_table,
+				[mapped_table.columns[1]]), executor)
+			_, seconds = timed(count_rows, plan)
+			report('%d workers (speedup %.2f)' % (workers,
+					serial_seconds/seconds), seconds, row_count)
+			executor.close()
+		mapped_table.close()
+	finally:
+		shutil.rmtree(directory)
+
+async def run_queries(port, sql, query_count, latencies):
+	'''
+	Runs a query query_count times over one connection, adding the seconds
+	each one took to latencies.
+	'''
+	reader, writer = await asyncio.open_connection('127.0.0.1', port)
+	await protocol.read_message(reader)
+	for request_id in range(query_count):
+		start = time.perf_counter()
+		protocol.write_message(writer, {'type': protocol.EXECUTE,
+			'id': request_id, 'sql': sql})
+		await writer.drain()
+		while True:
+			response = await protocol.read_message(reader)
+			if response['type'] == protocol.ERROR:
+				raise RuntimeError(response['message'])
+			if response['type'] == protocol.DONE:
+				break
+		latencies.append(time.perf_counter() - start)
+	protocol.write_message(writer, {'type': protocol.CLOSE})
+	writer.close()
+
+async def load_test(port, sql, connection_count, query_count):
+	latencies = []
+	await asyncio.gather(*[run_queries(port, sql, query_count, latencies)
+							for i in range(connection_count)])
+	return latencies
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(int(len(values)*fraction), len(values) - 1)]
+
+def benchmark_server(arguments):
+	'''
+	Measures the queries per second and latency of a server answering small
+	queries from --connections concurrent connections each running
+	--queries queries. The server runs in a thread of this process.
+	'''
+	db = repl.Db()
+	db.execute('create table t (a integer, b string);')
+	db.execute('insert into t values %s;' % ', '.join(
+		"(%d, 'name %d')" % (i, i) for i in range(1000)))
+	query_server = server.Server(db, port=0)
+	query_server.run_in_thread()
+	try:
+		sql = 'select a, b from t where a < 10;'
+		connection_count = arguments.connections
+		latencies, seconds = timed(asyncio.run, load_test(query_server.port,
+			sql, connection_count, arguments.queries))
+		report('%d connections' % connection_count, seconds)
+		print('%-40s %10.0f' % ('queries/s', len(latencies)/seconds))
+		for fraction in (0.5, 0.99):
+			report('p%d latency' % (fraction*100),
+					percentile(latencies, fraction))
+	finally:
+		query_server.stop_thread()
+
+def run_client_threads(thread_count, query_count, run_query):
+	def run():
+		for i in range(query_count):
+			run_query()
+	threads = [threading.Thread(target=run) for i in range(thread_count)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+def benchmark_pool(arguments):
+	'''
+	Compares --threads threads each running --queries small queries over a
+	new connection per query and over connections from a pool.
+	'''
+	db = repl.Db()
+	db.execute('create table t (a integer, b string);')
+	db.execute('insert into t values %s;' % ', '.join(
+		"(%d, 'name %d')" % (i, i) for i in range(1000)))
+	query_server = server.Server(db, port=0)
+	query_server.run_in_thread()
+	sql = 'select a, b from t where a < 10;'
+	query_count = arguments.threads*arguments.queries
+	def unpooled_query():
+		with client.Connection(port=query_server.port) as connection:
+			connection.cursor().execute(sql).fetchall()
+	pool = client.ConnectionPool(port=query_server.port,
+		max_size=arguments.threads)
+	def pooled_query():
+		with pool.connection() as connection:
+			connection.cursor().execute(sql).fetchall()
+	try:
+		_, seconds = timed(run_client_threads, arguments.threads,
+			arguments.queries, unpooled_query)
+		report('connection per query', seconds, query_count)
+		_, seconds = timed(run_client_threads, arguments.threads,
+			arguments.queries, pooled_query)
+		report('pooled connections', seconds, query_count)
+	finally:
+		pool.close()
+		query_server.stop_thread()
+
+benchmarks = {
+	'scan': benchmark_scan,
+	'encoding': benchmark_encoding,
+	'parallel': benchmark_parallel,
+	'sort': benchmark_sort,
+	'server': benchmark_server,
+	'pool': benchmark_pool,
+	'commit': benchmark_commit,
+	'snapshot': benchmark_snapshot,
+}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('names', nargs='*', metavar='name',
+						help='benchmarks to run, all by default: %s' %
+							', '.join(benchmarks))
+	parser.add_argument('--rows', type=int, default=1000000,
+						help='rows in scanned tables')
+	parser.add_argument('--snapshot-rows', type=int, default=10000000,
+						help='rows in saved and loaded snapshots')
+	parser.add_argument('--sort-rows', type=int, default=10000000,
+						help='rows in sorted tables')
+	parser.add_argument('--commits', type=int, default=2000,
+						help='statements executed by commit benchmarks')
+	parser.add_argument('--threads', type=int, default=8,
+						help='threads executing statements concurrently')
+	parser.add_argument('--workers', type=int, default=os.cpu_count(),
+						help='largest number of worker processes')
+	parser.add_argument('--connections', type=int, default=200,
+						help='concurrent connections of the server benchmark')
+	parser.add_argument('--queries', type=int, default=50,
+						help='queries run by each connection')
+	arguments = parser.parse_args()
+	for name in arguments.names:
+		if name not in benchmarks:
+			parser.error('unknown benchmark %r' % name)
+	for name in arguments.names or list(benchmarks):
+		print('%s:' % name)
+		benchmarks[name](arguments)
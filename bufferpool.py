@@ -0,0 +1,209 @@
+import itertools
+import threading
+
+import storage
+
+DEFAULT_CAPACITY = 64*2**20
+# Number of pages a sequential scan cycles through
+DEFAULT_RING_SIZE = 32
+# Scans of files larger than this fraction of the pool use a ring
+RING_THRESHOLD = 1/4
+
+class Frame:
+	def __init__(self, key, data):
+		'A page held by a buffer pool.'
+		self.key = key
+		self.data = data
+		self.pin_count = 0
+		# Set when the page is used and cleared as the clock hand passes
+		self.referenced = True
+		# True while the page is in the ring of a scan
+		self.in_ring = False
+
+class ScanRing:
+	def __init__(self, size=DEFAULT_RING_SIZE):
+		'''
+		A small set of frames reused by a sequential scan. Pages a scan reads
+		replace the pages it read earlier instead of the pages in the pool,
+		so one large scan does not evict the pages other queries use.
+		'''
+		self.size = size
+		self.frames = []
+		self.next = 0
+
+class BufferPool:
+	def __init__(self, capacity=DEFAULT_CAPACITY, page_size=storage.PAGE_SIZE):
+		'''
+		A cache of file pages shared by the tables of a database, holding at
+		most capacity bytes including memory reserved by operators. Pages
+		are pinned while in use and unpinned pages are evicted with the clock
+		algorithm.
+		'''
+		self.capacity = capacity
+		self.page_size = page_size
+		self.lock = threading.Lock()
+		self.frames = {}
+		self.clock = []
+		self.hand = 0
+		self.ring_frames = 0
+		self.reserved = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.file_ids = itertools.count(1)
+
+	def new_file_id(self):
+		'Returns an id identifying the pages of a file in the pool.'
+		return next(self.file_ids)
+
+	def frame_limit(self):
+		return max((self.capacity - self.reserved)//self.page_size, 0)
+
+	def scan_ring(self, page_count):
+		'''
+		Returns a ring for a sequential scan of a file with page_count pages,
+		or None if the file is small enough to be cached by the pool.
+		'''
+		if page_count > self.frame_limit()*RING_THRESHOLD:
+			return ScanRing()
+		return None
+
+	def pin(self, key, load, ring=None):
+		'''
+		Returns the frame of the page with the key, calling load to read the
+		page if it is not in the pool. The frame must be unpinned once the
+		caller no longer uses its data. Pages read for a scan are placed in
+		its ring.
+		'''
+		with self.lock:
+			frame = self.frames.get(key)
+			if frame != None:
+				self.hits += 1
+				frame.pin_count += 1
+				frame.referenced = True
+				return frame
+			self.misses += 1
+			frame = Frame(key, load())
+			if ring == None:
+				self.add_to_clock(frame)
+			else:
+				self.add_to_ring(frame, ring)
+			self.frames[key] = frame
+			frame.pin_count = 1
+			return frame
+
+	def unpin(self, frame):
+		with self.lock:
+			frame.pin_count -= 1
+
+	def sweep(self):
+		'''
+		Advances the clock hand to an unpinned page which has not been used
+		since the hand last passed it and returns its position.
+		'''
+		for i in range(2*len(self.clock)):
+			frame = self.clock[self.hand]
+			if frame.pin_count == 0:
+				if not frame.referenced:
+					return self.hand
+				frame.referenced = False
+			self.hand = (self.hand + 1) % len(self.clock)
+		raise MemoryError('Every page in the buffer pool is pinned')
+
+	def remove_from_clock(self, position):
+		frame = self.clock.pop(position)
+		if self.frames.get(frame.key) == frame:
+			del self.frames[frame.key]
+		if self.hand > position:
+			self.hand -= 1
+		if self.hand >= len(self.clock):
+			self.hand = 0
+
+	def add_to_clock(self, frame):
+		while self.clock and (
+				len(self.clock) + self.ring_frames >= self.frame_limit()):
+			self.remove_from_clock(self.sweep())
+			self.evictions += 1
+		self.clock.insert(self.hand, frame)
+		self.hand = (self.hand + 1) % len(self.clock)
+
+	def add_to_ring(self, frame, ring):
+		frame.in_ring = True
+		if len(ring.frames) < ring.size:
+			ring.frames.append(frame)
+			self.ring_frames += 1
+			return
+		for i in range(len(ring.frames)):
+			position = ring.next
+			ring.next = (ring.next + 1) % len(ring.frames)
+			victim = ring.frames[position]
+			if victim.pin_count == 0:
+				victim.in_ring = False
+				if self.frames.get(victim.key) == victim:
+					del self.frames[victim.key]
+					self.evictions += 1
+				ring.frames[position] = frame
+				return
+		# Every page of the ring is pinned
+		ring.frames.append(frame)
+		self.ring_frames += 1
+
+	def release_ring(self, ring):
+		'Drops the pages of a scan which has finished from the pool.'
+		with self.lock:
+			for frame in ring.frames:
+				frame.in_ring = False
+				if self.frames.get(frame.key) == frame:
+					del self.frames[frame.key]
+			self.ring_frames -= len(ring.frames)
+			ring.frames = []
+			ring.next = 0
+
+	def discard_file(self, file_id, first_page=0):
+		'''
+		Drops the pages of a file starting at first_page, which have changed
+		or no longer exist.
+		'''
+		with self.lock:
+			for key, frame in list(self.frames.items()):
+				if key[0] != file_id or key[1] < first_page:
+					continue
+				del self.frames[key]
+				if not frame.in_ring:
+					self.remove_from_clock(self.clock.index(frame))
+
+	def reserve(self, size):
+		'''
+		Reserves size bytes of the pool's memory for an operator, evicting
+		unpinned pages to make room. Raises MemoryError if the memory can not
+		be reserved.
+		'''
+		with self.lock:
+			if self.reserved + size > self.capacity:
+				raise MemoryError(
+					'Can not reserve %d bytes of the buffer pool' % size)
+			self.reserved += size
+			try:
+				while self.clock and (
+						len(self.clock) + self.ring_frames > self.frame_limit()):
+					self.remove_from_clock(self.sweep())
+					self.evictions += 1
+			except MemoryError:
+				self.reserved -= size
+				raise
+
+	def release(self, size):
+		'Returns memory reserved by reserve.'
+		with self.lock:
+			self.reserved -= size
+
+	def statistics(self):
+		'Returns the hit, miss and eviction counters and the memory in use.'
+		with self.lock:
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'pages': len(self.frames),
+				'reserved_bytes': self.reserved,
+			}
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+from bufferpool import *
+import unittest
+
+class TestBufferPool(unittest.TestCase):
+	def setUp(self):
+		self.pool = BufferPool(4*100, 100)
+		self.reads = []
+
+	def load(self, key):
+		def read():
+			self.reads.append(key)
+			return b'page %d' % key[1]
+		return read
+
+	def get(self, page_number, ring=None):
+		key = (1, page_number)
+		frame = self.pool.pin(key, self.load(key), ring)
+		self.pool.unpin(frame)
+		return frame.data
+
+	def test_should_count_hits_and_misses(self):
+		self.assertEqual(self.get(0), b'page 0')
+		self.assertEqual(self.get(0), b'page 0')
+		self.get(1)
+		statistics = self.pool.statistics()
+		self.assertEqual((statistics['hits'], statistics['misses']), (1, 2))
+		self.assertEqual(statistics['pages'], 2)
+		self.assertEqual(self.reads, [(1, 0), (1, 1)])
+
+	def test_clock_should_evict_pages_not_recently_used(self):
+		for page_number in range(4):
+			self.get(page_number)
+		# The hand clears every reference bit before evicting page 0
+		self.get(4)
+		self.assertEqual(sorted(key[1] for key in self.pool.frames),
+			[1, 2, 3, 4])
+		# Page 1 was used again so the next eviction skips it
+		self.get(1)
+		self.get(5)
+		self.assertEqual(sorted(key[1] for key in self.pool.frames),
+			[1, 3, 4, 5])
+		self.assertEqual(self.pool.evictions, 2)
+
+	def test_should_not_evict_pinned_pages(self):
+		frames = [self.pool.pin((1, i), self.load((1, i))) for i in range(4)]
+		with self.assertRaisesRegex(MemoryError, 'pinned'):
+			self.get(4)
+		self.pool.unpin(frames[2])
+		self.get(4)
+		self.assertNotIn((1, 2), self.pool.frames)
+		self.assertIn((1, 0), self.pool.frames)
+
+	def test_scan_ring_should_reuse_its_own_frames(self):
+		self.get(0)
+		self.get(1)
+		ring = self.pool.scan_ring(100)
+		ring.size = 2
+		for page_number in range(10, 20):
+			self.get(page_number, ring)
+		self.assertIn((1, 0), self.pool.frames)
+		self.assertIn((1, 1), self.pool.frames)
+		self.assertLessEqual(len(self.pool.frames), 4)
+		self.pool.release_ring(ring)
+		self.assertEqual(sorted(self.pool.frames), [(1, 0), (1, 1)])
+		self.assertEqual(self.pool.ring_frames, 0)
+
+	def test_small_files_should_not_use_a_ring(self):
+		self.assertIsNone(self.pool.scan_ring(1))
+		self.assertIsNotNone(self.pool.scan_ring(2))
+
+	def test_reserve_should_evict_pages(self):
+		for page_number in range(4):
+			self.get(page_number)
+		self.pool.reserve(250)
+		self.assertEqual(len(self.pool.frames), 1)
+		self.assertEqual(self.pool.statistics()['reserved_bytes'], 250)
+		with self.assertRaisesRegex(MemoryError, 'reserve'):
+			self.pool.reserve(200)
+		self.pool.release(250)
+		self.assertEqual(self.pool.frame_limit(), 4)
+
+	def test_reserve_should_fail_if_pages_are_pinned(self):
+		frames = [self.pool.pin((1, i), self.load((1, i))) for i in range(4)]
+		with self.assertRaises(MemoryError):
+			self.pool.reserve(100)
+		self.assertEqual(self.pool.reserved, 0)
+
+	def test_discard_file_should_drop_changed_pages(self):
+		for page_number in range(3):
+			self.get(page_number)
+		self.pool.pin((2, 0), self.load((2, 0)))
+		self.pool.discard_file(1, 1)
+		self.assertEqual(sorted(self.pool.frames), [(1, 0), (2, 0)])
+		self.get(1)
+		self.assertEqual(self.reads[-1], (1, 1))
+		self.assertEqual(len(self.pool.clock), 3)
+
+if __name__ == '__main__':
+	unittest.main()
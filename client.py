@@ -0,0 +1,743 @@
+'''
+Clients of the query server of server.py, with pools of connections shared
+by threads or by asyncio tasks.
+
+A connection sends requests without waiting for the responses to earlier
+ones and reads the responses in order, so the rows of a result are only
+read from the socket as a cursor fetches them.
+'''
+
+import asyncio
+import collections
+import contextlib
+import itertools
+import re
+import socket
+import threading
+import time
+
+import protocol
+import server
+
+DEFAULT_BATCH_ROWS = server.DEFAULT_BATCH_ROWS
+# Seconds a pooled connection may stay unused before it is checked with a
+# ping when acquired
+DEFAULT_HEALTH_CHECK_INTERVAL = 10.0
+# Seconds an unused pooled connection is kept open beyond the minimum size
+DEFAULT_IDLE_TIMEOUT = 60.0
+
+# Statements which do not change the database, so they can be sent again
+# when the connection is lost before their result arrives
+READ_ONLY_STATEMENTS = ('select', 'explain')
+
+def is_read_only(sql):
+	'Returns true if the statement does not change the database.'
+	match = re.match(r'[\s(]*([A-Za-z]+)', sql)
+	return match != None and match.group(1).lower() in READ_ONLY_STATEMENTS
+
+def can_retry(sql, result):
+	'''
+	Returns true if a statement can be sent again after the connection was
+	lost: either it was never sent, or it changes nothing and none of its
+	result was received.
+	'''
+	return result == None or (is_read_only(sql) and not result.received)
+
+class QueryError(Exception):
+	'An error the server reported for a request.'
+
+class Result:
+	def __init__(self, request_id):
+		'''
+		The responses to a request, filled in as they are read. columns is
+		the description of the result's columns, or None until it arrives
+		and for statements without results.
+		'''
+		self.request_id = request_id
+		self.columns = None
+		self.rows = collections.deque()
+		self.row_count = None
+		self.error = None
+		self.received = False
+		self.done = False
+
+	def add(self, message):
+		if message.get('id') != self.request_id:
+			raise protocol.ProtocolError(
+				'Response %r does not answer request %r' %
+				(message.get('id'), self.request_id))
+		self.received = True
+		message_type = message['type']
+		if message_type == protocol.DESCRIPTION:
+			self.columns = [tuple(column) for column in message['columns']]
+		elif message_type == protocol.BATCH:
+			self.rows.extend(tuple(row) for row in message['rows'])
+		elif message_type == protocol.DONE:
+			self.row_count = message['row_count']
+			self.done = True
+		elif message_type == protocol.ERROR:
+			self.error = message['message']
+			self.done = True
+		elif message_type == protocol.PONG:
+			self.done = True
+		else:
+			raise protocol.ProtocolError(
+				'Unexpected response type %r' % message_type)
+
+	def started(self):
+		return self.columns != None or self.done
+
+	def has_rows(self):
+		return bool(self.rows) or self.done
+
+	def check(self):
+		if self.error != None:
+			raise QueryError(self.error)
+
+class Connection:
+	def __init__(self, host='127.0.0.1', port=server.DEFAULT_PORT,
+			timeout=None):
+		'''
+		A blocking connection to a server. A connection closed after an error
+		is opened again by the next request, and a statement is sent again
+		on a new connection if the server closed the connection of an idle
+		client before answering it.
+		'''
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self.sock = None
+		self.session_id = None
+		self.request_ids = itertools.count(1)
+		# Results of the requests sent, in the order they are answered
+		self.pending = collections.deque()
+		self.last_used = time.monotonic()
+		self.connect()
+
+	def connect(self):
+		self.sock = socket.create_connection((self.host, self.port),
+												self.timeout)
+		try:
+			hello = protocol.receive_message(self.sock)
+		except (OSError, protocol.ProtocolError):
+			self.discard()
+			raise
+		if hello == None or hello.get('type') != protocol.HELLO:
+			self.discard()
+			raise ConnectionError('The server did not accept the connection')
+		self.session_id = hello['session']
+
+	@property
+	def closed(self):
+		return self.sock == None
+
+	def discard(self):
+		'Closes the socket after an error, abandoning the pending requests.'
+		if self.sock != None:
+			self.sock.close()
+			self.sock = None
+		self.pending.clear()
+
+	def close(self):
+		if self.sock == None:
+			return
+		try:
+			protocol.send_message(self.sock, {'type': protocol.CLOSE})
+		except OSError:
+			pass
+		self.discard()
+
+	def submit(self, message):
+		'Sends a request and returns the Result its responses are added to.'
+		if self.sock == None:
+			self.connect()
+		result = Result(next(self.request_ids))
+		message['id'] = result.request_id
+		try:
+			protocol.send_message(self.sock, message)
+		except OSError:
+			self.discard()
+			raise
+		self.pending.append(result)
+		self.last_used = time.monotonic()
+		return result
+
+	def wait(self, result, condition):
+		'''
+		Reads responses until condition(result) is true, adding responses to
+		earlier requests to their results.
+		'''
+		while not condition(result):
+			if not self.pending:
+				raise protocol.ProtocolError('The request was abandoned')
+			try:
+				message = protocol.receive_message(self.sock)
+			except (OSError, protocol.ProtocolError):
+				self.discard()
+				raise
+			if message == None:
+				self.discard()
+				raise ConnectionError('The server closed the connection')
+			self.pending[0].add(message)
+			if self.pending[0].done:
+				self.pending.popleft()
+		self.last_used = time.monotonic()
+
+	def start(self, sql, batch_rows=None):
+		'''
+		Sends a statement and waits for the description of its result.
+		Returns the Result, whose rows are read as they are waited for.
+		'''
+		message = {'type': protocol.EXECUTE, 'sql': sql}
+		if batch_rows != None:
+			message['batch_rows'] = batch_rows
+		retry = not self.pending
+		while True:
+			result = None
+			try:
+				result = self.submit(dict(message))
+				self.wait(result, Result.started)
+			except ConnectionError:
+				if not (retry and can_retry(sql, result)):
+					raise
+				retry = False
+				continue
+			result.check()
+			return result
+
+	def finish(self):
+		'Reads the responses to every request sent, dropping their rows.'
+		while self.pending:
+			result = self.pending[-1]
+			self.wait(result, lambda result: result.done)
+
+	def ping(self):
+		'Returns true if the server answers a ping.'
+		try:
+			self.finish()
+			result = self.submit({'type': protocol.PING})
+			self.wait(result, lambda result: result.done)
+			return True
+		except (OSError, protocol.ProtocolError):
+			return False
+
+	def pipeline(self, statements, batch_rows=None):
+		'''
+		Sends every statement before reading any response and returns the
+		rows of each one, or None for statements without results. The first
+		error is raised once every response has been read.
+		'''
+		results = []
+		for sql in statements:
+			message = {'type': protocol.EXECUTE, 'sql': sql}
+			if batch_rows != None:
+				message['batch_rows'] = batch_rows
+			results.append(self.submit(message))
+		for result in results:
+			self.wait(result, lambda result: result.done)
+		for result in results:
+			result.check()
+		return [list(result.rows) if result.columns != None else None
+				for result in results]
+
+	def cursor(self, batch_rows=DEFAULT_BATCH_ROWS):
+		return Cursor(self, batch_rows)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exception):
+		self.close()
+
+class Cursor:
+	def __init__(self, connection, batch_rows=DEFAULT_BATCH_ROWS):
+		'''
+		Executes statements over a connection and fetches their rows, which
+		the server sends in batches of batch_rows rows as they are fetched.
+		'''
+		self.connection = connection
+		self.batch_rows = batch_rows
+		self.arraysize = 1
+		self.result = None
+
+	@property
+	def description(self):
+		'The name, type name and nullability of the columns of the result.'
+		if self.result == None:
+			return None
+		return self.result.columns
+
+	@property
+	def rowcount(self):
+		if self.result == None or self.result.row_count == None:
+			return -1
+		return self.result.row_count
+
+	def execute(self, sql):
+		self.result = None
+		self.result = self.connection.start(sql, self.batch_rows)
+		return self
+
+	def fetchmany(self, size=None):
+		if self.result == None or self.result.columns == None:
+			raise ValueError('The statement has no result to fetch')
+		size = size or self.arraysize
+		rows = []
+		while len(rows) < size:
+			self.connection.wait(self.result, Result.has_rows)
+			self.result.check()
+			if not self.result.rows:
+				break
+			while self.result.rows and len(rows) < size:
+				rows.append(self.result.rows.popleft())
+		return rows
+
+	def fetchone(self):
+		rows = self.fetchmany(1)
+		return rows[0] if rows else None
+
+	def fetchall(self):
+		rows = []
+		while True:
+			batch = self.fetchmany(self.batch_rows)
+			if not batch:
+				return rows
+			rows.extend(batch)
+
+	def __iter__(self):
+		while True:
+			batch = self.fetchmany(self.batch_rows)
+			if not batch:
+				return
+			yield from batch
+
+	def close(self):
+		self.result = None
+
+class BasePool:
+	def __init__(self, min_size, max_size, idle_timeout,
+			health_check_interval):
+		if not 0 <= min_size <= max_size or max_size < 1:
+			raise ValueError('Pools need 0 <= min_size <= max_size and '
+								'max_size >= 1')
+		self.min_size = min_size
+		self.max_size = max_size
+		self.idle_timeout = idle_timeout
+		self.health_check_interval = health_check_interval
+		# Unused connections, least recently used first
+		self.idle = []
+		# Connections open or being opened, idle or in use
+		self.size = 0
+		self.closed = False
+		self.opened = 0
+		self.reused = 0
+		self.checks = 0
+		self.discarded = 0
+
+	def expired_connections(self):
+		'''
+		Removes and returns the idle connections which have been unused for
+		longer than the idle timeout, keeping at least min_size connections.
+		'''
+		expired = []
+		now = time.monotonic()
+		while self.idle and self.size > self.min_size and (
+				now - self.idle[0].last_used > self.idle_timeout):
+			expired.append(self.idle.pop(0))
+			self.size -= 1
+		return expired
+
+	def needs_check(self, connection):
+		return (time.monotonic() - connection.last_used >=
+				self.health_check_interval)
+
+	def statistics(self):
+		return {
+			'size': self.size,
+			'idle': len(self.idle),
+			'opened': self.opened,
+			'reused': self.reused,
+			'health_checks': self.checks,
+			'discarded': self.discarded,
+		}
+
+class ConnectionPool(BasePool):
+	def __init__(self, host='127.0.0.1', port=server.DEFAULT_PORT, min_size=1,
+			max_size=10, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+			health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL, timeout=None):
+		'''
+		A pool of connections shared by threads. Between min_size and
+		max_size connections are kept open, closing unused connections after
+		idle_timeout seconds. Connections unused for health_check_interval
+		seconds are pinged before they are handed out and replaced if the
+		server does not answer.
+		'''
+		super().__init__(min_size, max_size, idle_timeout,
+							health_check_interval)
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.available = threading.Condition(self.lock)
+		for i in range(min_size):
+			self.idle.append(self.open_connection())
+			self.size += 1
+
+	def open_connection(self):
+		connection = Connection(self.host, self.port, self.timeout)
+		self.opened += 1
+		return connection
+
+	def acquire(self, timeout=None):
+		'''
+		Returns an open connection, waiting up to timeout seconds for one to
+		be released if max_size connections are in use.
+		'''
+		deadline = None if timeout == None else time.monotonic() + timeout
+		with self.lock:
+			while True:
+				if self.closed:
+					raise ValueError('The connection pool is closed')
+				for connection in self.expired_connections():
+					connection.close()
+				if self.idle:
+					connection = self.idle.pop()
+					self.reused += 1
+					break
+				if self.size < self.max_size:
+					self.size += 1
+					connection = None
+					break
+				remaining = None
+				if deadline != None:
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						raise TimeoutError('No connection became available')
+				self.available.wait(remaining)
+		try:
+			if connection == None:
+				return self.open_connection()
+			if self.needs_check(connection):
+				self.checks += 1
+				if not connection.ping():
+					self.discarded += 1
+					connection.discard()
+					connection.connect()
+			return connection
+		except BaseException:
+			with self.lock:
+				self.size -= 1
+				self.available.notify()
+			raise
+
+	def release(self, connection):
+		'''
+		Returns a connection to the pool, first reading the rest of any
+		result which was not fetched.
+		'''
+		if not connection.closed:
+			try:
+				connection.finish()
+			except (OSError, protocol.ProtocolError):
+				connection.discard()
+		with self.lock:
+			if connection.closed or self.closed:
+				connection.close()
+				self.size -= 1
+				self.discarded += 1
+			else:
+				self.idle.append(connection)
+			self.available.notify()
+
+	@contextlib.contextmanager
+	def connection(self, timeout=None):
+		connection = self.acquire(timeout)
+		try:
+			yield connection
+		finally:
+			self.release(connection)
+
+	def close(self):
+		'Closes the idle connections, and the others once they are released.'
+		with self.lock:
+			self.closed = True
+			for connection in self.idle:
+				connection.close()
+			self.size -= len(self.idle)
+			self.idle = []
+			self.available.notify_all()
+
+class AsyncConnection:
+	def __init__(self, host='127.0.0.1', port=server.DEFAULT_PORT):
+		'''
+		A connection to a server for asyncio tasks, opened by connect. Like
+		Connection, it is opened again after an error and pipelines the
+		requests of tasks sharing it.
+		'''
+		self.host = host
+		self.port = port
+		self.reader = None
+		self.writer = None
+		self.session_id = None
+		self.request_ids = itertools.count(1)
+		self.pending = collections.deque()
+		self.last_used = time.monotonic()
+		# Serializes reading responses between the tasks using the connection
+		self.read_lock = asyncio.Lock()
+
+	async def connect(self):
+		self.reader, self.writer = await asyncio.open_connection(self.host,
+																	self.port)
+		try:
+			hello = await protocol.read_message(self.reader)
+		except (OSError, protocol.ProtocolError):
+			self.discard()
+			raise
+		if hello == None or hello.get('type') != protocol.HELLO:
+			self.discard()
+			raise ConnectionError('The server did not accept the connection')
+		self.session_id = hello['session']
+		return self
+
+	@property
+	def closed(self):
+		return self.writer == None
+
+	def discard(self):
+		if self.writer != None:
+			self.writer.close()
+			self.reader = self.writer = None
+		self.pending.clear()
+
+	async def close(self):
+		if self.writer == None:
+			return
+		try:
+			protocol.write_message(self.writer, {'type': protocol.CLOSE})
+			await self.writer.drain()
+		except OSError:
+			pass
+		self.discard()
+
+	async def submit(self, message):
+		if self.writer == None:
+			await self.connect()
+		result = Result(next(self.request_ids))
+		message['id'] = result.request_id
+		try:
+			protocol.write_message(self.writer, message)
+			await self.writer.drain()
+		except OSError:
+			self.discard()
+			raise
+		self.pending.append(result)
+		self.last_used = time.monotonic()
+		return result
+
+	async def wait(self, result, condition):
+		async with self.read_lock:
+			while not condition(result):
+				if not self.pending:
+					raise protocol.ProtocolError('The request was abandoned')
+				try:
+					message = await protocol.read_message(self.reader)
+				except (OSError, asyncio.IncompleteReadError,
+						protocol.ProtocolError):
+					self.discard()
+					raise ConnectionError('The connection was lost')
+				if message == None:
+					self.discard()
+					raise ConnectionError('The server closed the connection')
+				self.pending[0].add(message)
+				if self.pending[0].done:
+					self.pending.popleft()
+		self.last_used = time.monotonic()
+
+	async def start(self, sql, batch_rows=None):
+		message = {'type': protocol.EXECUTE, 'sql': sql}
+		if batch_rows != None:
+			message['batch_rows'] = batch_rows
+		retry = not self.pending
+		while True:
+			result = None
+			try:
+				result = await self.submit(dict(message))
+				await self.wait(result, Result.started)
+			except ConnectionError:
+				if not (retry and can_retry(sql, result)):
+					raise
+				retry = False
+				continue
+			result.check()
+			return result
+
+	async def finish(self):
+		while self.pending:
+			result = self.pending[-1]
+			await self.wait(result, lambda result: result.done)
+
+	async def ping(self):
+		try:
+			await self.finish()
+			result = await self.submit({'type': protocol.PING})
+			await self.wait(result, lambda result: result.done)
+			return True
+		except (OSError, protocol.ProtocolError):
+			return False
+
+	async def pipeline(self, statements, batch_rows=None):
+		results = []
+		for sql in statements:
+			message = {'type': protocol.EXECUTE, 'sql': sql}
+			if batch_rows != None:
+				message['batch_rows'] = batch_rows
+			results.append(await self.submit(message))
+		for result in results:
+			await self.wait(result, lambda result: result.done)
+		for result in results:
+			result.check()
+		return [list(result.rows) if result.columns != None else None
+				for result in results]
+
+	def cursor(self, batch_rows=DEFAULT_BATCH_ROWS):
+		return AsyncCursor(self, batch_rows)
+
+class AsyncCursor(Cursor):
+	'A Cursor whose execute and fetch methods are coroutines.'
+
+	async def execute(self, sql):
+		self.result = None
+		self.result = await self.connection.start(sql, self.batch_rows)
+		return self
+
+	async def fetchmany(self, size=None):
+		if self.result == None or self.result.columns == None:
+			raise ValueError('The statement has no result to fetch')
+		size = size or self.arraysize
+		rows = []
+		while len(rows) < size:
+			await self.connection.wait(self.result, Result.has_rows)
+			self.result.check()
+			if not self.result.rows:
+				break
+			while self.result.rows and len(rows) < size:
+				rows.append(self.result.rows.popleft())
+		return rows
+
+	async def fetchone(self):
+		rows = await self.fetchmany(1)
+		return rows[0] if rows else None
+
+	async def fetchall(self):
+		rows = []
+		while True:
+			batch = await self.fetchmany(self.batch_rows)
+			if not batch:
+				return rows
+			rows.extend(batch)
+
+	def __iter__(self):
+		raise TypeError('Use async for with an AsyncCursor')
+
+	async def __aiter__(self):
+		while True:
+			batch = await self.fetchmany(self.batch_rows)
+			if not batch:
+				return
+			for row in batch:
+				yield row
+
+class AsyncConnectionPool(BasePool):
+	def __init__(self, host='127.0.0.1', port=server.DEFAULT_PORT, min_size=1,
+			max_size=10, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+			health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL):
+		'''
+		A ConnectionPool for asyncio tasks. The min_size connections are
+		opened by open.
+		'''
+		super().__init__(min_size, max_size, idle_timeout,
+							health_check_interval)
+		self.host = host
+		self.port = port
+		self.available = asyncio.Condition()
+
+	async def open_connection(self):
+		connection = await AsyncConnection(self.host, self.port).connect()
+		self.opened += 1
+		return connection
+
+	async def open(self):
+		while self.size < self.min_size:
+			self.size += 1
+			try:
+				self.idle.append(await self.open_connection())
+			except BaseException:
+				self.size -= 1
+				raise
+		return self
+
+	async def acquire(self, timeout=None):
+		async with self.available:
+			try:
+				await asyncio.wait_for(self.available.wait_for(
+					lambda: self.closed or self.idle or (
+						self.size < self.max_size)), timeout)
+			except asyncio.TimeoutError:
+				raise TimeoutError('No connection became available')
+			if self.closed:
+				raise ValueError('The connection pool is closed')
+			for connection in self.expired_connections():
+				connection.discard()
+			if self.idle:
+				connection = self.idle.pop()
+				self.reused += 1
+			else:
+				self.size += 1
+				connection = None
+		try:
+			if connection == None:
+				return await self.open_connection()
+			if self.needs_check(connection):
+				self.checks += 1
+				if not await connection.ping():
+					self.discarded += 1
+					connection.discard()
+					await connection.connect()
+			return connection
+		except BaseException:
+			async with self.available:
+				self.size -= 1
+				self.available.notify()
+			raise
+
+	async def release(self, connection):
+		if not connection.closed:
+			try:
+				await connection.finish()
+			except (OSError, protocol.ProtocolError):
+				connection.discard()
+		async with self.available:
+			if connection.closed or self.closed:
+				connection.discard()
+				self.size -= 1
+				self.discarded += 1
+			else:
+				self.idle.append(connection)
+			self.available.notify()
+
+	@contextlib.asynccontextmanager
+	async def connection(self, timeout=None):
+		connection = await self.acquire(timeout)
+		try:
+			yield connection
+		finally:
+			await self.release(connection)
+
+	async def close(self):
+		async with self.available:
+			self.closed = True
+			for connection in self.idle:
+				await connection.close()
+			self.size -= len(self.idle)
+			self.idle = []
+			self.available.notify_all()
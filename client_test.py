@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+from client import *
+import asyncio
+import repl
+import threading
+import unittest
+
+class ServerTestCase(unittest.TestCase):
+	def setUp(self):
+		self.db = repl.Db()
+		self.db.execute('create table t (a integer not null, b string);')
+		self.db.execute('insert into t values %s;' % ', '.join(
+			"(%d, 'x%d')" % (i, i) for i in range(10)))
+		self.server = server.Server(self.db, port=0)
+		self.server.run_in_thread()
+
+	def tearDown(self):
+		self.server.stop_thread()
+
+	def drop_sessions(self):
+		'Makes the server close every connection.'
+		done = threading.Event()
+		def close_all():
+			for session in self.server.sessions.values():
+				session.writer.close()
+			done.set()
+		self.server.loop.call_soon_threadsafe(close_all)
+		done.wait()
+
+class TestConnection(ServerTestCase):
+	def test_cursor_should_fetch_batches(self):
+		with Connection(port=self.server.port) as connection:
+			cursor = connection.cursor(batch_rows=3)
+			cursor.execute('select a, b from t where a < 8;')
+			self.assertEqual(cursor.description,
+				[('a', 'integer', False), ('b', 'string', True)])
+			self.assertEqual(cursor.fetchone(), (0, 'x0'))
+			self.assertLessEqual(len(cursor.result.rows), 2)
+			self.assertEqual(cursor.fetchmany(3), [(1, 'x1'), (2, 'x2'),
+				(3, 'x3')])
+			self.assertEqual([row[0] for row in cursor], [4, 5, 6, 7])
+			self.assertEqual(cursor.fetchall(), [])
+			self.assertEqual(cursor.rowcount, 8)
+
+	def test_errors_should_be_raised(self):
+		with Connection(port=self.server.port) as connection:
+			cursor = connection.cursor()
+			with self.assertRaises(QueryError):
+				cursor.execute('select nope from t;')
+			cursor.execute("insert into t values (10, 'x10');")
+			self.assertIsNone(cursor.description)
+			with self.assertRaisesRegex(ValueError, 'no result'):
+				cursor.fetchone()
+
+	def test_pipeline(self):
+		with Connection(port=self.server.port) as connection:
+			self.assertEqual(connection.pipeline([
+				"insert into t values (10, 'x10');",
+				'select b from t where a = 10;',
+				'select a from t where a = 1;']),
+				[None, [('x10',)], [(1,)]])
+			with self.assertRaises(QueryError):
+				connection.pipeline(['select nope from t;',
+									'select a from t where a = 2;'])
+			self.assertEqual(connection.pipeline(
+				['select a from t where a = 3;']), [[(3,)]])
+
+	def test_unfinished_results_should_not_block_later_statements(self):
+		with Connection(port=self.server.port) as connection:
+			first = connection.cursor(batch_rows=2).execute('select a from t;')
+			second = connection.cursor().execute('select b from t where a = 4;')
+			self.assertEqual(second.fetchall(), [('x4',)])
+			self.assertEqual(len(first.fetchall()), 10)
+
+	def test_should_reconnect_after_server_closes_connection(self):
+		with Connection(port=self.server.port) as connection:
+			session_id = connection.session_id
+			self.drop_sessions()
+			cursor = connection.cursor().execute('select a from t where a = 5;')
+			self.assertEqual(cursor.fetchall(), [(5,)])
+			self.assertNotEqual(connection.session_id, session_id)
+
+	def test_should_not_send_writes_again_after_losing_connection(self):
+		with Connection(port=self.server.port) as connection:
+			self.drop_sessions()
+			# The server may have applied the insert, so it is not sent again
+			with self.assertRaises(ConnectionError):
+				connection.cursor().execute("insert into t values (10, 'y');")
+			cursor = connection.cursor().execute('select a from t where a = 10;')
+			self.assertLessEqual(len(cursor.fetchall()), 1)
+
+	def test_only_reads_should_be_retried(self):
+		self.assertTrue(is_read_only(' SELECT a from t;'))
+		self.assertTrue(is_read_only('(select a from t) union (select a from t);'))
+		self.assertTrue(is_read_only('explain analyze select a from t;'))
+		self.assertFalse(is_read_only("insert into t values (1, 'a');"))
+		self.assertFalse(is_read_only('create materialized view v as select a '
+			'from t;'))
+		self.assertTrue(can_retry("insert into t values (1, 'a');", None))
+
+class TestConnectionPool(ServerTestCase):
+	def test_should_reuse_connections(self):
+		pool = ConnectionPool(port=self.server.port, min_size=2, max_size=3)
+		self.assertEqual(pool.statistics()['opened'], 2)
+		for i in range(5):
+			with pool.connection() as connection:
+				cursor = connection.cursor().execute(
+					'select a from t where a = %d;' % i)
+				self.assertEqual(cursor.fetchall(), [(i,)])
+		statistics = pool.statistics()
+		self.assertEqual((statistics['opened'], statistics['reused']), (2, 5))
+		pool.close()
+		self.assertEqual(pool.size, 0)
+
+	def test_should_limit_size(self):
+		pool = ConnectionPool(port=self.server.port, min_size=0, max_size=1)
+		connection = pool.acquire()
+		with self.assertRaises(TimeoutError):
+			pool.acquire(timeout=0.05)
+		pool.release(connection)
+		self.assertIs(pool.acquire(timeout=0.05), connection)
+		pool.release(connection)
+		pool.close()
+
+	def test_should_share_connections_between_threads(self):
+		pool = ConnectionPool(port=self.server.port, min_size=0, max_size=3)
+		errors = []
+		def run(thread_index):
+			try:
+				for i in range(20):
+					with pool.connection() as connection:
+						value = (thread_index + i) % 10
+						rows = connection.cursor().execute(
+							'select a from t where a = %d;' % value).fetchall()
+						if rows != [(value,)]:
+							errors.append(rows)
+			except Exception as e:
+				errors.append(e)
+		threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(errors, [])
+		self.assertLessEqual(pool.statistics()['opened'], 3)
+		pool.close()
+
+	def test_unfetched_rows_should_be_read_on_release(self):
+		pool = ConnectionPool(port=self.server.port, max_size=1)
+		with pool.connection() as connection:
+			connection.cursor(batch_rows=1).execute('select a from t;')
+		with pool.connection() as connection:
+			self.assertEqual(connection.pipeline(
+				['select a from t where a = 1;']), [[(1,)]])
+		pool.close()
+
+	def test_should_close_idle_connections(self):
+		pool = ConnectionPool(port=self.server.port, min_size=1, max_size=3,
+			idle_timeout=0)
+		first = pool.acquire()
+		second = pool.acquire()
+		pool.release(first)
+		pool.release(second)
+		self.assertEqual(pool.size, 2)
+		pool.release(pool.acquire())
+		self.assertEqual(pool.size, 1)
+		pool.close()
+
+	def test_health_checks_should_replace_dead_connections(self):
+		pool = ConnectionPool(port=self.server.port, min_size=1,
+			health_check_interval=0)
+		self.drop_sessions()
+		with pool.connection() as connection:
+			self.assertEqual(connection.pipeline(
+				['select a from t where a = 1;']), [[(1,)]])
+		statistics = pool.statistics()
+		self.assertEqual((statistics['health_checks'],
+			statistics['discarded']), (1, 1))
+		pool.close()
+
+class TestAsyncConnectionPool(ServerTestCase):
+	def test_should_run_tasks_concurrently(self):
+		async def run_task(pool, value):
+			async with pool.connection() as connection:
+				cursor = await connection.cursor(batch_rows=2).execute(
+					'select a, b from t where a >= %d;' % value)
+				rows = [row async for row in cursor]
+				return rows
+		async def run():
+			pool = await AsyncConnectionPool(port=self.server.port,
+				min_size=1, max_size=2).open()
+			results = await asyncio.gather(*[run_task(pool, value)
+				for value in range(6)])
+			self.assertLessEqual(pool.statistics()['opened'], 2)
+			async with pool.connection() as connection:
+				self.assertEqual(await connection.pipeline([
+					'select a from t where a = 1;',
+					'select b from t where a = 2;']), [[(1,)], [('x2',)]])
+				with self.assertRaises(QueryError):
+					await connection.cursor().execute('select nope from t;')
+			await pool.close()
+			return results
+		results = asyncio.run(run())
+		for value, rows in enumerate(results):
+			self.assertEqual(rows, [(i, 'x%d' % i) for i in range(value, 10)])
+
+	def test_async_connection_should_reconnect(self):
+		async def run():
+			connection = await AsyncConnection(port=self.server.port).connect()
+			self.drop_sessions()
+			cursor = await connection.cursor().execute(
+				'select a from t where a = 5;')
+			rows = await cursor.fetchall()
+			await connection.close()
+			return rows
+		self.assertEqual(asyncio.run(run()), [(5,)])
+
+	def test_async_connection_should_not_send_writes_again(self):
+		async def run():
+			connection = await AsyncConnection(port=self.server.port).connect()
+			self.drop_sessions()
+			with self.assertRaises(ConnectionError):
+				await connection.cursor().execute(
+					"insert into t values (10, 'y');")
+			await connection.close()
+		asyncio.run(run())
+
+if __name__ == '__main__':
+	unittest.main()
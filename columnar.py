@@ -0,0 +1,238 @@
+import array
+import itertools
+import mmap
+import os
+import struct
+import sys
+
+import relation
+import storage
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+COLUMNAR_MAGIC = b'SQLCOL01'
+# magic, byte order of the values (1 for little endian), number of rows,
+# length of the schema
+HEADER = struct.Struct('<8sBQI')
+# Offsets of the null map (0 if the column has no nulls), the values and the
+# string data (0 unless the column is a string column)
+COLUMN_ENTRY = struct.Struct('<QQQ')
+# Regions are aligned to pages so that reading a column only faults in pages
+# of that column
+ALIGNMENT = mmap.PAGESIZE
+# Number of rows converted to tuples at a time by scans
+SCAN_BLOCK_ROWS = 65536
+
+native_byte_order = 1 if sys.byteorder == 'little' else 0
+
+# Array and memoryview formats of fixed width columns. String columns are
+# stored as an array of row_count + 1 offsets into their data.
+value_formats = {
+	bool: '?',
+	int: 'q',
+	float: 'd',
+	str: 'Q',
+}
+
+def aligned(offset):
+	return (offset + ALIGNMENT - 1)//ALIGNMENT*ALIGNMENT
+
+def column_regions(column_type, values):
+	'''
+	Returns the null map, values and string data of a column as bytes. The
+	null map and string data are None when not needed.
+	'''
+	null_map = None
+	if None in values:
+		null_map = bytes([value == None for value in values])
+		null_value = '' if column_type == str else column_type()
+		values = [null_value if value == None else value for value in values]
+	if column_type == bool:
+		return null_map, bytes(values), None
+	if column_type != str:
+		return null_map, array.array(value_formats[column_type],
+										values).tobytes(), None
+	encoded = [value.encode('utf-8') for value in values]
+	offsets = array.array('Q', itertools.accumulate(map(len, encoded),
+														initial=0))
+	return null_map, offsets.tobytes(), b''.join(encoded)
+
+def write(path, table, name=None):
+	'''
+	Writes the rows of a relation to a columnar file which can be opened with
+	MappedRelation. Values are stored in the byte order of this machine.
+	'''
+	rows = list(table)
+	name = name or table.name
+	schema = storage.encode_schema(name, table.columns)
+	regions = [column_regions(column.type,
+								[row[column.index] for row in rows])
+				for column in table.columns]
+	offset = aligned(HEADER.size + len(schema) +
+						COLUMN_ENTRY.size*len(table.columns))
+	entries = []
+	contents = []
+	for null_map, values, data in regions:
+		entry = []
+		for region in (null_map, values, data):
+			if region == None:
+				entry.append(0)
+				continue
+			entry.append(offset)
+			contents.append((offset, region))
+			offset = aligned(offset + len(region))
+		entries.append(COLUMN_ENTRY.pack(*entry))
+	temporary_path = path + '.tmp'
+	with open(temporary_path, 'wb') as f:
+		f.write(HEADER.pack(COLUMNAR_MAGIC, native_byte_order, len(rows),
+							len(schema)) + schema + b''.join(entries))
+		for region_offset, region in contents:
+			f.seek(region_offset)
+			f.write(region)
+		f.truncate(max(offset, f.tell()))
+	os.replace(temporary_path, path)
+
+class MappedColumn:
+	def __init__(self, column, buffer, row_count, null_offset, values_offset,
+			data_offset):
+		'''
+		Zero copy views of the values of a column in a mapped file. values is
+		a memoryview of the fixed width values, or of the string offsets for
+		string columns, and nulls is a memoryview with a byte per row which is
+		1 for null values or None if there are no nulls.
+		'''
+		self.column = column
+		self.row_count = row_count
+		self.nulls = None
+		if null_offset:
+			self.nulls = buffer[null_offset:null_offset + row_count]
+		value_format = value_formats[column.type]
+		count = row_count + 1 if column.type == str else row_count
+		size = struct.calcsize(value_format)*count
+		self.values = buffer[values_offset:values_offset + size].cast(
+			value_format)
+		self.data = None
+		if column.type == str:
+			self.data = buffer[data_offset:data_offset + self.values[-1]]
+
+	def array(self):
+		'''
+		Returns the fixed width values, or the string offsets, as a NumPy array
+		sharing memory with the file. Null values are stored as zero.
+		'''
+		if numpy == None:
+			raise ImportError('NumPy is required for array access')
+		return numpy.frombuffer(self.values, dtype=self.values.format)
+
+	def value(self, row_id):
+		if self.nulls != None and self.nulls[row_id]:
+			return None
+		if self.data == None:
+			return self.values[row_id]
+		start, end = self.values[row_id], self.values[row_id + 1]
+		return str(self.data[start:end], 'utf-8')
+
+	def slice(self, start, end):
+		'Returns the values of rows start to end as a list.'
+		if self.data == None:
+			values = self.values[start:end].tolist()
+		else:
+			offsets = self.values[start:end + 1].tolist()
+			base = offsets[0]
+			bounds = zip(offsets, itertools.islice(offsets, 1, None))
+			text = bytes(self.data[base:offsets[-1]])
+			decoded = text.decode('utf-8')
+			if len(decoded) == len(text):
+				# Only single byte characters, so byte offsets are character
+				# offsets
+				values = [decoded[s - base:e - base] for s, e in bounds]
+			else:
+				values = [text[s - base:e - base].decode('utf-8')
+							for s, e in bounds]
+		if self.nulls != None:
+			nulls = self.nulls[start:end]
+			if any(nulls):
+				values = [None if is_null else value
+							for value, is_null in zip(values, nulls)]
+		return values
+
+class MappedRelation(relation.Relation):
+	def __init__(self, path):
+		'''
+		A read only table backed by a memory mapped columnar file written by
+		write. Opening only reads the header, and the pages of a column are
+		read by the operating system when they are first accessed. Processes
+		mapping the same file share its pages in the page cache.
+		'''
+		self.path = path
+		self.file = open(path, 'rb')
+		header = self.file.read(HEADER.size)
+		if len(header) != HEADER.size or not header.startswith(
+				COLUMNAR_MAGIC):
+			self.file.close()
+			raise ValueError('%r is not a columnar table file' % path)
+		magic, byte_order, self.row_count, schema_length = HEADER.unpack(
+			header)
+		if byte_order != native_byte_order:
+			self.file.close()
+			raise ValueError(
+				'%r was written with a different byte order' % path)
+		name, columns, _ = storage.decode_schema(
+			self.file.read(schema_length))
+		super().__init__(columns, name)
+		self.entries = [COLUMN_ENTRY.unpack(self.file.read(COLUMN_ENTRY.size))
+						for column in self.columns]
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		self.buffer = memoryview(self.map)
+		self.mapped_columns = [None]*len(self.columns)
+		self.statistics = None
+		self.indexes = {}
+		self.version = next(relation.table_versions)
+
+	def column(self, column_index):
+		'Returns the MappedColumn of a column, creating it on first use.'
+		mapped_column = self.mapped_columns[column_index]
+		if mapped_column == None:
+			mapped_column = MappedColumn(self.columns[column_index],
+				self.buffer, self.row_count, *self.entries[column_index])
+			self.mapped_columns[column_index] = mapped_column
+		return mapped_column
+
+	def validate(self, values):
+		raise TypeError('Table %r is read only' % self.name)
+
+	def insert(self, values):
+		self.validate(values)
+
+	def get_row(self, row_id):
+		'Returns the row with the given position in insertion order.'
+		if row_id < 0 or row_id >= self.row_count:
+			raise IndexError('Row id %d out of range' % row_id)
+		return tuple([self.column(i).value(row_id)
+						for i in range(len(self.columns))])
+
+	def __iter__(self):
+		columns = [self.column(i) for i in range(len(self.columns))]
+		for start in range(0, self.row_count, SCAN_BLOCK_ROWS):
+			end = min(start + SCAN_BLOCK_ROWS, self.row_count)
+			yield from zip(*[column.slice(start, end) for column in columns])
+
+	def flush(self, sync=False):
+		pass
+
+	def close(self):
+		'Releases the mapping. Views of its columns must no longer be used.'
+		for mapped_column in self.mapped_columns:
+			if mapped_column == None:
+				continue
+			for view in (mapped_column.nulls, mapped_column.values,
+						mapped_column.data):
+				if view != None:
+					view.release()
+		self.mapped_columns = [None]*len(self.columns)
+		self.buffer.release()
+		self.map.close()
+		self.file.close()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+from columnar import *
+from relation import *
+import os
+import shutil
+import tempfile
+import unittest
+
+class TestMappedRelation(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 't.col')
+		self.source = MaterialRelation([Column('a', int, False),
+			Column('b', str), Column('c', float), Column('d', bool)], 't')
+		self.rows = [(1, 'one', 1.5, True), (2, None, None, None),
+					(3, 'trois é', -2.0, False)]
+		for row in self.rows:
+			self.source.insert(row)
+		write(self.path, self.source)
+		self.table = MappedRelation(self.path)
+
+	def tearDown(self):
+		self.table.close()
+		shutil.rmtree(self.directory)
+
+	def test_should_read_schema_and_rows(self):
+		self.assertEqual(self.table.name, 't')
+		self.assertEqual(self.table.row_count, 3)
+		self.assertEqual([(c.name, c.type, c.nullable)
+							for c in self.table.columns],
+			[(c.name, c.type, c.nullable) for c in self.source.columns])
+		self.assertEqual(list(self.table), self.rows)
+		self.assertEqual(self.table.get_row(2), self.rows[2])
+
+	def test_should_scan_in_blocks(self):
+		table = MaterialRelation([Column('a', int), Column('b', str)])
+		rows = [(i, None if i % 5 == 0 else str(i))
+				for i in range(2*SCAN_BLOCK_ROWS + 10)]
+		table.load(rows)
+		path = os.path.join(self.directory, 'large.col')
+		write(path, table, 'large')
+		mapped = MappedRelation(path)
+		self.assertEqual(mapped.name, 'large')
+		self.assertEqual(list(mapped), rows)
+		mapped.close()
+
+	def test_columns_should_be_views_of_the_file(self):
+		column = self.table.column(0)
+		self.assertIsInstance(column.values, memoryview)
+		self.assertEqual(column.values.tolist(), [1, 2, 3])
+		self.assertIsNone(column.nulls)
+		strings = self.table.column(1)
+		self.assertEqual(strings.values.tolist(), [0, 3, 3, 11])
+		self.assertEqual(bytes(strings.data), 'onetrois é'.encode('utf-8'))
+		self.assertEqual(strings.nulls.tolist(), [0, 1, 0])
+		self.assertIs(self.table.column(1), strings)
+
+	def test_regions_should_be_page_aligned(self):
+		for entry in self.table.entries:
+			for offset in entry:
+				self.assertEqual(offset % ALIGNMENT, 0)
+
+	@unittest.skipIf(numpy == None, 'NumPy is not installed')
+	def test_should_expose_numpy_arrays(self):
+		values = self.table.column(2).array()
+		self.assertEqual(values.tolist(), [1.5, 0.0, -2.0])
+		self.assertFalse(values.flags.writeable)
+
+	def test_should_be_read_only(self):
+		with self.assertRaisesRegex(TypeError, 'read only'):
+			self.table.insert((4, 'four', 4.0, True))
+
+	def test_should_reject_other_files(self):
+		path = os.path.join(self.directory, 'other')
+		with open(path, 'wb') as f:
+			f.write(b'not columnar')
+		with self.assertRaisesRegex(ValueError, 'not a columnar'):
+			MappedRelation(path)
+
+	def test_empty_table(self):
+		path = os.path.join(self.directory, 'empty.col')
+		write(path, MaterialRelation([Column('a', str)], 'empty'))
+		mapped = MappedRelation(path)
+		self.assertEqual(list(mapped), [])
+		mapped.close()
+
+if __name__ == '__main__':
+	unittest.main()
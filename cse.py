@@ -0,0 +1,80 @@
+'''
+Common subexpression elimination.
+
+Expressions a query computes more than once, in its select list, where
+clause or aggregate arguments, are replaced by a single SharedExpression
+which computes its value once per row. Operators pass rows on unchanged, so
+a value computed by a where clause is also reused by the select list.
+Expressions are compared by their structure with Expression.key.
+'''
+
+import relation
+
+def is_trivial(expression):
+	'Returns true if the expression is as cheap to compute as to reuse.'
+	return type(expression) in (relation.Constant, relation.Attribute)
+
+def map_expressions(node, function):
+	'''
+	Replaces each expression computed by the operators of a plan with the
+	result of calling function with it.
+	'''
+	node_type = type(node)
+	if node_type == relation.Selection:
+		node.predicate = function(node.predicate)
+	elif node_type == relation.GeneralizedProjection:
+		node.expressions = [function(e) for e in node.expressions]
+	elif node_type == relation.GroupBy:
+		for aggregate in node.aggregates:
+			if aggregate.expression != None:
+				aggregate.expression = function(aggregate.expression)
+	for child in node.children():
+		map_expressions(child, function)
+
+def count_expressions(expression, counts):
+	'''
+	Counts the occurrences of the expression and its operands by key. The
+	operands of a repeated expression are only counted once since they are
+	computed once.
+	'''
+	key = expression.key()
+	counts[key] = counts.get(key, 0) + 1
+	if counts[key] == 1:
+		for operand in relation.operands(expression):
+			count_expressions(operand, counts)
+	return expression
+
+def share_expressions(expression, counts, shared):
+	'''
+	Returns the expression with the repeated expressions it contains, and
+	the expression itself if repeated, replaced by SharedExpressions.
+	'''
+	key = expression.key()
+	if key in shared:
+		return shared[key]
+	for name in relation.operand_names:
+		operand = getattr(expression, name, None)
+		if type(operand) == list:
+			setattr(expression, name, [share_expressions(e, counts, shared)
+										for e in operand])
+		elif operand != None:
+			setattr(expression, name, share_expressions(operand, counts,
+															shared))
+	if counts[key] > 1 and not is_trivial(expression):
+		shared[key] = relation.SharedExpression(expression)
+		return shared[key]
+	return expression
+
+def eliminate_common_subexpressions(plan):
+	'''
+	Makes the operators of a plan share the expressions they compute more
+	than once. Plans with expressions without keys are left unchanged.
+	'''
+	counts = {}
+	try:
+		map_expressions(plan, lambda e: count_expressions(e, counts))
+	except TypeError:
+		return plan
+	shared = {}
+	map_expressions(plan, lambda e: share_expressions(e, counts, shared))
+	return plan
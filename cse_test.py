@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+from cse import *
+from relation import *
+import unittest
+
+class CountingConstant(Constant):
+	'A constant counting how many times it is evaluated.'
+	evaluations = 0
+
+	def evaluate(self, row):
+		CountingConstant.evaluations += 1
+		return super().evaluate(row)
+
+class TestCommonSubexpressions(unittest.TestCase):
+	def setUp(self):
+		CountingConstant.evaluations = 0
+		self.table = MaterialRelation([Column('a', int), Column('b', int)], 't')
+		self.table.load([(i, i % 3) for i in range(10)])
+
+	def product(self, relation):
+		'Returns a*b + 1, which evaluates a counting constant once.'
+		return Arithmetic('+', Arithmetic('*',
+			Attribute(relation.columns[0]), Attribute(relation.columns[1])),
+			CountingConstant(1))
+
+	def test_repeated_expressions_should_be_computed_once_per_row(self):
+		selection = Selection(self.table, Comparison('>',
+			self.product(self.table), Constant(5)))
+		plan = GeneralizedProjection(selection, [self.product(self.table),
+			Arithmetic('*', self.product(self.table), Constant(2))])
+		expected = list(plan)
+		self.assertEqual(CountingConstant.evaluations, 10 + 2*len(expected))
+		CountingConstant.evaluations = 0
+		eliminate_common_subexpressions(plan)
+		self.assertEqual(list(plan), expected)
+		self.assertEqual(CountingConstant.evaluations, 10)
+		shared = plan.expressions[0]
+		self.assertIsInstance(shared, SharedExpression)
+		self.assertIs(plan.expressions[1].lhs, shared)
+		self.assertIs(selection.predicate.lhs, shared)
+
+	def test_aggregate_arguments_should_be_shared(self):
+		group_by = GroupBy(self.table, [self.table.columns[1]], [
+			SumFactory(self.product(self.table)),
+			MaxFactory(self.product(self.table))])
+		expected = list(group_by)
+		CountingConstant.evaluations = 0
+		eliminate_common_subexpressions(group_by)
+		self.assertEqual(list(group_by), expected)
+		self.assertEqual(CountingConstant.evaluations, 10)
+
+	def test_single_and_trivial_expressions_should_not_be_shared(self):
+		plan = GeneralizedProjection(self.table, [self.product(self.table),
+			Attribute(self.table.columns[0]), Attribute(self.table.columns[0])])
+		eliminate_common_subexpressions(plan)
+		self.assertFalse(any(type(expression) == SharedExpression
+								for expression in plan.expressions))
+
+	def test_equal_keys_should_describe_equal_structures(self):
+		self.assertEqual(self.product(self.table).key(),
+			self.product(self.table).key())
+		self.assertNotEqual(Constant(1).key(), Constant(1.0).key())
+		self.assertNotEqual(Constant(1).key(), Constant(True).key())
+
+if __name__ == '__main__':
+	unittest.main()
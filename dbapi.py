@@ -0,0 +1,235 @@
+'''
+A DB-API 2.0 (PEP 249) interface to databases.
+
+Cursors read the rows of a result from the relation returned by Db.execute
+as they are fetched, so fetchmany keeps only the rows it returns in memory.
+Statements take parameters in the qmark style:
+
+	cursor.execute('select a from t where b = ?;', ('x',))
+'''
+
+import itertools
+
+import repl
+
+apilevel = '2.0'
+# Threads may share the module and connections but not cursors
+threadsafety = 2
+paramstyle = 'qmark'
+
+class Warning(Exception):
+	pass
+
+class Error(Exception):
+	pass
+
+class InterfaceError(Error):
+	pass
+
+class DatabaseError(Error):
+	pass
+
+class DataError(DatabaseError):
+	pass
+
+class OperationalError(DatabaseError):
+	pass
+
+class IntegrityError(DatabaseError):
+	pass
+
+class InternalError(DatabaseError):
+	pass
+
+class ProgrammingError(DatabaseError):
+	pass
+
+class NotSupportedError(DatabaseError):
+	pass
+
+class DBAPITypeObject:
+	def __init__(self, *types):
+		'Compares equal to the type codes of the columns of a kind.'
+		self.types = types
+
+	def __eq__(self, other):
+		return other in self.types
+
+	def __hash__(self):
+		return hash(self.types)
+
+STRING = DBAPITypeObject(str)
+NUMBER = DBAPITypeObject(int, float, bool)
+BOOLEAN = DBAPITypeObject(bool)
+# Binary and date columns are not supported
+BINARY = DBAPITypeObject()
+DATETIME = DBAPITypeObject()
+ROWID = DBAPITypeObject()
+
+def not_supported(*args):
+	raise NotSupportedError('Binary and date values are not supported')
+
+Binary = Date = Time = Timestamp = not_supported
+DateFromTicks = TimeFromTicks = TimestampFromTicks = not_supported
+
+def database_error(error):
+	'''
+	Returns the DB-API exception for an exception raised executing a
+	statement.
+	'''
+	if isinstance(error, TypeError):
+		return DataError(str(error))
+	if isinstance(error, (ValueError, KeyError)):
+		return ProgrammingError(str(error))
+	if isinstance(error, (OSError, MemoryError)):
+		return OperationalError(str(error))
+	return DatabaseError(str(error))
+
+def describe(columns):
+	'Returns the seven item description of each column of a result.'
+	return [(column.name, column.type, None, None, None, None,
+				column.nullable) for column in columns]
+
+def connect(path=None, **options):
+	'''
+	Opens a connection to a database, stored in the directory path or in
+	memory. Options are passed to Db.
+	'''
+	return Connection(repl.Db(path, **options), owned=True)
+
+class Connection:
+	def __init__(self, db, owned=False):
+		'''
+		A connection to a Db, which is closed with the connection if owned.
+		Every statement is committed when it completes, so commit has nothing
+		to do and rollback is not supported.
+		'''
+		self.db = db
+		self.owned = owned
+		self.closed = False
+
+	def check_open(self):
+		if self.closed:
+			raise InterfaceError('The connection is closed')
+
+	def close(self):
+		self.check_open()
+		self.closed = True
+		if self.owned:
+			self.db.close()
+
+	def commit(self):
+		self.check_open()
+
+	def rollback(self):
+		self.check_open()
+		raise NotSupportedError('Transactions can not be rolled back')
+
+	def cursor(self):
+		self.check_open()
+		return Cursor(self)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exception):
+		if not self.closed:
+			self.close()
+
+class Cursor:
+	def __init__(self, connection):
+		'''
+		Executes statements over a connection. For queries, rowcount is the
+		number of rows fetched so far since the rows are only produced as
+		they are fetched.
+		'''
+		self.connection = connection
+		self.arraysize = 1
+		self.description = None
+		self.rowcount = -1
+		self.rows = None
+		self.closed = False
+
+	def check_open(self):
+		if self.closed:
+			raise InterfaceError('The cursor is closed')
+		self.connection.check_open()
+
+	def close(self):
+		self.check_open()
+		self.closed = True
+		self.rows = None
+
+	def execute(self, operation, parameters=()):
+		'''
+		Executes a statement with the values of parameters in place of its ?
+		placeholders. The rows of a query are produced as they are fetched.
+		'''
+		self.check_open()
+		self.description = None
+		self.rowcount = -1
+		self.rows = None
+		try:
+			result = self.connection.db.execute(operation, parameters)
+		except Exception as e:
+			raise database_error(e) from e
+		if result == None:
+			return self
+		self.description = describe(result.columns)
+		self.rows = iter(result)
+		self.rowcount = 0
+		return self
+
+	def executemany(self, operation, seq_of_parameters):
+		for parameters in seq_of_parameters:
+			self.execute(operation, parameters)
+		self.description = None
+		self.rows = None
+
+	def fetchmany(self, size=None):
+		'Returns the next size rows of the result, arraysize by default.'
+		self.check_open()
+		if self.rows == None:
+			raise ProgrammingError('The statement has no result to fetch')
+		if size == None:
+			size = self.arraysize
+		try:
+			rows = list(itertools.islice(self.rows, size))
+		except Exception as e:
+			raise database_error(e) from e
+		self.rowcount += len(rows)
+		return rows
+
+	def fetchone(self):
+		rows = self.fetchmany(1)
+		return rows[0] if rows else None
+
+	def fetchall(self):
+		rows = []
+		while True:
+			batch = self.fetchmany(max(self.arraysize, 1000))
+			if not batch:
+				return rows
+			rows.extend(batch)
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		row = self.fetchone()
+		if row == None:
+			raise StopIteration
+		return row
+
+	def setinputsizes(self, sizes):
+		pass
+
+	def setoutputsize(self, size, column=None):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exception):
+		if not self.closed:
+			self.close()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import dbapi
+import shutil
+import tempfile
+import unittest
+
+class TestDbApi(unittest.TestCase):
+	def setUp(self):
+		self.connection = dbapi.connect()
+		self.cursor = self.connection.cursor()
+		self.cursor.execute('create table t (a integer not null, b string);')
+		self.cursor.executemany('insert into t values (?, ?);',
+			[(i, 'x%d' % i if i % 2 else None) for i in range(10)])
+
+	def tearDown(self):
+		self.connection.close()
+
+	def test_module_globals(self):
+		self.assertEqual(dbapi.apilevel, '2.0')
+		self.assertEqual(dbapi.paramstyle, 'qmark')
+		self.assertTrue(issubclass(dbapi.ProgrammingError, dbapi.Error))
+
+	def test_description(self):
+		self.cursor.execute('select a, b, a > 1 as big from t;')
+		self.assertEqual([column[0] for column in self.cursor.description],
+			['a', 'b', 'big'])
+		self.assertEqual([column[1] for column in self.cursor.description],
+			[int, str, bool])
+		self.assertEqual(self.cursor.description[0][1], dbapi.NUMBER)
+		self.assertEqual(self.cursor.description[1][1], dbapi.STRING)
+		self.assertEqual([column[6] for column in self.cursor.description],
+			[False, True, False])
+
+	def test_fetchmany_should_read_rows_incrementally(self):
+		self.cursor.execute('select a from t where a >= ?;', (3,))
+		self.cursor.arraysize = 3
+		self.assertEqual(self.cursor.fetchone(), (3,))
+		self.assertEqual(self.cursor.fetchmany(), [(4,), (5,), (6,)])
+		self.assertEqual(self.cursor.rowcount, 4)
+		self.assertEqual(list(self.cursor), [(7,), (8,), (9,)])
+		self.assertIsNone(self.cursor.fetchone())
+		self.assertEqual(self.cursor.fetchall(), [])
+
+	def test_parameters(self):
+		self.cursor.execute('insert into t values (?, ?);', (-4, "it's"))
+		self.cursor.execute('select a from t where b = ?;', ("it's",))
+		self.assertEqual(self.cursor.fetchall(), [(-4,)])
+		self.cursor.execute('select b from t where a = ?;', [2])
+		self.assertEqual(self.cursor.fetchall(), [(None,)])
+		with self.assertRaisesRegex(dbapi.ProgrammingError, 'parameters'):
+			self.cursor.execute('select a from t where a = ?;')
+		with self.assertRaises(dbapi.DataError):
+			self.cursor.execute('select a from t where a = ?;', [object()])
+
+	def test_errors(self):
+		with self.assertRaises(dbapi.ProgrammingError):
+			self.cursor.execute('select nope from t;')
+		with self.assertRaises(dbapi.DataError):
+			self.cursor.execute('insert into t values (null, null);')
+		self.cursor.execute("insert into t values (10, 'y');")
+		self.assertIsNone(self.cursor.description)
+		with self.assertRaises(dbapi.ProgrammingError):
+			self.cursor.fetchone()
+		with self.assertRaises(dbapi.NotSupportedError):
+			self.connection.rollback()
+		self.cursor.close()
+		with self.assertRaises(dbapi.InterfaceError):
+			self.cursor.execute('select a from t;')
+
+	def test_stored_database(self):
+		directory = tempfile.mkdtemp()
+		try:
+			with dbapi.connect(directory) as connection:
+				cursor = connection.cursor()
+				cursor.execute('create table u (c float);')
+				cursor.execute('insert into u values (?);', (0.5,))
+				connection.commit()
+			with dbapi.connect(directory) as connection:
+				cursor = connection.cursor()
+				cursor.execute('select c from u;')
+				self.assertEqual(cursor.fetchall(), [(0.5,)])
+		finally:
+			shutil.rmtree(directory)
+
+if __name__ == '__main__':
+	unittest.main()
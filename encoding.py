@@ -0,0 +1,450 @@
+import array
+import bisect
+import collections
+import itertools
+import sys
+
+import relation
+
+# Encodings
+PLAIN = 'plain'
+RUN_LENGTH = 'run_length'
+FRAME_OF_REFERENCE = 'frame_of_reference'
+DELTA = 'delta'
+BITMAP = 'bitmap'
+
+# Number of values bit packed together with a common reference value
+BLOCK_SIZE = 1024
+# Columns whose runs are at least this long on average are run length encoded
+MIN_AVERAGE_RUN_LENGTH = 4
+# Number of rows converted to tuples at a time by scans
+SCAN_BLOCK_ROWS = 65536
+# Size of a pointer to a value in a list or tuple
+POINTER_SIZE = 8
+
+EncodingStatistics = collections.namedtuple('EncodingStatistics',
+	['row_count', 'null_count', 'min', 'max', 'run_count', 'ascending',
+	'delta_min', 'delta_max'])
+
+def column_statistics(values):
+	'''
+	Computes the statistics encodings are chosen from in one pass over the
+	values of a column. The deltas are the differences between consecutive
+	non-null values and are only computed for integers.
+	'''
+	null_count = 0
+	min_value = max_value = None
+	run_count = 0
+	ascending = True
+	delta_min = delta_max = None
+	previous = None
+	last = object()
+	for value in values:
+		if value != last:
+			run_count += 1
+			last = value
+		if value == None:
+			null_count += 1
+			continue
+		if previous == None:
+			min_value = max_value = value
+		else:
+			if value < min_value:
+				min_value = value
+			elif value > max_value:
+				max_value = value
+			if value < previous:
+				ascending = False
+			if type(value) == int:
+				delta = value - previous
+				if delta_min == None:
+					delta_min = delta_max = delta
+				elif delta < delta_min:
+					delta_min = delta
+				elif delta > delta_max:
+					delta_max = delta
+		previous = value
+	return EncodingStatistics(len(values), null_count, min_value, max_value,
+		run_count, ascending, delta_min, delta_max)
+
+def choose_encoding(column_type, statistics):
+	'''
+	Returns the encoding which stores a column with the given statistics in
+	the least memory. Booleans are stored as bitmaps, columns with long runs
+	of equal values are run length encoded and other integer columns are bit
+	packed, using deltas if they are smaller than the range of the values.
+	'''
+	if column_type == bool:
+		return BITMAP
+	if statistics.run_count*MIN_AVERAGE_RUN_LENGTH <= statistics.row_count:
+		return RUN_LENGTH
+	if column_type != int:
+		return PLAIN
+	if statistics.min == None:
+		return FRAME_OF_REFERENCE
+	range_width = (statistics.max - statistics.min).bit_length()
+	if statistics.delta_min != None and (
+			statistics.delta_max - statistics.delta_min).bit_length() < (
+			range_width):
+		return DELTA
+	return FRAME_OF_REFERENCE
+
+def value_size(value):
+	'Returns the memory used by a value stored in a list or tuple.'
+	if value == None or type(value) == bool:
+		# Shared objects
+		return POINTER_SIZE
+	return POINTER_SIZE + sys.getsizeof(value)
+
+def plain_size(values):
+	'''
+	Estimates the memory used by values stored as Python objects, as they
+	are in the rows of a MaterialRelation.
+	'''
+	return sum(map(value_size, values))
+
+def null_bitmap(values):
+	'Returns an int with bit i set if value i is None, or None if none are.'
+	if None not in values:
+		return None
+	return int(''.join(['1' if value == None else '0'
+						for value in reversed(values)]), 2)
+
+def bitmap_slice(bitmap, start, end):
+	'Returns the bits start to end of a bitmap as a string of 0 and 1.'
+	bits = format((bitmap >> start) & ((1 << (end - start)) - 1),
+					'0%db' % (end - start)) if end > start else ''
+	return bits[::-1]
+
+class EncodedColumn:
+	encoding = None
+
+	def value(self, row_id):
+		return self.slice(row_id, row_id + 1)[0]
+
+	def slice(self, start, end):
+		'Returns the values of rows start to end as a list.'
+		raise NotImplemented
+
+	def runs(self):
+		'''
+		Returns (value, count) pairs whose counts add up to the row count,
+		for computing aggregates which do not depend on the order of the
+		values.
+		'''
+		return list(collections.Counter(self.slice(0, self.row_count)).items())
+
+	def memory_size(self):
+		'Returns the memory used by the encoded values in bytes.'
+		raise NotImplemented
+
+class PlainColumn(EncodedColumn):
+	encoding = PLAIN
+
+	def __init__(self, values):
+		'Values stored as a list.'
+		self.values = list(values)
+		self.row_count = len(self.values)
+
+	def value(self, row_id):
+		return self.values[row_id]
+
+	def slice(self, start, end):
+		return self.values[start:end]
+
+	def memory_size(self):
+		return plain_size(self.values)
+
+class RunLengthColumn(EncodedColumn):
+	encoding = RUN_LENGTH
+
+	def __init__(self, values):
+		'''
+		Stores each run of equal consecutive values once with the position
+		after its last row.
+		'''
+		self.values = []
+		self.ends = array.array('q')
+		position = 0
+		for value, group in itertools.groupby(values):
+			position += sum(1 for _ in group)
+			self.values.append(value)
+			self.ends.append(position)
+		self.row_count = position
+
+	def value(self, row_id):
+		if row_id < 0 or row_id >= self.row_count:
+			raise IndexError('Row id %d out of range' % row_id)
+		return self.values[bisect.bisect_right(self.ends, row_id)]
+
+	def slice(self, start, end):
+		end = min(end, self.row_count)
+		values = []
+		run = bisect.bisect_right(self.ends, start)
+		position = start
+		while position < end:
+			run_end = min(self.ends[run], end)
+			values.extend([self.values[run]]*(run_end - position))
+			position = run_end
+			run += 1
+		return values
+
+	def runs(self):
+		starts = itertools.chain((0,), self.ends)
+		return [(value, end - start)
+				for value, start, end in zip(self.values, starts, self.ends)]
+
+	def memory_size(self):
+		return plain_size(self.values) + (
+				self.ends.itemsize*len(self.ends))
+
+def pack(values, reference, width):
+	'''
+	Returns the differences of the values from the reference packed into
+	width bits each, with the first value in the lowest bits.
+	'''
+	if width == 0:
+		return b''
+	bits = ''.join([format(value - reference, '0%db' % width)
+					for value in reversed(values)])
+	return int(bits, 2).to_bytes((len(values)*width + 7)//8, 'little')
+
+def unpack(data, count, reference, width):
+	if width == 0:
+		return [reference]*count
+	bits = format(int.from_bytes(data, 'little'), '0%db' % (count*width))
+	length = len(bits)
+	return [int(bits[length - (i + 1)*width:length - i*width], 2) + reference
+			for i in range(count)]
+
+class BitPackedColumn(EncodedColumn):
+	def __init__(self, values, delta=False):
+		'''
+		Integers stored in blocks of BLOCK_SIZE values. Each block stores the
+		differences of its values from the smallest value of the block (frame
+		of reference) using only as many bits as the largest difference
+		needs. If delta is true, the differences between consecutive values
+		are stored instead of the values, which is smaller for sorted
+		columns, and each block records its first value.
+		'''
+		self.encoding = DELTA if delta else FRAME_OF_REFERENCE
+		self.delta = delta
+		self.row_count = len(values)
+		self.nulls = null_bitmap(values)
+		# Null values are stored as the previous value, which does not widen
+		# the range of a block and is a delta of 0
+		filled = []
+		previous = next((value for value in values if value != None), 0)
+		for value in values:
+			if value == None:
+				value = previous
+			filled.append(value)
+			previous = value
+		# (first value, reference, width, packed values) of each block
+		self.blocks = []
+		for start in range(0, len(filled), BLOCK_SIZE):
+			block = filled[start:start + BLOCK_SIZE]
+			first = block[0]
+			if delta:
+				block = [0] + [value - before
+						for before, value in zip(block, block[1:])]
+			reference = min(block)
+			width = (max(block) - reference).bit_length()
+			self.blocks.append((first, reference, width,
+								pack(block, reference, width)))
+
+	def decode_block(self, block_number):
+		first, reference, width, data = self.blocks[block_number]
+		count = min(BLOCK_SIZE, self.row_count - block_number*BLOCK_SIZE)
+		values = unpack(data, count, reference, width)
+		if self.delta:
+			values = list(itertools.accumulate(values, initial=first))[1:]
+		return values
+
+	def value(self, row_id):
+		if row_id < 0 or row_id >= self.row_count:
+			raise IndexError('Row id %d out of range' % row_id)
+		if self.nulls != None and self.nulls >> row_id & 1:
+			return None
+		block_number, position = divmod(row_id, BLOCK_SIZE)
+		if self.delta:
+			return self.decode_block(block_number)[position]
+		first, reference, width, data = self.blocks[block_number]
+		bit = position*width
+		packed = int.from_bytes(data[bit//8:(bit + width + 7)//8], 'little')
+		return (packed >> bit % 8 & ((1 << width) - 1)) + reference
+
+	def slice(self, start, end):
+		end = min(end, self.row_count)
+		values = []
+		for block_number in range(start//BLOCK_SIZE,
+									(end + BLOCK_SIZE - 1)//BLOCK_SIZE):
+			block_start = block_number*BLOCK_SIZE
+			block = self.decode_block(block_number)
+			values.extend(block[max(start - block_start, 0):end - block_start])
+		if self.nulls != None:
+			nulls = bitmap_slice(self.nulls, start, end)
+			if '1' in nulls:
+				values = [None if is_null == '1' else value
+							for value, is_null in zip(values, nulls)]
+		return values
+
+	def memory_size(self):
+		size = sum(len(data) + 3*POINTER_SIZE for *_, data in self.blocks)
+		if self.nulls != None:
+			size += (self.row_count + 7)//8
+		return size
+
+class BitmapColumn(EncodedColumn):
+	encoding = BITMAP
+
+	def __init__(self, values):
+		'Booleans stored as a bit per row, with a second bitmap of nulls.'
+		self.row_count = len(values)
+		self.nulls = null_bitmap(values)
+		self.bits = int(''.join(['1' if value else '0'
+								for value in reversed(values)]) or '0', 2)
+
+	def slice(self, start, end):
+		end = min(end, self.row_count)
+		values = [bit == '1' for bit in bitmap_slice(self.bits, start, end)]
+		if self.nulls != None:
+			nulls = bitmap_slice(self.nulls, start, end)
+			values = [None if is_null == '1' else value
+						for value, is_null in zip(values, nulls)]
+		return values
+
+	def runs(self):
+		'Counts the values from the number of bits set in each bitmap.'
+		null_count = 0 if self.nulls == None else self.nulls.bit_count()
+		true_count = self.bits.bit_count()
+		return [(value, count) for value, count in ((True, true_count),
+				(False, self.row_count - true_count - null_count),
+				(None, null_count)) if count]
+
+	def memory_size(self):
+		size = (self.row_count + 7)//8
+		if self.nulls != None:
+			size *= 2
+		return size
+
+def encode_column(column_type, values, encoding=None):
+	'''
+	Returns the values of a column in an encoding, which is chosen from the
+	statistics of the values if it is not given.
+	'''
+	if encoding == None:
+		encoding = choose_encoding(column_type, column_statistics(values))
+	if encoding == RUN_LENGTH:
+		return RunLengthColumn(values)
+	if encoding in (FRAME_OF_REFERENCE, DELTA):
+		if column_type != int:
+			raise TypeError('%s encoding requires an integer column' % encoding)
+		return BitPackedColumn(values, encoding == DELTA)
+	if encoding == BITMAP:
+		if column_type != bool:
+			raise TypeError('Bitmap encoding requires a boolean column')
+		return BitmapColumn(values)
+	if encoding == PLAIN:
+		return PlainColumn(values)
+	raise ValueError('Unknown encoding %r' % encoding)
+
+class EncodedRelation(relation.Relation):
+	def __init__(self, table, name=None, encodings=None):
+		'''
+		A read only copy of the rows of a relation stored column by column,
+		with each column compressed with the encoding given for it by name in
+		encodings or otherwise the encoding chosen from its statistics.
+		'''
+		super().__init__(table.columns, name or table.name)
+		if encodings == None:
+			encodings = {}
+		rows = list(table)
+		self.row_count = len(rows)
+		self.encoded_columns = [
+			encode_column(column.type, [row[column.index] for row in rows],
+							encodings.get(column.name))
+			for column in self.columns]
+		self.statistics = getattr(table, 'statistics', None)
+		self.indexes = {}
+		self.version = next(relation.table_versions)
+
+	def validate(self, values):
+		raise TypeError('Table %r is read only' % self.name)
+
+	def insert(self, values):
+		self.validate(values)
+
+	def get_row(self, row_id):
+		'Returns the row with the given position in insertion order.'
+		if row_id < 0 or row_id >= self.row_count:
+			raise IndexError('Row id %d out of range' % row_id)
+		return tuple([column.value(row_id) for column in self.encoded_columns])
+
+	def __iter__(self):
+		for start in range(0, self.row_count, SCAN_BLOCK_ROWS):
+			end = min(start + SCAN_BLOCK_ROWS, self.row_count)
+			yield from zip(*[column.slice(start, end)
+							for column in self.encoded_columns])
+
+	def memory_report(self):
+		'''
+		Returns the encoding of each column with the memory it uses and the
+		estimated memory its values would use as Python objects.
+		'''
+		report = []
+		for column, encoded in zip(self.columns, self.encoded_columns):
+			report.append({
+				'column': column.name,
+				'encoding': encoded.encoding,
+				'encoded_bytes': encoded.memory_size(),
+				'plain_bytes': plain_size(encoded.slice(0, self.row_count)),
+			})
+		return report
+
+def can_aggregate_runs(input_relation, aggregates):
+	'''
+	Returns true if the aggregates can be computed from the runs of the
+	columns of an encoded table, which requires each aggregate to be of a
+	column of the table or a count of rows.
+	'''
+	if type(input_relation) != EncodedRelation:
+		return False
+	for aggregate in aggregates:
+		expression = aggregate.expression
+		if expression == None:
+			continue
+		if type(expression) != relation.Attribute or not (
+				0 <= expression.column.index < len(input_relation.columns)):
+			return False
+	return True
+
+class RunAggregation(relation.Relation):
+	def __init__(self, table, aggregates):
+		'''
+		Computes aggregates of all rows of an encoded table from the runs of
+		its columns, without producing the rows. A run of a run length
+		encoded column is aggregated in constant time. Like GroupBy, there is
+		no row for an empty table.
+		'''
+		super().__init__([relation.Column(None, aggregate.value_type(),
+							aggregate.nullable()) for aggregate in aggregates])
+		self.table = table
+		self.aggregates = aggregates
+		self.row_count = min(table.row_count, 1)
+
+	def __iter__(self):
+		if self.table.row_count == 0:
+			return
+		results = []
+		for factory in self.aggregates:
+			aggregate = factory.new_aggregate()
+			if factory.expression == None:
+				aggregate.update_run(None, self.table.row_count)
+			else:
+				column = self.table.encoded_columns[
+							factory.expression.column.index]
+				for value, count in column.runs():
+					aggregate.update_run(value, count)
+			results.append(aggregate.final())
+		yield tuple(results)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+from encoding import *
+from relation import *
+import random
+import unittest
+
+class TestEncodings(unittest.TestCase):
+	def check_round_trip(self, column, values):
+		self.assertEqual(column.row_count, len(values))
+		self.assertEqual(column.slice(0, len(values)), values)
+		self.assertEqual(column.slice(3, 2000), values[3:2000])
+		for row_id in range(0, len(values), 97):
+			self.assertEqual(column.value(row_id), values[row_id])
+
+	def test_run_length(self):
+		values = ['a']*500 + [None]*300 + ['b'] + ['a']*1500
+		column = RunLengthColumn(values)
+		self.check_round_trip(column, values)
+		self.assertEqual(column.runs(),
+			[('a', 500), (None, 300), ('b', 1), ('a', 1500)])
+
+	def test_bit_packing(self):
+		rng = random.Random(1)
+		columns = [
+			list(range(3000)),
+			[rng.randint(-2**40, 2**40) for i in range(3000)],
+			[None, 5, None, -3, 2**70]*600,
+			[7]*2500,
+			[None]*10,
+		]
+		for values in columns:
+			for delta in (False, True):
+				self.check_round_trip(BitPackedColumn(values, delta), values)
+
+	def test_bit_packing_should_use_only_needed_bits(self):
+		column = BitPackedColumn([1000 + i % 16 for i in range(BLOCK_SIZE)])
+		first, reference, width, data = column.blocks[0]
+		self.assertEqual((reference, width), (1000, 4))
+		self.assertEqual(len(data), BLOCK_SIZE//2)
+		sorted_column = BitPackedColumn(list(range(0, 3*BLOCK_SIZE, 3)), True)
+		self.assertEqual(sorted_column.blocks[0][2], 2)
+
+	def test_bitmap(self):
+		values = [True, False, None, True]*700
+		column = BitmapColumn(values)
+		self.check_round_trip(column, values)
+		self.assertEqual(sorted(column.runs(), key=str),
+			[(False, 700), (None, 700), (True, 1400)])
+		self.assertEqual(column.memory_size(), 2*350)
+
+	def test_should_choose_encoding_from_statistics(self):
+		rng = random.Random(2)
+		cases = [
+			(bool, [True, False]*100, BITMAP),
+			(int, [i//10 for i in range(1000)], RUN_LENGTH),
+			(str, ['x']*50 + ['y']*50, RUN_LENGTH),
+			(int, list(range(0, 10**9, 10**6)), DELTA),
+			(int, [rng.randint(0, 100) for i in range(1000)],
+				FRAME_OF_REFERENCE),
+			(str, [str(i) for i in range(100)], PLAIN),
+			(float, [i/3 for i in range(100)], PLAIN),
+		]
+		for column_type, values, expected in cases:
+			self.assertEqual(
+				choose_encoding(column_type, column_statistics(values)),
+				expected)
+			self.assertEqual(encode_column(column_type, values).encoding,
+				expected)
+
+	def test_should_reject_encodings_for_other_types(self):
+		with self.assertRaises(TypeError):
+			encode_column(str, ['a'], DELTA)
+		with self.assertRaises(ValueError):
+			encode_column(int, [1], 'unknown')
+
+class TestEncodedRelation(unittest.TestCase):
+	def setUp(self):
+		self.source = MaterialRelation([Column('id', int, False),
+			Column('category', str), Column('score', int),
+			Column('flag', bool)], 't')
+		rng = random.Random(3)
+		self.rows = [(i, 'c%d' % (i//1000), rng.choice([None, 1, 2, 3]),
+					i % 3 == 0) for i in range(5000)]
+		self.source.load(self.rows)
+		self.table = EncodedRelation(self.source)
+
+	def test_should_scan_rows(self):
+		self.assertEqual(self.table.name, 't')
+		self.assertEqual(list(self.table), self.rows)
+		self.assertEqual(self.table.get_row(4321), self.rows[4321])
+		with self.assertRaisesRegex(TypeError, 'read only'):
+			self.table.insert((1, 'x', 1, True))
+
+	def test_memory_report(self):
+		report = self.table.memory_report()
+		self.assertEqual([(r['column'], r['encoding']) for r in report],
+			[('id', DELTA), ('category', RUN_LENGTH),
+			('score', FRAME_OF_REFERENCE), ('flag', BITMAP)])
+		for entry in report:
+			self.assertLess(entry['encoded_bytes'], entry['plain_bytes'])
+
+	def test_should_use_given_encodings(self):
+		table = EncodedRelation(self.source, encodings={'id': PLAIN})
+		self.assertEqual(table.encoded_columns[0].encoding, PLAIN)
+		self.assertEqual(list(table), self.rows)
+
+	def test_run_aggregation_should_match_group_by(self):
+		factories = [CountFactory()]
+		for column in self.table.columns[1:]:
+			factories.append(CountFactory(Attribute(column)))
+			factories.append(MinFactory(Attribute(column)))
+			factories.append(MaxFactory(Attribute(column)))
+		factories.append(SumFactory(Attribute(self.table.columns[2])))
+		factories.append(AvgFactory(Attribute(self.table.columns[2])))
+		self.assertTrue(can_aggregate_runs(self.table, factories))
+		self.assertEqual(list(RunAggregation(self.table, factories)),
+			list(GroupBy(self.source, [], factories)))
+
+	def test_run_aggregation_of_empty_table_should_match_group_by(self):
+		source = MaterialRelation(self.source.columns)
+		table = EncodedRelation(source)
+		factories = [CountFactory(), SumFactory(Attribute(table.columns[2]))]
+		self.assertEqual(list(RunAggregation(table, factories)), [])
+		self.assertEqual(list(GroupBy(source, [], factories)), [])
+
+	def test_run_aggregation_requires_columns(self):
+		expression = Arithmetic('+', Attribute(self.table.columns[0]),
+								Constant(1))
+		self.assertFalse(can_aggregate_runs(self.table,
+			[SumFactory(expression)]))
+		self.assertFalse(can_aggregate_runs(self.source, [CountFactory()]))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,402 @@
+import json
+import time
+
+import encoding
+import index
+import memory
+import parallel
+import relation
+import stats
+
+binary_operators = {
+	relation.And: 'and',
+	relation.Or: 'or',
+}
+
+type_names = {
+	bool: 'boolean',
+	int: 'integer',
+	float: 'float',
+	str: 'string',
+}
+
+def describe_column(column):
+	if column.name:
+		return column.name
+	return '#%d' % column.index
+
+def describe_value(value):
+	if value == None:
+		return 'null'
+	if type(value) == bool:
+		return 'true' if value else 'false'
+	if type(value) == str:
+		return "'%s'" % value.replace("'", "''")
+	return repr(value)
+
+def describe_expression(expression):
+	'Returns a SQL like description of a compiled expression.'
+	expression_type = type(expression)
+	if expression_type == relation.SharedExpression:
+		return describe_expression(expression.expression)
+	if expression_type in (relation.Conjunction, relation.Disjunction):
+		return describe_junction(expression.name, expression.operands)
+	if expression_type == relation.Constant:
+		return describe_value(expression.value)
+	if expression_type == relation.Attribute:
+		return describe_column(expression.column)
+	if expression_type in binary_operators:
+		operator = binary_operators[expression_type]
+	elif expression_type in (relation.Comparison, relation.Arithmetic):
+		operator = expression.operator
+	else:
+		operator = None
+	if operator:
+		return '(%s %s %s)' % (describe_expression(expression.lhs), operator,
+								describe_expression(expression.rhs))
+	if expression_type == relation.UnaryMinus:
+		return '(- %s)' % describe_expression(expression.expression)
+	if expression_type == relation.LogicalNot:
+		return '(not %s)' % describe_expression(expression.expression)
+	if expression_type == relation.IsNull:
+		return '(%s is null)' % describe_expression(expression.expression)
+	if expression_type == relation.IsNotNull:
+		return '(%s is not null)' % describe_expression(expression.expression)
+	if expression_type == relation.InList:
+		return '(%s in (%s))' % (describe_expression(expression.expression),
+			', '.join([describe_value(value) for value in expression.values]))
+	if expression_type == relation.Cast:
+		return 'cast(%s as %s)' % (describe_expression(expression.expression),
+									type_names[expression.target_type])
+	return expression_type.__name__
+
+def describe_junction(name, operands):
+	return '(%s)' % (' %s ' % name).join(
+		[describe_expression(operand) for operand in operands])
+
+def junctions(expression):
+	'Returns the conjunctions and disjunctions within an expression.'
+	result = []
+	if isinstance(expression, relation.Junction):
+		result.append(expression)
+	for operand in relation.operands(expression):
+		result.extend(junctions(operand))
+	return result
+
+def describe_reorderings(predicate):
+	'Returns the reorderings of the operands of a predicate during execution.'
+	reorderings = []
+	for junction in junctions(predicate):
+		for rows, operands in junction.reorderings:
+			reorderings.append('after %d rows: %s' % (rows,
+				describe_junction(junction.name, operands)))
+		hidden = junction.reorder_count - len(junction.reorderings)
+		if hidden:
+			reorderings.append('%d more' % hidden)
+	return reorderings
+
+def describe_zone_map_filter(node):
+	conditions = []
+	for column_index, bounds in sorted(node.ranges.items()):
+		column = describe_column(node.columns[column_index])
+		lower, lower_inclusive, upper, upper_inclusive = bounds
+		if lower != None:
+			conditions.append('%s %s %s' % (column,
+				'>=' if lower_inclusive else '>', describe_value(lower)))
+		if upper != None:
+			conditions.append('%s %s %s' % (column,
+				'<=' if upper_inclusive else '<', describe_value(upper)))
+	for column_index in node.null_columns:
+		conditions.append(
+			'%s is null' % describe_column(node.columns[column_index]))
+	return ' and '.join(conditions)
+
+def describe_aggregate(aggregate):
+	if aggregate.expression == None:
+		return '%s(*)' % aggregate.name
+	return '%s(%s)' % (aggregate.name,
+						describe_expression(aggregate.expression))
+
+def describe_stage(kind, argument):
+	if kind == parallel.FILTER:
+		return 'filter %s' % describe_expression(argument)
+	return 'project %s' % ', '.join(
+		[describe_expression(expression) for expression in argument])
+
+def describe_sort_key(node):
+	if node.sort_key:
+		key = [describe_column(column) for column in node.sort_key]
+	else:
+		key = [describe_column(column) for column in node.columns]
+	order = 'desc' if node.descending else 'asc'
+	nulls = 'nulls last' if node.nulls_last else 'nulls first'
+	return ['%s %s %s' % (column, order, nulls) for column in key]
+
+class OperatorProfile:
+	'Runtime measurements of an operator collected by EXPLAIN ANALYZE.'
+	def __init__(self):
+		self.rows = 0
+		self.loops = 0
+		self.wall_time = 0.0
+		self.cpu_time = 0.0
+
+	def add_time(self, wall_start, cpu_start):
+		self.wall_time += time.perf_counter() - wall_start
+		self.cpu_time += time.thread_time() - cpu_start
+
+class InstrumentedRelation(relation.Relation):
+	def __init__(self, node, profile):
+		'''
+		Wraps a relation and records the rows it produces and the time spent
+		producing them, including time spent in the relations it is derived
+		from.
+		'''
+		self.name = node.name
+		self.columns = node.columns
+		self.node = node
+		self.profile = profile
+
+	def __iter__(self):
+		profile = self.profile
+		profile.loops += 1
+		wall_start, cpu_start = time.perf_counter(), time.thread_time()
+		iterator = iter(self.node)
+		profile.add_time(wall_start, cpu_start)
+		while True:
+			wall_start, cpu_start = time.perf_counter(), time.thread_time()
+			try:
+				row = next(iterator)
+			except StopIteration:
+				profile.add_time(wall_start, cpu_start)
+				return
+			profile.add_time(wall_start, cpu_start)
+			profile.rows += 1
+			yield row
+
+def instrument(node, profiles, replaced):
+	'''
+	Wraps the inputs of every relation in the tree with an
+	InstrumentedRelation. Profiles are keyed by the id of the wrapped relation
+	and the replaced inputs are recorded as (relation, attribute, input) so
+	they can be restored.
+	'''
+	profile = profiles.setdefault(id(node), OperatorProfile())
+	for name in node.inputs:
+		child = getattr(node, name)
+		setattr(node, name, instrument(child, profiles, replaced))
+		replaced.append((node, name, child))
+	return InstrumentedRelation(node, profile)
+
+def uninstrument(replaced):
+	for node, name, child in reversed(replaced):
+		setattr(node, name, child)
+
+def profile_execution(node):
+	'''
+	Executes the query, discarding its output, and returns the profiles of its
+	operators.
+	'''
+	profiles = {}
+	replaced = []
+	if node.memory is relation.Relation.memory:
+		# Operators outside of a query are given accounts so their peak
+		# memory can be reported
+		node.set_memory(memory.MemoryTracker())
+	try:
+		for row in instrument(node, profiles, replaced):
+			pass
+	finally:
+		uninstrument(replaced)
+	return profiles
+
+# Operators which buffer rows and report their peak memory
+buffering_types = (relation.Sort, relation.GroupBy, parallel.ParallelGroupBy)
+
+def add_actuals(description, node, profiles):
+	node_type = type(node)
+	profile = profiles[id(node)]
+	children = node.children()
+	exclusive_wall = profile.wall_time
+	exclusive_cpu = profile.cpu_time
+	rows_in = 0
+	for child in children:
+		child_profile = profiles[id(child)]
+		exclusive_wall -= child_profile.wall_time
+		exclusive_cpu -= child_profile.cpu_time
+		rows_in += child_profile.rows
+	description['actual_rows'] = profile.rows
+	if children:
+		description['rows_in'] = rows_in
+	description['loops'] = profile.loops
+	description['wall_time_ms'] = round(max(exclusive_wall, 0)*1000, 3)
+	description['cpu_time_ms'] = round(max(exclusive_cpu, 0)*1000, 3)
+	account = node.memory
+	if node_type == relation.GroupBy:
+		# Group by buffers its input in a sort
+		account = node.relation.memory
+	if node_type in buffering_types:
+		description['peak_materialized_rows'] = account.peak_rows
+		description['peak_memory_bytes'] = account.peak
+	if node_type == relation.Sort:
+		description['spilled_runs'] = node.spilled_runs
+
+def plan_node(node, profiles=None):
+	'''
+	Returns a description of a relation and the relations it is derived from
+	as nested dictionaries. If profiles from profile_execution are given the
+	description includes the measurements of each operator. Times exclude the
+	time spent in the operator's inputs.
+	'''
+	node_type = type(node)
+	description = {'operator': node_type.__name__}
+	if not node.inputs and node.name:
+		description['table'] = node.name
+	description['columns'] = [describe_column(c) for c in node.columns]
+	if node_type in index.index_scan_types:
+		description['index'] = '%s using %s (%s)' % (node.index.name,
+			node.index.method,
+			', '.join([describe_column(c) for c in node.index.columns]))
+		description['index_condition'] = describe_expression(node.predicate())
+	elif node_type == relation.ZoneMapScan:
+		description['zone_map_filter'] = describe_zone_map_filter(node)
+		description['chunks'] = len(node.table.zone_maps)
+	elif node_type == relation.Selection:
+		description['predicate'] = describe_expression(node.predicate)
+	elif node_type == relation.GeneralizedProjection:
+		description['expressions'] = [
+			describe_expression(e) for e in node.expressions]
+	elif node_type == relation.Sort:
+		description['sort_key'] = describe_sort_key(node)
+	elif node_type == relation.GroupBy:
+		description['group_key'] = [
+			describe_column(c) for c in node.grouping_columns]
+		description['aggregates'] = [
+			describe_aggregate(a) for a in node.aggregates]
+	elif node_type == encoding.RunAggregation:
+		description['table'] = node.table.name
+		description['aggregates'] = [
+			describe_aggregate(a) for a in node.aggregates]
+	elif node_type == parallel.ParallelPipeline:
+		description['table'] = node.table.name
+		description['workers'] = node.executor.workers
+		description['morsel_rows'] = node.executor.morsel_rows
+		description['ordered'] = node.ordered
+		description['stages'] = [describe_stage(kind, argument)
+									for kind, argument in node.stages]
+	elif node_type == parallel.ParallelGroupBy:
+		description['table'] = node.table.name
+		description['group_key'] = [
+			describe_column(c) for c in node.plan.grouping_columns]
+		description['aggregates'] = [
+			describe_aggregate(a) for a in node.aggregates]
+		description['stages'] = [describe_stage(kind, argument)
+									for kind, argument in node.stages]
+		description['workers'] = node.executor.workers
+		description['morsel_rows'] = node.executor.morsel_rows
+		description['partitions'] = node.partition_count
+	elif node_type == parallel.ParallelSort:
+		description['table'] = node.table.name
+		description['sort_key'] = describe_sort_key(node.plan)
+		description['stages'] = [describe_stage(kind, argument)
+									for kind, argument in node.stages]
+		description['workers'] = node.executor.workers
+		description['morsel_rows'] = node.executor.morsel_rows
+		description['partitions'] = node.partition_count
+	elif isinstance(node, relation.SetCombination):
+		description['distinct'] = node.distinct
+	if node.ordering:
+		description['ordering'] = [describe_column(c) for c in node.ordering]
+	if node_type == relation.Sort and node.presorted:
+		description['presorted'] = True
+	description['estimated_rows'] = int(round(stats.estimate_rows(node)))
+	if profiles != None:
+		add_actuals(description, node, profiles)
+		if node_type == relation.Selection:
+			reorderings = describe_reorderings(node.predicate)
+			if reorderings:
+				description['reorderings'] = reorderings
+		if node_type == relation.ZoneMapScan:
+			description['chunks_read'] = node.chunks_read
+			description['chunks_skipped'] = node.chunks_skipped
+	description['inputs'] = [
+		plan_node(child, profiles) for child in node.children()]
+	return description
+
+# Order in which details of an operator are listed in the text format
+text_details = [
+	('table', 'table'),
+	('index', 'index'),
+	('index_condition', 'index condition'),
+	('zone_map_filter', 'zone map filter'),
+	('chunks', 'chunks'),
+	('chunks_read', 'chunks read'),
+	('chunks_skipped', 'chunks skipped'),
+	('columns', 'columns'),
+	('predicate', 'predicate'),
+	('expressions', 'expressions'),
+	('sort_key', 'sort key'),
+	('group_key', 'group key'),
+	('aggregates', 'aggregates'),
+	('stages', 'stages'),
+	('workers', 'workers'),
+	('morsel_rows', 'morsel rows'),
+	('partitions', 'partitions'),
+	('ordered', 'ordered output'),
+	('distinct', 'distinct'),
+	('ordering', 'ordered by'),
+	('presorted', 'input already sorted'),
+	('rows_in', 'rows in'),
+	('reorderings', 'predicate reorderings'),
+	('peak_materialized_rows', 'peak materialized rows'),
+	('peak_memory_bytes', 'peak memory bytes'),
+	('spilled_runs', 'spilled runs'),
+]
+
+def format_text(description, depth=0):
+	'Returns the lines of a human readable rendering of a plan description.'
+	indent = '      '*depth
+	prefix = '->  ' if depth else ''
+	header = '%s%s%s  (rows=%d)' % (indent, prefix, description['operator'],
+									description['estimated_rows'])
+	if 'actual_rows' in description:
+		header += ' (actual rows=%d loops=%d time=%.3f ms cpu=%.3f ms)' % (
+			description['actual_rows'], description['loops'],
+			description['wall_time_ms'], description['cpu_time_ms'])
+	lines = [header]
+	detail_indent = indent + ('    ' if depth else '  ')
+	for key, label in text_details:
+		if key not in description:
+			continue
+		value = description[key]
+		if type(value) == list:
+			value = ', '.join(value)
+		lines.append('%s%s: %s' % (detail_indent, label, value))
+	for child in description['inputs']:
+		lines.extend(format_text(child, depth + 1))
+	return lines
+
+def format_json(description):
+	return json.dumps(description, indent=2)
+
+formats = ('text', 'json')
+
+def explain(node, output_format='text', analyze=False):
+	'''
+	Returns a relation with a single string column describing the plan of the
+	relation. The text format has one row per line and the json format has a
+	single row.
+
+	If analyze is true, the query is executed and the description includes
+	the rows produced and time spent by each operator.
+	'''
+	if output_format not in formats:
+		raise ValueError('Unknown EXPLAIN format %r' % output_format)
+	profiles = profile_execution(node) if analyze else None
+	description = plan_node(node, profiles)
+	output = relation.MaterialRelation([relation.Column('plan', str, False)])
+	if output_format == 'json':
+		output.insert((format_json(description),))
+	else:
+		for line in format_text(description):
+			output.insert((line,))
+	return output
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+from explain import *
+from relation import *
+import json
+import unittest
+
+class TestDescribeExpression(unittest.TestCase):
+	def test_should_describe_nested_expressions(self):
+		a = Attribute(Column('a', int, index=0))
+		b = Attribute(Column(None, bool, index=1))
+		expression = Or(
+			Comparison('<=', Arithmetic('+', a, Constant(1)), Constant(3)),
+			LogicalNot(IsNull(b)))
+		self.assertEqual(describe_expression(expression),
+			'(((a + 1) <= 3) or (not (#1 is null)))')
+
+	def test_should_describe_constants_as_sql_literals(self):
+		self.assertEqual(describe_expression(Constant("it's")), "'it''s'")
+		self.assertEqual(describe_expression(Constant(True)), 'true')
+		self.assertEqual(describe_expression(Constant(None)), 'null')
+		self.assertEqual(describe_expression(Constant(2.5)), '2.5')
+
+	def test_should_describe_cast(self):
+		a = Attribute(Column('a', int, index=0))
+		self.assertEqual(describe_expression(Cast(a, str)),
+			'cast(a as string)')
+
+class TestPlanNode(unittest.TestCase):
+	def setUp(self):
+		self.table = MaterialRelation(
+			[Column('a', int), Column('b', str)], name='t')
+		for i in range(10):
+			self.table.insert((i, str(i)))
+
+	def test_should_describe_operator_tree(self):
+		selection = Selection(self.table,
+			Comparison('=', Attribute(self.table.columns[0]), Constant(1)))
+		group_by = GroupBy(selection, [self.table.columns[1]],
+			[CountFactory(), SumFactory(Attribute(self.table.columns[0]))])
+
+		description = plan_node(group_by)
+
+		self.assertEqual(description['operator'], 'GroupBy')
+		self.assertEqual(description['group_key'], ['b'])
+		self.assertEqual(description['aggregates'], ['count(*)', 'sum(a)'])
+		sort = description['inputs'][0]
+		self.assertEqual(sort['operator'], 'Sort')
+		self.assertEqual(sort['sort_key'], ['b asc nulls last'])
+		selection = sort['inputs'][0]
+		self.assertEqual(selection['predicate'], '(a = 1)')
+		scan = selection['inputs'][0]
+		self.assertEqual(scan['table'], 't')
+		self.assertEqual(scan['estimated_rows'], 10)
+		self.assertEqual(scan['inputs'], [])
+
+	def test_cross_join_estimate_should_be_product_of_inputs(self):
+		description = plan_node(CrossJoin(self.table, self.table))
+		self.assertEqual(description['estimated_rows'], 100)
+
+class TestProfileExecution(unittest.TestCase):
+	def setUp(self):
+		self.lhs = MaterialRelation([Column('a', int)], name='l')
+		self.rhs = MaterialRelation([Column('b', int)], name='r')
+		for i in range(3):
+			self.lhs.insert((i,))
+			self.rhs.insert((i,))
+
+	def test_should_count_rows_and_restarts(self):
+		product = CrossJoin(self.lhs, self.rhs)
+		selection = Selection(product,
+			Comparison('<', Attribute(product.columns[0]), Constant(2)))
+
+		description = plan_node(selection, profile_execution(selection))
+
+		self.assertEqual(description['actual_rows'], 6)
+		self.assertEqual(description['rows_in'], 9)
+		self.assertEqual(description['loops'], 1)
+		join = description['inputs'][0]
+		self.assertEqual(join['rows_in'], 12)
+		lhs, rhs = join['inputs']
+		self.assertEqual(lhs['loops'], 1)
+		self.assertEqual(rhs['loops'], 3)
+		self.assertEqual(rhs['actual_rows'], 9)
+		self.assertNotIn('rows_in', rhs)
+		self.assertGreaterEqual(description['wall_time_ms'], 0)
+		self.assertGreaterEqual(description['cpu_time_ms'], 0)
+
+	def test_should_report_peak_materialized_rows(self):
+		group_by = GroupBy(self.lhs, [self.lhs.columns[0]], [CountFactory()])
+
+		description = plan_node(group_by, profile_execution(group_by))
+
+		self.assertEqual(description['peak_materialized_rows'], 3)
+		self.assertEqual(description['inputs'][0]['operator'], 'Sort')
+		self.assertEqual(
+			description['inputs'][0]['peak_materialized_rows'], 3)
+		self.assertGreater(description['peak_memory_bytes'], 0)
+		self.assertEqual(description['inputs'][0]['spilled_runs'], 0)
+
+	def test_should_report_predicate_reorderings(self):
+		table = MaterialRelation([Column('a', int)], name='t')
+		table.load([(i,) for i in range(2000)])
+		a = Attribute(table.columns[0])
+		selection = Selection(table, Conjunction([
+			Comparison('>=', a, Constant(0)), Comparison('=', a, Constant(7))]))
+
+		description = plan_node(selection, profile_execution(selection))
+
+		self.assertEqual(description['reorderings'],
+			['after 1024 rows: ((a = 7) and (a >= 0))'])
+		self.assertEqual(description['predicate'], '((a = 7) and (a >= 0))')
+		self.assertIn('predicate reorderings: after 1024 rows',
+			'\n'.join(format_text(description)))
+
+	def test_should_restore_plan_after_execution(self):
+		selection = Selection(self.lhs, Constant(True))
+		profile_execution(selection)
+		self.assertIs(selection.relation, self.lhs)
+		self.assertEqual(list(selection), [(0,), (1,), (2,)])
+
+class TestExplain(unittest.TestCase):
+	def test_text_format_should_have_one_row_per_line(self):
+		table = MaterialRelation([Column('a', int)], name='t')
+		output = explain(Selection(table, Constant(True)))
+		self.assertEqual(output.columns[0].name, 'plan')
+		self.assertEqual([row[0] for row in output], [
+			'Selection  (rows=0)',
+			'  columns: a',
+			'  predicate: true',
+			'      ->  MaterialRelation  (rows=0)',
+			'          table: t',
+			'          columns: a',
+		])
+
+	def test_json_format_should_have_single_row(self):
+		table = MaterialRelation([Column('a', int)], name='t')
+		rows = list(explain(table, 'json'))
+		self.assertEqual(len(rows), 1)
+		self.assertEqual(json.loads(rows[0][0])['table'], 't')
+
+	def test_should_raise_error_for_unknown_format(self):
+		table = MaterialRelation([Column('a', int)], name='t')
+		with self.assertRaisesRegex(ValueError, 'format'):
+			explain(table, 'yaml')
+
+if __name__ == '__main__':
+	unittest.main()
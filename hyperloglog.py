@@ -0,0 +1,86 @@
+'''
+HyperLogLog sketches estimating the number of distinct values in a stream.
+
+A sketch of precision p keeps 2**p registers of one byte. Each value is
+hashed to 64 bits: the first p bits pick a register and the register keeps
+the largest position of the first one bit in the remaining bits. The
+estimate has a relative standard error of about 1.04/sqrt(2**p) whatever
+the number of values, and sketches of different parts of a stream are
+merged by taking the largest value of each register.
+
+Values are hashed with blake2b rather than hash, which is randomized for
+strings between processes, so sketches built by parallel workers or stored
+between sessions can be merged.
+'''
+
+import hashlib
+import math
+
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+DEFAULT_PRECISION = 14
+
+HASH_BITS = 64
+
+def hash_value(value):
+	'Returns a 64 bit hash of a value which is the same in every process.'
+	data = ('%s:%r' % (type(value).__name__, value)).encode(
+		'utf-8', 'surrogatepass')
+	return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+							'big')
+
+def alpha(register_count):
+	'Returns the bias correction constant for a number of registers.'
+	if register_count == 16:
+		return 0.673
+	if register_count == 32:
+		return 0.697
+	if register_count == 64:
+		return 0.709
+	return 0.7213/(1 + 1.079/register_count)
+
+class HyperLogLog:
+	def __init__(self, precision=DEFAULT_PRECISION):
+		'A sketch of the distinct values added to it with 2**precision registers.'
+		if type(precision) != int or not (
+				MIN_PRECISION <= precision <= MAX_PRECISION):
+			raise ValueError('Precision must be an integer from %d to %d' %
+								(MIN_PRECISION, MAX_PRECISION))
+		self.precision = precision
+		self.registers = bytearray(2**precision)
+
+	def add(self, value):
+		h = hash_value(value)
+		remaining_bits = HASH_BITS - self.precision
+		register = h >> remaining_bits
+		rest = h & ((1 << remaining_bits) - 1)
+		# Position of the first one bit, or one more than the bits if none
+		rank = remaining_bits - rest.bit_length() + 1
+		if rank > self.registers[register]:
+			self.registers[register] = rank
+
+	def merge(self, other):
+		'Adds the values of another sketch of the same precision.'
+		if other.precision != self.precision:
+			raise ValueError('Can not merge sketches of precision %d and %d' %
+								(self.precision, other.precision))
+		self.registers = bytearray(map(max, self.registers, other.registers))
+
+	def estimate(self):
+		'Returns the estimated number of distinct values added.'
+		register_count = len(self.registers)
+		total = math.fsum([2.0**-rank for rank in self.registers])
+		estimate = alpha(register_count)*register_count**2/total
+		empty = self.registers.count(0)
+		if estimate <= 2.5*register_count and empty:
+			# Linear counting is more accurate for few values
+			estimate = register_count*math.log(register_count/empty)
+		return estimate
+
+	def serialize(self):
+		return (self.precision, bytes(self.registers))
+
+	def deserialize(self, state):
+		'Replaces the registers with a state from serialize.'
+		self.precision, registers = state
+		self.registers = bytearray(registers)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+from hyperloglog import *
+import math
+import os
+import random
+import subprocess
+import sys
+import unittest
+
+class TestHyperLogLog(unittest.TestCase):
+	def relative_error(self, sketch, count):
+		return abs(sketch.estimate() - count)/count
+
+	def test_estimates_should_be_within_error_bounds(self):
+		rng = random.Random(7)
+		for precision in (10, 12, 14):
+			standard_error = 1.04/math.sqrt(2**precision)
+			for count in (100, 5000, 100000):
+				sketch = HyperLogLog(precision)
+				values = [rng.getrandbits(48) for i in range(count)]
+				# Repeated values do not change the estimate
+				for value in values + values[:count//2]:
+					sketch.add(value)
+				self.assertLess(self.relative_error(sketch, count),
+					4*standard_error, msg='%d values, precision %d' %
+					(count, precision))
+
+	def test_should_estimate_strings_and_floats(self):
+		for values in (['user%d' % i for i in range(20000)],
+						[i/3 for i in range(20000)]):
+			sketch = HyperLogLog(12)
+			for value in values:
+				sketch.add(value)
+			self.assertLess(self.relative_error(sketch, 20000), 4*1.04/64)
+
+	def test_small_counts_should_be_nearly_exact(self):
+		sketch = HyperLogLog()
+		for i in range(50):
+			sketch.add(i)
+		self.assertEqual(round(sketch.estimate()), 50)
+		self.assertEqual(HyperLogLog().estimate(), 0)
+
+	def test_merged_sketches_should_equal_sketch_of_all_values(self):
+		merged = HyperLogLog(10)
+		whole = HyperLogLog(10)
+		for part in range(4):
+			sketch = HyperLogLog(10)
+			for i in range(part*1000, part*1000 + 1500):
+				sketch.add(i)
+				whole.add(i)
+			merged.merge(sketch)
+		self.assertEqual(merged.registers, whole.registers)
+		with self.assertRaisesRegex(ValueError, 'precision'):
+			merged.merge(HyperLogLog(11))
+
+	def test_should_serialize_state(self):
+		sketch = HyperLogLog(8)
+		for i in range(300):
+			sketch.add(str(i))
+		copy = HyperLogLog(8)
+		copy.deserialize(sketch.serialize())
+		self.assertEqual(copy.estimate(), sketch.estimate())
+
+	def test_hashes_should_not_depend_on_the_process(self):
+		script = 'import hyperloglog; print(hyperloglog.hash_value("abc"))'
+		output = subprocess.check_output([sys.executable, '-c', script],
+			env={'PYTHONHASHSEED': '1', 
+			'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))})
+		self.assertEqual(int(output), hash_value('abc'))
+		self.assertNotEqual(hash_value(1), hash_value('1'))
+
+	def test_should_check_precision(self):
+		for precision in (MIN_PRECISION - 1, MAX_PRECISION + 1, 10.0):
+			with self.assertRaisesRegex(ValueError, 'Precision'):
+				HyperLogLog(precision)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,207 @@
+import bisect
+
+import relation
+
+class HashIndex:
+	method = 'hash'
+
+	def __init__(self, name, table, columns):
+		'''
+		Maps the values of the indexed columns of a table to the ids of the
+		rows with those values. Rows with a null value in any indexed column
+		are not indexed since they can never be equal to a lookup key.
+		'''
+		self.name = name
+		self.table = table
+		self.columns = columns
+		self.entries = {}
+		for row_id, row in enumerate(table):
+			self.insert(row_id, row)
+
+	def key(self, row):
+		return tuple([row[column.index] for column in self.columns])
+
+	def insert(self, row_id, row):
+		key = self.key(row)
+		if None in key:
+			return
+		row_ids = self.entries.get(key)
+		if row_ids == None:
+			self.entries[key] = [row_id]
+		else:
+			row_ids.append(row_id)
+
+	def remove(self, row_id, row):
+		key = self.key(row)
+		if None in key:
+			return
+		row_ids = self.entries[key]
+		row_ids.remove(row_id)
+		if not row_ids:
+			del self.entries[key]
+
+	def lookup(self, key):
+		'Returns the ids of the rows whose indexed columns equal the key.'
+		return self.entries.get(key, [])
+
+def leading_column(key):
+	return key[0]
+
+class OrderedIndex:
+	method = 'ordered'
+
+	def __init__(self, name, table, columns):
+		'''
+		Keeps the ids of the rows of a table in a sorted array ordered by the
+		values of the indexed columns and then by row id. Like hash indexes,
+		rows with a null value in any indexed column are not indexed.
+		'''
+		self.name = name
+		self.table = table
+		self.columns = columns
+		entries = []
+		for row_id, row in enumerate(table):
+			key = self.key(row)
+			if None not in key:
+				entries.append((key, row_id))
+		entries.sort()
+		self.keys = [key for key, row_id in entries]
+		self.row_ids = [row_id for key, row_id in entries]
+
+	def key(self, row):
+		return tuple([row[column.index] for column in self.columns])
+
+	def insert(self, row_id, row):
+		key = self.key(row)
+		if None in key:
+			return
+		# Rows are inserted in increasing row id order so placing the key
+		# after equal keys keeps them ordered by row id. Appending in key order
+		# only costs a binary search.
+		position = bisect.bisect_right(self.keys, key)
+		self.keys.insert(position, key)
+		self.row_ids.insert(position, row_id)
+
+	def remove(self, row_id, row):
+		key = self.key(row)
+		if None in key:
+			return
+		start = bisect.bisect_left(self.keys, key)
+		end = bisect.bisect_right(self.keys, key)
+		position = start + self.row_ids[start:end].index(row_id)
+		del self.keys[position]
+		del self.row_ids[position]
+
+	def lookup(self, key):
+		'Returns the ids of the rows whose indexed columns equal the key.'
+		start = bisect.bisect_left(self.keys, key)
+		end = bisect.bisect_right(self.keys, key)
+		return self.row_ids[start:end]
+
+	def scan(self, lower=None, lower_inclusive=True, upper=None,
+			upper_inclusive=True):
+		'''
+		Returns the ids of the rows whose leading indexed column is between the
+		bounds in index order. A bound of None is unbounded.
+		'''
+		start, end = 0, len(self.keys)
+		if lower != None:
+			search = bisect.bisect_left if lower_inclusive else (
+						bisect.bisect_right)
+			start = search(self.keys, lower, key=leading_column)
+		if upper != None:
+			search = bisect.bisect_right if upper_inclusive else (
+						bisect.bisect_left)
+			end = search(self.keys, upper, key=leading_column)
+		return self.row_ids[start:end]
+
+class IndexScan(relation.Relation):
+	def __init__(self, table, index, keys):
+		'''
+		Represents the rows of the table whose indexed columns are equal to
+		one of the keys. Rows are produced in the order they were inserted.
+		'''
+		super().__init__(table.columns, table.name)
+		self.table = table
+		self.index = index
+		self.keys = list(dict.fromkeys(keys))
+
+	def predicate(self):
+		'Returns an expression equivalent to the index lookup.'
+		alternatives = []
+		for key in self.keys:
+			conjuncts = [relation.Comparison('=', relation.Attribute(column),
+								relation.Constant(value))
+							for column, value in zip(self.index.columns, key)]
+			alternatives.append(relation.conjunction(conjuncts))
+		if not alternatives:
+			return relation.Constant(False)
+		predicate = alternatives[0]
+		for alternative in alternatives[1:]:
+			predicate = relation.Or(predicate, alternative)
+		return predicate
+
+	def __iter__(self):
+		row_ids = []
+		for key in self.keys:
+			row_ids.extend(self.index.lookup(key))
+		row_ids.sort()
+		return (self.table.get_row(row_id) for row_id in row_ids)
+
+class IndexRangeScan(relation.Relation):
+	def __init__(self, table, index, lower=None, lower_inclusive=True,
+			upper=None, upper_inclusive=True):
+		'''
+		Represents the rows of the table whose leading indexed column is
+		between the bounds. Rows are produced in index order, so the relation
+		is ordered by the leading indexed column. It is not ordered by the
+		later columns, since rows with a null in them are not indexed.
+		'''
+		super().__init__(table.columns, table.name)
+		self.table = table
+		self.index = index
+		self.lower = lower
+		self.lower_inclusive = lower_inclusive
+		self.upper = upper
+		self.upper_inclusive = upper_inclusive
+		self.ordering = [self.columns[index.columns[0].index]]
+
+	def predicate(self):
+		'Returns an expression equivalent to the range scan.'
+		column = relation.Attribute(self.index.columns[0])
+		conjuncts = []
+		if self.lower != None:
+			operator = '>=' if self.lower_inclusive else '>'
+			conjuncts.append(relation.Comparison(operator, column,
+								relation.Constant(self.lower)))
+		if self.upper != None:
+			operator = '<=' if self.upper_inclusive else '<'
+			conjuncts.append(relation.Comparison(operator, column,
+								relation.Constant(self.upper)))
+		if not conjuncts:
+			return relation.IsNotNull(column)
+		return relation.conjunction(conjuncts)
+
+	def __iter__(self):
+		row_ids = self.index.scan(self.lower, self.lower_inclusive,
+									self.upper, self.upper_inclusive)
+		return (self.table.get_row(row_id) for row_id in row_ids)
+
+index_scan_types = (IndexScan, IndexRangeScan)
+
+index_methods = {
+	'hash': HashIndex,
+	'ordered': OrderedIndex,
+	'btree': OrderedIndex,
+}
+
+def create_index(name, table, column_names, method='hash'):
+	'Builds an index over the named columns of the table.'
+	if method not in index_methods:
+		raise ValueError('Unknown index method %r' % method)
+	if name in table.indexes:
+		raise ValueError('Index %r already exists' % name)
+	columns = [table.get_column(column_name) for column_name in column_names]
+	index = index_methods[method](name, table, columns)
+	table.indexes[name] = index
+	return index
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+from index import *
+from relation import *
+import unittest
+
+def make_table():
+	table = MaterialRelation([Column('id', int), Column('name', str)],
+		name='users')
+	table.insert((1, 'Alice'))
+	table.insert((2, 'Bob'))
+	table.insert((None, 'Eve'))
+	table.insert((2, 'Mallory'))
+	return table
+
+class TestHashIndex(unittest.TestCase):
+	def test_should_index_existing_rows(self):
+		table = make_table()
+		index = create_index('users_id', table, ['id'])
+		self.assertIs(table.indexes['users_id'], index)
+		self.assertEqual(index.lookup((2,)), [1, 3])
+		self.assertEqual(index.lookup((1,)), [0])
+		self.assertEqual(index.lookup((3,)), [])
+
+	def test_should_not_index_null_keys(self):
+		index = create_index('users_id', make_table(), ['id'])
+		self.assertEqual(index.lookup((None,)), [])
+
+	def test_should_index_inserted_rows(self):
+		table = make_table()
+		index = create_index('users_id_name', table, ['id', 'name'])
+		table.insert((3, 'Trent'))
+		self.assertEqual(index.lookup((3, 'Trent')), [4])
+		self.assertEqual(index.lookup((2, 'Bob')), [1])
+
+	def test_truncate_should_remove_index_entries(self):
+		table = make_table()
+		index = create_index('users_id', table, ['id'])
+		table.truncate(2)
+		self.assertEqual(index.lookup((2,)), [1])
+		table.insert((2, 'Mallory'))
+		self.assertEqual(index.lookup((2,)), [1, 2])
+
+	def test_should_raise_error_for_duplicate_name(self):
+		table = make_table()
+		create_index('users_id', table, ['id'])
+		with self.assertRaisesRegex(ValueError, 'already exists'):
+			create_index('users_id', table, ['name'])
+
+	def test_should_raise_error_for_unknown_column_or_method(self):
+		with self.assertRaisesRegex(KeyError, 'dne'):
+			create_index('users_dne', make_table(), ['dne'])
+		with self.assertRaisesRegex(ValueError, 'method'):
+			create_index('users_id', make_table(), ['id'], 'gist')
+
+class TestOrderedIndex(unittest.TestCase):
+	def test_bulk_build_should_order_keys(self):
+		index = create_index('users_id', make_table(), ['id'], 'ordered')
+		self.assertEqual(index.keys, [(1,), (2,), (2,)])
+		self.assertEqual(index.row_ids, [0, 1, 3])
+
+	def test_should_keep_order_on_insert(self):
+		table = make_table()
+		index = create_index('users_id', table, ['id'], 'btree')
+		table.insert((0, 'Trent'))
+		table.insert((2, 'Walter'))
+		table.insert((9, 'Peggy'))
+		self.assertEqual(index.keys, [(0,), (1,), (2,), (2,), (2,), (9,)])
+		self.assertEqual(index.row_ids, [4, 0, 1, 3, 5, 6])
+		self.assertEqual(index.lookup((2,)), [1, 3, 5])
+
+	def test_truncate_should_remove_entries(self):
+		table = make_table()
+		index = create_index('users_id', table, ['id'], 'ordered')
+		table.truncate(1)
+		self.assertEqual(index.keys, [(1,)])
+		self.assertEqual(index.row_ids, [0])
+
+	def test_range_scan(self):
+		table = MaterialRelation([Column('x', int)])
+		for x in [5, 3, 8, 1, 3, None, 7]:
+			table.insert((x,))
+		index = create_index('x', table, ['x'], 'ordered')
+		self.assertEqual(index.scan(), [3, 1, 4, 0, 6, 2])
+		self.assertEqual(index.scan(3, True, 7, False), [1, 4, 0])
+		self.assertEqual(index.scan(3, False, 7, True), [0, 6])
+		self.assertEqual(index.scan(upper=3), [3, 1, 4])
+		self.assertEqual(index.scan(lower=8, lower_inclusive=False), [])
+
+	def test_range_scan_should_use_leading_column(self):
+		table = MaterialRelation([Column('x', int), Column('y', str)])
+		for row in [(2, 'b'), (1, 'z'), (2, 'a'), (3, 'a')]:
+			table.insert(row)
+		index = create_index('x_y', table, ['x', 'y'], 'ordered')
+		self.assertEqual(index.scan(2, True, 2, True), [2, 0])
+		self.assertEqual(index.lookup((2, 'b')), [0])
+
+class TestIndexRangeScan(unittest.TestCase):
+	def test_should_return_rows_in_index_order(self):
+		table = make_table()
+		index = create_index('users_id', table, ['id'], 'ordered')
+		scan = IndexRangeScan(table, index, 1, False)
+		self.assertEqual(list(scan), [(2, 'Bob'), (2, 'Mallory')])
+		self.assertEqual([c.name for c in scan.ordering], ['id'])
+
+	def test_should_only_be_ordered_by_leading_column(self):
+		table = make_table()
+		index = create_index('users_id_name', table, ['id', 'name'], 'btree')
+		scan = IndexRangeScan(table, index, 1)
+		self.assertEqual([c.name for c in scan.ordering], ['id'])
+
+	def test_predicate_should_match_scan(self):
+		table = make_table()
+		index = create_index('users_id', table, ['id'], 'ordered')
+		scan = IndexRangeScan(table, index, 1, True, 2, False)
+		self.assertEqual(list(Selection(table, scan.predicate())),
+			list(scan))
+
+class TestIndexScan(unittest.TestCase):
+	def test_should_return_matching_rows_in_insertion_order(self):
+		table = make_table()
+		index = create_index('users_id', table, ['id'])
+		scan = IndexScan(table, index, [(2,), (1,), (2,)])
+		self.assertEqual(list(scan),
+			[(1, 'Alice'), (2, 'Bob'), (2, 'Mallory')])
+		self.assertEqual(scan.name, 'users')
+		self.assertEqual(len(scan.columns), 2)
+
+	def test_predicate_should_match_lookup(self):
+		table = make_table()
+		index = create_index('users_id', table, ['id'])
+		scan = IndexScan(table, index, [(2,), (1,)])
+		self.assertEqual(list(Selection(table, scan.predicate())),
+			list(scan))
+		self.assertEqual(list(Selection(table,
+			IndexScan(table, index, []).predicate())), [])
+
+if __name__ == '__main__':
+	unittest.main()
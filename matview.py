@@ -0,0 +1,218 @@
+'''
+Materialized views: the result of a query stored as a table and kept up to
+date as rows are inserted into the tables it reads.
+
+Views are maintained from the rows each insert adds rather than by running
+their query again:
+
+- Views made of selections, projections, cross joins and union all only
+  gain rows. For each occurrence of the changed table in the query, the
+  query is run with that occurrence reading the new rows, the occurrences
+  before it the table with the new rows and the ones after it the table
+  without them, and the rows it produces are appended to the view.
+- Views grouping such a query keep the aggregates of every group, update the
+  aggregates of the groups of the rows the same delta query produces and
+  replace the rows of those groups in place. Groups first seen by an insert
+  are appended to the view, so its rows are not in group order.
+- Other views are computed again.
+'''
+
+import itertools
+
+import cse
+import relation
+
+# Kinds of maintenance
+APPEND = 'append'
+AGGREGATE = 'aggregate'
+RECOMPUTE = 'recompute'
+
+class TablePrefix:
+	def __init__(self, table, row_count):
+		'The first row_count rows of a table, which can be read many times.'
+		self.table = table
+		self.row_count = row_count
+
+	def __iter__(self):
+		return itertools.islice(iter(self.table), self.row_count)
+
+class ViewInput(relation.Relation):
+	def __init__(self, table):
+		'''
+		Stands for an occurrence of a table in the query of a view and
+		produces the rows of source, which is set before the query is run.
+		'''
+		super().__init__(table.columns, table.name)
+		self.source = ()
+
+	def __iter__(self):
+		return iter(self.source)
+
+class InputCatalog:
+	def __init__(self, catalog):
+		'''
+		Resolves table names like a catalog, returning a new ViewInput for
+		every occurrence of a table in a query.
+		'''
+		self.catalog = catalog
+		self.inputs = []
+
+	def __getitem__(self, name):
+		if name not in self.catalog:
+			raise KeyError('Table %r does not exist' % name)
+		view_input = ViewInput(self.catalog[name])
+		self.inputs.append(view_input)
+		return view_input
+
+def is_linear(node):
+	'''
+	Returns true if every row the plan produces comes from one combination of
+	input rows, so inserted rows only add rows to its result.
+	'''
+	node_type = type(node)
+	if node_type == ViewInput:
+		return True
+	if node_type == relation.Union and not node.distinct:
+		# Union inputs are sorted, which does not change the rows
+		return all(is_linear(child.relation) for child in node.children())
+	if node_type not in (relation.Selection, relation.GeneralizedProjection,
+							relation.CrossJoin):
+		return False
+	return all(is_linear(child) for child in node.children())
+
+def input_branches(node, branches, path=()):
+	'''
+	Maps each ViewInput of the plan to the union branches it is read in, a
+	tuple of (union, branch index) pairs.
+	'''
+	if type(node) == ViewInput:
+		branches[node] = path
+		return
+	for i, child in enumerate(node.children()):
+		child_path = path
+		if type(node) == relation.Union:
+			child_path = path + ((node, i),)
+		input_branches(child, branches, child_path)
+
+def in_other_branch(lhs, rhs):
+	'Returns true if the union branches lhs and rhs are read in differ.'
+	rhs = dict(rhs)
+	return any(union in rhs and rhs[union] != i for union, i in lhs)
+
+class Group:
+	def __init__(self, factories):
+		'The aggregates of a group of a view and the id of its row.'
+		self.aggregates = [factory.new_aggregate() for factory in factories]
+		self.row_id = None
+
+class MaterializedView:
+	def __init__(self, name, query, catalog):
+		'''
+		Creates a view named name with the result of the query, an AST node
+		compiled against the catalog.
+		'''
+		inputs = InputCatalog(catalog)
+		self.plan = cse.eliminate_common_subexpressions(query.compile(inputs))
+		self.inputs = inputs.inputs
+		self.branches = {}
+		input_branches(self.plan, self.branches)
+		self.base_tables = {view_input.name for view_input in self.inputs}
+		self.table = relation.MaterialRelation(self.plan.columns, name)
+		self.groups = {}
+		plan = self.plan
+		self.projection = None
+		if type(plan) == relation.GeneralizedProjection and (
+				type(plan.relation) == relation.GroupBy):
+			self.projection = plan
+			plan = plan.relation
+		if is_linear(self.plan):
+			self.kind = APPEND
+			self.delta_plan = self.plan
+		elif type(plan) == relation.GroupBy and is_linear(
+				plan.relation.relation):
+			self.kind = AGGREGATE
+			self.group_by = plan
+			# The sort of the group by is skipped, groups are found by key
+			self.delta_plan = plan.relation.relation
+		else:
+			self.kind = RECOMPUTE
+		self.refresh(catalog)
+
+	def refresh(self, catalog):
+		'Computes the rows of the view from the tables in the catalog.'
+		for view_input in self.inputs:
+			view_input.source = catalog[view_input.name]
+		self.table.truncate(0)
+		self.groups = {}
+		if self.kind == AGGREGATE:
+			self.update_groups(self.delta_plan)
+		else:
+			self.table.load(list(self.plan))
+
+	def delta_rows(self, catalog, table_name, row_count, rows):
+		'''
+		Yields the rows the delta plan produces from rows inserted into the
+		table, which had row_count rows before. Union branches not reading
+		the changed occurrence of the table produce no rows.
+		'''
+		table = catalog[table_name]
+		changed = [i for i, view_input in enumerate(self.inputs)
+					if view_input.name == table_name]
+		for i in changed:
+			changed_branches = self.branches[self.inputs[i]]
+			for j, view_input in enumerate(self.inputs):
+				if in_other_branch(self.branches[view_input], changed_branches):
+					view_input.source = ()
+				elif view_input.name != table_name:
+					view_input.source = catalog[view_input.name]
+				elif j < i:
+					view_input.source = table
+				elif j == i:
+					view_input.source = rows
+				else:
+					view_input.source = TablePrefix(table, row_count)
+			yield from self.delta_plan
+
+	def insert(self, catalog, table_name, row_count, rows):
+		'''
+		Updates the view after rows were appended to the table named
+		table_name, which had row_count rows before.
+		'''
+		if self.kind == APPEND:
+			self.table.load(list(self.delta_rows(catalog, table_name,
+													row_count, rows)))
+		elif self.kind == AGGREGATE:
+			self.update_groups(self.delta_rows(catalog, table_name, row_count,
+												rows))
+		else:
+			self.refresh(catalog)
+
+	def update_groups(self, rows):
+		'''
+		Adds the rows to the aggregates of their groups and writes the rows of
+		the groups which changed.
+		'''
+		grouping_columns = self.group_by.grouping_columns
+		factories = self.group_by.aggregates
+		changed = {}
+		for row in rows:
+			key = tuple([row[column.index] for column in grouping_columns])
+			group = self.groups.get(key)
+			if group == None:
+				group = self.groups[key] = Group(factories)
+			for aggregate in group.aggregates:
+				aggregate.update(row)
+			changed[key] = group
+		new_rows = []
+		for key, group in changed.items():
+			row = key + tuple([aggregate.final()
+								for aggregate in group.aggregates])
+			if self.projection != None:
+				row = tuple([expression.evaluate(row)
+							for expression in self.projection.expressions])
+			if group.row_id == None:
+				group.row_id = self.table.row_count + len(new_rows)
+				new_rows.append(row)
+			else:
+				self.table.replace(group.row_id, row)
+		self.table.load(new_rows)
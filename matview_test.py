@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+from matview import *
+import repl
+import shutil
+import tempfile
+import unittest
+
+class TestMaterializedView(unittest.TestCase):
+	def setUp(self):
+		self.db = repl.Db()
+		self.db.execute('create table t (a integer, b integer);')
+		self.db.execute('create table s (a integer, c string);')
+		self.db.execute('insert into t values (1, 10), (2, 20), (1, 5);')
+		self.db.execute("insert into s values (1, 'x'), (2, 'y');")
+
+	def check_view(self, query, kind):
+		'''
+		Creates a view of the query and checks it matches the query after
+		inserts into both tables.
+		'''
+		self.db.execute('create materialized view v as %s;' % query)
+		view = self.db.views['v']
+		self.assertEqual(view.kind, kind)
+		self.db.execute('insert into t values (2, 7), (3, 1), (1, 100);')
+		self.db.execute("insert into s values (3, 'z'), (1, 'w');")
+		self.db.execute('insert into t values (3, ?);', (None,))
+		self.assertEqual(sorted(self.db.execute('select * from v;'), key=repr),
+			sorted(self.db.execute('%s;' % query), key=repr))
+		return view
+
+	def test_selection_views_should_append_rows(self):
+		view = self.check_view('select a, b*2 as d from t where b > 6', APPEND)
+		# Rows are appended in insert order
+		self.assertEqual(view.table.rows, [(1, 20), (2, 40), (2, 14), (1, 200)])
+
+	def test_join_views_should_apply_deltas(self):
+		self.check_view('select t.a, s.c, t.b from t, s where t.a = s.a', APPEND)
+
+	def test_self_join_views_should_count_new_pairs_once(self):
+		self.check_view('select x.b as p, y.b as q from t as x, t as y '
+						'where x.a = y.a', APPEND)
+
+	def test_group_by_views_should_update_groups_in_place(self):
+		view = self.check_view('select a, count(b) as n, sum(b) as total, '
+			'avg(b) as mean, min(b) as low, max(b) as high from t group by a',
+			AGGREGATE)
+		self.assertEqual(view.table.row_count, 3)
+		self.assertEqual(view.table.rows[0], (1, 3, 115, 115/3, 5, 100))
+
+	def test_aggregates_of_all_rows(self):
+		self.check_view('select count(b) as n, max(b) + 1 as m from t',
+			AGGREGATE)
+
+	def test_union_all_views_should_append_rows_of_each_side(self):
+		self.db.execute('create table u (a integer);')
+		self.check_view('select a from t union all select a from s '
+			'union all select a from u', APPEND)
+		self.db.execute('insert into u values (7);')
+		self.db.execute('insert into t values (8, 0);')
+		self.assertEqual(sorted(self.db.execute('select * from v;')),
+			[(1,), (1,), (1,), (1,), (1,), (2,), (2,), (2,), (3,),
+			(3,), (3,), (7,), (8,)])
+
+	def test_union_all_group_by_views_should_count_rows_once(self):
+		self.db.execute('create table u (a integer);')
+		self.db.execute('create materialized view g as select a, count(a) as n '
+			'from (select a from t union all select a from u) as x group by a;')
+		self.assertEqual(self.db.views['g'].kind, AGGREGATE)
+		self.db.execute('insert into u values (1), (8);')
+		self.db.execute('insert into t values (8, 0);')
+		self.assertEqual(sorted(self.db.execute('select * from g;')),
+			[(1, 3), (2, 1), (8, 2)])
+
+	def test_other_views_should_be_computed_again(self):
+		self.check_view('select a from t union select a from s', RECOMPUTE)
+
+	def test_views_of_views_should_follow_their_views(self):
+		self.db.execute('create materialized view groups as '
+						'select a, count(b) as n from t group by a;')
+		self.check_view('select count(n) as group_count from groups', AGGREGATE)
+
+	def test_views_should_not_be_written_directly(self):
+		self.db.execute('create materialized view v as select a from t;')
+		with self.assertRaisesRegex(ValueError, 'materialized view'):
+			self.db.execute('insert into v values (1);')
+		with self.assertRaisesRegex(ValueError, 'already exists'):
+			self.db.execute('create materialized view t as select a from s;')
+
+class TestFailedMaintenance(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_failed_maintenance_should_undo_the_insert(self):
+		db = repl.Db(self.directory, checkpoint_interval=None)
+		db.execute('create table t (x integer);')
+		db.execute('insert into t values (2), (5);')
+		db.execute('create materialized view w as select 10 / x as y from t;')
+		db.execute('create materialized view n as select count(y) as c '
+					'from w;')
+		with self.assertRaises(ZeroDivisionError):
+			db.execute('insert into t values (1), (0);')
+		self.assertEqual(list(db.execute('select * from t;')), [(2,), (5,)])
+		self.assertEqual(list(db.execute('select * from w;')), [(5,), (2,)])
+		self.assertEqual(list(db.execute('select * from n;')), [(2,)])
+		db.execute('insert into t values (10);')
+		self.assertEqual(list(db.execute('select * from w;')),
+			[(5,), (2,), (1,)])
+		# Simulate a crash: the failed insert was not logged
+		db.wal.close()
+		db = repl.Db(self.directory, checkpoint_interval=None)
+		self.assertEqual(list(db.execute('select * from t;')),
+			[(2,), (5,), (10,)])
+		db.close()
+
+if __name__ == '__main__':
+	unittest.main()
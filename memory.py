@@ -0,0 +1,151 @@
+'''
+Accounting of the memory used by the operators of queries.
+
+Operators which buffer rows charge the estimated size of the rows to their
+account in the memory tracker of their query and release it once the rows
+are no longer kept. Trackers reserve the memory from the buffer pool of the
+database in blocks, so the pool's capacity bounds the memory of all queries
+together, and raise MemoryLimitExceeded when a query would use more than its
+own limit or the pool has no memory left. Operators which can spill rows to
+disk do so, others let the error fail the query.
+'''
+
+import pickle
+import sys
+import tempfile
+import threading
+
+# Bytes reserved from the buffer pool at a time
+RESERVATION_SIZE = 64*1024
+# Size of a pointer to a row held in a list
+POINTER_SIZE = 8
+# Rows pickled together in a spill file
+SPILL_BATCH_ROWS = 1024
+
+class MemoryLimitExceeded(MemoryError):
+	pass
+
+def estimate_row_size(row):
+	'''
+	Estimates the bytes used by a row held in a list: the pointer to it, the
+	tuple and its values. None and booleans are shared by every row and are
+	not counted.
+	'''
+	size = POINTER_SIZE + sys.getsizeof(row)
+	for value in row:
+		if value != None and type(value) != bool:
+			size += sys.getsizeof(value)
+	return size
+
+class OperatorMemory:
+	def __init__(self, tracker):
+		'The memory charged by an operator to the tracker of its query.'
+		self.tracker = tracker
+		self.used = 0
+		self.rows = 0
+		self.peak = 0
+		self.peak_rows = 0
+
+	def charge(self, size, rows=1):
+		'''
+		Charges size bytes holding rows rows to the query. Raises
+		MemoryLimitExceeded if the memory is not available.
+		'''
+		self.tracker.charge(size)
+		self.used += size
+		self.rows += rows
+		self.peak = max(self.peak, self.used)
+		self.peak_rows = max(self.peak_rows, self.rows)
+
+	def release(self):
+		'Releases all the memory charged by the operator.'
+		self.tracker.release(self.used)
+		self.used = 0
+		self.rows = 0
+
+class UnlimitedMemory:
+	'''
+	The account of operators outside of a query, which neither limits nor
+	records their memory, so the operators sharing it do not affect each
+	other.
+	'''
+	used = 0
+	rows = 0
+	peak = 0
+	peak_rows = 0
+
+	def charge(self, size, rows=1):
+		pass
+
+	def release(self):
+		pass
+
+class MemoryTracker:
+	def __init__(self, limit=None, buffer_pool=None):
+		'''
+		Tracks the memory used by the operators of a query, which may use at
+		most limit bytes together, or any amount if limit is None. The memory
+		is reserved from buffer_pool if one is given and returned to it once
+		the operators have released all their memory.
+		'''
+		self.limit = limit
+		self.buffer_pool = buffer_pool
+		self.used = 0
+		self.peak = 0
+		self.reserved = 0
+		self.lock = threading.Lock()
+
+	def account(self):
+		'Returns a new account for an operator of the query.'
+		return OperatorMemory(self)
+
+	def charge(self, size):
+		with self.lock:
+			if self.limit != None and self.used + size > self.limit:
+				raise MemoryLimitExceeded(
+					'The query needs more than its memory limit of %d bytes'
+					% self.limit)
+			if self.buffer_pool != None and self.used + size > self.reserved:
+				amount = max(RESERVATION_SIZE,
+								self.used + size - self.reserved)
+				try:
+					self.buffer_pool.reserve(amount)
+				except MemoryError as e:
+					raise MemoryLimitExceeded(
+						'The database has no memory left for the query: %s'
+						% e)
+				self.reserved += amount
+			self.used += size
+			self.peak = max(self.peak, self.used)
+
+	def release(self, size):
+		with self.lock:
+			self.used -= size
+			if self.used == 0 and self.reserved:
+				self.buffer_pool.release(self.reserved)
+				self.reserved = 0
+
+class SpillFile:
+	def __init__(self, rows):
+		'''
+		Writes rows to a temporary file, which is deleted when the file is
+		closed.
+		'''
+		self.file = tempfile.TemporaryFile(prefix='spill')
+		for start in range(0, len(rows), SPILL_BATCH_ROWS):
+			pickle.dump(rows[start:start + SPILL_BATCH_ROWS], self.file,
+						pickle.HIGHEST_PROTOCOL)
+		self.file.flush()
+
+	def __iter__(self):
+		'Yields the rows of the file, reading a batch at a time.'
+		self.file.seek(0)
+		while True:
+			try:
+				rows = pickle.load(self.file)
+			except EOFError:
+				return
+			yield from rows
+
+	def close(self):
+		self.file.close()
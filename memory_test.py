@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+from memory import *
+import bufferpool
+import unittest
+
+class TestMemoryTracker(unittest.TestCase):
+	def test_row_sizes_should_grow_with_values(self):
+		self.assertGreater(estimate_row_size((1, 'a'*100)),
+			estimate_row_size((1, 'a')))
+		self.assertEqual(estimate_row_size((None, True)),
+			estimate_row_size((False, None)))
+
+	def test_should_fail_past_the_limit(self):
+		tracker = MemoryTracker(100)
+		account = tracker.account()
+		account.charge(60)
+		with self.assertRaisesRegex(MemoryLimitExceeded, '100 bytes'):
+			tracker.account().charge(50)
+		self.assertEqual(tracker.used, 60)
+		account.release()
+		tracker.account().charge(100)
+
+	def test_accounts_should_record_peaks(self):
+		tracker = MemoryTracker()
+		account = tracker.account()
+		account.charge(30)
+		account.charge(20, 2)
+		account.release()
+		account.charge(10)
+		self.assertEqual((account.peak, account.peak_rows), (50, 3))
+		self.assertEqual((account.used, account.rows), (10, 1))
+		self.assertEqual(tracker.peak, 50)
+
+	def test_should_reserve_from_the_buffer_pool(self):
+		pool = bufferpool.BufferPool(2*RESERVATION_SIZE)
+		tracker = MemoryTracker(buffer_pool=pool)
+		account = tracker.account()
+		account.charge(10)
+		self.assertEqual(pool.reserved, RESERVATION_SIZE)
+		account.charge(RESERVATION_SIZE)
+		self.assertEqual(pool.reserved, 2*RESERVATION_SIZE)
+		with self.assertRaisesRegex(MemoryLimitExceeded, 'no memory left'):
+			MemoryTracker(buffer_pool=pool).account().charge(1)
+		account.release()
+		self.assertEqual(pool.reserved, 0)
+
+	def test_unlimited_memory_should_keep_no_state(self):
+		account = UnlimitedMemory()
+		account.charge(2**40, 10)
+		account.release()
+		account.charge(10)
+		self.assertEqual((account.used, account.peak, account.peak_rows),
+			(0, 0, 0))
+
+class TestSpillFile(unittest.TestCase):
+	def test_should_read_rows_back(self):
+		rows = [(i, str(i)) for i in range(2*SPILL_BATCH_ROWS + 5)]
+		spill = SpillFile(rows)
+		try:
+			self.assertEqual(list(spill), rows)
+			self.assertEqual(list(spill), rows)
+		finally:
+			spill.close()
+
+if __name__ == '__main__':
+	unittest.main()
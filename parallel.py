@@ -0,0 +1,575 @@
+import bisect
+import collections
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import zlib
+
+import columnar
+import memory
+import relation
+
+# Number of rows processed by a worker at a time
+DEFAULT_MORSEL_ROWS = 16384
+# Number of tasks queued for each worker, so workers do not wait for the
+# next morsel while results are consumed
+TASKS_PER_WORKER = 2
+
+# Number of partitions of the groups of a parallel group by for each worker.
+# Having more partitions than workers lets workers which merged small
+# partitions take the remaining partitions.
+PARTITIONS_PER_WORKER = 4
+
+# Pipeline stages
+FILTER = 'filter'
+PROJECT = 'project'
+
+# A range of rows of a columnar file, which workers read from the file
+# themselves rather than receiving the rows
+MappedMorsel = collections.namedtuple('MappedMorsel',
+	['path', 'inode', 'start', 'end'])
+
+# Columnar files mapped by this worker process, by path and inode
+mapped_tables = {}
+
+def read_morsel(morsel):
+	'Returns the rows of a morsel in a worker process.'
+	if type(morsel) != MappedMorsel:
+		return morsel
+	key = (morsel.path, morsel.inode)
+	table = mapped_tables.get(key)
+	if table == None:
+		for other_key in [k for k in mapped_tables if k[0] == morsel.path]:
+			# The file has been replaced
+			mapped_tables.pop(other_key).close()
+		table = columnar.MappedRelation(morsel.path)
+		mapped_tables[key] = table
+	columns = [table.column(i) for i in range(len(table.columns))]
+	return list(zip(*[column.slice(morsel.start, morsel.end)
+						for column in columns]))
+
+def run_stages(rows, stages):
+	'Applies the filters and projections of a pipeline to a list of rows.'
+	for kind, argument in stages:
+		if kind == FILTER:
+			rows = [row for row in rows if argument.evaluate(row)]
+		else:
+			rows = [tuple([expression.evaluate(row)
+							for expression in argument]) for row in rows]
+	return rows
+
+def run_pipeline(morsel, stages):
+	return run_stages(read_morsel(morsel), stages)
+
+def partition_of(key, partition_count, seed=0):
+	'''
+	Returns the partition of a group key. Unlike hash, the partition is the
+	same in every process. Different seeds split keys independently.
+	'''
+	return zlib.crc32(repr(key).encode('utf-8'), seed) % partition_count
+
+def partition_path(directory, morsel_number, partition):
+	return os.path.join(directory, '%d.%d' % (morsel_number, partition))
+
+def new_aggregates(factories):
+	return [factory.new_aggregate() for factory in factories]
+
+def aggregate_morsel(numbered_morsel, stages, grouping_indexes, factories,
+		partition_count, directory):
+	'''
+	Aggregates the rows of a morsel by group in a worker process. The
+	serialized aggregate states of the groups of each partition are written
+	to a file in the directory, so they are exchanged between workers
+	without passing through the coordinating process. Returns the number of
+	groups in each partition.
+	'''
+	morsel_number, morsel = numbered_morsel
+	groups = {}
+	for row in run_stages(read_morsel(morsel), stages):
+		key = tuple([row[i] for i in grouping_indexes])
+		aggregates = groups.get(key)
+		if aggregates == None:
+			aggregates = groups[key] = new_aggregates(factories)
+		for aggregate in aggregates:
+			aggregate.update(row)
+	partitions = [{} for i in range(partition_count)]
+	for key, aggregates in groups.items():
+		partitions[partition_of(key, partition_count)][key] = [
+			aggregate.serialize() for aggregate in aggregates]
+	for partition, states in enumerate(partitions):
+		if states:
+			with open(partition_path(directory, morsel_number, partition),
+					'wb') as f:
+				pickle.dump(states, f, pickle.HIGHEST_PROTOCOL)
+	return [len(states) for states in partitions]
+
+def merge_partition(task, factories):
+	'''
+	Merges the aggregate states of the groups of a partition written by
+	aggregate_morsel in a worker process. A large partition is merged by
+	several tasks, each merging the groups whose keys fall in its split.
+	Returns a row for each group.
+	'''
+	paths, split, split_count = task
+	groups = {}
+	for path in paths:
+		with open(path, 'rb') as f:
+			partial = pickle.load(f)
+		for key, states in partial.items():
+			if split_count > 1 and partition_of(key, split_count, 1) != split:
+				continue
+			aggregates = groups.get(key)
+			for i, state in enumerate(states):
+				aggregate = factories[i].new_aggregate()
+				aggregate.deserialize(state)
+				if aggregates == None:
+					states[i] = aggregate
+				else:
+					aggregates[i].merge(aggregate)
+			if aggregates == None:
+				groups[key] = states
+	return [key + tuple([aggregate.final() for aggregate in aggregates])
+			for key, aggregates in groups.items()]
+
+# How a parallel sort orders rows: the indexes of the sort key columns or
+# None to sort by every column, and the descending and nulls_last options of
+# Sort
+SortOrder = collections.namedtuple('SortOrder',
+	['key_indexes', 'descending', 'nulls_last'])
+
+def order_key(order):
+	'''
+	Returns a key function ordering sort keys like Sort. Descending order
+	reverses the comparison rather than the sort, which keeps rows with equal
+	keys in input order like the reversed sort of Sort does.
+	'''
+	direction = -1 if order.descending else 1
+	return functools.cmp_to_key(lambda lhs, rhs:
+		direction*relation.compare_tuples(lhs, rhs, order.nulls_last))
+
+def sort_key_of(order):
+	'Returns a function extracting the sort key of a row.'
+	if order.key_indexes == None:
+		return lambda row: row
+	return lambda row: [row[i] for i in order.key_indexes]
+
+def row_key(order):
+	'Returns a key function ordering rows like Sort.'
+	key = order_key(order)
+	sort_key = sort_key_of(order)
+	return lambda row: key(sort_key(row))
+
+def run_path(directory, morsel_number):
+	return os.path.join(directory, '%d.run' % morsel_number)
+
+def write_rows(path, rows):
+	with open(path, 'wb') as f:
+		pickle.dump(rows, f, pickle.HIGHEST_PROTOCOL)
+
+def read_rows(path):
+	with open(path, 'rb') as f:
+		return pickle.load(f)
+
+def sort_morsel(numbered_morsel, stages, order, sample_count, directory):
+	'''
+	Sorts the rows of a morsel into a run written to a file in a worker
+	process. Returns the number of rows and the sort keys of sample_count
+	rows evenly spaced in the run, from which the ranges of the partitions
+	are chosen.
+	'''
+	morsel_number, morsel = numbered_morsel
+	rows = run_stages(read_morsel(morsel), stages)
+	rows.sort(key=row_key(order))
+	if rows:
+		write_rows(run_path(directory, morsel_number), rows)
+	sort_key = sort_key_of(order)
+	samples = [sort_key(rows[(i*len(rows))//sample_count])
+				for i in range(sample_count)] if rows else []
+	return len(rows), samples
+
+def choose_splitters(samples, partition_count, order):
+	'''
+	Returns the sort keys separating the ranges of the partitions, which are
+	evenly spaced in the sorted samples. Partition i holds the rows whose
+	keys are greater than splitter i - 1 and at most splitter i, so rows
+	with equal keys are always in the same partition. Repeated splitters and
+	splitters equal to the largest sample are dropped, leaving fewer
+	partitions when the keys have few values.
+	'''
+	key = order_key(order)
+	samples = sorted(samples, key=key)
+	splitters = []
+	if not samples:
+		return splitters
+	for partition in range(1, partition_count):
+		splitter = samples[(partition*len(samples))//partition_count]
+		if not key(splitter) < key(samples[-1]):
+			break
+		if not splitters or key(splitters[-1]) < key(splitter):
+			splitters.append(splitter)
+	return splitters
+
+def partition_run(morsel_number, order, splitters, directory):
+	'''
+	Splits a sorted run between the partitions in a worker process, writing
+	the rows of each partition to a file. Returns the number of rows in each
+	partition.
+	'''
+	path = run_path(directory, morsel_number)
+	rows = read_rows(path)
+	os.remove(path)
+	key = order_key(order)
+	run_key = row_key(order)
+	bounds = [bisect.bisect_right(rows, key(splitter), key=run_key)
+				for splitter in splitters]
+	counts = []
+	for partition, (start, end) in enumerate(zip([0] + bounds,
+													bounds + [len(rows)])):
+		if end > start:
+			write_rows(partition_path(directory, morsel_number, partition),
+						rows[start:end])
+		counts.append(end - start)
+	return counts
+
+def merge_files(paths, order):
+	'''
+	Yields the rows of the sorted runs in the files in order, with rows with
+	equal keys in the order of the files.
+	'''
+	return heapq.merge(*[read_rows(path) for path in paths],
+						key=row_key(order))
+
+def merge_runs(paths, order):
+	'Merges sorted runs in a worker process and returns the rows in order.'
+	return list(merge_files(paths, order))
+
+def table_morsels(table, morsel_rows):
+	'''
+	Yields the morsels of a table, which are either the rows of the morsel
+	or a MappedMorsel for tables read from columnar files.
+	'''
+	if type(table) == columnar.MappedRelation:
+		inode = os.fstat(table.file.fileno()).st_ino
+		for start in range(0, table.row_count, morsel_rows):
+			yield MappedMorsel(table.path, inode, start,
+								min(start + morsel_rows, table.row_count))
+	elif type(table) == relation.MaterialRelation:
+		rows = table.rows
+		for start in range(0, len(rows), morsel_rows):
+			yield rows[start:start + morsel_rows]
+	else:
+		rows = iter(table)
+		while True:
+			morsel = list(itertools.islice(rows, morsel_rows))
+			if not morsel:
+				return
+			yield morsel
+
+class ParallelExecutor:
+	def __init__(self, workers=None, morsel_rows=DEFAULT_MORSEL_ROWS):
+		'''
+		Runs tasks on morsels of rows in a pool of worker processes. The
+		workers are started when first needed and reused by later queries.
+		'''
+		self.workers = workers or os.cpu_count()
+		self.morsel_rows = morsel_rows
+		self.pool = None
+		self.lock = threading.Lock()
+
+	def get_pool(self):
+		with self.lock:
+			if self.pool == None:
+				# Worker processes are not forked since the database may
+				# have threads holding locks
+				self.pool = concurrent.futures.ProcessPoolExecutor(
+					self.workers, multiprocessing.get_context('spawn'))
+			return self.pool
+
+	def map(self, function, morsels, *args, ordered=True):
+		'''
+		Calls function(morsel, *args) for each morsel in the worker processes
+		and yields the results, in the order of the morsels if ordered is
+		true or as they are completed otherwise. Morsels are taken from the
+		iterable as workers become free.
+		'''
+		pool = self.get_pool()
+		window = self.workers*TASKS_PER_WORKER
+		pending = collections.deque() if ordered else set()
+		try:
+			for morsel in morsels:
+				if len(pending) >= window:
+					if ordered:
+						yield pending.popleft().result()
+					else:
+						done, pending = concurrent.futures.wait(pending,
+							return_when=concurrent.futures.FIRST_COMPLETED)
+						for future in done:
+							yield future.result()
+				future = pool.submit(function, morsel, *args)
+				if ordered:
+					pending.append(future)
+				else:
+					pending.add(future)
+			if ordered:
+				while pending:
+					yield pending.popleft().result()
+			else:
+				for future in concurrent.futures.as_completed(pending):
+					yield future.result()
+				pending = ()
+		finally:
+			# The consumer stopped early or a task failed
+			for future in pending:
+				future.cancel()
+
+	def close(self):
+		with self.lock:
+			if self.pool != None:
+				self.pool.shutdown(cancel_futures=True)
+				self.pool = None
+
+def split_pipeline(node):
+	'''
+	Returns the table at the bottom of a chain of selections and projections
+	and the stages applied to its rows, first to last, or None if the
+	relation is not such a chain. A table is a chain without stages.
+	'''
+	stages = []
+	while type(node) in (relation.Selection, relation.GeneralizedProjection):
+		if type(node) == relation.Selection:
+			stages.append((FILTER, node.predicate))
+		else:
+			stages.append((PROJECT, node.expressions))
+		node = node.relation
+	if node.inputs:
+		return None
+	stages.reverse()
+	return node, stages
+
+def fuse(node):
+	'Returns the result of split_pipeline if the chain has any stages.'
+	pipeline = split_pipeline(node)
+	if pipeline == None or not pipeline[1]:
+		return None
+	return pipeline
+
+class ParallelOperator(relation.Relation):
+	def set_token(self, token):
+		'''
+		Parallel operators have no inputs but check the token of their query
+		between morsels.
+		'''
+		self.token = token
+
+	def set_memory(self, tracker):
+		self.memory = tracker.account()
+
+class ParallelPipeline(ParallelOperator):
+	def __init__(self, plan, executor, ordered=True):
+		'''
+		Produces the rows of a chain of selections and projections of a table
+		by running the chain on morsels of the table in parallel. Rows are in
+		the order of the table if ordered is true.
+		'''
+		super().__init__(plan.columns)
+		self.plan = plan
+		self.table, self.stages = fuse(plan)
+		self.executor = executor
+		self.ordered = ordered
+		if ordered:
+			self.ordering = plan.ordering
+
+	def __iter__(self):
+		morsels = table_morsels(self.table, self.executor.morsel_rows)
+		for rows in self.executor.map(run_pipeline, morsels, self.stages,
+										ordered=self.ordered):
+			self.token.check()
+			yield from rows
+
+class ParallelGroupBy(ParallelOperator):
+	def __init__(self, plan, executor):
+		'''
+		Produces the rows of a GroupBy of a chain of selections and
+		projections of a table in two phases. Workers first aggregate morsels
+		of the table by group, writing the states of each partition of the
+		group keys to a file. Workers then merge the files of each partition,
+		with partitions holding many more groups than the others split
+		between several workers. Rows are produced in the order of the
+		grouping columns like GroupBy.
+		'''
+		super().__init__(plan.columns)
+		self.plan = plan
+		# The input of a GroupBy is sorted by the grouping columns
+		self.table, self.stages = split_pipeline(plan.relation.relation)
+		self.grouping_indexes = [column.index
+									for column in plan.grouping_columns]
+		self.aggregates = plan.aggregates
+		self.executor = executor
+		self.partition_count = executor.workers*PARTITIONS_PER_WORKER
+		self.ordering = plan.ordering
+
+	def merge_tasks(self, directory, morsel_counts):
+		'''
+		Returns the (paths, split, split_count) merge tasks for the
+		partitions, given the group counts of each morsel's partitions.
+		Partitions with many more groups than the average are split so that
+		several workers merge them, and the largest tasks are listed first.
+		'''
+		partitions = []
+		for partition in range(self.partition_count):
+			paths = []
+			group_count = 0
+			for morsel_number, counts in morsel_counts.items():
+				if counts[partition]:
+					paths.append(partition_path(directory, morsel_number,
+												partition))
+					group_count += counts[partition]
+			if paths:
+				partitions.append((group_count, paths))
+		if not partitions:
+			return []
+		average = sum(count for count, paths in partitions)/len(partitions)
+		tasks = []
+		for group_count, paths in partitions:
+			split_count = min(self.executor.workers,
+								max(1, round(group_count/average)))
+			for split in range(split_count):
+				tasks.append((group_count/split_count, (paths, split,
+														split_count)))
+		tasks.sort(key=lambda task: task[0], reverse=True)
+		return [task for size, task in tasks]
+
+	def __iter__(self):
+		'''
+		Merges the groups in worker processes and sorts them, charging the
+		groups to the query's memory. Queries without enough memory for the
+		groups fail.
+		'''
+		morsels = enumerate(table_morsels(self.table,
+											self.executor.morsel_rows))
+		directory = tempfile.mkdtemp(prefix='groupby')
+		account = self.memory
+		try:
+			morsel_counts = {}
+			counts = self.executor.map(aggregate_morsel, morsels,
+				self.stages, self.grouping_indexes, self.aggregates,
+				self.partition_count, directory, ordered=True)
+			for morsel_number, partition_counts in enumerate(counts):
+				self.token.check()
+				morsel_counts[morsel_number] = partition_counts
+			rows = []
+			for partition_rows in self.executor.map(merge_partition,
+					self.merge_tasks(directory, morsel_counts),
+					self.aggregates, ordered=False):
+				self.token.check()
+				account.charge(sum(map(memory.estimate_row_size,
+										partition_rows)), len(partition_rows))
+				rows.extend(partition_rows)
+			shutil.rmtree(directory)
+			directory = None
+			key_length = len(self.grouping_indexes)
+			rows.sort(key=functools.cmp_to_key(lambda lhs, rhs:
+				relation.compare_tuples(lhs[:key_length], rhs[:key_length],
+										True)))
+			yield from rows
+		finally:
+			if directory != None:
+				shutil.rmtree(directory)
+			account.release()
+
+class ParallelSort(ParallelOperator):
+	def __init__(self, plan, executor):
+		'''
+		Produces the rows of a Sort of a chain of selections and projections
+		of a table in the same order as the Sort. Workers sort morsels of the
+		table into runs and sample their keys. The coordinator chooses
+		splitters from the samples which divide the range of keys into
+		partitions, workers split each run between the partitions and then
+		merge the pieces of each partition independently. Partitions are
+		produced one after another. Without splitters, because there is one
+		worker or the keys have one value, the coordinator merges the runs
+		itself.
+		'''
+		super().__init__(plan.columns)
+		self.plan = plan
+		self.table, self.stages = split_pipeline(plan.relation)
+		key_indexes = None
+		if plan.sort_key:
+			key_indexes = [column.index for column in plan.sort_key]
+		self.order = SortOrder(key_indexes, plan.descending, plan.nulls_last)
+		self.executor = executor
+		self.partition_count = executor.workers*PARTITIONS_PER_WORKER
+		if executor.workers == 1:
+			self.partition_count = 1
+		self.ordering = plan.ordering
+
+	def __iter__(self):
+		morsels = enumerate(table_morsels(self.table,
+											self.executor.morsel_rows))
+		directory = tempfile.mkdtemp(prefix='sort')
+		try:
+			runs = []
+			samples = []
+			for morsel_number, (row_count, run_samples) in enumerate(
+					self.executor.map(sort_morsel, morsels, self.stages,
+						self.order, self.partition_count, directory)):
+				self.token.check()
+				if row_count:
+					runs.append(morsel_number)
+				samples.extend(run_samples)
+			splitters = choose_splitters(samples, self.partition_count,
+											self.order)
+			if not splitters:
+				runs = merge_files([run_path(directory, run) for run in runs],
+									self.order)
+				yield from self.token.checked(runs)
+				return
+			run_counts = list(self.executor.map(partition_run, runs,
+									self.order, splitters, directory))
+			tasks = []
+			for partition in range(len(splitters) + 1):
+				tasks.append([partition_path(directory, run, partition)
+							for run, counts in zip(runs, run_counts)
+							if counts[partition]])
+			for rows in self.executor.map(merge_runs, tasks, self.order):
+				self.token.check()
+				yield from rows
+		finally:
+			shutil.rmtree(directory)
+
+def parallelize(node, executor, ordered=True):
+	'''
+	Replaces chains of selections and projections of tables with at least
+	two morsels of rows with ParallelPipelines, and group bys and sorts of
+	such chains with ParallelGroupBys and ParallelSorts. Rows are only kept
+	in order where the operator consuming them depends on their order.
+	'''
+	def is_large(pipeline):
+		table, stages = pipeline
+		return getattr(table, 'row_count', 0) >= 2*executor.morsel_rows
+	if type(node) == relation.GroupBy:
+		pipeline = split_pipeline(node.relation.relation)
+		if pipeline != None and is_large(pipeline):
+			return ParallelGroupBy(node, executor)
+	if type(node) == relation.Sort and not node.presorted:
+		pipeline = split_pipeline(node.relation)
+		if pipeline != None and is_large(pipeline):
+			return ParallelSort(node, executor)
+	fused = fuse(node)
+	if fused != None:
+		if not is_large(fused):
+			return node
+		return ParallelPipeline(node, executor, ordered)
+	# Sorts reorder their input unless it is already sorted
+	input_ordered = not (type(node) == relation.Sort and not node.presorted)
+	for name in node.inputs:
+		setattr(node, name,
+				parallelize(getattr(node, name), executor, input_ordered))
+	return node
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+from parallel import *
+from relation import *
+import columnar
+import encoding
+import memory
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import zlib
+
+class TestParallelPipeline(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.executor = ParallelExecutor(2, morsel_rows=100)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.executor.close()
+
+	def setUp(self):
+		self.table = MaterialRelation([Column('a', int, False),
+										Column('b', str)], 't')
+		self.table.load([(i, None if i % 3 else 'row %d' % i)
+							for i in range(1050)])
+
+	def pipeline(self, table):
+		a = Attribute(table.columns[0])
+		selection = Selection(table, Comparison('>', Cast(
+			Arithmetic('%', a, Constant(7)), str), Constant('3')))
+		return GeneralizedProjection(selection,
+			[Arithmetic('*', a, Constant(2)), Attribute(table.columns[1])])
+
+	def test_fuse_should_find_table_and_stages(self):
+		plan = self.pipeline(self.table)
+		table, stages = fuse(plan)
+		self.assertIs(table, self.table)
+		self.assertEqual([kind for kind, argument in stages], [FILTER, PROJECT])
+		self.assertIsNone(fuse(self.table))
+		self.assertIsNone(fuse(Selection(Sort(self.table),
+			Comparison('>', Attribute(self.table.columns[0]), Constant(1)))))
+
+	def test_should_produce_rows_in_order(self):
+		plan = self.pipeline(self.table)
+		expected = list(plan)
+		self.assertEqual(list(ParallelPipeline(plan, self.executor)),
+			expected)
+		unordered = ParallelPipeline(plan, self.executor, ordered=False)
+		self.assertEqual(sorted(unordered, key=repr), sorted(expected, key=repr))
+
+	def test_workers_should_read_columnar_files(self):
+		directory = tempfile.mkdtemp()
+		try:
+			path = os.path.join(directory, 't.col')
+			columnar.write(path, self.table)
+			mapped = columnar.MappedRelation(path)
+			plan = self.pipeline(mapped)
+			self.assertIsInstance(next(table_morsels(mapped, 100)), MappedMorsel)
+			self.assertEqual(list(ParallelPipeline(plan, self.executor)),
+				list(self.pipeline(self.table)))
+			mapped.close()
+		finally:
+			shutil.rmtree(directory)
+
+	def test_other_tables_should_be_read_in_morsels(self):
+		encoded = encoding.EncodedRelation(self.table)
+		self.assertEqual(list(ParallelPipeline(self.pipeline(encoded),
+			self.executor)), list(self.pipeline(self.table)))
+
+	def test_workers_should_be_reused(self):
+		list(ParallelPipeline(self.pipeline(self.table), self.executor))
+		pool = self.executor.pool
+		list(ParallelPipeline(self.pipeline(self.table), self.executor))
+		self.assertIs(self.executor.pool, pool)
+
+	def test_errors_should_be_raised(self):
+		a = Attribute(self.table.columns[0])
+		plan = GeneralizedProjection(self.table,
+			[Arithmetic('/', Constant(1), Arithmetic('-', a, Constant(500)))])
+		with self.assertRaises(ZeroDivisionError):
+			list(ParallelPipeline(plan, self.executor))
+
+	def test_parallelize_should_keep_order_only_when_needed(self):
+		plan = self.pipeline(self.table)
+		parallel_plan = parallelize(plan, self.executor)
+		self.assertIsInstance(parallel_plan, ParallelPipeline)
+		self.assertTrue(parallel_plan.ordered)
+		sort = parallelize(Sort(self.pipeline(self.table)), self.executor)
+		self.assertIsInstance(sort, ParallelSort)
+		self.assertEqual(list(sort), list(Sort(plan)))
+		small = MaterialRelation(self.table.columns)
+		small.load(self.table.rows[:150])
+		self.assertIsInstance(parallelize(self.pipeline(small), self.executor),
+			GeneralizedProjection)
+
+	def group_by(self, input_relation, grouping_columns):
+		a = Attribute(input_relation.columns[0])
+		b = Attribute(input_relation.columns[1])
+		return GroupBy(input_relation, grouping_columns, [CountFactory(),
+			CountFactory(b), SumFactory(a), MinFactory(b), MaxFactory(a),
+			AvgFactory(a)])
+
+	def check_parallel_group_by(self, group_by):
+		expected = list(group_by)
+		parallel_group_by = parallelize(group_by, self.executor)
+		self.assertIsInstance(parallel_group_by, ParallelGroupBy)
+		self.assertEqual(list(parallel_group_by), expected)
+
+	def test_parallel_group_by_of_table(self):
+		self.assertEqual(split_pipeline(self.table), (self.table, []))
+		# Column b is null in two thirds of the rows
+		self.check_parallel_group_by(
+			self.group_by(self.table, [self.table.columns[1]]))
+		self.check_parallel_group_by(self.group_by(self.table, []))
+
+	def test_parallel_group_by_of_pipeline(self):
+		a = Attribute(self.table.columns[0])
+		selection = Selection(self.table,
+			Comparison('>', a, Constant(100)))
+		projection = GeneralizedProjection(selection,
+			[Arithmetic('%', a, Constant(13)), Attribute(self.table.columns[1])])
+		self.check_parallel_group_by(self.group_by(projection,
+			[projection.columns[1], projection.columns[0]]))
+		group_by = self.group_by(projection, [projection.columns[0]])
+		self.assertEqual(parallelize(group_by, self.executor).stages[0][0],
+			FILTER)
+
+	def test_parallel_group_by_should_split_large_partitions(self):
+		table = MaterialRelation([Column('k', int), Column('v', str)])
+		table.load([(i, 'x') for i in range(3000)])
+		group_by = parallelize(self.group_by(table, [table.columns[0]]),
+								self.executor)
+		counts = {0: [1000] + [1]*(group_by.partition_count - 1)}
+		tasks = group_by.merge_tasks('d', counts)
+		self.assertEqual([task[1:] for task in tasks[:2]], [(0, 2), (1, 2)])
+		self.assertEqual(len(tasks), group_by.partition_count + 1)
+		self.assertEqual(list(group_by),
+			list(self.group_by(table, [table.columns[0]])))
+
+	def test_parallel_group_by_should_fail_without_memory(self):
+		group_by = ParallelGroupBy(GroupBy(self.table,
+			[self.table.columns[1]], [CountFactory()]), self.executor)
+		tracker = memory.MemoryTracker(100)
+		group_by.set_memory(tracker)
+		with self.assertRaisesRegex(MemoryError, 'memory limit'):
+			list(group_by)
+		self.assertEqual(tracker.used, 0)
+
+	def test_empty_parallel_group_by(self):
+		selection = Selection(self.table, Comparison('<',
+			Attribute(self.table.columns[0]), Constant(0)))
+		self.check_parallel_group_by(self.group_by(selection, []))
+
+	def check_parallel_sort(self, sort):
+		expected = list(sort)
+		parallel_sort = parallelize(sort, self.executor)
+		self.assertIsInstance(parallel_sort, ParallelSort)
+		self.assertEqual(list(parallel_sort), expected)
+
+	def test_parallel_sort_should_match_sort(self):
+		# Rows with equal keys must stay in input order
+		table = MaterialRelation([Column('k', int), Column('v', int)])
+		table.load([(None if i % 11 == 0 else (i*7919) % 37, i)
+					for i in range(1050)])
+		for descending in (False, True):
+			for nulls_last in (False, True):
+				self.check_parallel_sort(Sort(table, [table.columns[0]],
+					descending, nulls_last))
+		self.check_parallel_sort(Sort(self.pipeline(self.table),
+			descending=True))
+
+	def test_parallel_sort_should_merge_unsplit_runs(self):
+		# Every key is equal, so there are no splitters
+		self.check_parallel_sort(Sort(self.table, [self.table.columns[1]]))
+		order = SortOrder([1], False, True)
+		self.assertEqual(choose_splitters([[None]]*8, 4, order), [])
+		self.assertEqual(choose_splitters([[i] for i in range(8)], 4, order),
+			[[2], [4], [6]])
+
+	def test_empty_parallel_sort(self):
+		selection = Selection(self.table, Comparison('<',
+			Attribute(self.table.columns[0]), Constant(0)))
+		self.check_parallel_sort(Sort(selection))
+
+	def test_cancelled_parallel_operators_should_stop(self):
+		plans = [ParallelPipeline(self.pipeline(self.table), self.executor),
+			ParallelSort(Sort(self.table), self.executor)]
+		for plan in plans:
+			token = CancellationToken()
+			plan.set_token(token)
+			token.cancel()
+			with self.assertRaises(QueryCancelled):
+				list(plan)
+
+	def test_partitions_should_not_depend_on_the_process(self):
+		self.assertEqual(partition_of(('a', None, 1), 1000),
+			zlib.crc32(b"('a', None, 1)") % 1000)
+
+	def test_expressions_should_be_picklable(self):
+		expression = Cast(Arithmetic('+', Attribute(self.table.columns[0]),
+							Constant(1)), str)
+		copy = pickle.loads(pickle.dumps(expression))
+		self.assertEqual(copy.evaluate((41, None)), '42')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,276 @@
+import itertools
+
+import index
+import relation
+import stats
+
+# Maps an operator to the operator with the operands swapped
+flipped_operators = stats.flipped_operators
+
+def is_table(node):
+	'Returns true if the relation is a table which may have indexes.'
+	return not node.inputs and hasattr(node, 'indexes')
+
+def equality_values(predicate, column):
+	'''
+	Returns the list of values the column must be equal to for the predicate
+	to be true or None if the predicate is not an equality test of the column.
+	'''
+	predicate_type = type(predicate)
+	if predicate_type == relation.Comparison and predicate.operator == '=':
+		lhs, rhs = predicate.lhs, predicate.rhs
+		if type(lhs) == relation.Constant:
+			lhs, rhs = rhs, lhs
+		if (type(lhs) == relation.Attribute and
+				type(rhs) == relation.Constant and
+				lhs.column.index == column.index):
+			return [] if rhs.value == None else [rhs.value]
+	elif predicate_type == relation.InList:
+		expression = predicate.expression
+		if (type(expression) == relation.Attribute and
+				expression.column.index == column.index):
+			return [value for value in predicate.values if value != None]
+	return None
+
+def range_bound(predicate, column):
+	'''
+	Returns the bounds (lower, lower_inclusive, upper, upper_inclusive) the
+	predicate places on the column or None if the predicate is not a range
+	comparison of the column with a constant.
+	'''
+	if type(predicate) != relation.Comparison:
+		return None
+	lhs, rhs, operator = predicate.lhs, predicate.rhs, predicate.operator
+	if type(lhs) == relation.Constant:
+		lhs, rhs, operator = rhs, lhs, flipped_operators[operator]
+	if not (type(lhs) == relation.Attribute and
+			type(rhs) == relation.Constant and
+			lhs.column.index == column.index and rhs.value != None):
+		return None
+	value = rhs.value
+	if operator == '=':
+		return (value, True, value, True)
+	if operator == '>':
+		return (value, False, None, True)
+	if operator == '>=':
+		return (value, True, None, True)
+	if operator == '<':
+		return (None, True, value, False)
+	if operator == '<=':
+		return (None, True, value, True)
+	return None
+
+def compared_column(predicate):
+	'''
+	Returns the column compared with a constant by the predicate or None if
+	the predicate is not a comparison of a column with a constant.
+	'''
+	if type(predicate) != relation.Comparison:
+		return None
+	lhs, rhs = predicate.lhs, predicate.rhs
+	if type(lhs) == relation.Constant:
+		lhs, rhs = rhs, lhs
+	if type(lhs) == relation.Attribute and type(rhs) == relation.Constant:
+		return lhs.column
+	return None
+
+def tighter_lower(current, bound):
+	if current[0] == None or bound[0] > current[0]:
+		return bound
+	if bound[0] == current[0] and not bound[1]:
+		return bound
+	return current
+
+def tighter_upper(current, bound):
+	if current[0] == None or bound[0] < current[0]:
+		return bound
+	if bound[0] == current[0] and not bound[1]:
+		return bound
+	return current
+
+def plan_range_scan(table, ordered_index, predicates):
+	'''
+	Returns an index range scan and the predicates it does not account for if
+	there are range predicates on the indexed column. Otherwise returns None.
+	Indexes on several columns do not index rows with a null in a later
+	column, which the predicates on the leading column would match, so only
+	indexes on a single column are used.
+	'''
+	if len(ordered_index.columns) != 1:
+		return None
+	column = ordered_index.columns[0]
+	lower, upper = (None, True), (None, True)
+	remaining = []
+	for predicate in predicates:
+		bound = range_bound(predicate, column)
+		if bound == None:
+			remaining.append(predicate)
+			continue
+		if bound[0] != None:
+			lower = tighter_lower(lower, bound[:2])
+		if bound[2] != None:
+			upper = tighter_upper(upper, bound[2:])
+	if len(remaining) == len(predicates):
+		return None
+	return index.IndexRangeScan(table, ordered_index, lower[0], lower[1],
+								upper[0], upper[1]), remaining
+
+def plan_hash_lookup(table, hash_index, predicates):
+	'''
+	Returns an index scan and the predicates it does not account for if there
+	is an equality predicate for each indexed column. Otherwise returns None.
+	'''
+	remaining = list(predicates)
+	column_values = []
+	for column in hash_index.columns:
+		for predicate in remaining:
+			values = equality_values(predicate, column)
+			if values != None:
+				column_values.append(values)
+				remaining.remove(predicate)
+				break
+		else:
+			return None
+	keys = list(itertools.product(*column_values))
+	return index.IndexScan(table, hash_index, keys), remaining
+
+def plan_index_scan(table, predicates):
+	'''
+	Returns the best index scan for the predicates and the predicates it does
+	not account for or None if no index applies.
+	'''
+	best = None
+	best_rows = None
+	for table_index in table.indexes.values():
+		plan = plan_hash_lookup(table, table_index, predicates)
+		if plan == None and table_index.method == 'ordered':
+			plan = plan_range_scan(table, table_index, predicates)
+		if plan == None:
+			continue
+		# Prefer the index expected to produce the fewest rows and then the
+		# one which accounts for the most predicates.
+		rows = stats.estimate_rows(plan[0])
+		if best == None or (rows, len(plan[1])) < (best_rows, len(best[1])):
+			best = plan
+			best_rows = rows
+	return best
+
+def plan_zone_map_scan(table, predicates):
+	'''
+	Returns a scan skipping the chunks of the table whose zone maps show the
+	predicates can not match or None if none of the predicates can be checked
+	against zone maps.
+	'''
+	bounds = {}
+	null_columns = []
+	for predicate in predicates:
+		predicate_type = type(predicate)
+		if (predicate_type == relation.IsNull and
+				type(predicate.expression) == relation.Attribute):
+			null_columns.append(predicate.expression.column.index)
+			continue
+		if (predicate_type == relation.InList and
+				type(predicate.expression) == relation.Attribute):
+			column = predicate.expression.column
+			values = [value for value in predicate.values if value != None]
+			if not values:
+				continue
+			bound = (min(values), True, max(values), True)
+		else:
+			column = compared_column(predicate)
+			if column == None:
+				continue
+			bound = range_bound(predicate, column)
+			if bound == None:
+				continue
+		lower, upper = bounds.get(column.index, ((None, True), (None, True)))
+		if bound[0] != None:
+			lower = tighter_lower(lower, bound[:2])
+		if bound[2] != None:
+			upper = tighter_upper(upper, bound[2:])
+		bounds[column.index] = (lower, upper)
+	if not (bounds or null_columns):
+		return None
+	ranges = {column_index: lower + upper
+				for column_index, (lower, upper) in bounds.items()}
+	return relation.ZoneMapScan(table, ranges, null_columns)
+
+def estimate_cost(expression):
+	'Returns the estimated cost of evaluating an expression, in operations.'
+	cost = 1
+	if type(expression) == relation.Cast and (
+			expression.expression.value_type() == str):
+		# Parsing strings costs more than other conversions
+		cost = 4
+	return cost + sum([estimate_cost(operand)
+						for operand in relation.operands(expression)])
+
+def junction_operands(predicate, junction_type):
+	'Returns the operands of a chain of ands or ors.'
+	if type(predicate) == junction_type:
+		return (junction_operands(predicate.lhs, junction_type) +
+				junction_operands(predicate.rhs, junction_type))
+	return [predicate]
+
+def order_predicate(predicate, column_statistics=lambda index: None):
+	'''
+	Returns the predicate with chains of ands and ors replaced by
+	conjunctions and disjunctions. Their operands are ordered by estimated
+	cost per row decided, the rows an and operand is false for or an or
+	operand is true for, so cheap selective operands are evaluated first.
+	Operands which can raise errors keep their written position.
+	column_statistics is passed to stats.estimate_selectivity.
+	'''
+	predicate_type = type(predicate)
+	if predicate_type == relation.And:
+		junction_type = relation.Conjunction
+	elif predicate_type == relation.Or:
+		junction_type = relation.Disjunction
+	else:
+		return predicate
+	operands = [order_predicate(operand, column_statistics) for operand in
+				junction_operands(predicate, predicate_type)]
+	def rank(operand):
+		decided = stats.estimate_selectivity(operand, column_statistics)
+		if junction_type == relation.Conjunction:
+			decided = 1 - decided
+		return estimate_cost(operand)/max(decided, 0.001)
+	# Operands which can raise errors stay after the operands guarding them
+	order = relation.guarded_order([rank(operand) for operand in operands],
+		[relation.can_raise(operand) for operand in operands])
+	return junction_type([operands[i] for i in order])
+
+def ordered_selection(input_relation, predicate, table):
+	'''
+	Returns a selection with the predicate ordered using the statistics of
+	the table the input rows come from.
+	'''
+	column_statistics = lambda index: None
+	if getattr(table, 'statistics', None) != None:
+		column_statistics = table.statistics.column
+	return relation.Selection(input_relation,
+		order_predicate(predicate, column_statistics))
+
+def plan_selection(input_relation, predicate):
+	'''
+	Returns a relation with the rows of the input relation meeting the
+	predicate. When the input is a table, an index is used if one applies
+	and otherwise chunks which can not match are skipped using zone maps.
+	'''
+	if not is_table(input_relation):
+		return ordered_selection(input_relation, predicate, None)
+	predicates = relation.conjuncts(predicate)
+	plan = None
+	if input_relation.indexes:
+		plan = plan_index_scan(input_relation, predicates)
+	if plan != None:
+		scan, remaining = plan
+		if not remaining:
+			return scan
+		return ordered_selection(scan, relation.conjunction(remaining),
+									input_relation)
+	if len(getattr(input_relation, 'zone_maps', ())) > 1:
+		scan = plan_zone_map_scan(input_relation, predicates)
+		if scan != None:
+			return ordered_selection(scan, predicate, input_relation)
+	return ordered_selection(input_relation, predicate, input_relation)
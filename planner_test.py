@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+from index import create_index, IndexScan, IndexRangeScan
+from planner import *
+from relation import *
+import stats
+import unittest
+
+class TestPlanSelection(unittest.TestCase):
+	def setUp(self):
+		self.table = MaterialRelation([Column('a', int), Column('b', str)],
+			name='t')
+		for i in range(10):
+			self.table.insert((i % 5, str(i)))
+		self.a = Attribute(self.table.columns[0])
+		self.b = Attribute(self.table.columns[1])
+
+	def test_should_scan_table_without_index(self):
+		plan = plan_selection(self.table,
+			Comparison('=', self.a, Constant(1)))
+		self.assertEqual(type(plan), Selection)
+
+	def test_should_use_index_for_equality(self):
+		create_index('t_a', self.table, ['a'])
+		plan = plan_selection(self.table,
+			Comparison('=', Constant(1), self.a))
+		self.assertEqual(type(plan), IndexScan)
+		self.assertEqual(list(plan), [(1, '1'), (1, '6')])
+
+	def test_should_use_index_for_in_list(self):
+		create_index('t_a', self.table, ['a'])
+		plan = plan_selection(self.table, InList(self.a, [4, None, 0]))
+		self.assertEqual(type(plan), IndexScan)
+		self.assertEqual(list(plan), [(0, '0'), (4, '4'), (0, '5'), (4, '9')])
+
+	def test_should_keep_remaining_predicates(self):
+		create_index('t_a', self.table, ['a'])
+		plan = plan_selection(self.table, And(
+			Comparison('=', self.b, Constant('6')),
+			Comparison('=', self.a, Constant(1))))
+		self.assertEqual(type(plan), Selection)
+		self.assertEqual(type(plan.relation), IndexScan)
+		self.assertEqual(list(plan), [(1, '6')])
+
+	def test_should_require_all_index_columns(self):
+		create_index('t_a_b', self.table, ['a', 'b'])
+		plan = plan_selection(self.table, Comparison('=', self.a, Constant(1)))
+		self.assertEqual(type(plan), Selection)
+
+		plan = plan_selection(self.table, And(
+			Comparison('=', self.b, Constant('6')),
+			InList(self.a, [1, 2])))
+		self.assertEqual(type(plan), IndexScan)
+		self.assertEqual(list(plan), [(1, '6')])
+
+	def test_should_not_use_index_for_disjunction(self):
+		create_index('t_a', self.table, ['a'])
+		plan = plan_selection(self.table, Or(
+			Comparison('=', self.a, Constant(1)),
+			Comparison('=', self.b, Constant('2'))))
+		self.assertEqual(type(plan), Selection)
+
+class TestOrderPredicate(unittest.TestCase):
+	def setUp(self):
+		self.a = Attribute(Column('a', int, index=0))
+		self.b = Attribute(Column('b', str, index=1))
+
+	def test_should_flatten_chains(self):
+		predicates = [Comparison('>', self.a, Constant(i)) for i in range(3)]
+		predicate = order_predicate(Or(And(predicates[0], predicates[1]),
+			Or(predicates[2], predicates[0])))
+		self.assertEqual(type(predicate), Disjunction)
+		self.assertEqual(len(predicate.operands), 3)
+		conjunction = [p for p in predicate.operands if type(p) == Conjunction]
+		self.assertEqual(conjunction[0].operands, predicates[:2])
+
+	def test_should_order_by_cost_and_selectivity(self):
+		equality = Comparison('=', self.a, Constant(1))
+		inequality = Comparison('<>', self.a, Constant(1))
+		costly = Comparison('=', Arithmetic('+', self.a,
+			Arithmetic('*', self.a, self.a)), Constant(1))
+		predicate = order_predicate(And(And(inequality, costly), equality))
+		self.assertEqual(predicate.operands, [equality, costly, inequality])
+		predicate = order_predicate(Or(equality, inequality))
+		self.assertEqual(predicate.operands, [inequality, equality])
+
+	def test_should_keep_operands_which_can_raise_in_place(self):
+		guard = Comparison('<>', self.a, Constant(0))
+		division = Comparison('>', Arithmetic('/', Constant(10), self.a),
+			Constant(2))
+		cast = Comparison('=', Cast(self.b, int), Constant(1))
+		equality = Comparison('=', self.a, Constant(1))
+		predicate = order_predicate(And(And(And(guard, division), cast),
+			equality))
+		self.assertEqual(predicate.operands, [guard, division, cast, equality])
+		predicate = order_predicate(Or(Comparison('=', self.a, Constant(0)),
+			division))
+		self.assertEqual(predicate.operands[1], division)
+
+	def test_selections_should_order_with_table_statistics(self):
+		table = MaterialRelation([Column('a', int), Column('b', str)], 't')
+		table.load([(i % 2, str(i)) for i in range(100)])
+		table.statistics = stats.analyze(table)
+		a = Attribute(table.columns[0])
+		b = Attribute(table.columns[1])
+		common = Comparison('=', a, Constant(1))
+		rare = Comparison('=', b, Constant('7'))
+		plan = plan_selection(table, And(common, rare))
+		self.assertEqual(plan.predicate.operands, [rare, common])
+		self.assertEqual(list(plan), [(1, '7')])
+
+class TestPlanRangeScan(unittest.TestCase):
+	def setUp(self):
+		self.table = MaterialRelation([Column('ts', int), Column('v', str)],
+			name='t')
+		for i in [5, 1, 9, 3, None, 7]:
+			self.table.insert((i, str(i)))
+		self.ts = Attribute(self.table.columns[0])
+		create_index('t_ts', self.table, ['ts'], 'ordered')
+
+	def test_should_combine_range_predicates(self):
+		plan = plan_selection(self.table, And(And(
+			Comparison('>=', self.ts, Constant(1)),
+			Comparison('<', self.ts, Constant(9))),
+			Comparison('>', Constant(7), self.ts)))
+		self.assertEqual(type(plan), IndexRangeScan)
+		self.assertEqual((plan.lower, plan.lower_inclusive), (1, True))
+		self.assertEqual((plan.upper, plan.upper_inclusive), (7, False))
+		self.assertEqual([row[0] for row in plan], [1, 3, 5])
+
+	def test_exclusive_bound_should_win_ties(self):
+		plan = plan_selection(self.table, And(
+			Comparison('>=', self.ts, Constant(3)),
+			Comparison('>', self.ts, Constant(3))))
+		self.assertEqual((plan.lower, plan.lower_inclusive), (3, False))
+
+	def test_should_keep_other_predicates_and_ordering(self):
+		plan = plan_selection(self.table, And(
+			Comparison('>', self.ts, Constant(1)),
+			Comparison('<>', Attribute(self.table.columns[1]), Constant('5'))))
+		self.assertEqual(type(plan), Selection)
+		self.assertEqual(type(plan.relation), IndexRangeScan)
+		self.assertEqual([c.name for c in plan.ordering], ['ts'])
+		self.assertEqual([row[0] for row in plan], [3, 7, 9])
+
+	def test_sort_should_skip_ordered_input(self):
+		plan = plan_selection(self.table,
+			Comparison('>', self.ts, Constant(1)))
+		self.assertTrue(Sort(plan, [self.table.columns[0]]).presorted)
+		self.assertFalse(Sort(plan, [self.table.columns[1]]).presorted)
+		self.assertFalse(
+			Sort(plan, [self.table.columns[0]], descending=True).presorted)
+		group_by = GroupBy(plan, [self.table.columns[0]], [CountFactory()])
+		self.assertTrue(group_by.relation.presorted)
+		self.assertEqual(list(group_by), [(3, 1), (5, 1), (7, 1), (9, 1)])
+
+	def test_should_not_use_index_missing_rows_with_nulls(self):
+		table = MaterialRelation([Column('a', int), Column('b', int)],
+			name='t')
+		for row in [(5, None), (6, 2), (7, None)]:
+			table.insert(row)
+		create_index('t_a_b', table, ['a', 'b'], 'btree')
+		a = Attribute(table.columns[0])
+		plan = plan_selection(table, Comparison('>=', a, Constant(5)))
+		self.assertNotEqual(type(plan), IndexRangeScan)
+		self.assertEqual(list(plan), [(5, None), (6, 2), (7, None)])
+		plan = plan_selection(table, Comparison('=', a, Constant(5)))
+		self.assertEqual(list(plan), [(5, None)])
+
+	def test_should_prefer_equality_lookup(self):
+		create_index('t_v', self.table, ['v'])
+		plan = plan_selection(self.table, And(
+			Comparison('>', self.ts, Constant(1)),
+			Comparison('=', Attribute(self.table.columns[1]), Constant('5'))))
+		self.assertEqual(type(plan.relation), IndexScan)
+		self.assertEqual(list(plan), [(5, '5')])
+
+class TestPlanZoneMapScan(unittest.TestCase):
+	def setUp(self):
+		self.table = MaterialRelation([Column('ts', int), Column('v', str)],
+			name='t', chunk_size=10)
+		for i in range(100):
+			self.table.insert((i, None if i == 95 else str(i)))
+		self.ts = Attribute(self.table.columns[0])
+		self.v = Attribute(self.table.columns[1])
+
+	def test_should_skip_chunks_for_range(self):
+		predicate = And(Comparison('>=', self.ts, Constant(35)),
+						Comparison('<', Constant(45), self.ts))
+		plan = plan_selection(self.table, predicate)
+		self.assertEqual(type(plan.relation), ZoneMapScan)
+		self.assertEqual(plan.relation.ranges, {0: (45, False, None, True)})
+		self.assertEqual([row[0] for row in plan], list(range(46, 100)))
+		self.assertEqual(plan.relation.chunks_skipped, 4)
+
+	def test_should_skip_chunks_for_in_list_and_null_test(self):
+		plan = plan_selection(self.table, InList(self.ts, [3, 17]))
+		self.assertEqual([row[0] for row in plan], [3, 17])
+		self.assertEqual(plan.relation.chunks_read, 2)
+
+		plan = plan_selection(self.table, IsNull(self.v))
+		self.assertEqual(list(plan), [(95, None)])
+		self.assertEqual(plan.relation.chunks_read, 1)
+
+	def test_should_not_use_zone_maps_without_usable_predicates(self):
+		plan = plan_selection(self.table, Or(
+			Comparison('=', self.ts, Constant(1)),
+			Comparison('=', self.ts, Constant(2))))
+		self.assertIs(plan.relation, self.table)
+
+	def test_should_prefer_index(self):
+		create_index('t_ts', self.table, ['ts'], 'ordered')
+		plan = plan_selection(self.table, Comparison('>', self.ts, Constant(1)))
+		self.assertEqual(type(plan), IndexRangeScan)
+
+if __name__ == '__main__':
+	unittest.main()
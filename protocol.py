@@ -0,0 +1,114 @@
+'''
+Messages exchanged by the query server and its clients. Every message is a
+JSON object preceded by its length as a 4 byte big endian integer.
+
+A client sends execute, ping and close requests with an id which is
+repeated in the responses to the request, so requests can be sent before the
+responses to earlier ones arrive. The server answers each request in the
+order they were sent. A query is answered with a description of its columns,
+batches of rows and a done message, and a statement without a result with
+just a done message.
+'''
+
+import asyncio
+import json
+import struct
+
+MESSAGE_HEADER = struct.Struct('>I')
+MAX_MESSAGE_SIZE = 64*1024*1024
+
+# Request types
+EXECUTE = 'execute'
+PING = 'ping'
+CLOSE = 'close'
+
+# Response types
+HELLO = 'hello'
+DESCRIPTION = 'description'
+BATCH = 'batch'
+DONE = 'done'
+ERROR = 'error'
+PONG = 'pong'
+
+type_names = {
+	int: 'integer',
+	float: 'float',
+	bool: 'boolean',
+	str: 'string',
+}
+types_by_name = {name: column_type
+					for column_type, name in type_names.items()}
+
+class ProtocolError(Exception):
+	pass
+
+def encode_message(message):
+	payload = json.dumps(message, separators=(',', ':')).encode('utf-8')
+	if len(payload) > MAX_MESSAGE_SIZE:
+		raise ProtocolError('Message of %d bytes is too large' % len(payload))
+	return MESSAGE_HEADER.pack(len(payload)) + payload
+
+def decode_message(payload):
+	try:
+		message = json.loads(payload)
+	except ValueError as e:
+		raise ProtocolError('Malformed message: %s' % e)
+	if type(message) != dict:
+		raise ProtocolError('Messages must be objects')
+	return message
+
+def message_length(header):
+	length, = MESSAGE_HEADER.unpack(header)
+	if length > MAX_MESSAGE_SIZE:
+		raise ProtocolError('Message of %d bytes is too large' % length)
+	return length
+
+async def read_message(reader):
+	'''
+	Reads a message from an asyncio stream. Returns None if the stream ends
+	before the message starts.
+	'''
+	try:
+		header = await reader.readexactly(MESSAGE_HEADER.size)
+	except asyncio.IncompleteReadError as e:
+		if e.partial:
+			raise ProtocolError('Connection closed in a message header')
+		return None
+	return decode_message(await reader.readexactly(message_length(header)))
+
+def write_message(writer, message):
+	'Writes a message to an asyncio stream without waiting for it to drain.'
+	writer.write(encode_message(message))
+
+def receive_exactly(sock, size):
+	data = bytearray()
+	while len(data) < size:
+		chunk = sock.recv(size - len(data))
+		if not chunk:
+			return bytes(data)
+		data += chunk
+	return bytes(data)
+
+def receive_message(sock):
+	'''
+	Reads a message from a blocking socket. Returns None if the connection is
+	closed before the message starts.
+	'''
+	header = receive_exactly(sock, MESSAGE_HEADER.size)
+	if not header:
+		return None
+	if len(header) < MESSAGE_HEADER.size:
+		raise ProtocolError('Connection closed in a message header')
+	length = message_length(header)
+	payload = receive_exactly(sock, length)
+	if len(payload) < length:
+		raise ProtocolError('Connection closed in a message')
+	return decode_message(payload)
+
+def send_message(sock, message):
+	sock.sendall(encode_message(message))
+
+def describe_columns(columns):
+	'Returns the name, type name and nullability of each column.'
+	return [[column.name, type_names.get(column.type), column.nullable]
+			for column in columns]
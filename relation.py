@@ -1,5 +1,12 @@
 import functools
+import heapq
 import itertools
+import math
+import operator
+import time
+
+import hyperloglog
+import memory
 
 # types: INTEGER, FLOAT, STRING, BOOLEAN
 
@@ -31,7 +38,56 @@ class Column:
 				new_nullability if new_nullability != None else self.nullable,
 				new_index if new_index != None else self.index)
 
+class QueryCancelled(Exception):
+	pass
+
+class CancellationToken:
+	def __init__(self, timeout=None):
+		'''
+		Lets a running query be cancelled. Operators call check between rows,
+		which raises QueryCancelled once cancel has been called or timeout
+		seconds after the token was created.
+		'''
+		self.cancelled = False
+		self.reason = None
+		self.deadline = math.inf
+		if timeout != None:
+			self.deadline = time.monotonic() + timeout
+
+	def cancel(self, reason='The query was cancelled'):
+		if not self.cancelled:
+			self.reason = reason
+			self.cancelled = True
+
+	def check(self):
+		if self.cancelled:
+			raise QueryCancelled(self.reason)
+		if time.monotonic() > self.deadline:
+			self.cancel('The query exceeded the statement timeout')
+			raise QueryCancelled(self.reason)
+
+	def checked(self, rows):
+		'Yields the rows, checking the token before each one.'
+		for row in rows:
+			self.check()
+			yield row
+
 class Relation:
+	# Names of the attributes holding the relations this relation is derived
+	# from
+	inputs = ()
+	# Checked by operators between rows. Operators of a query are given the
+	# query's token by set_token, others share this one, which is never
+	# cancelled.
+	token = CancellationToken()
+	# Charged with the memory of the rows an operator buffers. Operators of a
+	# query are given an account of the query's tracker by set_memory, others
+	# share this one, which has no limit and keeps no state.
+	memory = memory.UnlimitedMemory()
+	# Columns the rows are known to be sorted by in ascending order. The
+	# columns contain no null values.
+	ordering = ()
+
 	def __init__(self, columns, name=None):
 		self.name = name
 		self.columns = [
@@ -52,6 +108,33 @@ class Relation:
 				return True
 		return False
 
+	def children(self):
+		'Returns the relations this relation is derived from.'
+		return [getattr(self, name) for name in self.inputs]
+
+	def set_token(self, token):
+		'''
+		Makes this operator and the operators it is derived from check the
+		cancellation token of a query. Tables, which are shared by queries,
+		are left alone.
+		'''
+		if not self.inputs:
+			return
+		self.token = token
+		for child in self.children():
+			child.set_token(token)
+
+	def set_memory(self, tracker):
+		'''
+		Gives this operator and the operators it is derived from their own
+		account in the memory tracker of a query. Tables are left alone.
+		'''
+		if not self.inputs:
+			return
+		self.memory = tracker.account()
+		for child in self.children():
+			child.set_memory(tracker)
+
 	def __iter__(self):
 		'Returns an iterator for iterating over all tuples in the relation'
 		raise NotImplemented
@@ -60,25 +143,222 @@ class Relation:
 	# or have relations automatically swapped out for material relations after
 	# first iteration
 
+class ZoneMap:
+	def __init__(self, start, width):
+		'''
+		Summary of the values in a chunk of consecutive rows of a table
+		starting at row id start. For each column it records the minimum and
+		maximum non-null value and the number of null values.
+		'''
+		self.start = start
+		self.row_count = 0
+		self.min = [None]*width
+		self.max = [None]*width
+		self.null_count = [0]*width
+
+	def add(self, row):
+		self.widen(row)
+		self.row_count += 1
+
+	def widen(self, row):
+		'''
+		Includes the values of a row without counting it as a row of the
+		chunk.
+		'''
+		for i, value in enumerate(row):
+			if value == None:
+				self.null_count[i] += 1
+				continue
+			if self.min[i] == None or value < self.min[i]:
+				self.min[i] = value
+			if self.max[i] == None or value > self.max[i]:
+				self.max[i] = value
+
+	def add_rows(self, rows):
+		'Adds a list of rows. Faster than adding the rows one at a time.'
+		for i, values in enumerate(zip(*rows)):
+			null_count = values.count(None)
+			self.null_count[i] += null_count
+			if null_count == len(values):
+				continue
+			non_null = values
+			if null_count:
+				non_null = [value for value in values if value != None]
+			low, high = min(non_null), max(non_null)
+			if self.min[i] == None or low < self.min[i]:
+				self.min[i] = low
+			if self.max[i] == None or high > self.max[i]:
+				self.max[i] = high
+		self.row_count += len(rows)
+
+	def may_contain_range(self, column_index, lower, lower_inclusive, upper,
+			upper_inclusive):
+		'''
+		Returns false if no value of the column in the chunk can be between
+		the bounds. A bound of None is unbounded.
+		'''
+		low, high = self.min[column_index], self.max[column_index]
+		if low == None:
+			# Only null values
+			return False
+		if lower != None and (high < lower or
+				(high == lower and not lower_inclusive)):
+			return False
+		if upper != None and (low > upper or
+				(low == upper and not upper_inclusive)):
+			return False
+		return True
+
+	def may_contain_null(self, column_index):
+		return self.null_count[column_index] > 0
+
+# Number of rows summarized by each zone map of a table
+DEFAULT_CHUNK_SIZE = 65536
+
+# Tables take a new version whenever their rows change. Versions are never
+# reused, even by other tables, so a table's version identifies its rows.
+table_versions = itertools.count(1)
+
 class MaterialRelation(Relation):
 	'''
 	A material relation stores a list of tuples. All other relations are derived
 	from other relations.
+
+	Rows are grouped into chunks of chunk_size consecutive rows, each with a
+	zone map summarizing its values so scans can skip chunks.
 	'''
-	def __init__(self, columns, name=None):
+	def __init__(self, columns, name=None, chunk_size=DEFAULT_CHUNK_SIZE):
 		super().__init__(columns, name)
 		self.rows = []
-
-	def insert(self, values):
+		self.row_count = 0
+		# Statistics computed by the most recent ANALYZE or None
+		self.statistics = None
+		# Indexes by name. Indexes are kept up to date by insert and truncate.
+		self.indexes = {}
+		self.chunk_size = chunk_size
+		self.zone_maps = []
+		self.version = next(table_versions)
+
+	def validate(self, values):
+		'''
+		Returns the values as a row of the relation or raises an exception if
+		they can not be inserted.
+		'''
 		if len(values) != len(self.columns):
 			raise TypeError("Wrong number of columns")
 		for value, column in zip(values, self.columns):
 			column.check_value_type(value)
-		self.rows.append(tuple(values))
+		return tuple(values)
+
+	def insert(self, values):
+		row = self.validate(values)
+		for index in self.indexes.values():
+			index.insert(self.row_count, row)
+		if self.row_count % self.chunk_size == 0:
+			self.zone_maps.append(ZoneMap(self.row_count, len(self.columns)))
+		self.zone_maps[-1].add(row)
+		self.rows.append(row)
+		self.row_count += 1
+		self.version = next(table_versions)
+
+	def load(self, rows):
+		'''
+		Appends a list of rows which are already known to be valid, without
+		checking the types of their values.
+		'''
+		for index in self.indexes.values():
+			for row_id, row in enumerate(rows, self.row_count):
+				index.insert(row_id, row)
+		position = 0
+		while position < len(rows):
+			if self.row_count % self.chunk_size == 0:
+				self.zone_maps.append(
+					ZoneMap(self.row_count, len(self.columns)))
+			end = position + self.chunk_size - (
+					self.row_count % self.chunk_size)
+			chunk = rows[position:end]
+			self.zone_maps[-1].add_rows(chunk)
+			self.rows.extend(chunk)
+			self.row_count += len(chunk)
+			position = end
+		self.version = next(table_versions)
+
+	def replace(self, row_id, values):
+		'''
+		Replaces the row with the given row id. The zone map of its chunk is
+		widened to include the new values, so it may still include values of
+		the old row.
+		'''
+		row = self.validate(values)
+		for index in self.indexes.values():
+			index.remove(row_id, self.rows[row_id])
+			index.insert(row_id, row)
+		self.zone_maps[row_id//self.chunk_size].widen(row)
+		self.rows[row_id] = row
+		self.version = next(table_versions)
+
+	def truncate(self, row_count):
+		'Removes all rows after the first row_count rows.'
+		for row_id in range(len(self.rows) - 1, row_count - 1, -1):
+			for index in self.indexes.values():
+				index.remove(row_id, self.rows[row_id])
+		del self.rows[row_count:]
+		self.row_count = len(self.rows)
+		self.version = next(table_versions)
+		# Values can not be removed from a zone map, so the zone map of a
+		# partially truncated chunk is rebuilt
+		chunks = (row_count + self.chunk_size - 1)//self.chunk_size
+		del self.zone_maps[chunks:]
+		if row_count % self.chunk_size:
+			zone_map = ZoneMap(self.zone_maps[-1].start, len(self.columns))
+			for row in self.rows[zone_map.start:]:
+				zone_map.add(row)
+			self.zone_maps[-1] = zone_map
+
+	def get_row(self, row_id):
+		'Returns the row with the given position in insertion order.'
+		return self.rows[row_id]
 
 	def __iter__(self):
 		return self.rows.__iter__()
 
+class ZoneMapScan(Relation):
+	def __init__(self, table, ranges, null_columns=()):
+		'''
+		Represents the rows of the table in chunks whose zone maps show they
+		may contain matching rows. ranges maps column indexes to the bounds
+		(lower, lower_inclusive, upper, upper_inclusive) the column values
+		must be within and null_columns are the indexes of columns which must
+		be null. All rows of chunks which may match are produced, so the
+		relation must still be filtered.
+		'''
+		super().__init__(table.columns, table.name)
+		self.table = table
+		self.ranges = ranges
+		self.null_columns = null_columns
+		self.chunks_read = 0
+		self.chunks_skipped = 0
+
+	def may_match(self, zone_map):
+		for column_index, bounds in self.ranges.items():
+			if not zone_map.may_contain_range(column_index, *bounds):
+				return False
+		for column_index in self.null_columns:
+			if not zone_map.may_contain_null(column_index):
+				return False
+		return True
+
+	def __iter__(self):
+		self.chunks_read = 0
+		self.chunks_skipped = 0
+		rows = self.table.rows
+		for zone_map in self.table.zone_maps:
+			if not self.may_match(zone_map):
+				self.chunks_skipped += 1
+				continue
+			self.chunks_read += 1
+			yield from rows[zone_map.start:zone_map.start + zone_map.row_count]
+
 class Expression:
 	def value_type(self):
 		'Returns the type the expression evaluates to'
@@ -92,6 +372,17 @@ class Expression:
 		'Returns the value of the expression for the attribute values of a row'
 		raise NotImplemented
 
+	def key(self):
+		'''
+		Returns a tuple describing the structure of the expression, equal for
+		expressions which always evaluate to the same values.
+		'''
+		raise TypeError('%s expressions have no key' % type(self).__name__)
+
+def value_key(value):
+	'Returns a key for a value distinguishing 1, 1.0 and true.'
+	return (type(value).__name__, value)
+
 class Constant(Expression):
 	def __init__(self, value):
 		self.value = value
@@ -105,6 +396,9 @@ class Constant(Expression):
 	def evaluate(self, row):
 		return self.value
 
+	def key(self):
+		return ('constant', value_key(self.value))
+
 class Attribute(Expression):
 	def __init__(self, column):
 		self.column = column
@@ -120,6 +414,9 @@ class Attribute(Expression):
 		self.column.check_value_type(value) # remove later
 		return value
 
+	def key(self):
+		return ('attribute', self.column.index, self.column.type.__name__)
+
 def str_to_bool(s):
 	if s == None:
 		return None
@@ -192,6 +489,21 @@ class Cast(Expression):
 			return None
 		return self.op(self.expression.evaluate(row))
 
+	def key(self):
+		return ('cast', self.expression.key(), self.target_type.__name__)
+
+	def __getstate__(self):
+		# Conversion functions can not be pickled, so they are looked up
+		# again when unpickled
+		state = self.__dict__.copy()
+		del state['op']
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.op = Cast.conversion_functions[
+			self.expression.value_type()][self.target_type]
+
 class BinaryOperation(Expression):
 	def __init__(self, lhs, rhs):
 		self.lhs = lhs
@@ -209,6 +521,10 @@ class BinaryOperation(Expression):
 			return None
 		return self.op(lhs, rhs)
 
+	def key(self):
+		return (type(self).__name__, getattr(self, 'operator', None),
+				self.lhs.key(), self.rhs.key())
+
 class And(BinaryOperation):
 	def __init__(self, lhs, rhs):
 		super().__init__(lhs, rhs)
@@ -247,21 +563,222 @@ class Or(BinaryOperation):
 			return True
 		return None
 
+def conjuncts(predicate):
+	'Returns the list of predicates which are and-ed together.'
+	if type(predicate) == And:
+		return conjuncts(predicate.lhs) + conjuncts(predicate.rhs)
+	return [predicate]
+
+def conjunction(predicates):
+	'Returns a predicate which is true when all of the predicates are true.'
+	if not predicates:
+		return Constant(True)
+	predicate = predicates[0]
+	for rhs in predicates[1:]:
+		predicate = And(predicate, rhs)
+	return predicate
+
+# Rows between the rows on which the operands of conjunctions and
+# disjunctions are timed
+JUNCTION_SAMPLE_INTERVAL = 16
+# Timed rows between reorderings of the operands
+JUNCTION_REORDER_SAMPLES = 64
+# Reorderings kept for EXPLAIN ANALYZE
+JUNCTION_MAX_REORDERINGS = 16
+
+class OperandMeasurements:
+	'The time an operand took and the rows it decided on the timed rows.'
+	def __init__(self):
+		self.evaluations = 0.0
+		self.decisions = 0.0
+		self.time = 0.0
+
+	def rank(self):
+		'''
+		Returns the time the operand takes per row it decides. Operands
+		which were not evaluated rank last.
+		'''
+		if not self.evaluations:
+			return math.inf
+		# The fraction of rows decided is smoothed towards a half, so
+		# operands which never decided still rank by their time
+		decided = (self.decisions + 1)/(self.evaluations + 2)
+		return self.time/self.evaluations/decided
+
+	def decay(self):
+		'Halves the measurements, so recent rows count more than older ones.'
+		self.evaluations /= 2
+		self.decisions /= 2
+		self.time /= 2
+
+class Junction(Expression):
+	# The operand value which decides the result
+	decisive_value = None
+	name = None
+
+	def __init__(self, operands):
+		'''
+		The operands are evaluated in order until one decides the result.
+		The order changes as rows are evaluated: every
+		JUNCTION_SAMPLE_INTERVAL rows the operands are timed, and every
+		JUNCTION_REORDER_SAMPLES timed rows they are ordered by the time
+		they take per row they decide. Null operands do not decide the
+		result, so the order does not change it. Operands which can raise
+		errors keep their position, since the operands before them may
+		guard them.
+		'''
+		for operand in operands:
+			if operand.value_type() != bool:
+				raise TypeError('Operands of %s must be booleans' % self.name)
+		self.operands = list(operands)
+		self.measurements = [OperandMeasurements() for operand in operands]
+		self.fixed = [can_raise(operand) for operand in operands]
+		self.rows = 0
+		self.samples = 0
+		self.reorder_count = 0
+		# (rows evaluated, operands) after each reordering
+		self.reorderings = []
+
+	def value_type(self):
+		return bool
+
+	def nullable(self):
+		return any(operand.nullable() for operand in self.operands)
+
+	def evaluate_timed(self, row):
+		'Evaluates the operands for a row, measuring each of them.'
+		decisive_value = self.decisive_value
+		result = not decisive_value
+		for operand, measurements in zip(self.operands, self.measurements):
+			start = time.perf_counter()
+			value = operand.evaluate(row)
+			measurements.time += time.perf_counter() - start
+			measurements.evaluations += 1
+			if value == decisive_value:
+				measurements.decisions += 1
+				result = value
+				break
+			if value == None:
+				result = None
+		self.samples += 1
+		if self.samples % JUNCTION_REORDER_SAMPLES == 0:
+			self.reorder()
+		return result
+
+	def reorder(self):
+		'Orders the operands by the time they take per row they decide.'
+		order = guarded_order(
+			[measurements.rank() for measurements in self.measurements],
+			self.fixed)
+		for measurements in self.measurements:
+			measurements.decay()
+		if order == list(range(len(order))):
+			return
+		self.operands = [self.operands[i] for i in order]
+		self.measurements = [self.measurements[i] for i in order]
+		self.fixed = [self.fixed[i] for i in order]
+		self.reorder_count += 1
+		if len(self.reorderings) < JUNCTION_MAX_REORDERINGS:
+			self.reorderings.append((self.rows, list(self.operands)))
+
+	def key(self):
+		# The order of the operands does not change the result
+		return (self.name, tuple(sorted([operand.key()
+							for operand in self.operands], key=repr)))
+
+class Conjunction(Junction):
+	decisive_value = False
+	name = 'and'
+
+	def evaluate(self, row):
+		self.rows += 1
+		if self.rows % JUNCTION_SAMPLE_INTERVAL == 0:
+			return self.evaluate_timed(row)
+		result = True
+		for operand in self.operands:
+			value = operand.evaluate(row)
+			if value == False:
+				return False
+			if value == None:
+				result = None
+		return result
+
+class Disjunction(Junction):
+	decisive_value = True
+	name = 'or'
+
+	def evaluate(self, row):
+		self.rows += 1
+		if self.rows % JUNCTION_SAMPLE_INTERVAL == 0:
+			return self.evaluate_timed(row)
+		result = False
+		for operand in self.operands:
+			value = operand.evaluate(row)
+			if value == True:
+				return True
+			if value == None:
+				result = None
+		return result
+
+# Attributes of expressions holding their operands, as an expression or a
+# list of expressions
+operand_names = ('lhs', 'rhs', 'expression', 'operands')
+
+def operands(expression):
+	'Returns the expressions an expression is computed from.'
+	result = []
+	for name in operand_names:
+		value = getattr(expression, name, None)
+		if type(value) == list:
+			result.extend(value)
+		elif value != None:
+			result.append(value)
+	return result
+
+def can_raise(expression):
+	'''
+	Returns true if evaluating the expression may raise an error for some
+	rows, as divisions, modulos and casts do.
+	'''
+	if type(expression) == Cast:
+		return True
+	if type(expression) == Arithmetic and expression.operator in (
+			'/', '//', '%'):
+		return True
+	return any(can_raise(operand) for operand in operands(expression))
+
+def guarded_order(ranks, fixed):
+	'''
+	Returns the positions of operands sorted by rank, except that fixed
+	operands keep their position, so the operands before a fixed operand
+	stay before it and the operands after it stay after it.
+	'''
+	order = []
+	start = 0
+	for i in range(len(ranks) + 1):
+		if i == len(ranks) or fixed[i]:
+			order.extend(sorted(range(start, i), key=lambda j: ranks[j]))
+			if i < len(ranks):
+				order.append(i)
+			start = i + 1
+	return order
+
 class Comparison(BinaryOperation):
 	operators = {
-		'<': lambda a, b: a < b,
-		'<=': lambda a, b: a <= b,
-		'=': lambda a, b: a == b,
-		'>=': lambda a, b: a >= b,
-		'>': lambda a, b: a > b,
-		'<>': lambda a, b: a != b,
-		'!=': lambda a, b: a != b,
+		'<': operator.lt,
+		'<=': operator.le,
+		'=': operator.eq,
+		'>=': operator.ge,
+		'>': operator.gt,
+		'<>': operator.ne,
+		'!=': operator.ne,
 	}
 	def __init__(self, op, lhs, rhs):
 		super().__init__(lhs, rhs)
 		if lhs.value_type() != rhs.value_type():
 			raise TypeError('Operands must have the same type')
 		# TODO: compare int and float
+		self.operator = op
 		self.op = Comparison.operators[op]
 
 	def value_type(self):
@@ -272,12 +789,12 @@ def is_numeric(value_type):
 
 class Arithmetic(BinaryOperation):
 	operators = {
-		'*': lambda a, b: a * b,
-		'/': lambda a, b: a / b,
-		'//': lambda a, b: a // b,
-		'%': lambda a, b: a % b,
-		'+': lambda a, b: a + b,
-		'-': lambda a, b: a - b,
+		'*': operator.mul,
+		'/': operator.truediv,
+		'//': operator.floordiv,
+		'%': operator.mod,
+		'+': operator.add,
+		'-': operator.sub,
 	}
 	def __init__(self, op, lhs, rhs):
 		super().__init__(lhs, rhs)
@@ -288,11 +805,48 @@ class Arithmetic(BinaryOperation):
 								rhs.value_type() == float) else int
 		if op == '/' and self.type == int:
 			op = '//'
+		self.operator = op
 		self.op = Arithmetic.operators[op]
 
 	def value_type(self):
 		return self.type
 
+class InList(Expression):
+	def __init__(self, expression, values):
+		'''
+		True if the expression is equal to one of the constant values. Like a
+		chain of equality comparisons, the result is null if the expression is
+		null or it is not in the list and the list contains a null.
+		'''
+		for value in values:
+			if value != None and type(value) != expression.value_type():
+				raise TypeError('Values in list must have the same type as '
+								'the expression')
+		self.expression = expression
+		self.values = values
+		self.value_set = set([value for value in values if value != None])
+		self.has_null = any(value == None for value in values)
+
+	def value_type(self):
+		return bool
+
+	def nullable(self):
+		return self.expression.nullable() or self.has_null
+
+	def evaluate(self, row):
+		value = self.expression.evaluate(row)
+		if value == None:
+			return None
+		if value in self.value_set:
+			return True
+		if self.has_null:
+			return None
+		return False
+
+	def key(self):
+		return ('in', self.expression.key(),
+				tuple([value_key(value) for value in self.values]))
+
 class UnaryMinus(Expression):
 	def __init__(self, expression):
 		if not is_numeric(expression.value_type()):
@@ -311,6 +865,9 @@ class UnaryMinus(Expression):
 			return None
 		return - value
 
+	def key(self):
+		return ('minus', self.expression.key())
+
 class LogicalNot(Expression):
 	def __init__(self, expression):
 		if expression.value_type() != bool:
@@ -329,6 +886,9 @@ class LogicalNot(Expression):
 			return None
 		return not value
 
+	def key(self):
+		return ('not', self.expression.key())
+
 class IsNull(Expression):
 	def __init__(self, expression):
 		self.expression = expression
@@ -342,6 +902,9 @@ class IsNull(Expression):
 	def evaluate(self, row):
 		return self.expression.evaluate(row) == None
 
+	def key(self):
+		return ('is null', self.expression.key())
+
 class IsNotNull(Expression):
 	def __init__(self, expression):
 		self.expression = expression
@@ -355,7 +918,42 @@ class IsNotNull(Expression):
 	def evaluate(self, row):
 		return self.expression.evaluate(row) != None
 
+	def key(self):
+		return ('is not null', self.expression.key())
+
+class SharedExpression(Expression):
+	def __init__(self, expression):
+		'''
+		An expression used more than once by a query. The value is computed
+		once per row: evaluating the expression again for the same row
+		returns the value computed before.
+		'''
+		self.expression = expression
+		self.row = None
+		self.value = None
+
+	def value_type(self):
+		return self.expression.value_type()
+
+	def nullable(self):
+		return self.expression.nullable()
+
+	def evaluate(self, row):
+		# The row is kept, so another row can not have the same identity
+		if row is not self.row:
+			self.value = self.expression.evaluate(row)
+			self.row = row
+		return self.value
+
+	def key(self):
+		return self.expression.key()
+
+	def __getstate__(self):
+		return {'expression': self.expression, 'row': None, 'value': None}
+
 class Selection(Relation):
+	inputs = ('relation',)
+
 	def __init__(self, relation, predicate):
 		'''
 		Represents all tuples in the relation meeting the predicate.
@@ -366,9 +964,14 @@ class Selection(Relation):
 			raise TypeError('Predicate must be a boolean valued expression')
 		self.relation = relation
 		self.predicate = predicate
+		self.ordering = relation.ordering
 
 	def __iter__(self):
-		return (row for row in self.relation if self.predicate.evaluate(row))
+		token = self.token
+		for row in self.relation:
+			token.check()
+			if self.predicate.evaluate(row):
+				yield row
 
 
 class Deduplicate(Relation):
@@ -378,6 +981,8 @@ class Deduplicate(Relation):
 		'''
 
 class GeneralizedProjection(Relation):
+	inputs = ('relation',)
+
 	def __init__(self, relation, expressions):
 		'''
 		Represents a relation where each tuple's attributes are expressions in
@@ -401,7 +1006,15 @@ class GeneralizedProjection(Relation):
 
 	def __iter__(self):
 		project = lambda row: tuple([x.evaluate(row) for x in self.expressions])
-		return (project(row) for row in self.relation)
+		return (project(row) for row in self.token.checked(self.relation))
+
+def is_ordered_by(relation, columns):
+	'Returns true if the rows of the relation are sorted by the columns.'
+	ordering = relation.ordering
+	if len(columns) > len(ordering):
+		return False
+	return all(column.index == ordered.index
+				for column, ordered in zip(columns, ordering))
 
 def compare_tuples(lhs_tuple, rhs_tuple, nulls_last):
 	'''
@@ -421,6 +1034,8 @@ def compare_tuples(lhs_tuple, rhs_tuple, nulls_last):
 	return 0
 
 class Sort(MaterialRelation):
+	inputs = ('relation',)
+
 	def __init__(self, relation, sort_key=None, descending=False,
 			nulls_last=True):
 		super().__init__(relation.columns)
@@ -441,16 +1056,71 @@ class Sort(MaterialRelation):
 			self.compare = lambda lhs, rhs:\
 				compare_tuples(lhs, rhs, nulls_last)
 
+		self.sort_key = sort_key
 		self.descending = descending
 		self.nulls_last = nulls_last
 		self.materialized = False
+		# Number of runs spilled to files by the last sort
+		self.spilled_runs = 0
+		# The input may already be in order, in which case sorting is skipped
+		self.presorted = not descending and is_ordered_by(relation,
+												sort_key or relation.columns)
+
+	def sort_rows(self, rows, key):
+		if not self.presorted:
+			rows.sort(key=key, reverse=self.descending)
 
 	def __iter__(self):
-		if not self.materialized:
-			self.rows = list(self.relation)
-			key = functools.cmp_to_key(self.compare)
-			self.rows.sort(key=key, reverse=self.descending)
-		return self.rows.__iter__()
+		'''
+		Sorts the rows in memory, charging them to the query. Once the query
+		runs out of memory the sorted rows are spilled to a file and the runs
+		in the files are merged.
+		'''
+		if self.materialized:
+			yield from self.rows
+			return
+		token = self.token
+		compare = self.compare
+		if token is not Relation.token:
+			def compare(lhs, rhs):
+				token.check()
+				return self.compare(lhs, rhs)
+		key = functools.cmp_to_key(compare)
+		account = self.memory
+		# Rows are only kept while they are produced, so nothing is left
+		# behind if the query is cancelled or fails
+		rows = []
+		runs = []
+		try:
+			for row in token.checked(self.relation):
+				size = memory.estimate_row_size(row)
+				try:
+					account.charge(size)
+				except memory.MemoryLimitExceeded:
+					if not rows:
+						raise
+					self.sort_rows(rows, key)
+					runs.append(memory.SpillFile(rows))
+					rows = []
+					account.release()
+					account.charge(size)
+				rows.append(row)
+			self.sort_rows(rows, key)
+			self.spilled_runs = len(runs)
+			if not runs:
+				self.rows = rows
+				yield from rows
+				return
+			runs.append(memory.SpillFile(rows))
+			rows = []
+			account.release()
+			# Merging keeps rows with equal keys in the order of the runs
+			yield from heapq.merge(*runs, key=key, reverse=self.descending)
+		finally:
+			self.rows = []
+			account.release()
+			for run in runs:
+				run.close()
 
 def create_compatible_schema(lhs_relation, rhs_relation):
 	'''
@@ -564,6 +1234,8 @@ def stream_difference(lhs_iter, rhs_iter):
 		lhs = next_value(lhs_iter)
 
 class SetCombination(Relation):
+	inputs = ('lhs', 'rhs')
+
 	def __init__(self, combine_streams, lhs, rhs, distinct=True):
 		'''
 		Combines the tuples in both input relations by sorting them and passing
@@ -580,13 +1252,16 @@ class SetCombination(Relation):
 		super().__init__(create_compatible_schema(lhs, rhs))
 		self.lhs = Sort(lhs)
 		self.rhs = Sort(rhs)
+		self.distinct = distinct
+		# The combined streams check the token for every row they take
 		if distinct:
-			self.new_iter = lambda: remove_duplicates(
-										combine_streams(self.lhs.__iter__(),
-											self.rhs.__iter__()))
+			self.new_iter = lambda: remove_duplicates(combine_streams(
+				self.token.checked(self.lhs.__iter__()),
+				self.token.checked(self.rhs.__iter__())))
 		else:
-			self.new_iter = lambda: combine_streams(self.lhs.__iter__(),
-										self.rhs.__iter__())
+			self.new_iter = lambda: combine_streams(
+				self.token.checked(self.lhs.__iter__()),
+				self.token.checked(self.rhs.__iter__()))
 
 	def __iter__(self):
 		return self.new_iter()
@@ -621,11 +1296,39 @@ class Aggregate:
 		'Adds the row to the computation of the aggregate.'
 		raise NotImplemented
 
+	def update_run(self, value, count):
+		'''
+		Adds count rows for which the aggregated expression has the value,
+		without evaluating the expression for each row.
+		'''
+		raise NotImplemented
+
+	def merge(self, other):
+		'''
+		Adds the rows aggregated by another aggregate of the same kind, which
+		aggregated a different part of the input.
+		'''
+		raise NotImplemented
+
+	def serialize(self):
+		'''
+		Returns the state of the aggregate as a value which can be pickled
+		without the aggregated expression.
+		'''
+		raise NotImplemented
+
+	def deserialize(self, state):
+		'Replaces the state of the aggregate with a state from serialize.'
+		raise NotImplemented
+
 	def final(self):
 		'Returns the final value of the aggregate.'
 		raise NotImplemented
 
 class AggregateFactory:
+	# Name of the aggregate function in SQL
+	name = None
+
 	def value_type(self):
 		'Returns the type of the value returned by the aggregate function.'
 		raise NotImplemented
@@ -638,6 +1341,12 @@ class AggregateFactory:
 		'Returns a new Aggregate object for computing an aggregate.'
 		raise NotImplemented
 
+	def key(self):
+		'Returns a tuple describing the aggregate like Expression.key.'
+		if self.expression == None:
+			return (self.name, None)
+		return (self.name, self.expression.key())
+
 class Count(Aggregate):
 	def __init__(self, expression=None):
 		'''
@@ -651,10 +1360,25 @@ class Count(Aggregate):
 		if self.expression == None or self.expression.evaluate(row) != None:
 			self.count += 1
 
+	def update_run(self, value, count):
+		if self.expression == None or value != None:
+			self.count += count
+
+	def merge(self, other):
+		self.count += other.count
+
+	def serialize(self):
+		return self.count
+
+	def deserialize(self, state):
+		self.count = state
+
 	def final(self):
 		return self.count
 
 class CountFactory(AggregateFactory):
+	name = 'count'
+
 	def __init__(self, expression=None):
 		self.expression = expression
 
@@ -678,10 +1402,26 @@ class Max(Aggregate):
 		if self.max == None or (value != None and value > self.max):
 			self.max = value
 
+	def update_run(self, value, count):
+		if self.max == None or (value != None and value > self.max):
+			self.max = value
+
+	def merge(self, other):
+		if self.max == None or (other.max != None and other.max > self.max):
+			self.max = other.max
+
+	def serialize(self):
+		return self.max
+
+	def deserialize(self, state):
+		self.max = state
+
 	def final(self):
 		return self.max
 
 class MaxFactory(AggregateFactory):
+	name = 'max'
+
 	def __init__(self, expression):
 		self.expression = expression
 
@@ -706,10 +1446,26 @@ class Min(Aggregate):
 		if self.min == None or (value != None and value < self.min):
 			self.min = value
 
+	def update_run(self, value, count):
+		if self.min == None or (value != None and value < self.min):
+			self.min = value
+
+	def merge(self, other):
+		if self.min == None or (other.min != None and other.min < self.min):
+			self.min = other.min
+
+	def serialize(self):
+		return self.min
+
+	def deserialize(self, state):
+		self.min = state
+
 	def final(self):
 		return self.min
 
 class MinFactory(AggregateFactory):
+	name = 'min'
+
 	def __init__(self, expression):
 		self.expression = expression
 
@@ -734,10 +1490,25 @@ class Sum(Aggregate):
 		if value:
 			self.sum += value
 
+	def update_run(self, value, count):
+		if value:
+			self.sum += value*count
+
+	def merge(self, other):
+		self.sum += other.sum
+
+	def serialize(self):
+		return self.sum
+
+	def deserialize(self, state):
+		self.sum = state
+
 	def final(self):
 		return self.sum
 
 class SumFactory(AggregateFactory):
+	name = 'sum'
+
 	def __init__(self, expression):
 		self.expression = expression
 
@@ -763,12 +1534,29 @@ class Avg(Aggregate):
 			self.sum += value
 			self.count += 1
 
+	def update_run(self, value, count):
+		if value:
+			self.sum += value*count
+			self.count += count
+
+	def merge(self, other):
+		self.sum += other.sum
+		self.count += other.count
+
+	def serialize(self):
+		return (self.sum, self.count)
+
+	def deserialize(self, state):
+		self.sum, self.count = state
+
 	def final(self):
 		if self.count == 0:
 			return None
 		return self.sum/self.count
 
 class AvgFactory(AggregateFactory):
+	name = 'avg'
+
 	def __init__(self, expression):
 		if not is_numeric(expression.value_type()):
 			raise TypeError('Avg requires a numeric expression')
@@ -783,7 +1571,60 @@ class AvgFactory(AggregateFactory):
 	def new_aggregate(self):
 		return Avg(self.expression)
 
+class ApproxCountDistinct(Aggregate):
+	def __init__(self, expression, precision):
+		'''
+		Estimates the number of distinct non-null values of the expression
+		with a HyperLogLog sketch of the given precision.
+		'''
+		self.expression = expression
+		self.sketch = hyperloglog.HyperLogLog(precision)
+
+	def update(self, row):
+		value = self.expression.evaluate(row)
+		if value != None:
+			self.sketch.add(value)
+
+	def update_run(self, value, count):
+		if value != None:
+			self.sketch.add(value)
+
+	def merge(self, other):
+		self.sketch.merge(other.sketch)
+
+	def serialize(self):
+		return self.sketch.serialize()
+
+	def deserialize(self, state):
+		self.sketch.deserialize(state)
+
+	def final(self):
+		return int(round(self.sketch.estimate()))
+
+class ApproxCountDistinctFactory(AggregateFactory):
+	name = 'approx_count_distinct'
+
+	def __init__(self, expression, precision=hyperloglog.DEFAULT_PRECISION):
+		# Checks the precision
+		hyperloglog.HyperLogLog(precision)
+		self.expression = expression
+		self.precision = precision
+
+	def value_type(self):
+		return int
+
+	def nullable(self):
+		return False
+
+	def new_aggregate(self):
+		return ApproxCountDistinct(self.expression, self.precision)
+
+	def key(self):
+		return super().key() + (self.precision,)
+
 class GroupBy(Relation):
+	inputs = ('relation',)
+
 	def __init__(self, relation, grouping_columns, aggregates=[]):
 		'''
 		Represents a relation with one output tuple for each distinct set of
@@ -806,7 +1647,7 @@ class GroupBy(Relation):
 	def __iter__(self):
 		current_group = None
 		current_aggregates = None
-		for row in self.relation:
+		for row in self.token.checked(self.relation):
 			row_group = [row[column.index] for column in self.grouping_columns]
 			if row_group != current_group:
 				if current_group != None:
@@ -824,6 +1665,8 @@ class GroupBy(Relation):
 			yield tuple(current_group)
 
 class CrossJoin(Relation):
+	inputs = ('lhs', 'rhs')
+
 	def __init__(self, lhs, rhs):
 		'A relation consisting of the Cartesian product of the input relations.'
 		columns = []
@@ -836,8 +1679,10 @@ class CrossJoin(Relation):
 		self.rhs = rhs
 
 	def __iter__(self):
+		token = self.token
 		for lhs in self.lhs:
 			for rhs in self.rhs:
+				token.check()
 				yield tuple(lhs + rhs)
 
 # See: https://postgresql.org/docs/8.3/queries-table-expressions.html#QUERIES-FROM
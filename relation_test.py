@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
 from relation import *
+import itertools
+import memory
+import time
 import unittest
 
 class TestColumn(unittest.TestCase):
@@ -81,6 +84,67 @@ class TestMaterialRelation(unittest.TestCase):
 		relation2.set_name('Users')
 		self.assertEqual(relation2.name, 'Users')
 
+class TestZoneMaps(unittest.TestCase):
+	def make_table(self):
+		relation = MaterialRelation([Column('ts', int), Column('v', str)],
+			chunk_size=2)
+		for row in [(1, 'a'), (2, None), (3, 'c'), (5, 'b'), (4, None)]:
+			relation.insert(row)
+		return relation
+
+	def test_should_maintain_zone_map_per_chunk(self):
+		relation = self.make_table()
+		self.assertEqual(len(relation.zone_maps), 3)
+		zone_map = relation.zone_maps[1]
+		self.assertEqual(zone_map.start, 2)
+		self.assertEqual(zone_map.row_count, 2)
+		self.assertEqual(zone_map.min, [3, 'b'])
+		self.assertEqual(zone_map.max, [5, 'c'])
+		self.assertEqual(zone_map.null_count, [0, 0])
+		self.assertEqual(relation.zone_maps[2].null_count, [0, 1])
+		self.assertEqual(relation.zone_maps[2].min, [4, None])
+
+	def test_load_should_build_same_zone_maps_as_insert(self):
+		inserted = self.make_table()
+		loaded = MaterialRelation([Column('ts', int), Column('v', str)],
+			chunk_size=2)
+		loaded.load([(1, 'a')])
+		loaded.load([(2, None), (3, 'c'), (5, 'b'), (4, None)])
+		self.assertEqual(list(loaded), list(inserted))
+		self.assertEqual(
+			[(z.start, z.row_count, z.min, z.max, z.null_count)
+				for z in loaded.zone_maps],
+			[(z.start, z.row_count, z.min, z.max, z.null_count)
+				for z in inserted.zone_maps])
+
+	def test_truncate_should_rebuild_zone_maps(self):
+		relation = self.make_table()
+		relation.truncate(3)
+		self.assertEqual(len(relation.zone_maps), 2)
+		self.assertEqual(relation.zone_maps[1].row_count, 1)
+		self.assertEqual(relation.zone_maps[1].max, [3, 'c'])
+		relation.truncate(2)
+		self.assertEqual(len(relation.zone_maps), 1)
+		relation.insert((9, 'z'))
+		self.assertEqual(relation.zone_maps[1].min, [9, 'z'])
+
+	def test_may_contain_range(self):
+		zone_map = ZoneMap(0, 1)
+		zone_map.add((3,))
+		zone_map.add((5,))
+		self.assertTrue(zone_map.may_contain_range(0, 5, True, None, True))
+		self.assertFalse(zone_map.may_contain_range(0, 5, False, None, True))
+		self.assertFalse(zone_map.may_contain_range(0, None, True, 3, False))
+		self.assertTrue(zone_map.may_contain_range(0, 4, True, 4, True))
+		self.assertFalse(zone_map.may_contain_null(0))
+
+	def test_scan_should_skip_chunks(self):
+		relation = self.make_table()
+		scan = ZoneMapScan(relation, {0: (4, True, None, True)}, [1])
+		self.assertEqual(list(scan), [(4, None)])
+		self.assertEqual(scan.chunks_read, 1)
+		self.assertEqual(scan.chunks_skipped, 2)
+
 class ValueExpression(Expression):
 	def __init__(self, value, expression_type, nullable=True):
 		self.value = value
@@ -463,6 +527,94 @@ class TestOr(unittest.TestCase):
 				Or(ValueExpression(True, bool),
 					ValueExpression(None, incorrect_type, nullable=True))
 
+class TestJunctions(unittest.TestCase):
+	def test_should_match_chains_of_ands_and_ors(self):
+		values = [None, False, True]
+		for junction_type, binary_type in ((Conjunction, And),
+											(Disjunction, Or)):
+			for case in itertools.product(values, repeat=3):
+				operands = [ValueExpression(value, bool) for value in case]
+				expected = binary_type(binary_type(operands[0], operands[1]),
+										operands[2]).evaluate([])
+				junction = junction_type(operands)
+				# Every order gives the same result, timed or not
+				for order in itertools.permutations(operands):
+					junction.operands = list(order)
+					for i in range(JUNCTION_SAMPLE_INTERVAL):
+						self.assertEqual(junction.evaluate([]), expected,
+							msg='%s %r' % (junction.name, case))
+
+	def test_should_evaluate_deciding_operands_first(self):
+		table = MaterialRelation([Column('a', int)])
+		table.load([(i,) for i in range(10000)])
+		a = Attribute(table.columns[0])
+		# The first operand is almost always true and the second false
+		always = Comparison('>=', a, Constant(1))
+		rarely = Comparison('<', a, Constant(10))
+		junction = Conjunction([always, rarely])
+		self.assertEqual(len(list(Selection(table, junction))), 9)
+		self.assertEqual(junction.operands, [rarely, always])
+		rows, operands = junction.reorderings[0]
+		self.assertEqual(rows,
+			JUNCTION_SAMPLE_INTERVAL*JUNCTION_REORDER_SAMPLES)
+		self.assertEqual(operands, [rarely, always])
+		self.assertEqual(junction.reorder_count, 1)
+
+	def test_should_not_move_operands_which_can_raise(self):
+		table = MaterialRelation([Column('x', int)])
+		table.load([(i % 100,) for i in range(10000)])
+		x = Attribute(table.columns[0])
+		guard = Comparison('<>', x, Constant(0))
+		division = Comparison('>', Arithmetic('/', Constant(10), x),
+			Constant(2))
+		cheap = Comparison('>', x, Constant(-1))
+		junction = Conjunction([cheap, guard, division])
+		self.assertEqual(len(list(Selection(table, junction))), 300)
+		# The guard may move before the cheap operand but not after the
+		# division
+		self.assertEqual(junction.operands[2], division)
+		self.assertEqual(guarded_order([3, 2, 1, 0], [False, False, True,
+			False]), [1, 0, 2, 3])
+
+	def test_keys_should_not_depend_on_order(self):
+		lhs = Comparison('=', Constant(1), Constant(2))
+		rhs = Comparison('<', Constant(1), Constant(2))
+		self.assertEqual(Disjunction([lhs, rhs]).key(),
+			Disjunction([rhs, lhs]).key())
+		self.assertNotEqual(Disjunction([lhs, rhs]).key(),
+			Conjunction([lhs, rhs]).key())
+
+	def test_should_return_type_error_for_non_booleans(self):
+		with self.assertRaisesRegex(TypeError, 'booleans'):
+			Conjunction([ValueExpression(True, bool), Constant(1)])
+
+class TestInList(unittest.TestCase):
+	def test_should_test_membership(self):
+		expr = InList(ValueExpression(2, int), [1, 2, 3])
+		self.assertEqual(expr.value_type(), bool)
+		self.assertTrue(expr.evaluate(()))
+		self.assertFalse(
+			InList(ValueExpression(4, int), [1, 2, 3]).evaluate(()))
+
+	def test_should_follow_null_semantics(self):
+		self.assertIsNone(
+			InList(ValueExpression(None, int), [1, 2]).evaluate(()))
+		self.assertIsNone(
+			InList(ValueExpression(4, int), [1, None]).evaluate(()))
+		self.assertTrue(
+			InList(ValueExpression(1, int), [1, None]).evaluate(()))
+
+	def test_nullability(self):
+		self.assertFalse(
+			InList(ValueExpression(1, int, False), [1, 2]).nullable())
+		self.assertTrue(
+			InList(ValueExpression(1, int, False), [1, None]).nullable())
+		self.assertTrue(InList(ValueExpression(1, int), [1, 2]).nullable())
+
+	def test_should_raise_error_for_wrong_value_type(self):
+		with self.assertRaisesRegex(TypeError, 'same type'):
+			InList(ValueExpression(1, int), [1, 'a'])
+
 class TestArithmetic(unittest.TestCase):
 	def test_should_return_error_for_non_numeric_types(self):
 		for incorrect_type in (bool, str):
@@ -849,6 +1001,16 @@ class TestSort(unittest.TestCase):
 		ordered = Sort(relation)
 		self.assertEqual(list(ordered), [(13,), (25,), (35,), (None,)])
 
+	def test_should_not_sort_ordered_input(self):
+		relation = MaterialRelation([Column('age', int)])
+		relation.insert((35,))
+		relation.insert((13,))
+		relation.ordering = [relation.columns[0]]
+
+		ordered = Sort(relation)
+		self.assertTrue(ordered.presorted)
+		self.assertEqual(list(ordered), [(35,), (13,)])
+
 	def test_should_have_same_columns_as_input(self):
 		relation = Sort(MaterialRelation([
 			Column('name', str, nullable=False),
@@ -867,6 +1029,32 @@ class TestSort(unittest.TestCase):
 
 		self.assertIsNone(relation.name)
 
+	def test_should_spill_when_out_of_memory(self):
+		# Rows with equal keys must stay in input order
+		relation = MaterialRelation([Column('k', int), Column('v', int)])
+		relation.load([(None if i % 7 == 0 else i % 13, i)
+						for i in range(2000)])
+		for descending in (False, True):
+			for nulls_last in (False, True):
+				sort = Sort(relation, [relation.columns[0]], descending,
+							nulls_last)
+				expected = list(sort)
+				self.assertEqual(sort.spilled_runs, 0)
+				tracker = memory.MemoryTracker(10000)
+				sort.set_memory(tracker)
+				self.assertEqual(list(sort), expected)
+				self.assertGreater(sort.spilled_runs, 1)
+				self.assertLessEqual(sort.memory.peak, 10000)
+				self.assertEqual(tracker.used, 0)
+
+	def test_should_fail_if_a_row_does_not_fit(self):
+		relation = MaterialRelation([Column('s', str)])
+		relation.insert(('x'*1000,))
+		sort = Sort(relation)
+		sort.set_memory(memory.MemoryTracker(100))
+		with self.assertRaisesRegex(MemoryError, 'memory limit of 100'):
+			list(sort)
+
 class TestUnion(unittest.TestCase):
 	def test_should_return_error_for_varying_tuple_length(self):
 		lhs = MaterialRelation([Column('a', str), Column('b', int)])
@@ -1028,6 +1216,42 @@ class TestGroupBy(unittest.TestCase):
 		self.assertEqual(output.columns[2].nullable, False)
 		self.assertEqual(output.columns[2].index, 2)
 
+	def test_merged_aggregates_should_equal_single_aggregate(self):
+		relation = MaterialRelation([Column('a', int)])
+		rows = [(3,), (None,), (-1,), (7,), (None,), (2,)]
+		attribute = Attribute(relation.columns[0])
+		factories = [CountFactory(), CountFactory(attribute),
+			SumFactory(attribute), MinFactory(attribute),
+			MaxFactory(attribute), AvgFactory(attribute),
+			ApproxCountDistinctFactory(attribute, 8)]
+		for factory in factories:
+			whole = factory.new_aggregate()
+			for row in rows:
+				whole.update(row)
+			merged = factory.new_aggregate()
+			for part in (rows[:1], rows[1:2], rows[2:5], rows[5:], []):
+				aggregate = factory.new_aggregate()
+				for row in part:
+					aggregate.update(row)
+				copy = factory.new_aggregate()
+				copy.deserialize(aggregate.serialize())
+				merged.merge(copy)
+			self.assertEqual(merged.final(), whole.final(), factory.name)
+
+	def test_should_approximate_distinct_counts(self):
+		relation = MaterialRelation([Column('a', int), Column('b', str)])
+		relation.load([(i % 2, None if i % 7 == 0 else str(i % 3000))
+						for i in range(20000)])
+		output = GroupBy(relation, relation.columns[:1], [
+			ApproxCountDistinctFactory(Attribute(relation.columns[1])),
+			ApproxCountDistinctFactory(Attribute(relation.columns[1]), 6)])
+		# Each group has 1500 distinct values, standard errors of 0.8% and 13%
+		for a, precise, rough in output:
+			self.assertLess(abs(precise - 1500), 1500*4*0.008)
+			self.assertLess(abs(rough - 1500), 1500*4*0.13)
+		with self.assertRaisesRegex(ValueError, 'Precision'):
+			ApproxCountDistinctFactory(Attribute(relation.columns[1]), 20)
+
 	# TODO:
 	# Function, type, nullable?
 	# count, int, false
@@ -1145,5 +1369,49 @@ class TestCrossJoin(unittest.TestCase):
 # comparison - bool -> int -> float -> string
 # nullability - short circuiting
 
+class TestCancellation(unittest.TestCase):
+	def setUp(self):
+		self.table = MaterialRelation([Column('a', int), Column('b', int)])
+		self.table.load([(i % 5, i) for i in range(20)])
+
+	def check_cancelled(self, plan):
+		token = CancellationToken()
+		plan.set_token(token)
+		token.cancel()
+		with self.assertRaisesRegex(QueryCancelled, 'cancelled'):
+			list(plan)
+
+	def test_operators_should_stop_when_cancelled(self):
+		a = Attribute(self.table.columns[0])
+		self.check_cancelled(Selection(self.table,
+			Comparison('>', a, Constant(1))))
+		self.check_cancelled(CrossJoin(self.table, self.table))
+		self.check_cancelled(Sort(self.table, [self.table.columns[0]]))
+		self.check_cancelled(GroupBy(self.table, [self.table.columns[0]],
+			[CountFactory()]))
+		self.check_cancelled(Union(self.table, self.table))
+		self.check_cancelled(GeneralizedProjection(self.table, [a]))
+
+	def test_cancelled_sort_should_keep_no_rows(self):
+		sort = Sort(self.table)
+		token = CancellationToken()
+		sort.set_token(token)
+		token.cancel()
+		with self.assertRaises(QueryCancelled):
+			list(sort)
+		self.assertEqual(sort.rows, [])
+
+	def test_tables_should_keep_the_default_token(self):
+		token = CancellationToken()
+		Selection(self.table, Constant(True)).set_token(token)
+		self.assertIsNot(self.table.token, token)
+
+	def test_token_should_expire_after_timeout(self):
+		token = CancellationToken(0)
+		time.sleep(0.01)
+		with self.assertRaisesRegex(QueryCancelled, 'timeout'):
+			token.check()
+		CancellationToken().check()
+
 if __name__ == '__main__':
 	unittest.main()
@@ -2,12 +2,34 @@
 
 import lex
 import yacc
+import bufferpool
+import columnar
+import cse
+import encoding
+import explain
+import index
+import matview
+import memory
+import parallel
+import planner
 import relation
+import resultcache
+import snapshot
+import stats
+import storage
+import wal
+import itertools
+import os
+import signal
+import sys
+import threading
+import weakref
 from collections import namedtuple
 
 keywords = {
 	#w.lower() : w.upper() for w in
 	'all':'ALL',
+	'analyze':'ANALYZE',
 	'and':'AND',
 	'as':'AS',
 	'boolean':'BOOLEAN',
@@ -16,24 +38,34 @@ keywords = {
 	'create':'CREATE',
 	'distinct':'DISTINCT',
 	'except':'EXCEPT',
+	'explain':'EXPLAIN',
 	'false':'FALSE',
 	'float':'FLOAT',
 	'from':'FROM',
 	'group':'GROUP',
+	'in':'IN',
+	'index':'INDEX',
 	'insert':'INSERT',
 	'integer':'INTEGER',
 	'intersect':'INTERSECT',
 	'into':'INTO',
 	'is':'IS',
+	'load':'LOAD',
+	'materialized':'MATERIALIZED',
 	'not':'NOT',
 	'null':'NULL',
+	'on':'ON',
 	'or':'OR',
+	'save':'SAVE',
 	'select':'SELECT',
+	'set':'SET',
 	'string':'STRING',
 	'table':'TABLE',
 	'true':'TRUE',
 	'union':'UNION',
+	'using':'USING',
 	'values':'VALUES',
+	'view':'VIEW',
 	'where':'WHERE'
 }
 
@@ -52,13 +84,14 @@ precedence = (
 	('left', 'INTERSECT'),
 	('left', 'OR'),
 	('left', 'AND'),
-	('nonassoc', '<', '>', '=', 'LEQ', 'GEQ', 'NEQ'),
+	('nonassoc', '<', '>', '=', 'LEQ', 'GEQ', 'NEQ', 'IN'),
 	('left', '+', '-'),
 	('left', '*', '/')
 )
 
 def SqlLexer():
-	literals = ['(', ')', ',', ';', '.', '*', '+', '-', '*', '/', '<', '=', '>']
+	literals = ['(', ')', ',', ';', '.', '*', '+', '-', '*', '/', '<', '=', '>',
+				'?']
 
 	t_LEQ = r'<='
 	t_GEQ = r'>='
@@ -100,14 +133,110 @@ def SqlLexer():
 def p_statement(p):
 	'''statement : insert_statement ';'
 				| create_table_statement ';'
+				| create_index_statement ';'
+				| create_view_statement ';'
 				| query_statement ';'
+				| analyze_statement ';'
+				| explain_statement ';'
+				| save_statement ';'
+				| load_statement ';'
+				| set_statement ';'
 	'''
 	p[0] = p[1]
 
+def p_save_statement(p):
+	'''save_statement : SAVE STRING_LITERAL snapshot_compression'''
+	p[0] = SaveNode(path=p[2], compress=p[3])
+
+def p_snapshot_compression_default(p):
+	'''snapshot_compression : empty'''
+	p[0] = False
+
+def p_snapshot_compression(p):
+	'''snapshot_compression : USING IDENTIFIER'''
+	if p[2] != 'zlib':
+		raise ValueError('Unknown snapshot compression %r' % p[2])
+	p[0] = True
+
+def p_load_statement(p):
+	'''load_statement : LOAD STRING_LITERAL'''
+	p[0] = LoadNode(path=p[2])
+
+def p_set_statement(p):
+	'''set_statement : SET IDENTIFIER '=' primitive'''
+	p[0] = SetNode(name=p[2], value=p[4])
+
+def p_analyze_statement_all_tables(p):
+	'''analyze_statement : ANALYZE'''
+	p[0] = AnalyzeNode(table_name=None)
+
+def p_analyze_statement(p):
+	'''analyze_statement : ANALYZE IDENTIFIER'''
+	p[0] = AnalyzeNode(table_name=p[2])
+
+def p_explain_statement(p):
+	'''explain_statement : EXPLAIN query_statement'''
+	p[0] = ExplainNode(query=p[2], format='text', analyze=False)
+
+def p_explain_analyze_statement(p):
+	'''explain_statement : EXPLAIN ANALYZE query_statement'''
+	p[0] = ExplainNode(query=p[3], format='text', analyze=True)
+
+def p_explain_statement_with_options(p):
+	'''explain_statement : EXPLAIN '(' explain_option_list ')' query_statement'''
+	options = dict(p[3])
+	p[0] = ExplainNode(query=p[5], format=options.get('format', 'text'),
+						analyze=options.get('analyze', False))
+
+def p_explain_option_list_base(p):
+	'''explain_option_list : explain_option'''
+	p[0] = [p[1]]
+
+def p_explain_option_list(p):
+	'''explain_option_list : explain_option_list ',' explain_option'''
+	p[1].append(p[3])
+	p[0] = p[1]
+
+def p_explain_option_analyze(p):
+	'''explain_option : ANALYZE'''
+	p[0] = ('analyze', True)
+
+def p_explain_option(p):
+	'''explain_option : IDENTIFIER IDENTIFIER'''
+	if p[1] != 'format':
+		raise ValueError('Unknown EXPLAIN option %r' % p[1])
+	p[0] = (p[1], p[2])
+
 def p_create_table_statement(p):
 	'''create_table_statement : CREATE TABLE IDENTIFIER '(' column_list ')' '''
 	p[0] = CreateTableNode(name=p[3], columns=p[5])
 
+def p_create_view_statement(p):
+	'''create_view_statement : CREATE MATERIALIZED VIEW IDENTIFIER AS query_statement'''
+	p[0] = CreateViewNode(name=p[4], query=p[6])
+
+def p_create_index_statement(p):
+	'''create_index_statement : CREATE INDEX IDENTIFIER ON IDENTIFIER '(' identifier_list ')' index_method'''
+	p[0] = CreateIndexNode(name=p[3], table_name=p[5], column_names=p[7],
+							method=p[9])
+
+def p_identifier_list_base(p):
+	'''identifier_list : IDENTIFIER'''
+	p[0] = [p[1]]
+
+def p_identifier_list(p):
+	'''identifier_list : identifier_list ',' IDENTIFIER'''
+	p[1].append(p[3])
+	p[0] = p[1]
+
+def p_index_method_default(p):
+	'''index_method : empty'''
+	p[0] = 'hash'
+
+def p_index_method(p):
+	'''index_method : USING IDENTIFIER'''
+	p[0] = p[2]
+
 def p_column_list_base(p):
 	'''column_list : column_definition'''
 	p[0] = [p[1]]
@@ -185,6 +314,15 @@ def p_primitive(p):
 	else:
 		p[0] = p[1]
 
+def p_parameter(p):
+	'''primitive : '?' '''
+	value = next(bound_parameters, missing_parameter)
+	if value is missing_parameter:
+		raise ValueError('Not enough parameters for the statement')
+	if type(value) not in (type(None), bool, int, float, str):
+		raise TypeError('Unsupported parameter type %s' % type(value).__name__)
+	p[0] = value
+
 def p_expression_constant(p):
 	'''expression_constant : primitive'''
 	p[0] = ConstantNode(p[1])
@@ -303,6 +441,10 @@ def p_expression_function_evaluation(p):
 	'''expression : IDENTIFIER '(' expression ')' '''
 	p[0] = FunctionEvaluationNode(name=p[1], argument=p[3])
 
+def p_expression_function_evaluation_with_parameter(p):
+	'''expression : IDENTIFIER '(' expression ',' INTEGER_LITERAL ')' '''
+	p[0] = FunctionEvaluationNode(name=p[1], argument=p[3], parameter=p[5])
+
 def p_expression_binary_operator(p):
 	'''expression :   expression '+' expression
 					| expression '-' expression
@@ -332,6 +474,14 @@ def p_expression_unary_postfix_operator(p):
 	else:
 		p[0] = UnaryOperationNode('is not null', p[1])
 
+def p_expression_in_list(p):
+	'''expression : expression IN '(' primitive_list ')' '''
+	p[0] = InListNode(p[1], p[4], negated=False)
+
+def p_expression_not_in_list(p):
+	'''expression : expression NOT IN '(' primitive_list ')' '''
+	p[0] = InListNode(p[1], p[5], negated=True)
+
 def p_expression_cast(p):
 	'''expression : CAST '(' expression AS primitive_type ')' '''
 	p[0] = CastNode(p[3], p[5])
@@ -362,6 +512,30 @@ def p_error(p):
 
 lexer = SqlLexer()
 parser = yacc.yacc()
+# The lexer and parser keep state while parsing, so statements executed from
+# several threads are parsed one at a time
+parse_lock = threading.Lock()
+# Values of the parameters of the statement being parsed, which replace its
+# ? placeholders in order
+bound_parameters = iter(())
+missing_parameter = object()
+
+def parse(sql_command, parameters=()):
+	'''
+	Returns the syntax tree of a statement, with the values of parameters
+	in place of its ? placeholders.
+	'''
+	global bound_parameters
+	with parse_lock:
+		bound_parameters = iter(parameters)
+		try:
+			ast_root = parser.parse(sql_command, lexer=lexer)
+			if next(bound_parameters, missing_parameter) is not (
+					missing_parameter):
+				raise ValueError('Too many parameters for the statement')
+		finally:
+			bound_parameters = iter(())
+	return ast_root
 
 class AstNode:
 	def compile(self, **kwargs):
@@ -408,15 +582,26 @@ class ColumnReferenceNode(ExpressionNode):
 		return relation.Attribute(column_mappings.get_column(self))
 
 class FunctionEvaluationNode(ExpressionNode):
-	def __init__(self, name, argument):
+	def __init__(self, name, argument, parameter=None):
 		self.name = name
 		self.argument = argument
+		# An integer literal following the argument
+		self.parameter = parameter
 		self.attribute_access = None
 
 	def compile(self, column_mappings):
 		return self.attribute_access
 
 	def get_aggregation(self, column_mappings):
+		if self.name == 'approx_count_distinct':
+			argument = self.argument.compile(column_mappings)
+			if self.parameter == None:
+				return relation.ApproxCountDistinctFactory(argument)
+			# The parameter is the precision of the sketch
+			return relation.ApproxCountDistinctFactory(argument, self.parameter)
+		if self.parameter != None:
+			raise ValueError('Aggregation function %r takes one argument' %
+								self.name)
 		if self.name == 'count':
 			return relation.CountFactory(self.argument.compile(column_mappings))
 		if self.name == 'max':
@@ -473,8 +658,28 @@ class CastNode(ExpressionNode):
 	def compile(self, env):
 		return relation.Cast(self.expression.compile(env), self.target_type)
 
+class InListNode(ExpressionNode):
+	def __init__(self, expression, values, negated):
+		self.expression = expression
+		self.values = values
+		self.negated = negated
+
+	def compile(self, env):
+		in_list = relation.InList(self.expression.compile(env), self.values)
+		if self.negated:
+			return relation.LogicalNot(in_list)
+		return in_list
+
 CreateTableNode = namedtuple('CreateTableNode', ['name', 'columns'])
 InsertIntoNode = namedtuple('InsertIntoNode', ['table_name', 'tuples'])
+CreateIndexNode = namedtuple('CreateIndexNode',
+					['name', 'table_name', 'column_names', 'method'])
+AnalyzeNode = namedtuple('AnalyzeNode', ['table_name'])
+CreateViewNode = namedtuple('CreateViewNode', ['name', 'query'])
+ExplainNode = namedtuple('ExplainNode', ['query', 'format', 'analyze'])
+SaveNode = namedtuple('SaveNode', ['path', 'compress'])
+LoadNode = namedtuple('LoadNode', ['path'])
+SetNode = namedtuple('SetNode', ['name', 'value'])
 
 class FromItem:
 	def __init__(self, from_item, name=None):
@@ -564,7 +769,7 @@ class SelectNode:
 	def compile_selection(self, input_relation, column_mappings):
 		if not self.where_predicate:
 			return input_relation
-		return relation.Selection(input_relation,
+		return planner.plan_selection(input_relation,
 								self.where_predicate.compile(column_mappings))
 
 	def compile_group_by(self, input_relation, column_mappings):
@@ -588,7 +793,7 @@ class SelectNode:
 				extract_aggregates(node.rhs)
 			elif type(node) == UnaryOperationNode:
 				extract_aggregates(node.operand)
-			elif type(node) == CastNode:
+			elif type(node) in (CastNode, InListNode):
 				extract_aggregates(node.expression)
 			else:
 				raise TypeError('Unrecognized node type %r' % type(node))
@@ -599,8 +804,17 @@ class SelectNode:
 		if not (self.group_by or aggregate_nodes):
 			return input_relation, column_mappings
 
-		aggregates = [
-			node.get_aggregation(column_mappings) for node in aggregate_nodes]
+		# Identical aggregates are computed once and share their column
+		aggregates = []
+		aggregate_indexes = []
+		positions = {}
+		for node in aggregate_nodes:
+			aggregate = node.get_aggregation(column_mappings)
+			key = aggregate.key()
+			if key not in positions:
+				positions[key] = len(aggregates)
+				aggregates.append(aggregate)
+			aggregate_indexes.append(positions[key])
 		grouping_columns = []
 		output_mappings = ColumnMappings()
 		for column_ref in self.group_by:
@@ -609,15 +823,21 @@ class SelectNode:
 			grouping_columns.append(column)
 			output_mappings.add_column(table_name, column)
 
-		output_relation = relation.GroupBy(
+		if not grouping_columns and encoding.can_aggregate_runs(
+				input_relation, aggregates):
+			output_relation = encoding.RunAggregation(input_relation,
+														aggregates)
+		else:
+			output_relation = relation.GroupBy(
 								input_relation, grouping_columns, aggregates)
 		aggregate_columns = output_relation.columns[len(grouping_columns):]
-		for node, column in zip(aggregate_nodes, aggregate_columns):
+		for column in aggregate_columns:
 			table_name = None
 			# Add aggregates to output mappings
 			output_mappings.add_column(table_name, column)
+		for node, i in zip(aggregate_nodes, aggregate_indexes):
 			# Rewrite select list expression to reference output of group by
-			node.attribute_access = relation.Attribute(column)
+			node.attribute_access = relation.Attribute(aggregate_columns[i])
 		assert(len(output_relation.columns) == len(grouping_columns) + len(aggregates))
 
 		return output_relation, output_mappings
@@ -664,37 +884,429 @@ class SetOperatorNode:
 		return self.op(self.lhs.compile(catalog),
 					self.rhs.compile(catalog), self.distinct)
 
+# Seconds between checkpoints of a database with stored tables
+DEFAULT_CHECKPOINT_INTERVAL = 60.0
+
 class Db:
-	def __init__(self):
+	def __init__(self, path=None, group_commit=True,
+			checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+			buffer_pool_size=bufferpool.DEFAULT_CAPACITY, parallel_workers=None,
+			query_memory_limit=None, result_cache_size=0,
+			result_cache_ttl=resultcache.DEFAULT_TTL):
+		'''
+		If path is given, tables are stored in files in that directory and
+		the tables created by previous sessions are opened. Otherwise tables
+		only exist in memory.
+
+		Changes to stored tables are recorded in a write-ahead log and are
+		durable once execute returns. Concurrent changes are made durable
+		together by a single flush of the log unless group_commit is false.
+		Checkpoints write the tables to their files and empty the log every
+		checkpoint_interval seconds, or only when the database is closed if
+		checkpoint_interval is None.
+
+		Materialized views are kept in memory, also in databases with stored
+		tables, and are not stored.
+
+		Pages of stored tables are cached in a buffer pool of
+		buffer_pool_size bytes. Operators buffering rows reserve their memory
+		from the pool, and each query may use at most query_memory_limit
+		bytes, which SET query_memory_limit = bytes changes and 0 removes.
+		Sorts spill to files once out of memory, other queries fail.
+
+		If result_cache_size is not 0, the results of up to that many bytes
+		of queries are cached for result_cache_ttl seconds or until a table
+		they read changes.
+
+		If parallel_workers is given, filters and projections of large tables
+		are run by that many worker processes.
+
+		Queries are cancelled once they run for longer than the statement
+		timeout, which SET statement_timeout = milliseconds sets and 0
+		disables, or by cancel with the query_id of their result.
+		'''
+		self.path = path
 		self.catalog = {}
+		# Materialized views by name, in the order they were created, which
+		# is the order they are maintained in
+		self.views = {}
+		self.buffer_pool = bufferpool.BufferPool(buffer_pool_size)
+		self.executor = None
+		if parallel_workers:
+			self.executor = parallel.ParallelExecutor(parallel_workers)
+		self.wal = None
+		self.checkpointer = None
+		# Serializes changes so they are applied in the order they are logged
+		self.write_lock = threading.RLock()
+		# Seconds a query may run or None
+		self.statement_timeout = None
+		self.query_memory_limit = query_memory_limit
+		self.result_cache = None
+		if result_cache_size:
+			self.result_cache = resultcache.ResultCache(result_cache_size,
+														result_cache_ttl)
+		# Cancellation tokens of the queries whose results are still in use,
+		# by query id
+		self.queries = weakref.WeakValueDictionary()
+		self.query_ids = itertools.count(1)
+		if path == None:
+			return
+		os.makedirs(path, exist_ok=True)
+		self.catalog, checkpoint_lsn = storage.load_catalog(path,
+			self.buffer_pool)
+		log_path = os.path.join(path, wal.LOG_FILE)
+		next_lsn = self.__recover(log_path, checkpoint_lsn)
+		self.wal = wal.WriteAheadLog(log_path, next_lsn, group_commit)
+		self.checkpoint()
+		if checkpoint_interval != None:
+			self.checkpointer = wal.Checkpointer(self.checkpoint,
+													checkpoint_interval)
+			self.checkpointer.start()
+
+	def __recover(self, log_path, checkpoint_lsn):
+		'''
+		Applies the changes logged after the last checkpoint and returns the
+		sequence number of the next log record.
+		'''
+		next_lsn = checkpoint_lsn + 1
+		if not os.path.exists(log_path):
+			return next_lsn
+		records, valid_length = wal.read_records(log_path)
+		os.truncate(log_path, valid_length)
+		for record in records:
+			next_lsn = max(next_lsn, record.lsn + 1)
+			if record.lsn <= checkpoint_lsn:
+				continue
+			if record.type == wal.CREATE_TABLE:
+				name, columns = wal.decode_create_table(record.payload)
+				self.__create_stored_table(name, columns, record.lsn)
+			elif record.type == wal.INSERT:
+				table_name, first_row_id, rows = wal.decode_insert(
+					record.payload, self.catalog)
+				table = self.catalog[table_name]
+				if table.row_count < first_row_id:
+					raise ValueError('Log does not match table %r' % table_name)
+				# The table file may already contain some of the rows
+				table.truncate(first_row_id)
+				for row in rows:
+					table.insert(row)
+			else:
+				raise ValueError('Unknown log record type %d' % record.type)
+		return next_lsn
+
+	def __create_stored_table(self, name, columns, lsn):
+		if name in self.catalog:
+			self.catalog[name].close()
+		self.catalog[name] = storage.DiskRelation.create(
+			os.path.join(self.path, storage.table_file_name(name, lsn)),
+			columns, name, self.buffer_pool)
 
 	def __execute_create_table(self, node):
 		name, columns = node.name, node.columns
-		self.catalog[name] = relation.MaterialRelation(columns, name)
+		if name in self.views:
+			raise ValueError('%r is a materialized view' % name)
+		with self.write_lock:
+			if self.wal == None:
+				self.catalog[name] = relation.MaterialRelation(columns, name)
+				return
+			lsn = self.wal.append(wal.CREATE_TABLE,
+									wal.create_table_payload(name, columns))
+			self.__create_stored_table(name, columns, lsn)
+		self.wal.commit(lsn)
+
+	def __execute_create_index(self, node):
+		for table in self.catalog.values():
+			if node.name in table.indexes:
+				raise ValueError('Index %r already exists' % node.name)
+		table = self.get_table(node.table_name)
+		index.create_index(node.name, table, node.column_names, node.method)
+
+	def __execute_create_view(self, node):
+		with self.write_lock:
+			if node.name in self.catalog:
+				raise ValueError('Table %r already exists' % node.name)
+			view = matview.MaterializedView(node.name, node.query,
+											self.catalog)
+			self.views[node.name] = view
+			self.catalog[node.name] = view.table
+
+	def __maintain_views(self, table_name, row_count, rows):
+		'''
+		Updates the views reading a table after rows were appended to it, and
+		the views reading those views.
+		'''
+		changed = set()
+		for view in self.views.values():
+			if view.base_tables & changed:
+				view.refresh(self.catalog)
+			elif table_name in view.base_tables:
+				view.insert(self.catalog, table_name, row_count, rows)
+			else:
+				continue
+			changed.add(view.table.name)
+
+	def __restore_views(self, table_name):
+		'Computes the views reading a table again, after an insert failed.'
+		changed = {table_name}
+		for view in self.views.values():
+			if view.base_tables & changed:
+				view.refresh(self.catalog)
+				changed.add(view.table.name)
 
 	def __execute_insert(self, node):
-		table_name, tuples = node.table_name, node.tuples
+		table_name = node.table_name
+		if table_name in self.views:
+			raise ValueError('Can not insert into materialized view %r' %
+								table_name)
+		table = self.get_table(table_name)
+		# Every row is validated before anything is applied, so an insert
+		# adds either all of its rows or none of them
+		rows = [table.validate(values) for values in node.tuples]
+		with self.write_lock:
+			row_count = table.row_count
+			# The rows are logged once the views are maintained, since
+			# maintaining them can fail. Tables only write the row count
+			# covering the new rows at checkpoints, which take the write lock,
+			# so unlogged rows are never recovered.
+			try:
+				for row in rows:
+					table.insert(row)
+				self.__maintain_views(table_name, row_count, rows)
+				if self.wal != None:
+					lsn = self.wal.append(wal.INSERT, wal.insert_payload(
+						table_name, row_count, rows, table.codec))
+			except BaseException:
+				table.truncate(row_count)
+				self.__restore_views(table_name)
+				raise
+		if self.wal != None:
+			self.wal.commit(lsn)
+
+	def __execute_analyze(self, node):
+		if node.table_name == None:
+			tables = list(self.catalog.values())
+		else:
+			tables = [self.get_table(node.table_name)]
+		for table in tables:
+			table.statistics = stats.analyze(table)
+
+	def save_snapshot(self, path, compress=False):
+		'''
+		Writes the schema and rows of every table to a snapshot file. If
+		compress is true, columns are compressed with zlib when that makes
+		them smaller.
+		'''
+		with self.write_lock:
+			snapshot.save(path, self.catalog, compress)
+
+	def load_snapshot(self, path):
+		'''
+		Creates the tables of a snapshot file, replacing tables with the same
+		names. The rows are not type checked since they were checked before
+		the snapshot was saved.
+
+		Either every table of the snapshot is loaded or none is. Stored tables
+		are written to new files which are not logged and only replace the
+		old tables when the checkpoint saving the catalog completes, so a
+		crash while loading leaves the old tables in place.
+		'''
+		with snapshot.garbage_collection_paused(), self.write_lock:
+			if self.wal == None:
+				loaded = {}
+				for name, columns, rows in snapshot.load(path):
+					loaded[name] = relation.MaterialRelation(columns, name)
+					loaded[name].load(rows)
+				self.catalog.update(loaded)
+				self.__refresh_views()
+				return
+			loaded = {}
+			try:
+				for name, columns, rows in snapshot.load(path):
+					if name in loaded:
+						loaded[name].close()
+					loaded[name] = storage.DiskRelation.create(
+						os.path.join(self.path, storage.table_file_name(
+							name, self.wal.reserve_lsn())),
+						columns, name, self.buffer_pool)
+					loaded[name].load(rows)
+			except BaseException:
+				# The files of the new tables are removed by the next
+				# checkpoint
+				for table in loaded.values():
+					table.close()
+				raise
+			replaced = [self.catalog[name] for name in loaded
+						if name in self.catalog]
+			self.catalog.update(loaded)
+			# The rows are not logged, so they are made durable by writing the
+			# tables
+			self.checkpoint()
+			for table in replaced:
+				table.close()
+			self.__refresh_views()
+
+	def __refresh_views(self):
+		'''
+		Computes views again after tables were replaced. Views replaced by a
+		table are dropped.
+		'''
+		for name, view in list(self.views.items()):
+			if self.catalog.get(name) is not view.table:
+				del self.views[name]
+			else:
+				view.refresh(self.catalog)
+
+	def attach(self, path, name=None):
+		'''
+		Adds the read only table in a columnar file to the catalog under the
+		given name or the name it was written with. Attached tables are not
+		recorded in the catalog of a database with stored tables.
+		'''
+		table = columnar.MappedRelation(path)
+		name = name or table.name
+		table.set_name(name)
+		with self.write_lock:
+			self.catalog[name] = table
+		return table
+
+	def encode_table(self, table_name, encodings=None):
+		'''
+		Replaces a table with a read only copy whose columns are compressed.
+		Encodings may be given for columns by name and are otherwise chosen
+		from the values of each column. Returns the encoded table, whose
+		memory_report shows the memory used by each column.
+		'''
+		with self.write_lock:
+			table = self.get_table(table_name)
+			if type(table) != relation.MaterialRelation:
+				raise TypeError('Only in memory tables can be encoded')
+			encoded = encoding.EncodedRelation(table, table_name, encodings)
+			self.catalog[table_name] = encoded
+		return encoded
+
+	def checkpoint(self):
+		'''
+		Writes stored tables to their files, records the log position they
+		are current to in the catalog and empties the log. Files of tables
+		which have been replaced are removed.
+		'''
+		with self.write_lock:
+			stored_tables = {name: table
+				for name, table in self.catalog.items()
+				if type(table) == storage.DiskRelation}
+			for table in stored_tables.values():
+				table.flush(sync=True)
+			storage.save_catalog(self.path, stored_tables,
+									self.wal.next_lsn - 1)
+			self.wal.reset()
+			table_files = {os.path.basename(table.path)
+							for table in stored_tables.values()}
+			for file_name in os.listdir(self.path):
+				if storage.is_table_file_name(file_name) and (
+						file_name not in table_files):
+					os.remove(os.path.join(self.path, file_name))
+
+	def close(self):
+		'''
+		Stops the worker processes and checkpoints and closes the files of a
+		database with stored tables.
+		'''
+		if self.executor != None:
+			self.executor.close()
+		if self.wal == None:
+			return
+		if self.checkpointer != None:
+			self.checkpointer.stop()
+		self.checkpoint()
+		self.wal.close()
+		for table in self.catalog.values():
+			table.close()
+
+	def get_table(self, table_name):
 		if table_name not in self.catalog:
 			raise KeyError('Table %r does not exist' % table_name)
-		table = self.catalog[table_name]
-		# TODO: move atomic insert logic into MaterialRelation
-		checkpoint_index = len(table.rows)
-		try:
-			for values in tuples:
-				table.insert(values)
-		except Exception as e:
-			table.rows = table.rows[:checkpoint_index]
-			raise e
+		return self.catalog[table_name]
+
+	def get_statistics(self, table_name):
+		'''
+		Returns the statistics from the last ANALYZE of the table or None if
+		the table has not been analyzed.
+		'''
+		return self.get_table(table_name).statistics
+
+	def compile_query(self, query):
+		plan = cse.eliminate_common_subexpressions(query.compile(self.catalog))
+		if self.executor != None:
+			plan = parallel.parallelize(plan, self.executor)
+		token = relation.CancellationToken(self.statement_timeout)
+		plan.set_token(token)
+		plan.set_memory(memory.MemoryTracker(self.query_memory_limit,
+												self.buffer_pool))
+		plan.query_id = next(self.query_ids)
+		self.queries[plan.query_id] = token
+		return plan
+
+	def cancel(self, query_id):
+		'''
+		Cancels the query with the query_id of its result, whose rows then
+		raise QueryCancelled. Returns False if the query is unknown, which it
+		is once its result is no longer used.
+		'''
+		token = self.queries.get(query_id)
+		if token == None:
+			return False
+		token.cancel()
+		return True
+
+	def __execute_set(self, ast_root):
+		if ast_root.name not in ('statement_timeout', 'query_memory_limit'):
+			raise ValueError('Unknown setting %r' % ast_root.name)
+		if type(ast_root.value) != int or ast_root.value < 0:
+			raise ValueError('%s must be a non-negative integer' %
+								ast_root.name)
+		if ast_root.name == 'statement_timeout':
+			# In milliseconds
+			self.statement_timeout = ast_root.value / 1000 or None
+		else:
+			self.query_memory_limit = ast_root.value or None
 
-	def execute(self, sql_command):
-		ast_root = parser.parse(sql_command, lexer=lexer)
+	def execute(self, sql_command, parameters=(), cache=True):
+		'''
+		Executes a statement, returning a relation with the result of
+		queries. The values of parameters replace the ? placeholders of the
+		statement in order. Results of queries are read from and stored in
+		the result cache, if the database has one, unless cache is false.
+		'''
+		ast_root = parse(sql_command, parameters)
 		statement_type = type(ast_root)
 		if statement_type == CreateTableNode:
 			self.__execute_create_table(ast_root)
+		elif statement_type == CreateIndexNode:
+			self.__execute_create_index(ast_root)
+		elif statement_type == CreateViewNode:
+			self.__execute_create_view(ast_root)
 		elif statement_type == InsertIntoNode:
 			self.__execute_insert(ast_root)
+		elif statement_type == AnalyzeNode:
+			self.__execute_analyze(ast_root)
+		elif statement_type == SaveNode:
+			self.save_snapshot(ast_root.path, ast_root.compress)
+		elif statement_type == LoadNode:
+			self.load_snapshot(ast_root.path)
+		elif statement_type == SetNode:
+			self.__execute_set(ast_root)
+		elif statement_type == ExplainNode:
+			plan = self.compile_query(ast_root.query)
+			result = explain.explain(plan, ast_root.format, ast_root.analyze)
+			result.query_id = plan.query_id
+			return result
 		elif statement_type == SelectNode or statement_type == SetOperatorNode:
-			return ast_root.compile(self.catalog)
+			plan = self.compile_query(ast_root)
+			if self.result_cache == None or not cache:
+				return plan
+			result = self.result_cache.result(plan)
+			result.query_id = plan.query_id
+			return result
 		else:
 			raise TypeError('Unknown AST node type')
 
@@ -721,19 +1333,55 @@ class InputCompletion:
 			s for s in self.vocabulary if s.startswith(text)] + [None]
 		return results[state]
 
+class ShellInterrupts:
+	def __init__(self, db):
+		'''
+		Handles Ctrl-C while the shell runs a statement. Queries are cancelled
+		through their cancellation tokens, so they stop at their next check.
+		Statements changing the database are never interrupted: an insert or
+		the maintenance of views runs to completion rather than stopping
+		part way through.
+		'''
+		self.db = db
+		self.interrupted = False
+
+	def __call__(self, signum, frame):
+		self.interrupted = True
+		for query_id in list(self.db.queries):
+			self.db.cancel(query_id)
+
 if __name__ == '__main__':
-	db = Db()
+	db = Db(sys.argv[1] if len(sys.argv) > 1 else None)
 	input_completion = InputCompletion(db)
+	interrupts = ShellInterrupts(db)
 	while True:
 		input_completion.refresh_vocabulary()
-		line = input('$ ')
+		try:
+			line = input('$ ')
+		except EOFError:
+			db.close()
+			break
+		except KeyboardInterrupt:
+			print()
+			continue
+		# Ctrl-C cancels the running query rather than the session
+		interrupts.interrupted = False
+		signal.signal(signal.SIGINT, interrupts)
 		try:
 			result = db.execute(line)
+			if result == None:
+				print('Success!')
+				if interrupts.interrupted:
+					print('not cancelled: the statement changes the database')
+				continue
+			if interrupts.interrupted:
+				# Interrupted before the query was compiled
+				db.cancel(result.query_id)
+			for row in result:
+				print(row)
+		except relation.QueryCancelled:
+			print('cancelled')
 		except Exception as e:
 			print('error:', e)
-			continue
-		if not result:
-			print('Success!')
-			continue
-		for row in result:
-			print(row)
+		finally:
+			signal.signal(signal.SIGINT, signal.default_int_handler)
@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 
 from repl import *
+import json
+import os
+import shutil
+import signal
+import tempfile
 import unittest
 
 class TestCreateTable(unittest.TestCase):
@@ -147,6 +152,494 @@ class TestInsertInto(unittest.TestCase):
 
 		self.assertEqual(list(db.catalog['t']), [(1, 'a'), (2, 'b')])
 
+class TestAnalyze(unittest.TestCase):
+
+	def test_should_compute_statistics_for_table(self):
+		db = Db()
+		db.execute('create table t (a integer, b string);')
+		db.execute('''insert into t values (1, 'x'), (2, null), (2, 'y');''')
+		self.assertIsNone(db.get_statistics('t'))
+
+		db.execute('analyze t;')
+
+		statistics = db.get_statistics('t')
+		self.assertEqual(statistics.row_count, 3)
+		self.assertEqual(statistics.column(0).distinct_count, 2)
+		self.assertEqual(statistics.column(0).min, 1)
+		self.assertEqual(statistics.column(0).max, 2)
+		self.assertAlmostEqual(statistics.column(1).null_fraction, 1/3)
+
+	def test_should_analyze_all_tables(self):
+		db = Db()
+		db.execute('create table t (a integer);')
+		db.execute('create table s (a integer);')
+		db.execute('insert into s values (1);')
+
+		db.execute('analyze;')
+
+		self.assertEqual(db.get_statistics('t').row_count, 0)
+		self.assertEqual(db.get_statistics('s').row_count, 1)
+
+	def test_should_raise_error_for_non_existing_table(self):
+		db = Db()
+		with self.assertRaisesRegex(KeyError, 'Table .* does not exist'):
+			db.execute('analyze dne;')
+
+	def test_failed_insert_should_not_change_row_count(self):
+		db = Db()
+		db.execute('create table t (a integer not null);')
+		db.execute('insert into t values (1);')
+		with self.assertRaises(TypeError):
+			db.execute('insert into t values (2), (null);')
+		self.assertEqual(db.catalog['t'].row_count, 1)
+
+class TestExplain(unittest.TestCase):
+
+	def test_should_describe_query_plan(self):
+		db = Db()
+		db.execute('create table t (a integer, b string);')
+		db.execute('''insert into t values (1, 'x'), (2, 'y');''')
+
+		cursor = db.execute('explain select b from t where a = 1;')
+
+		self.assertEqual([row[0] for row in cursor], [
+			'GeneralizedProjection  (rows=0)',
+			'  columns: b',
+			'  expressions: b',
+			'      ->  Selection  (rows=0)',
+			'          columns: a, b',
+			'          predicate: (a = 1)',
+			'            ->  MaterialRelation  (rows=2)',
+			'                table: t',
+			'                columns: a, b',
+		])
+
+	def test_estimates_should_use_statistics(self):
+		db = Db()
+		db.execute('create table t (a integer);')
+		db.execute('insert into t values (1), (2), (3), (4);')
+		db.execute('analyze t;')
+
+		cursor = db.execute('explain (format json) select a from t where a = 1;')
+
+		plan = json.loads(list(cursor)[0][0])
+		self.assertEqual(plan['operator'], 'GeneralizedProjection')
+		self.assertEqual(plan['estimated_rows'], 1)
+		self.assertEqual(plan['inputs'][0]['operator'], 'Selection')
+
+	def test_should_explain_set_operations(self):
+		db = Db()
+		db.execute('create table t (a integer);')
+
+		cursor = db.execute('explain select a from t except select a from t;')
+
+		self.assertEqual(list(cursor)[0], ('Difference  (rows=0)',))
+
+	def test_explain_analyze_should_report_actual_rows(self):
+		db = Db()
+		db.execute('create table t (a integer);')
+		db.execute('insert into t values (1), (2), (3), (4);')
+
+		cursor = db.execute('explain analyze select a from t where a > 2;')
+
+		lines = [row[0] for row in cursor]
+		self.assertRegex(lines[0], r'^GeneralizedProjection  \(rows=1\) '
+			r'\(actual rows=2 loops=1 time=[0-9.]+ ms cpu=[0-9.]+ ms\)$')
+		self.assertIn('  rows in: 2', lines)
+
+		cursor = db.execute(
+			'explain (analyze, format json) select a from t where a > 2;')
+
+		plan = json.loads(list(cursor)[0][0])
+		self.assertEqual(plan['actual_rows'], 2)
+		self.assertEqual(plan['inputs'][0]['rows_in'], 4)
+
+	def test_should_raise_error_for_unknown_option(self):
+		db = Db()
+		db.execute('create table t (a integer);')
+
+		with self.assertRaisesRegex(ValueError, 'EXPLAIN format'):
+			db.execute('explain (format yaml) select a from t;')
+		with self.assertRaisesRegex(ValueError, 'EXPLAIN option'):
+			db.execute('explain (verbose yes) select a from t;')
+
+class TestCreateIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.db = Db()
+		self.db.execute('create table t (id integer, v string);')
+		self.db.execute('''insert into t values
+			(1, 'a'), (2, 'b'), (3, 'c'), (2, 'd'), (null, 'e');''')
+
+	def test_should_use_index_for_point_lookup(self):
+		self.db.execute('create index t_id on t (id) using hash;')
+
+		self.assertEqual(list(self.db.execute('select v from t where id = 2;')),
+			[('b',), ('d',)])
+		plan = [row[0] for row in self.db.execute(
+			'explain select v from t where id = 2;')]
+		self.assertIn('          index: t_id using hash (id)', plan)
+
+	def test_should_use_index_for_in_list(self):
+		self.db.execute('create index t_id on t (id);')
+
+		cursor = self.db.execute(
+			'select v from t where id in (3, 1) and v <> \'c\';')
+
+		self.assertEqual(list(cursor), [('a',)])
+
+	def test_should_maintain_index_on_insert(self):
+		self.db.execute('create index t_id on t (id);')
+		self.db.execute('insert into t values (4, \'f\');')
+
+		self.assertEqual(list(self.db.execute('select v from t where id = 4;')),
+			[('f',)])
+
+	def test_failed_insert_should_roll_back_index(self):
+		self.db.execute('create table u (id integer, v string not null);')
+		self.db.execute('create index u_id on u (id);')
+		with self.assertRaisesRegex(TypeError, 'NULL value'):
+			self.db.execute('insert into u values (1, \'a\'), (2, null);')
+
+		self.assertEqual(self.db.catalog['u'].indexes['u_id'].entries, {})
+		self.assertEqual(list(self.db.execute('select v from u where id = 1;')),
+			[])
+
+	def test_should_use_ordered_index_for_range(self):
+		self.db.execute('create index t_id on t (id) using btree;')
+
+		cursor = self.db.execute(
+			'select v from t where id >= 2 and id < 3;')
+		self.assertEqual(list(cursor), [('b',), ('d',)])
+
+		cursor = self.db.execute(
+			'select id, count(1) from t where id > 1 group by id;')
+		self.assertEqual(list(cursor), [(2, 2), (3, 1)])
+
+		plan = [row[0] for row in self.db.execute(
+			'explain select id, count(1) from t where id > 1 group by id;')]
+		self.assertIn('                input already sorted: True', plan)
+
+	def test_should_raise_error_for_duplicate_index(self):
+		self.db.execute('create table u (id integer);')
+		self.db.execute('create index i on t (id);')
+		with self.assertRaisesRegex(ValueError, 'already exists'):
+			self.db.execute('create index i on u (id);')
+
+	def test_should_raise_error_for_unknown_table_or_method(self):
+		with self.assertRaisesRegex(KeyError, 'does not exist'):
+			self.db.execute('create index i on dne (id);')
+		with self.assertRaisesRegex(ValueError, 'method'):
+			self.db.execute('create index i on t (id) using gist;')
+
+class TestZoneMaps(unittest.TestCase):
+
+	def test_should_report_skipped_chunks(self):
+		db = Db()
+		db.execute('create table t (ts integer, v integer);')
+		db.catalog['t'].chunk_size = 2
+		db.execute('insert into t values (1, 1), (2, 2), (3, 3), (4, 4);')
+
+		self.assertEqual(list(db.execute('select v from t where ts > 2;')),
+			[(3,), (4,)])
+
+		cursor = db.execute('explain analyze select v from t where ts > 2;')
+
+		plan = [row[0].strip() for row in cursor]
+		self.assertIn('zone map filter: ts > 2', plan)
+		self.assertIn('chunks read: 1', plan)
+		self.assertIn('chunks skipped: 1', plan)
+
+class TestStoredTables(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_tables_should_survive_reopening_database(self):
+		db = Db(self.directory)
+		db.execute('create table t (a integer not null, b string);')
+		db.execute("insert into t values (1, 'one'), (2, null);")
+		db.close()
+
+		db = Db(self.directory)
+		self.assertEqual(list(db.execute('select b from t where a = 1;')),
+			[('one',)])
+		db.execute("insert into t values (3, 'three');")
+		self.assertEqual(list(db.execute('select a from t;')),
+			[(1,), (2,), (3,)])
+		db.close()
+
+	def test_should_recover_logged_changes_after_crash(self):
+		db = Db(self.directory, checkpoint_interval=None)
+		db.execute('create table t (a integer, b string);')
+		db.execute("insert into t values (1, 'one');")
+		db.checkpoint()
+		db.execute("insert into t values (2, 'two'), (3, null);")
+		db.execute('create table u (c boolean);')
+		db.execute('insert into u values (true);')
+		# Simulate a crash by abandoning the database without closing it
+		db.wal.close()
+
+		db = Db(self.directory)
+		self.assertEqual(list(db.execute('select a, b from t;')),
+			[(1, 'one'), (2, 'two'), (3, None)])
+		self.assertEqual(list(db.execute('select c from u;')), [(True,)])
+		db.close()
+
+	def test_recovery_should_not_duplicate_rows_already_stored(self):
+		db = Db(self.directory, checkpoint_interval=None)
+		db.execute('create table t (a integer);')
+		db.execute('insert into t values (1), (2);')
+		# The table file is written but the checkpoint is not completed
+		db.get_table('t').flush(sync=True)
+		db.wal.close()
+
+		db = Db(self.directory)
+		self.assertEqual(list(db.execute('select a from t;')), [(1,), (2,)])
+		db.close()
+
+	def test_recovery_should_ignore_incomplete_log_record(self):
+		db = Db(self.directory, checkpoint_interval=None)
+		db.execute('create table t (a integer);')
+		db.execute('insert into t values (1);')
+		db.wal.file.write(b'partial record')
+		db.wal.close()
+
+		db = Db(self.directory)
+		self.assertEqual(list(db.execute('select a from t;')), [(1,)])
+		db.execute('insert into t values (2);')
+		db.close()
+		db = Db(self.directory)
+		self.assertEqual(list(db.execute('select a from t;')), [(1,), (2,)])
+		db.close()
+
+	def test_replaced_table_should_not_keep_old_rows(self):
+		db = Db(self.directory)
+		db.execute('create table t (a integer);')
+		db.execute('insert into t values (1);')
+		db.execute('create table t (b string);')
+		db.close()
+		db = Db(self.directory)
+		self.assertEqual(list(db.execute('select b from t;')), [])
+		db.close()
+		self.assertEqual(len([f for f in os.listdir(self.directory)
+							if f.endswith('.tbl')]), 1)
+
+	def test_failed_insert_should_not_be_logged(self):
+		db = Db(self.directory, checkpoint_interval=None)
+		db.execute('create table t (a integer not null);')
+		size = db.wal.size()
+		with self.assertRaises(TypeError):
+			db.execute('insert into t values (1), (null);')
+		self.assertEqual(db.wal.size(), size)
+		db.close()
+
+	def test_failed_insert_should_not_be_stored(self):
+		db = Db(self.directory)
+		db.execute('create table t (a integer not null);')
+		with self.assertRaises(TypeError):
+			db.execute('insert into t values (1), (null);')
+		db.close()
+		db = Db(self.directory)
+		self.assertEqual(list(db.execute('select a from t;')), [])
+		db.close()
+
+class TestSnapshots(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'snapshot')
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def make_db(self):
+		db = Db()
+		db.execute('create table t (a integer not null, b string);')
+		db.execute("insert into t values (1, 'one'), (2, null);")
+		return db
+
+	def test_should_restore_saved_tables(self):
+		self.make_db().execute("save '%s';" % self.path)
+		db = Db()
+		db.execute('create table u (c float);')
+		db.execute("load '%s';" % self.path)
+		self.assertEqual(list(db.execute('select a, b from t;')),
+			[(1, 'one'), (2, None)])
+		self.assertEqual(db.get_table('t').columns[0].nullable, False)
+		self.assertIn('u', db.catalog)
+
+	def test_should_save_compressed_snapshots(self):
+		self.make_db().execute("save '%s' using zlib;" % self.path)
+		db = Db()
+		db.load_snapshot(self.path)
+		self.assertEqual(list(db.execute('select a from t;')), [(1,), (2,)])
+		with self.assertRaisesRegex(ValueError, 'compression'):
+			db.execute("save '%s' using lz4;" % self.path)
+
+	def test_loaded_stored_tables_should_survive_reopening(self):
+		self.make_db().save_snapshot(self.path)
+		stored = os.path.join(self.directory, 'db')
+		db = Db(stored)
+		db.load_snapshot(self.path)
+		db.close()
+		db = Db(stored)
+		self.assertEqual(list(db.execute('select a, b from t;')),
+			[(1, 'one'), (2, None)])
+		db.close()
+
+	def test_failed_load_should_keep_stored_tables(self):
+		db = self.make_db()
+		db.execute('create table u (c boolean);')
+		db.save_snapshot(self.path)
+		with open(self.path, 'rb') as f:
+			data = f.read()
+		with open(self.path, 'wb') as f:
+			f.write(data[:-3])
+		stored = os.path.join(self.directory, 'db')
+		db = Db(stored, checkpoint_interval=None)
+		db.execute('create table t (a integer);')
+		db.execute('insert into t values (5);')
+		with self.assertRaisesRegex(ValueError, 'truncated'):
+			db.load_snapshot(self.path)
+		self.assertEqual(list(db.execute('select a from t;')), [(5,)])
+		# Simulate a crash by abandoning the database without closing it
+		db.wal.close()
+		db = Db(stored)
+		self.assertEqual(list(db.execute('select a from t;')), [(5,)])
+		self.assertEqual(len([f for f in os.listdir(stored)
+							if f.endswith('.tbl')]), 1)
+		db.close()
+
+class TestEncodeTable(unittest.TestCase):
+	def setUp(self):
+		self.db = Db()
+		self.db.execute('create table t (a integer, b boolean);')
+		self.db.execute('''insert into t values
+			(1, true), (1, false), (1, null), (2, true), (null, true);''')
+
+	def test_should_query_encoded_table(self):
+		table = self.db.encode_table('t', {'a': encoding.RUN_LENGTH})
+		self.assertIs(self.db.get_table('t'), table)
+		self.assertEqual([entry['encoding'] for entry in table.memory_report()],
+			[encoding.RUN_LENGTH, encoding.BITMAP])
+		self.assertEqual(list(self.db.execute('select b from t where a = 2;')),
+			[(True,)])
+		with self.assertRaisesRegex(TypeError, 'read only'):
+			self.db.execute('insert into t values (3, true);')
+
+	def test_aggregates_should_use_runs(self):
+		expected = list(self.db.execute(
+			'select count(b), count(a), sum(a), min(b), max(a) from t;'))
+		self.db.encode_table('t')
+		query = 'select count(b), count(a), sum(a), min(b), max(a) from t;'
+		self.assertEqual(list(self.db.execute(query)), expected)
+		plan = '\n'.join(row[0] for row in self.db.execute('explain ' + query))
+		self.assertIn('RunAggregation', plan)
+		self.assertIn('aggregates: count(b), count(a), sum(a)', plan)
+		plan = list(self.db.execute('explain ' +
+			'select a, count(b) from t group by a;'))
+		self.assertNotIn('RunAggregation', '\n'.join(row[0] for row in plan))
+
+	def test_aggregates_of_empty_table_should_have_no_rows(self):
+		self.db.execute('create table e (a integer);')
+		query = 'select count(a), sum(a) from e;'
+		self.assertEqual(list(self.db.execute(query)), [])
+		self.db.encode_table('e')
+		self.assertEqual(list(self.db.execute(query)), [])
+
+	def test_stored_tables_can_not_be_encoded(self):
+		directory = tempfile.mkdtemp()
+		try:
+			db = Db(directory, checkpoint_interval=None)
+			db.execute('create table s (a integer);')
+			with self.assertRaisesRegex(TypeError, 'in memory'):
+				db.encode_table('s')
+			db.close()
+		finally:
+			shutil.rmtree(directory)
+
+class TestParallelQueries(unittest.TestCase):
+	def test_should_run_pipelines_in_workers(self):
+		db = Db(parallel_workers=2)
+		db.executor.morsel_rows = 10
+		db.execute('create table t (a integer, b string);')
+		db.execute('insert into t values %s;' % ', '.join(
+			"(%d, 'x%d')" % (i, i) for i in range(100)))
+		query = 'select a + 1, b from t where a > 90;'
+		self.assertEqual(list(db.execute(query)),
+			[(i + 1, 'x%d' % i) for i in range(91, 100)])
+		plan = [row[0] for row in db.execute('explain ' + query)]
+		self.assertEqual(plan[0], 'ParallelPipeline  (rows=33)')
+		self.assertIn('  stages: filter (a > 90), project (a + 1), b', plan)
+		self.assertEqual(list(db.execute('select max(a) from t where a < 50;')),
+			[(49,)])
+		query = 'select b, count(a) from t where a < 3 group by b;'
+		self.assertEqual(list(db.execute(query)),
+			[('x0', 1), ('x1', 1), ('x2', 1)])
+		plan = [row[0] for row in db.execute('explain ' + query)]
+		self.assertIn('ParallelGroupBy', plan[3])
+		query = ('select b, approx_count_distinct(a) from t where a < 3 '
+					'group by b;')
+		self.assertEqual(list(db.execute(query)),
+			[('x0', 1), ('x1', 1), ('x2', 1)])
+		self.assertEqual(list(db.execute(
+			'select approx_count_distinct(a) from t;')), [(100,)])
+		query = 'select a from t where a > 96 union select a from t where a < 2;'
+		self.assertEqual(list(db.execute(query)),
+			[(0,), (1,), (97,), (98,), (99,)])
+		plan = [row[0] for row in db.execute('explain ' + query)]
+		self.assertEqual(sum('ParallelSort' in line for line in plan), 2)
+		db.close()
+		self.assertIsNone(db.executor.pool)
+
+class TestParameters(unittest.TestCase):
+	def test_placeholders_should_take_parameters_in_order(self):
+		db = Db()
+		db.execute('create table t (a integer, b string);')
+		db.execute('insert into t values (?, ?), (?, ?);',
+			(-1, "a 'quoted'\nline", 2, None))
+		self.assertEqual(list(db.execute('select b from t where a < ?;', [0])),
+			[("a 'quoted'\nline",)])
+		self.assertEqual(list(db.execute("select a from t where b = '?';")),
+			[])
+		with self.assertRaisesRegex(ValueError, 'Too many'):
+			db.execute('select a from t;', [1])
+
+class TestAttach(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'pets.col')
+		pets = relation.MaterialRelation(
+			[relation.Column('name', str), relation.Column('age', int)], 'pets')
+		pets.insert(('Spot', 3))
+		pets.insert(('Fido', 2))
+		columnar.write(self.path, pets)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_should_query_attached_table(self):
+		db = Db()
+		db.attach(self.path, 'animals')
+		self.assertEqual(
+			list(db.execute('select name from animals where age < 3;')),
+			[('Fido',)])
+		with self.assertRaisesRegex(TypeError, 'read only'):
+			db.execute("insert into animals values ('Rex', 1);")
+		db.get_table('animals').close()
+
+	def test_attached_tables_should_not_be_stored(self):
+		stored = os.path.join(self.directory, 'db')
+		db = Db(stored)
+		db.attach(self.path)
+		db.execute('create table t (a integer);')
+		db.close()
+		db = Db(stored)
+		self.assertEqual(list(db.catalog), ['t'])
+		db.close()
+
 class TestSelect(unittest.TestCase):
 
 	def test_select_all_columns(self):
@@ -942,6 +1435,16 @@ class TestSetOperations(unittest.TestCase):
 		with self.assertRaisesRegex(ValueError, 'same'):
 			db.execute('select s from t union select * from t;')
 
+	def test_in_list(self):
+		db = Db()
+		db.execute('create table t (a integer);')
+		db.execute('insert into t values (1), (2), (3), (null);')
+
+		cursor = db.execute('select a in (1, 3), a not in (1, 3) from t;')
+
+		self.assertEqual(list(cursor), [
+			(True, False), (False, True), (True, False), (None, None)])
+
 	# TODO:
 	# - table wildcard e.g. SELECT r.* FROM r, s
 	# TODO:
@@ -950,6 +1453,165 @@ class TestSetOperations(unittest.TestCase):
 	# select without a "FROM" e.g. "select 123;"
 	# TODO: short alias for select e.g. select x + 1 a from b;
 
+class TestCancellation(unittest.TestCase):
+	def setUp(self):
+		self.db = Db()
+		self.db.execute('create table t (a integer);')
+		for i in range(200):
+			self.db.execute('insert into t values (?);', (i,))
+
+	def test_statement_timeout_should_cancel_queries(self):
+		self.db.execute('set statement_timeout = 20;')
+		result = self.db.execute('select x.a from t as x, t as y, t as z;')
+		with self.assertRaisesRegex(relation.QueryCancelled, 'timeout'):
+			list(result)
+		self.db.execute('set statement_timeout = 0;')
+		self.assertIsNone(self.db.statement_timeout)
+		self.assertEqual(len(list(self.db.execute('select a from t;'))), 200)
+
+	def test_set_should_reject_unknown_settings(self):
+		with self.assertRaisesRegex(ValueError, 'Unknown setting'):
+			self.db.execute('set work_mem = 10;')
+		with self.assertRaisesRegex(ValueError, 'non-negative'):
+			self.db.execute("set statement_timeout = 'soon';")
+
+	def test_cancel_should_stop_a_running_query(self):
+		result = self.db.execute('select x.a from t as x, t as y;')
+		rows = iter(result)
+		next(rows)
+		self.assertTrue(self.db.cancel(result.query_id))
+		with self.assertRaisesRegex(relation.QueryCancelled, 'cancelled'):
+			list(rows)
+
+	def test_shell_interrupts_should_cancel_queries_but_not_writes(self):
+		interrupts = ShellInterrupts(self.db)
+		previous = signal.signal(signal.SIGINT, interrupts)
+		table = self.db.catalog['t']
+		insert = table.insert
+		def interrupted_insert(row):
+			signal.raise_signal(signal.SIGINT)
+			insert(row)
+		try:
+			result = self.db.execute('select a from t;')
+			table.insert = interrupted_insert
+			self.db.execute('insert into t values (1), (2), (3);')
+		finally:
+			del table.insert
+			signal.signal(signal.SIGINT, previous)
+		self.assertTrue(interrupts.interrupted)
+		self.assertEqual(table.row_count, 203)
+		with self.assertRaisesRegex(relation.QueryCancelled, 'cancelled'):
+			list(result)
+
+	def test_cancel_should_ignore_unknown_queries(self):
+		result = self.db.execute('select a from t;')
+		query_id = result.query_id
+		self.assertFalse(self.db.cancel(query_id + 1))
+		del result
+		self.assertFalse(self.db.cancel(query_id))
+
+class TestMemoryLimits(unittest.TestCase):
+	def test_sorts_should_spill_past_the_query_memory_limit(self):
+		db = Db(buffer_pool_size=2**20)
+		db.execute('create table t (a integer, b string);')
+		for i in range(500):
+			db.execute('insert into t values (?, ?);', (i % 10, 'x'*(i % 40)))
+		expected = list(db.execute('select a, count(b) from t group by a;'))
+		db.execute('set query_memory_limit = 10000;')
+		self.assertEqual(db.query_memory_limit, 10000)
+		plan = ''.join(row[0] for row in db.execute(
+			'explain analyze select a, count(b) from t group by a;'))
+		self.assertRegex(plan, r'spilled runs: [1-9]')
+		self.assertEqual(
+			list(db.execute('select a, count(b) from t group by a;')),
+			expected)
+		self.assertEqual(db.buffer_pool.reserved, 0)
+		db.execute('set query_memory_limit = 0;')
+		self.assertIsNone(db.query_memory_limit)
+
+class TestResultCache(unittest.TestCase):
+	def setUp(self):
+		self.db = Db(result_cache_size=2**20)
+		self.db.execute('create table t (a integer, b string);')
+		for i in range(20):
+			self.db.execute('insert into t values (?, ?);', (i % 4, str(i)))
+
+	def test_should_reuse_results_until_tables_change(self):
+		query = 'select a, count(b) from t where a > 0 group by a;'
+		expected = list(self.db.execute(query))
+		result = self.db.execute('SELECT a, count(b) FROM t WHERE a > 0 '
+									'GROUP BY a;')
+		self.assertIsInstance(result, resultcache.CachedResult)
+		self.assertEqual(list(result), expected)
+		self.db.execute("insert into t values (1, 'x');")
+		self.assertEqual(list(self.db.execute(query)),
+			[(1, 6), (2, 5), (3, 5)])
+		statistics = self.db.result_cache.statistics()
+		self.assertEqual(statistics['hits'], 1)
+		self.assertEqual(statistics['invalidations'], 1)
+
+	def test_queries_should_opt_out(self):
+		list(self.db.execute('select a from t;'))
+		result = self.db.execute('select a from t;', cache=False)
+		self.assertNotIsInstance(result, resultcache.CachedResult)
+		self.assertEqual(self.db.result_cache.statistics()['hits'], 0)
+
+class TestPredicateOrder(unittest.TestCase):
+	def test_guards_should_be_evaluated_before_divisions(self):
+		db = Db()
+		db.execute('create table t (x integer);')
+		db.execute('insert into t values %s;' % ', '.join(
+			'(%d)' % (i % 10) for i in range(5000)))
+		result = list(db.execute('select x from t where x <> 0 and 10 / x > 2;'))
+		self.assertEqual(sorted(set(result)), [(1,), (2,), (3,)])
+		self.assertEqual(len(result), 1500)
+		result = list(db.execute('select x from t where x = 0 or 10 / x > 2;'))
+		self.assertEqual(len(result), 2000)
+
+class TestApproxCountDistinct(unittest.TestCase):
+	def setUp(self):
+		self.db = Db()
+		self.db.execute('create table t (a integer, b string);')
+		self.db.execute('insert into t values %s;' % ', '.join(
+			"(%d, 'v%d')" % (i % 3, i % 2000) for i in range(6000)))
+
+	def test_should_estimate_distinct_values(self):
+		[(n, rough)] = self.db.execute('select approx_count_distinct(b), '
+										'approx_count_distinct(b, 6) from t;')
+		# Standard errors of 0.8% and 13%
+		self.assertLess(abs(n - 2000), 2000*4*0.008)
+		self.assertLess(abs(rough - 2000), 2000*4*0.13)
+		self.assertNotEqual(n, rough)
+		self.assertEqual(list(self.db.execute('select a, '
+			'approx_count_distinct(a) from t group by a;')),
+			[(0, 1), (1, 1), (2, 1)])
+
+	def test_should_check_arguments(self):
+		with self.assertRaisesRegex(ValueError, 'Precision'):
+			self.db.execute('select approx_count_distinct(b, 30) from t;')
+		with self.assertRaisesRegex(ValueError, 'one argument'):
+			self.db.execute('select sum(a, 2) from t;')
+
+class TestCommonSubexpressions(unittest.TestCase):
+	def setUp(self):
+		self.db = Db()
+		self.db.execute('create table t (a integer, b integer);')
+		self.db.execute('insert into t values (1, 2), (2, 3), (1, 4);')
+
+	def test_repeated_expressions_should_be_shared(self):
+		query = parse('select a*b + 1, (a*b + 1)*2 from t where a*b + 1 > 3;')
+		plan = self.db.compile_query(query)
+		self.assertIsInstance(plan.expressions[0], relation.SharedExpression)
+		self.assertIs(plan.expressions[1].lhs, plan.expressions[0])
+		self.assertEqual(list(plan), [(7, 14), (5, 10)])
+
+	def test_identical_aggregates_should_be_computed_once(self):
+		query = parse('select a, sum(b) as s, sum(b) + 1 as t, count(b) as n, '
+						'sum(b)*2 as d from t group by a;')
+		plan = self.db.compile_query(query)
+		self.assertEqual(len(plan.relation.aggregates), 2)
+		self.assertEqual(list(plan), [(1, 6, 7, 2, 12), (2, 3, 4, 1, 6)])
+
 # Insert into
 # TODO: use integer literal for floating point column
 
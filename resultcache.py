@@ -0,0 +1,213 @@
+'''
+A cache of query results keyed on the normalized plan of the query.
+
+The key of a plan describes the structure of its operators and expressions,
+so queries written differently but compiled to the same plan share an entry.
+Each entry records the versions of the tables the query read and is dropped
+when a lookup finds that any of them has changed since. Results are stored
+pickled, in a least recently used list bounded in total size, and expire a
+time to live after they were stored.
+'''
+
+import collections
+import math
+import pickle
+import threading
+import time
+
+import encoding
+import index
+import memory
+import parallel
+import relation
+
+DEFAULT_CAPACITY = 16*2**20
+# Seconds a result is kept
+DEFAULT_TTL = 300.0
+# Results larger than this fraction of the capacity are not stored
+MAX_ENTRY_FRACTION = 1/4
+
+def table_key(table, tables):
+	if not hasattr(table, 'version'):
+		raise TypeError('Table %r has no version' % table.name)
+	tables.append(table)
+	return ('table', table.name)
+
+def plan_key(node, tables):
+	'''
+	Returns a tuple describing the structure of a plan, which is equal for
+	plans producing the same rows in the same order from the same tables,
+	and appends the tables the plan reads to tables. Raises TypeError for
+	plans which can not be described.
+	'''
+	node_type = type(node)
+	if not node.inputs and not hasattr(node, 'table'):
+		return table_key(node, tables)
+	if node_type in index.index_scan_types:
+		return (node_type.__name__, table_key(node.table, tables),
+				node.index.name, node.predicate().key())
+	if node_type == relation.ZoneMapScan:
+		return (node_type.__name__, table_key(node.table, tables),
+				repr(sorted(node.ranges.items())), tuple(node.null_columns))
+	if node_type == encoding.RunAggregation:
+		return (node_type.__name__, table_key(node.table, tables),
+				tuple([aggregate.key() for aggregate in node.aggregates]))
+	if node_type == parallel.ParallelPipeline:
+		return (node_type.__name__, node.ordered, plan_key(node.plan, tables))
+	if node_type in (parallel.ParallelGroupBy, parallel.ParallelSort):
+		# The rows are the same as those of the serial plan
+		return plan_key(node.plan, tables)
+	if node_type == relation.Selection:
+		details = (node.predicate.key(),)
+	elif node_type == relation.GeneralizedProjection:
+		details = tuple([expression.key() for expression in node.expressions])
+	elif node_type == relation.Sort:
+		details = (tuple([column.index for column in node.sort_key or ()]),
+					node.descending, node.nulls_last)
+	elif node_type == relation.GroupBy:
+		details = (tuple([column.index for column in node.grouping_columns]),
+					tuple([aggregate.key() for aggregate in node.aggregates]))
+	elif isinstance(node, relation.SetCombination):
+		details = (node.distinct,)
+	elif node_type == relation.CrossJoin:
+		details = ()
+	else:
+		raise TypeError('%s plans have no key' % node_type.__name__)
+	return (node_type.__name__,) + details + tuple(
+		[plan_key(child, tables) for child in node.children()])
+
+class CacheEntry:
+	def __init__(self, data, versions, expires):
+		'Pickled rows of a result and the table versions they were read at.'
+		self.data = data
+		self.versions = versions
+		self.expires = expires
+
+class CachedResult(relation.Relation):
+	def __init__(self, plan, rows):
+		'The rows of a result read from the cache, with the columns of plan.'
+		self.name = plan.name
+		self.columns = plan.columns
+		self.token = plan.token
+		self.rows = rows
+
+	def __iter__(self):
+		return self.token.checked(self.rows)
+
+class CachingRelation(relation.Relation):
+	inputs = ('relation',)
+
+	def __init__(self, plan, cache, key, versions):
+		'''
+		Produces the rows of plan and stores them in the cache once they have
+		all been produced, unless they are too large to store.
+		'''
+		self.name = plan.name
+		self.columns = plan.columns
+		self.relation = plan
+		self.cache = cache
+		self.key = key
+		self.versions = versions
+
+	def __iter__(self):
+		rows = []
+		size = 0
+		for row in self.relation:
+			if rows != None:
+				rows.append(row)
+				size += memory.estimate_row_size(row)
+				# Rows take several times more memory than once pickled
+				if size > self.cache.capacity:
+					# Too large to store, so the rows are not kept
+					rows = None
+			yield row
+		if rows != None:
+			self.cache.store(self.key, self.versions, rows)
+
+class ResultCache:
+	def __init__(self, capacity=DEFAULT_CAPACITY, ttl=DEFAULT_TTL):
+		'''
+		Caches results of up to capacity bytes in total, pickled, for ttl
+		seconds or until their tables change, or without expiring if ttl is
+		None.
+		'''
+		self.capacity = capacity
+		self.ttl = ttl
+		self.entries = collections.OrderedDict()
+		self.size = 0
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.uncacheable = 0
+		self.evictions = 0
+		self.expirations = 0
+		self.invalidations = 0
+
+	def result(self, plan):
+		'''
+		Returns a relation with the rows of the plan, read from the cache if
+		they are stored and otherwise produced by the plan and stored once
+		they have all been read.
+		'''
+		tables = []
+		try:
+			key = plan_key(plan, tables)
+		except TypeError:
+			with self.lock:
+				self.uncacheable += 1
+			return plan
+		versions = tuple([table.version for table in tables])
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry != None and entry.versions != versions:
+				self.remove(key)
+				self.invalidations += 1
+			elif entry != None and entry.expires < time.monotonic():
+				self.remove(key)
+				self.expirations += 1
+			elif entry != None:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return CachedResult(plan, pickle.loads(entry.data))
+			self.misses += 1
+		return CachingRelation(plan, self, key, versions)
+
+	def store(self, key, versions, rows):
+		data = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+		if len(data) > self.capacity*MAX_ENTRY_FRACTION:
+			return
+		expires = math.inf
+		if self.ttl != None:
+			expires = time.monotonic() + self.ttl
+		with self.lock:
+			if key in self.entries:
+				self.remove(key)
+			self.entries[key] = CacheEntry(data, versions, expires)
+			self.size += len(data)
+			while self.size > self.capacity:
+				self.remove(next(iter(self.entries)))
+				self.evictions += 1
+
+	def remove(self, key):
+		self.size -= len(self.entries.pop(key).data)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.size = 0
+
+	def statistics(self):
+		'Returns the hit and miss counters and the memory used by the cache.'
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'hit_ratio': self.hits/lookups if lookups else 0.0,
+				'uncacheable': self.uncacheable,
+				'evictions': self.evictions,
+				'expirations': self.expirations,
+				'invalidations': self.invalidations,
+				'entries': len(self.entries),
+				'bytes': self.size,
+			}
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+from resultcache import *
+from relation import *
+import time
+import unittest
+
+class TestPlanKey(unittest.TestCase):
+	def setUp(self):
+		self.table = MaterialRelation([Column('a', int), Column('b', str)], 't')
+		self.table.load([(i, str(i % 3)) for i in range(10)])
+
+	def selection(self, value):
+		return Selection(self.table, Comparison('>',
+			Attribute(self.table.columns[0]), Constant(value)))
+
+	def key(self, plan):
+		tables = []
+		key = plan_key(plan, tables)
+		return key, tables
+
+	def test_equal_plans_should_have_equal_keys(self):
+		key, tables = self.key(self.selection(3))
+		self.assertEqual(key, self.key(self.selection(3))[0])
+		self.assertEqual(tables, [self.table])
+		self.assertNotEqual(key, self.key(self.selection(4))[0])
+
+	def test_keys_should_tell_columns_apart(self):
+		product = CrossJoin(self.table, self.table)
+		first = GeneralizedProjection(product, [Attribute(product.columns[0])])
+		second = GeneralizedProjection(product, [Attribute(product.columns[2])])
+		self.assertNotEqual(self.key(first)[0], self.key(second)[0])
+		self.assertEqual(len(self.key(first)[1]), 2)
+
+	def test_unknown_plans_should_have_no_key(self):
+		class Unknown(Relation):
+			inputs = ('relation',)
+		plan = Unknown(self.table.columns)
+		plan.relation = self.table
+		with self.assertRaises(TypeError):
+			self.key(plan)
+
+class TestResultCache(unittest.TestCase):
+	def setUp(self):
+		self.table = MaterialRelation([Column('a', int)], 't')
+		self.table.load([(i,) for i in range(100)])
+
+	def query(self, value=0):
+		return Selection(self.table, Comparison('>=',
+			Attribute(self.table.columns[0]), Constant(value)))
+
+	def test_should_return_stored_results(self):
+		cache = ResultCache()
+		first = cache.result(self.query())
+		self.assertIsInstance(first, CachingRelation)
+		expected = list(first)
+		second = cache.result(self.query())
+		self.assertIsInstance(second, CachedResult)
+		self.assertEqual(list(second), expected)
+		statistics = cache.statistics()
+		self.assertEqual((statistics['hits'], statistics['misses']), (1, 1))
+		self.assertEqual(statistics['entries'], 1)
+
+	def test_should_only_store_complete_results(self):
+		cache = ResultCache()
+		next(iter(cache.result(self.query())))
+		self.assertEqual(cache.statistics()['entries'], 0)
+
+	def test_changed_tables_should_invalidate_results(self):
+		cache = ResultCache()
+		list(cache.result(self.query()))
+		self.table.insert((100,))
+		result = cache.result(self.query())
+		self.assertIsInstance(result, CachingRelation)
+		self.assertEqual(len(list(result)), 101)
+		self.assertEqual(cache.statistics()['invalidations'], 1)
+
+	def test_results_should_expire(self):
+		cache = ResultCache(ttl=0)
+		list(cache.result(self.query()))
+		time.sleep(0.01)
+		self.assertIsInstance(cache.result(self.query()), CachingRelation)
+		self.assertEqual(cache.statistics()['expirations'], 1)
+
+	def test_should_evict_least_recently_used_results(self):
+		table = MaterialRelation([Column('a', int), Column('b', str)], 'u')
+		table.load([(i, '%d %s' % (i, 'x'*100)) for i in range(10)])
+		query = lambda value: Selection(table, Comparison('>=',
+			Attribute(table.columns[0]), Constant(value)))
+		# Each result takes about 1000 bytes
+		cache = ResultCache(capacity=5000)
+		for value in range(6):
+			list(cache.result(query(value)))
+		self.assertLessEqual(cache.size, 5000)
+		self.assertGreater(cache.statistics()['evictions'], 0)
+		self.assertIsInstance(cache.result(query(0)), CachingRelation)
+		self.assertIsInstance(cache.result(query(5)), CachedResult)
+
+	def test_should_not_store_large_results(self):
+		cache = ResultCache(capacity=1024)
+		list(cache.result(self.query()))
+		self.assertEqual(cache.statistics()['entries'], 0)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+'''
+Serves a database to many clients over TCP with the messages of protocol.py.
+
+Usage: server.py [DIRECTORY] [--host HOST] [--port PORT] [--threads N]
+'''
+
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import threading
+
+import protocol
+import repl
+
+DEFAULT_PORT = 5480
+# Rows sent in each batch of a result unless the request asks for another
+# number
+DEFAULT_BATCH_ROWS = 1000
+
+def take(rows, count):
+	'Returns a list of up to count rows of the iterator.'
+	return [list(row) for row in itertools.islice(rows, count)]
+
+class Session:
+	def __init__(self, session_id, peer, writer):
+		'State of a client connection.'
+		self.session_id = session_id
+		self.peer = peer
+		self.writer = writer
+		self.statements = 0
+
+class Server:
+	def __init__(self, db, host='127.0.0.1', port=DEFAULT_PORT, threads=None,
+			batch_rows=DEFAULT_BATCH_ROWS):
+		'''
+		Serves the database to clients connecting to the host and port, or to
+		a free port if port is 0. Statements are executed and results are
+		read by a pool of threads so the event loop keeps serving other
+		clients while queries run. Results are streamed in batches of
+		batch_rows rows, reading the next batch once the client has received
+		the previous ones.
+		'''
+		self.db = db
+		self.host = host
+		self.port = port
+		self.batch_rows = batch_rows
+		self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+		self.sessions = {}
+		self.session_ids = itertools.count(1)
+		self.server = None
+		self.loop = None
+		self.thread = None
+
+	async def start(self):
+		self.server = await asyncio.start_server(self.serve_client,
+													self.host, self.port)
+		self.port = self.server.sockets[0].getsockname()[1]
+
+	async def close(self):
+		'Stops accepting connections and closes the open ones.'
+		self.server.close()
+		for session in list(self.sessions.values()):
+			session.writer.close()
+		await self.server.wait_closed()
+		self.executor.shutdown(cancel_futures=True)
+
+	async def serve_forever(self):
+		await self.start()
+		try:
+			await self.server.serve_forever()
+		finally:
+			await self.close()
+
+	def run_in_thread(self):
+		'''
+		Serves in a new thread with its own event loop, returning once the
+		server accepts connections. stop_thread stops serving.
+		'''
+		started = threading.Event()
+		errors = []
+		def run():
+			self.loop = asyncio.new_event_loop()
+			asyncio.set_event_loop(self.loop)
+			try:
+				self.loop.run_until_complete(self.start())
+			except Exception as e:
+				errors.append(e)
+				started.set()
+				self.loop.close()
+				return
+			started.set()
+			self.loop.run_forever()
+			self.loop.run_until_complete(self.close())
+			# Let the handlers of the closed connections finish
+			tasks = asyncio.all_tasks(self.loop)
+			for task in tasks:
+				task.cancel()
+			self.loop.run_until_complete(
+				asyncio.gather(*tasks, return_exceptions=True))
+			self.loop.close()
+		self.thread = threading.Thread(target=run, daemon=True)
+		self.thread.start()
+		started.wait()
+		if errors:
+			raise errors[0]
+
+	def stop_thread(self):
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+
+	def run_in_executor(self, function, *args):
+		return asyncio.get_running_loop().run_in_executor(self.executor,
+															function, *args)
+
+	async def serve_client(self, reader, writer):
+		session = Session(next(self.session_ids),
+							writer.get_extra_info('peername'), writer)
+		self.sessions[session.session_id] = session
+		try:
+			protocol.write_message(writer, {'type': protocol.HELLO,
+											'session': session.session_id})
+			await writer.drain()
+			while True:
+				request = await protocol.read_message(reader)
+				if request == None or request.get('type') == protocol.CLOSE:
+					break
+				await self.handle_request(session, request)
+		except (ConnectionError, asyncio.IncompleteReadError,
+				protocol.ProtocolError):
+			# The client went away or does not speak the protocol
+			pass
+		finally:
+			del self.sessions[session.session_id]
+			writer.close()
+
+	async def handle_request(self, session, request):
+		request_id = request.get('id')
+		request_type = request.get('type')
+		if request_type == protocol.PING:
+			protocol.write_message(session.writer,
+				{'type': protocol.PONG, 'id': request_id})
+		elif request_type == protocol.EXECUTE:
+			await self.execute(session, request_id, request.get('sql'),
+				request.get('batch_rows') or self.batch_rows)
+		else:
+			self.send_error(session, request_id,
+				'Unknown request type %r' % request_type)
+		await session.writer.drain()
+
+	def send_error(self, session, request_id, message):
+		protocol.write_message(session.writer, {'type': protocol.ERROR,
+			'id': request_id, 'message': message})
+
+	async def execute(self, session, request_id, sql, batch_rows):
+		session.statements += 1
+		writer = session.writer
+		try:
+			if type(sql) != str:
+				raise TypeError('Execute requests need an sql string')
+			result = await self.run_in_executor(self.db.execute, sql)
+		except Exception as e:
+			self.send_error(session, request_id, str(e))
+			return
+		if result == None:
+			protocol.write_message(writer, {'type': protocol.DONE,
+				'id': request_id, 'row_count': None})
+			return
+		protocol.write_message(writer, {'type': protocol.DESCRIPTION,
+			'id': request_id,
+			'columns': protocol.describe_columns(result.columns)})
+		rows = iter(result)
+		row_count = 0
+		while True:
+			try:
+				batch = await self.run_in_executor(take, rows, batch_rows)
+			except Exception as e:
+				self.send_error(session, request_id, str(e))
+				return
+			if not batch:
+				break
+			row_count += len(batch)
+			protocol.write_message(writer, {'type': protocol.BATCH,
+				'id': request_id, 'rows': batch})
+			# Results are only read as fast as the client receives them
+			await writer.drain()
+		protocol.write_message(writer, {'type': protocol.DONE,
+			'id': request_id, 'row_count': row_count})
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('directory', nargs='?',
+						help='database directory, in memory if not given')
+	parser.add_argument('--host', default='127.0.0.1',
+						help='address to listen on')
+	parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+						help='port to listen on')
+	parser.add_argument('--threads', type=int,
+						help='threads executing statements')
+	arguments = parser.parse_args()
+	db = repl.Db(arguments.directory)
+	server = Server(db, arguments.host, arguments.port, arguments.threads)
+	try:
+		asyncio.run(server.serve_forever())
+	except KeyboardInterrupt:
+		pass
+	finally:
+		db.close()
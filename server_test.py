@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+from server import *
+import protocol
+import socket
+import unittest
+
+class TestServer(unittest.TestCase):
+	def setUp(self):
+		self.db = repl.Db()
+		self.db.execute('create table t (a integer not null, b string);')
+		self.db.execute('insert into t values %s;' % ', '.join(
+			"(%d, 'x%d')" % (i, i) for i in range(5)))
+		self.server = Server(self.db, port=0, batch_rows=2)
+		self.server.run_in_thread()
+		self.connections = []
+
+	def tearDown(self):
+		for connection in self.connections:
+			connection.close()
+		self.server.stop_thread()
+
+	def connect(self):
+		connection = socket.create_connection(('127.0.0.1', self.server.port))
+		self.connections.append(connection)
+		hello = protocol.receive_message(connection)
+		self.assertEqual(hello['type'], protocol.HELLO)
+		return connection
+
+	def execute(self, connection, sql, request_id=1):
+		protocol.send_message(connection, {'type': protocol.EXECUTE,
+			'id': request_id, 'sql': sql})
+		return self.responses(connection)
+
+	def responses(self, connection):
+		responses = []
+		while True:
+			response = protocol.receive_message(connection)
+			responses.append(response)
+			if response['type'] in (protocol.DONE, protocol.ERROR):
+				return responses
+
+	def test_should_stream_results_in_batches(self):
+		connection = self.connect()
+		responses = self.execute(connection, 'select a, b from t where a > 0;')
+		self.assertEqual([r['type'] for r in responses], [protocol.DESCRIPTION,
+			protocol.BATCH, protocol.BATCH, protocol.DONE])
+		self.assertEqual(responses[0]['columns'],
+			[['a', 'integer', False], ['b', 'string', True]])
+		self.assertEqual(responses[1]['rows'] + responses[2]['rows'],
+			[[1, 'x1'], [2, 'x2'], [3, 'x3'], [4, 'x4']])
+		self.assertEqual(responses[3]['row_count'], 4)
+
+	def test_statements_without_results(self):
+		connection = self.connect()
+		responses = self.execute(connection, 'insert into t values (9, null);')
+		self.assertEqual(responses, [{'type': protocol.DONE, 'id': 1,
+			'row_count': None}])
+		self.assertEqual(list(self.db.execute('select b from t where a = 9;')),
+			[(None,)])
+
+	def test_errors_should_not_end_the_session(self):
+		connection = self.connect()
+		responses = self.execute(connection, 'select nope from t;')
+		self.assertEqual(responses[0]['type'], protocol.ERROR)
+		protocol.send_message(connection, {'type': 'unknown', 'id': 2})
+		self.assertIn('Unknown request type',
+			protocol.receive_message(connection)['message'])
+		responses = self.execute(connection, 'select a from t where a = 3;')
+		self.assertEqual(responses[1]['rows'], [[3]])
+
+	def test_pipelined_requests_should_be_answered_in_order(self):
+		connection = self.connect()
+		for request_id in range(3):
+			protocol.send_message(connection, {'type': protocol.EXECUTE,
+				'id': request_id, 'sql': 'select a from t where a = %d;' %
+				request_id})
+		protocol.send_message(connection, {'type': protocol.PING, 'id': 3})
+		for request_id in range(3):
+			responses = self.responses(connection)
+			self.assertEqual({r['id'] for r in responses}, {request_id})
+			self.assertEqual(responses[1]['rows'], [[request_id]])
+		self.assertEqual(protocol.receive_message(connection),
+			{'type': protocol.PONG, 'id': 3})
+
+	def test_sessions_should_be_tracked(self):
+		first = self.connect()
+		second = self.connect()
+		self.execute(second, 'select a from t;')
+		self.assertEqual(len(self.server.sessions), 2)
+		protocol.send_message(first, {'type': protocol.CLOSE})
+		self.assertIsNone(protocol.receive_message(first))
+		self.assertEqual(len(self.server.sessions), 1)
+
+	def test_oversized_messages_should_close_the_connection(self):
+		connection = self.connect()
+		connection.sendall(protocol.MESSAGE_HEADER.pack(
+			protocol.MAX_MESSAGE_SIZE + 1))
+		self.assertIsNone(protocol.receive_message(connection))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,169 @@
+import array
+import contextlib
+import gc
+import itertools
+import os
+import struct
+import sys
+import zlib
+
+import storage
+
+SNAPSHOT_MAGIC = b'SQLSNP01'
+# magic, number of tables
+SNAPSHOT_HEADER = struct.Struct('<8sI')
+# length of the schema, number of rows
+TABLE_HEADER = struct.Struct('<IQ')
+# flags, stored length of the null map, stored length of the values
+COLUMN_HEADER = struct.Struct('<BQQ')
+
+# Column flags
+HAS_NULLS = 1
+COMPRESSED = 2
+
+array_typecodes = {
+	int: 'q',
+	float: 'd',
+}
+
+null_values = {
+	bool: False,
+	int: 0,
+	float: 0.0,
+	str: '',
+}
+
+@contextlib.contextmanager
+def garbage_collection_paused():
+	'''
+	Pauses the cyclic garbage collector, which would otherwise repeatedly
+	traverse the millions of rows created by a large load although rows can
+	not form reference cycles.
+	'''
+	enabled = gc.isenabled()
+	gc.disable()
+	try:
+		yield
+	finally:
+		if enabled:
+			gc.enable()
+
+def to_little_endian(values):
+	if sys.byteorder == 'big':
+		values.byteswap()
+	return values
+
+def encode_values(column_type, values):
+	if column_type in array_typecodes:
+		return to_little_endian(
+			array.array(array_typecodes[column_type], values)).tobytes()
+	if column_type == bool:
+		return bytes(values)
+	encoded = [value.encode('utf-8') for value in values]
+	lengths = to_little_endian(array.array('I', map(len, encoded)))
+	return lengths.tobytes() + b''.join(encoded)
+
+def decode_values(column_type, data, row_count):
+	if column_type in array_typecodes:
+		values = array.array(array_typecodes[column_type])
+		values.frombytes(data)
+		return to_little_endian(values).tolist()
+	if column_type == bool:
+		return [value == 1 for value in data]
+	lengths = array.array('I')
+	lengths.frombytes(data[:4*row_count])
+	lengths = to_little_endian(lengths)
+	text = data[4*row_count:]
+	offsets = list(itertools.accumulate(lengths, initial=0))
+	decoded = text.decode('utf-8')
+	if len(decoded) == len(text):
+		# Only single byte characters, so byte lengths are character lengths
+		return [decoded[start:end]
+				for start, end in zip(offsets, itertools.islice(offsets, 1, None))]
+	return [text[start:end].decode('utf-8')
+			for start, end in zip(offsets, itertools.islice(offsets, 1, None))]
+
+def encode_column(column_type, values, compress):
+	'''
+	Returns the stored form of the values of a column: a header followed by
+	a map of null values, which is empty if there are none, and the values.
+	When compress is true, the column is compressed if that makes it smaller.
+	'''
+	flags = 0
+	null_map = b''
+	if None in values:
+		flags |= HAS_NULLS
+		null_map = bytes([value == None for value in values])
+		null_value = null_values[column_type]
+		values = [null_value if value == None else value for value in values]
+	data = encode_values(column_type, values)
+	if compress:
+		compressed_null_map = zlib.compress(null_map)
+		compressed_data = zlib.compress(data)
+		if len(compressed_null_map) + len(compressed_data) < (
+				len(null_map) + len(data)):
+			flags |= COMPRESSED
+			null_map, data = compressed_null_map, compressed_data
+	return COLUMN_HEADER.pack(flags, len(null_map), len(data)) + (
+			null_map + data)
+
+def read_exactly(f, size):
+	data = f.read(size)
+	if len(data) != size:
+		raise ValueError('Snapshot file is truncated')
+	return data
+
+def read_column(f, column_type, row_count):
+	flags, null_map_length, data_length = COLUMN_HEADER.unpack(
+		read_exactly(f, COLUMN_HEADER.size))
+	null_map = read_exactly(f, null_map_length)
+	data = read_exactly(f, data_length)
+	if flags & COMPRESSED:
+		null_map = zlib.decompress(null_map)
+		data = zlib.decompress(data)
+	values = decode_values(column_type, data, row_count)
+	if flags & HAS_NULLS:
+		values = [None if is_null else value
+					for value, is_null in zip(values, null_map)]
+	return values
+
+def save(path, tables, compress=False):
+	'''
+	Writes the schemas and rows of the tables, given by name, to a snapshot
+	file. The file is replaced atomically.
+	'''
+	temporary_path = path + '.tmp'
+	with open(temporary_path, 'wb') as f:
+		f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(tables)))
+		for name, table in tables.items():
+			schema = storage.encode_schema(name, table.columns)
+			rows = list(table)
+			f.write(TABLE_HEADER.pack(len(schema), len(rows)) + schema)
+			for column in table.columns:
+				values = [row[column.index] for row in rows]
+				f.write(encode_column(column.type, values, compress))
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(temporary_path, path)
+
+def load(path):
+	'''
+	Reads a snapshot file and returns a list of (name, columns, rows) for
+	each of its tables.
+	'''
+	tables = []
+	with open(path, 'rb') as f:
+		header = f.read(SNAPSHOT_HEADER.size)
+		if len(header) != SNAPSHOT_HEADER.size or (
+				not header.startswith(SNAPSHOT_MAGIC)):
+			raise ValueError('%r is not a snapshot file' % path)
+		magic, table_count = SNAPSHOT_HEADER.unpack(header)
+		for i in range(table_count):
+			schema_length, row_count = TABLE_HEADER.unpack(
+				read_exactly(f, TABLE_HEADER.size))
+			name, columns, _ = storage.decode_schema(
+				read_exactly(f, schema_length))
+			values = [read_column(f, column.type, row_count)
+						for column in columns]
+			tables.append((name, columns, list(zip(*values))))
+	return tables
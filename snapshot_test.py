@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+from relation import *
+from snapshot import *
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+class TestColumns(unittest.TestCase):
+	def round_trip(self, column_type, values, compress=False):
+		data = encode_column(column_type, values, compress)
+		return read_column(io.BytesIO(data), column_type, len(values))
+
+	def test_should_round_trip_each_type(self):
+		columns = [
+			(int, [0, -2**63, 2**63 - 1, 5]),
+			(float, [0.5, -1e300, 3.0]),
+			(bool, [True, False, True]),
+			(str, ['', 'abc', "it's"]),
+			(str, ['héllo', '', 'wörld']),
+		]
+		for column_type, values in columns:
+			self.assertEqual(self.round_trip(column_type, values), values)
+
+	def test_should_round_trip_nulls(self):
+		for column_type, values in [(int, [None, 1, None]),
+									(str, ['a', None, 'é']),
+									(bool, [None, True, False])]:
+			self.assertEqual(self.round_trip(column_type, values), values)
+			self.assertEqual(self.round_trip(column_type, values, True),
+				values)
+
+	def test_should_compress_only_when_smaller(self):
+		repetitive = encode_column(int, [7]*1000, True)
+		self.assertTrue(COLUMN_HEADER.unpack_from(repetitive)[0] & COMPRESSED)
+		self.assertLess(len(repetitive), 1000)
+		tiny = encode_column(int, [7], True)
+		self.assertFalse(COLUMN_HEADER.unpack_from(tiny)[0] & COMPRESSED)
+		self.assertEqual(self.round_trip(int, [7]*1000, True), [7]*1000)
+
+class TestSnapshot(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'snapshot')
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_should_round_trip_tables(self):
+		pets = MaterialRelation([Column('name', str, False),
+								Column('age', int), Column('weight', float),
+								Column('vaccinated', bool)], 'pets')
+		for row in [('Spot', 3, 10.5, True), ('Mittens', None, 4.0, None)]:
+			pets.insert(row)
+		empty = MaterialRelation([Column('a', int)], 'empty')
+		for compress in (False, True):
+			save(self.path, {'pets': pets, 'empty': empty}, compress)
+			tables = load(self.path)
+			self.assertEqual([name for name, columns, rows in tables],
+				['pets', 'empty'])
+			name, columns, rows = tables[0]
+			self.assertEqual([(c.name, c.type, c.nullable) for c in columns],
+				[(c.name, c.type, c.nullable) for c in pets.columns])
+			self.assertEqual(rows, list(pets))
+			self.assertEqual(tables[1][2], [])
+
+	def test_should_reject_other_files(self):
+		with open(self.path, 'wb') as f:
+			f.write(b'not a snapshot')
+		with self.assertRaisesRegex(ValueError, 'not a snapshot'):
+			load(self.path)
+
+	def test_should_reject_truncated_files(self):
+		table = MaterialRelation([Column('a', int)], 't')
+		table.insert((1,))
+		save(self.path, {'t': table})
+		with open(self.path, 'rb') as f:
+			data = f.read()
+		with open(self.path, 'wb') as f:
+			f.write(data[:-1])
+		with self.assertRaisesRegex(ValueError, 'truncated'):
+			load(self.path)
+
+if __name__ == '__main__':
+	unittest.main()
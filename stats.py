@@ -0,0 +1,340 @@
+import bisect
+import math
+import random
+
+import index
+import parallel
+import relation
+
+# Number of rows ANALYZE examines. Tables with more rows are sampled so the
+# cost of ANALYZE does not grow with the size of the table.
+DEFAULT_SAMPLE_SIZE = 30000
+DEFAULT_HISTOGRAM_BUCKETS = 100
+
+# Selectivities assumed when there are no statistics for a column
+DEFAULT_EQUALITY_SELECTIVITY = 0.005
+DEFAULT_INEQUALITY_SELECTIVITY = 1/3
+DEFAULT_NULL_SELECTIVITY = 0.005
+DEFAULT_SELECTIVITY = 0.5
+
+# Maps an operator to the operator with the operands swapped
+flipped_operators = {
+	'<': '>',
+	'<=': '>=',
+	'=': '=',
+	'>=': '<=',
+	'>': '<',
+	'<>': '<>',
+	'!=': '!=',
+}
+
+def clamp(fraction):
+	return min(1.0, max(0.0, fraction))
+
+class ColumnStatistics:
+	def __init__(self, null_fraction, distinct_count, min_value, max_value,
+			histogram):
+		'''
+		Summary of the values of a column.
+
+		The histogram is an equi-depth histogram given as a sorted list of
+		bucket boundaries. Each pair of adjacent boundaries encloses roughly
+		the same fraction of the non-null values.
+		'''
+		self.null_fraction = null_fraction
+		self.distinct_count = distinct_count
+		self.min = min_value
+		self.max = max_value
+		self.histogram = histogram
+
+	def fraction_below(self, value, inclusive):
+		'''
+		Returns the estimated fraction of non-null values less than value (or
+		less than or equal to value if inclusive is true).
+		'''
+		if not self.histogram:
+			return DEFAULT_INEQUALITY_SELECTIVITY
+		if value < self.min or (value == self.min and not inclusive):
+			return 0.0
+		if value > self.max or (value == self.max and inclusive):
+			return 1.0
+		bounds = self.histogram
+		buckets = len(bounds) - 1
+		if buckets == 0:
+			return 0.5
+		if inclusive:
+			i = bisect.bisect_right(bounds, value) - 1
+		else:
+			i = bisect.bisect_left(bounds, value) - 1
+		i = min(max(i, 0), buckets - 1)
+		lower, upper = bounds[i], bounds[i + 1]
+		if (relation.is_numeric(type(value)) and
+				relation.is_numeric(type(lower)) and upper != lower):
+			within = (value - lower)/(upper - lower)
+		else:
+			within = 0.5
+		return clamp((i + clamp(within))/buckets)
+
+	def equality_selectivity(self, value):
+		'Returns the estimated fraction of rows equal to value.'
+		if self.distinct_count == 0:
+			return 0.0
+		if value < self.min or value > self.max:
+			return 0.0
+		return (1 - self.null_fraction)/self.distinct_count
+
+	def selectivity(self, operator, value):
+		'''
+		Returns the estimated fraction of rows for which "column <operator>
+		value" is true.
+		'''
+		if value == None:
+			# Comparisons with null are never true
+			return 0.0
+		non_null = 1 - self.null_fraction
+		if operator == '=':
+			return self.equality_selectivity(value)
+		if operator in ('<>', '!='):
+			return clamp(non_null - self.equality_selectivity(value))
+		if operator == '<':
+			return non_null*self.fraction_below(value, False)
+		if operator == '<=':
+			return non_null*self.fraction_below(value, True)
+		if operator == '>':
+			return non_null*(1 - self.fraction_below(value, True))
+		if operator == '>=':
+			return non_null*(1 - self.fraction_below(value, False))
+		raise ValueError('Unknown comparison operator %r' % operator)
+
+class TableStatistics:
+	def __init__(self, row_count, sample_size, columns):
+		'''
+		Statistics for a table. columns is a list of ColumnStatistics in the
+		same order as the table's columns.
+		'''
+		self.row_count = row_count
+		self.sample_size = sample_size
+		self.columns = columns
+
+	def column(self, index):
+		return self.columns[index]
+
+def sample_rows(table, sample_size, rng):
+	'''
+	Returns a uniform random sample of at most sample_size rows of the table.
+	'''
+	row_count = table.row_count
+	if row_count <= sample_size:
+		return list(table)
+	row_ids = sorted(rng.sample(range(row_count), sample_size))
+	return [table.get_row(row_id) for row_id in row_ids]
+
+def estimate_distinct_count(values, row_count):
+	'''
+	Estimates the number of distinct values in a column of row_count non-null
+	values from a uniform sample of its values.
+
+	Uses the Duj1 estimator from Haas et al. "Sampling-Based Estimation of the
+	Number of Distinct Values of an Attribute".
+	'''
+	sample_size = len(values)
+	if sample_size == 0:
+		return 0
+	frequencies = {}
+	for value in values:
+		frequencies[value] = frequencies.get(value, 0) + 1
+	distinct = len(frequencies)
+	if sample_size >= row_count:
+		return distinct
+	singletons = sum(1 for count in frequencies.values() if count == 1)
+	denominator = (sample_size - singletons +
+					singletons*sample_size/row_count)
+	if denominator == 0:
+		return row_count
+	estimate = sample_size*distinct/denominator
+	return int(round(min(max(estimate, distinct), row_count)))
+
+def equi_depth_histogram(sorted_values, buckets):
+	'Returns the bucket boundaries of an equi-depth histogram.'
+	if not sorted_values:
+		return []
+	buckets = min(buckets, len(sorted_values))
+	last = len(sorted_values) - 1
+	return [sorted_values[(i*last)//buckets] for i in range(buckets + 1)]
+
+def analyze_column(values, row_count, histogram_buckets):
+	'''
+	Computes statistics for a column from a sample of its values taken from a
+	table with row_count rows.
+	'''
+	non_null = sorted(value for value in values if value != None)
+	if not values:
+		return ColumnStatistics(0.0, 0, None, None, [])
+	null_fraction = 1 - len(non_null)/len(values)
+	non_null_rows = int(round(row_count*(1 - null_fraction)))
+	if not non_null:
+		return ColumnStatistics(null_fraction, 0, None, None, [])
+	return ColumnStatistics(null_fraction,
+			estimate_distinct_count(non_null, non_null_rows),
+			non_null[0], non_null[-1],
+			equi_depth_histogram(non_null, histogram_buckets))
+
+def analyze(table, sample_size=DEFAULT_SAMPLE_SIZE,
+		histogram_buckets=DEFAULT_HISTOGRAM_BUCKETS, seed=None):
+	'Computes statistics for a table from a sample of its rows.'
+	rng = random.Random(seed)
+	row_count = table.row_count
+	sample = sample_rows(table, sample_size, rng)
+	columns = []
+	for column in table.columns:
+		values = [row[column.index] for row in sample]
+		columns.append(analyze_column(values, row_count, histogram_buckets))
+	return TableStatistics(row_count, len(sample), columns)
+
+def comparison_selectivity(predicate, column_statistics):
+	lhs, rhs = predicate.lhs, predicate.rhs
+	operator = predicate.operator
+	if type(lhs) == relation.Constant and type(rhs) == relation.Attribute:
+		lhs, rhs = rhs, lhs
+		operator = flipped_operators[operator]
+	if type(lhs) == relation.Attribute and type(rhs) == relation.Constant:
+		statistics = column_statistics(lhs.column.index)
+		if statistics:
+			return statistics.selectivity(operator, rhs.value)
+	elif (type(lhs) == relation.Attribute and
+			type(rhs) == relation.Attribute and operator == '='):
+		lhs_statistics = column_statistics(lhs.column.index)
+		rhs_statistics = column_statistics(rhs.column.index)
+		if lhs_statistics and rhs_statistics:
+			distinct = max(lhs_statistics.distinct_count,
+						rhs_statistics.distinct_count)
+			return 1/distinct if distinct else 0.0
+	if operator == '=':
+		return DEFAULT_EQUALITY_SELECTIVITY
+	if operator in ('<>', '!='):
+		return 1 - DEFAULT_EQUALITY_SELECTIVITY
+	return DEFAULT_INEQUALITY_SELECTIVITY
+
+def estimate_selectivity(predicate, column_statistics=lambda index: None):
+	'''
+	Returns the estimated fraction of rows for which the predicate is true.
+
+	column_statistics maps the index of an input column to its
+	ColumnStatistics or None if the column has no statistics.
+	'''
+	predicate_type = type(predicate)
+	if predicate_type == relation.Constant:
+		return 1.0 if predicate.value == True else 0.0
+	if predicate_type == relation.And:
+		return (estimate_selectivity(predicate.lhs, column_statistics) *
+				estimate_selectivity(predicate.rhs, column_statistics))
+	if predicate_type == relation.Or:
+		lhs = estimate_selectivity(predicate.lhs, column_statistics)
+		rhs = estimate_selectivity(predicate.rhs, column_statistics)
+		return clamp(lhs + rhs - lhs*rhs)
+	if predicate_type == relation.Conjunction:
+		return math.prod([estimate_selectivity(operand, column_statistics)
+							for operand in predicate.operands])
+	if predicate_type == relation.Disjunction:
+		return clamp(1 - math.prod([
+			1 - estimate_selectivity(operand, column_statistics)
+			for operand in predicate.operands]))
+	if predicate_type == relation.LogicalNot:
+		return clamp(
+			1 - estimate_selectivity(predicate.expression, column_statistics))
+	if predicate_type in (relation.IsNull, relation.IsNotNull):
+		null_fraction = DEFAULT_NULL_SELECTIVITY
+		if type(predicate.expression) == relation.Attribute:
+			statistics = column_statistics(predicate.expression.column.index)
+			if statistics:
+				null_fraction = statistics.null_fraction
+		if predicate_type == relation.IsNull:
+			return null_fraction
+		return 1 - null_fraction
+	if predicate_type == relation.Comparison:
+		return comparison_selectivity(predicate, column_statistics)
+	return DEFAULT_SELECTIVITY
+
+def table_selectivity(table, predicate):
+	'''
+	Returns the estimated fraction of the rows of a table for which the
+	predicate is true using the statistics from the last ANALYZE of the table.
+	'''
+	def column_statistics(index):
+		if table.statistics == None:
+			return None
+		return table.statistics.column(index)
+	return estimate_selectivity(predicate, column_statistics)
+
+# Fraction of input rows assumed to be distinct groups when the grouping
+# columns have no statistics
+DEFAULT_GROUP_FRACTION = 0.1
+
+def find_column_statistics(node, column_index):
+	'''
+	Returns the statistics of the base table column that the column at
+	column_index of the relation is taken from or None if the column is
+	computed or the table has not been analyzed.
+	'''
+	if (type(node) in index.index_scan_types or
+			type(node) == relation.ZoneMapScan):
+		return find_column_statistics(node.table, column_index)
+	if not node.inputs:
+		statistics = getattr(node, 'statistics', None)
+		return statistics.column(column_index) if statistics else None
+	if type(node) == relation.CrossJoin:
+		lhs_width = len(node.lhs.columns)
+		if column_index < lhs_width:
+			return find_column_statistics(node.lhs, column_index)
+		return find_column_statistics(node.rhs, column_index - lhs_width)
+	if type(node) == relation.GeneralizedProjection:
+		expression = node.expressions[column_index]
+		if type(expression) != relation.Attribute:
+			return None
+		return find_column_statistics(node.relation, expression.column.index)
+	if type(node) in (relation.Selection, relation.Sort):
+		return find_column_statistics(node.relation, column_index)
+	return None
+
+def estimate_rows(node):
+	'Returns the estimated number of rows produced by the relation.'
+	node_type = type(node)
+	if node_type in index.index_scan_types:
+		return (estimate_rows(node.table) *
+				table_selectivity(node.table, node.predicate()))
+	if node_type == relation.ZoneMapScan:
+		# The scan is always filtered by a selection with the same
+		# predicates, so its estimate is left to the selection
+		return estimate_rows(node.table)
+	if node_type in (parallel.ParallelPipeline, parallel.ParallelGroupBy,
+			parallel.ParallelSort):
+		return estimate_rows(node.plan)
+	if not node.inputs:
+		return getattr(node, 'row_count', 0)
+	if node_type == relation.Selection:
+		selectivity = estimate_selectivity(node.predicate,
+			lambda i: find_column_statistics(node.relation, i))
+		return estimate_rows(node.relation)*selectivity
+	if node_type == relation.CrossJoin:
+		return estimate_rows(node.lhs)*estimate_rows(node.rhs)
+	if node_type == relation.GroupBy:
+		input_rows = estimate_rows(node.relation)
+		if not node.grouping_columns:
+			return 1
+		groups = 1
+		for column in node.grouping_columns:
+			statistics = find_column_statistics(node.relation, column.index)
+			if statistics == None:
+				return max(1, input_rows*DEFAULT_GROUP_FRACTION)
+			# A null group is produced if there are null values
+			groups *= statistics.distinct_count + (
+						1 if statistics.null_fraction > 0 else 0)
+		return min(input_rows, groups)
+	if node_type == relation.Union:
+		return estimate_rows(node.lhs) + estimate_rows(node.rhs)
+	if node_type == relation.Intersection:
+		return min(estimate_rows(node.lhs), estimate_rows(node.rhs))
+	if node_type == relation.Difference:
+		return estimate_rows(node.lhs)
+	# Operators which output one row for each input row
+	return estimate_rows(node.children()[0])
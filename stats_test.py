@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+from relation import *
+from stats import *
+import unittest
+
+def make_table(values, column_type=int, nullable=True):
+	table = MaterialRelation([Column('x', column_type, nullable)])
+	for value in values:
+		table.insert((value,))
+	return table
+
+class TestMaterialRelationRowCount(unittest.TestCase):
+	def test_should_count_inserted_rows(self):
+		table = make_table([1, 2, 3])
+		self.assertEqual(table.row_count, 3)
+
+	def test_truncate_should_update_row_count(self):
+		table = make_table([1, 2, 3])
+		table.truncate(1)
+		self.assertEqual(table.row_count, 1)
+		self.assertEqual(list(table), [(1,)])
+
+class TestAnalyze(unittest.TestCase):
+	def test_should_compute_exact_statistics_for_small_table(self):
+		table = make_table([3, 1, None, 2, 2, None, 5, 4])
+		statistics = analyze(table)
+
+		self.assertEqual(statistics.row_count, 8)
+		self.assertEqual(statistics.sample_size, 8)
+		column = statistics.column(0)
+		self.assertAlmostEqual(column.null_fraction, 0.25)
+		self.assertEqual(column.distinct_count, 5)
+		self.assertEqual(column.min, 1)
+		self.assertEqual(column.max, 5)
+		self.assertEqual(column.histogram[0], 1)
+		self.assertEqual(column.histogram[-1], 5)
+
+	def test_histogram_should_be_sorted_and_bounded_by_bucket_count(self):
+		table = make_table(list(range(1000)))
+		column = analyze(table, histogram_buckets=10).column(0)
+		self.assertEqual(len(column.histogram), 11)
+		self.assertEqual(column.histogram, sorted(column.histogram))
+
+	def test_should_handle_empty_and_all_null_columns(self):
+		column = analyze(make_table([])).column(0)
+		self.assertEqual(column.distinct_count, 0)
+		self.assertEqual(column.histogram, [])
+
+		column = analyze(make_table([None, None])).column(0)
+		self.assertEqual(column.null_fraction, 1.0)
+		self.assertIsNone(column.min)
+
+	def test_should_sample_large_tables(self):
+		table = make_table(list(range(10000)))
+		statistics = analyze(table, sample_size=1000, seed=1)
+		self.assertEqual(statistics.row_count, 10000)
+		self.assertEqual(statistics.sample_size, 1000)
+		# All sampled values are unique so the estimate should scale up to the
+		# table size.
+		self.assertGreater(statistics.column(0).distinct_count, 5000)
+
+	def test_should_estimate_low_cardinality_from_sample(self):
+		table = make_table([i % 10 for i in range(10000)])
+		statistics = analyze(table, sample_size=1000, seed=1)
+		self.assertEqual(statistics.column(0).distinct_count, 10)
+
+class TestSelectivity(unittest.TestCase):
+	def setUp(self):
+		self.table = make_table(list(range(100)) + [None]*100)
+		self.table.statistics = analyze(self.table)
+		self.x = Attribute(self.table.columns[0])
+
+	def estimate(self, predicate):
+		return table_selectivity(self.table, predicate)
+
+	def test_equality(self):
+		self.assertAlmostEqual(
+			self.estimate(Comparison('=', self.x, Constant(10))), 0.005)
+		self.assertEqual(
+			self.estimate(Comparison('=', self.x, Constant(1000))), 0.0)
+
+	def test_range(self):
+		self.assertAlmostEqual(
+			self.estimate(Comparison('<', self.x, Constant(50))), 0.25,
+			delta=0.01)
+		self.assertAlmostEqual(
+			self.estimate(Comparison('>=', self.x, Constant(50))), 0.25,
+			delta=0.01)
+		self.assertEqual(
+			self.estimate(Comparison('<', self.x, Constant(-1))), 0.0)
+		self.assertAlmostEqual(
+			self.estimate(Comparison('<=', self.x, Constant(1000))), 0.5)
+
+	def test_constant_on_left_hand_side(self):
+		self.assertAlmostEqual(
+			self.estimate(Comparison('>', Constant(50), self.x)), 0.25,
+			delta=0.01)
+
+	def test_null_tests(self):
+		self.assertAlmostEqual(self.estimate(IsNull(self.x)), 0.5)
+		self.assertAlmostEqual(self.estimate(IsNotNull(self.x)), 0.5)
+
+	def test_logical_operators(self):
+		lhs = Comparison('<', self.x, Constant(50))
+		rhs = IsNull(self.x)
+		self.assertAlmostEqual(self.estimate(And(lhs, rhs)), 0.125, delta=0.01)
+		self.assertAlmostEqual(self.estimate(Or(lhs, rhs)), 0.625, delta=0.01)
+		self.assertAlmostEqual(self.estimate(LogicalNot(rhs)), 0.5)
+
+	def test_should_use_defaults_without_statistics(self):
+		table = make_table([1, 2, 3])
+		x = Attribute(table.columns[0])
+		self.assertEqual(
+			table_selectivity(table, Comparison('=', x, Constant(1))),
+			DEFAULT_EQUALITY_SELECTIVITY)
+		self.assertEqual(
+			table_selectivity(table, Comparison('<', x, Constant(1))),
+			DEFAULT_INEQUALITY_SELECTIVITY)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,528 @@
+import json
+import os
+import struct
+
+import relation
+
+PAGE_SIZE = 8192
+# Number of pages read at a time by sequential scans
+SCAN_BUFFER_PAGES = 64
+
+TABLE_MAGIC = b'SQLTBL01'
+# magic, page size, page count, row count, schema length
+TABLE_HEADER = struct.Struct('<8sIIQI')
+# id of the first row in the page, number of rows, offset of free space
+PAGE_HEADER = struct.Struct('<QHH')
+# Records start with their length
+RECORD_LENGTH = struct.Struct('<H')
+STRING_LENGTH = struct.Struct('<I')
+COLUMN_COUNT = struct.Struct('<H')
+COLUMN_INFO = struct.Struct('<BB')
+
+type_codes = {
+	bool: 1,
+	int: 2,
+	float: 3,
+	str: 4,
+}
+types_by_code = {code: value_type for value_type, code in type_codes.items()}
+
+def encode_string(s):
+	data = s.encode('utf-8')
+	return STRING_LENGTH.pack(len(data)) + data
+
+def decode_string(buffer, offset):
+	'Returns the string at the offset and the offset following it.'
+	length, = STRING_LENGTH.unpack_from(buffer, offset)
+	offset += STRING_LENGTH.size
+	return bytes(buffer[offset:offset + length]).decode('utf-8'), (
+			offset + length)
+
+def encode_schema(name, columns):
+	parts = [encode_string(name or ''), COLUMN_COUNT.pack(len(columns))]
+	for column in columns:
+		parts.append(encode_string(column.name))
+		parts.append(COLUMN_INFO.pack(type_codes[column.type],
+										1 if column.nullable else 0))
+	return b''.join(parts)
+
+def decode_schema(buffer, offset=0):
+	'Returns the table name, columns and the offset following the schema.'
+	name, offset = decode_string(buffer, offset)
+	count, = COLUMN_COUNT.unpack_from(buffer, offset)
+	offset += COLUMN_COUNT.size
+	columns = []
+	for i in range(count):
+		column_name, offset = decode_string(buffer, offset)
+		type_code, nullable = COLUMN_INFO.unpack_from(buffer, offset)
+		offset += COLUMN_INFO.size
+		columns.append(relation.Column(column_name, types_by_code[type_code],
+										nullable == 1, i))
+	return name or None, columns, offset
+
+# Formats of the null bitmap of a row by the number of columns it covers
+bitmap_formats = [(8, 'B'), (16, 'H'), (32, 'I'), (64, 'Q')]
+
+class RowCodec:
+	fixed_formats = {
+		bool: '?',
+		int: 'q',
+		float: 'd',
+		str: 'I',
+	}
+	null_values = {
+		bool: False,
+		int: 0,
+		float: 0.0,
+		str: 0,
+	}
+
+	def __init__(self, columns):
+		'''
+		Encodes rows as records made of a fixed width part followed by the
+		bytes of any strings. The fixed width part holds the length of the
+		record, a bitmap of the null columns and one slot per column. String
+		slots hold the length of the string.
+		'''
+		self.columns = columns
+		self.wide_bitmap = len(columns) > 64
+		if self.wide_bitmap:
+			bitmap_format = '%ds' % ((len(columns) + 7)//8)
+		else:
+			bitmap_format = [f for bits, f in bitmap_formats
+								if len(columns) <= bits][0]
+		self.fixed = struct.Struct('<H' + bitmap_format + ''.join(
+			[RowCodec.fixed_formats[column.type] for column in columns]))
+		self.string_columns = [
+			i for i, column in enumerate(columns) if column.type == str]
+		self.null_values = [
+			RowCodec.null_values[column.type] for column in columns]
+
+	def encode(self, row):
+		'Returns the record of a row.'
+		bitmap = 0
+		values = list(row)
+		for i, value in enumerate(values):
+			if value == None:
+				bitmap |= 1 << i
+				values[i] = self.null_values[i]
+		strings = []
+		length = self.fixed.size
+		for i in self.string_columns:
+			if bitmap & (1 << i):
+				continue
+			data = values[i].encode('utf-8')
+			values[i] = len(data)
+			length += len(data)
+			strings.append(data)
+		if self.wide_bitmap:
+			bitmap = bitmap.to_bytes((len(self.columns) + 7)//8, 'little')
+		try:
+			fixed = self.fixed.pack(length, bitmap, *values)
+		except struct.error as e:
+			raise ValueError('Can not store row %r: %s' % (row, e))
+		return fixed + b''.join(strings)
+
+	def decode_records(self, buffer, offset, count):
+		'Returns the rows of count consecutive records starting at offset.'
+		unpack_from = self.fixed.unpack_from
+		fixed_size = self.fixed.size
+		string_columns = self.string_columns
+		rows = []
+		for _ in range(count):
+			values = unpack_from(buffer, offset)
+			position = offset + fixed_size
+			offset += values[0]
+			if not (values[1] or string_columns):
+				rows.append(values[2:])
+				continue
+			row = list(values[2:])
+			for i in string_columns:
+				end = position + row[i]
+				row[i] = str(buffer[position:end], 'utf-8')
+				position = end
+			bitmap = values[1]
+			if bitmap:
+				if self.wide_bitmap:
+					bitmap = int.from_bytes(bitmap, 'little')
+				for i in range(len(row)):
+					if bitmap & (1 << i):
+						row[i] = None
+			rows.append(tuple(row))
+		return rows
+
+	def decode(self, buffer, offset):
+		'Returns the row of the record at offset.'
+		return self.decode_records(buffer, offset, 1)[0]
+
+def new_page(first_row_id):
+	page = bytearray(PAGE_SIZE)
+	PAGE_HEADER.pack_into(page, 0, first_row_id, 0, PAGE_HEADER.size)
+	return page
+
+def record_offset(page, position):
+	'Returns the offset of the record at the position in a page.'
+	offset = PAGE_HEADER.size
+	for _ in range(position):
+		offset += RECORD_LENGTH.unpack_from(page, offset)[0]
+	return offset
+
+class DiskRelation(relation.Relation):
+	def __init__(self, path, file, columns, name, page_count, row_count,
+			buffer_pool=None):
+		'''
+		A table stored in a file of fixed size pages. The first page holds the
+		header and schema and the remaining pages hold rows in insertion
+		order. Each data page records the id of its first row, its number of
+		rows and where its free space starts. Rows are only appended, so the
+		last page is the only one with free space.
+
+		Pages are read through the buffer pool if one is given.
+
+		Use create and open rather than the constructor.
+		'''
+		super().__init__(columns, name)
+		self.path = path
+		self.file = file
+		self.codec = RowCodec(self.columns)
+		self.page_count = page_count
+		self.row_count = row_count
+		# The last page, which rows are appended to, once it has been read
+		self.tail = None
+		self.dirty = False
+		self.statistics = None
+		# Indexes are kept in memory and are not stored in the file
+		self.indexes = {}
+		self.buffer_pool = buffer_pool
+		if buffer_pool != None:
+			self.file_id = buffer_pool.new_file_id()
+		self.version = next(relation.table_versions)
+
+	@staticmethod
+	def create(path, columns, name=None, buffer_pool=None):
+		'Creates an empty table file, replacing any existing file.'
+		file = open(path, 'w+b')
+		table = DiskRelation(path, file, columns, name, 1, 0, buffer_pool)
+		table.write_header()
+		return table
+
+	@staticmethod
+	def open(path, buffer_pool=None):
+		'''
+		Opens an existing table file. Only the header and the last page are
+		read. Rows appended to the last page after the header was last
+		written are discarded, as are pages after the last page.
+		'''
+		file = open(path, 'r+b')
+		header = file.read(PAGE_SIZE)
+		magic, page_size, page_count, row_count, schema_length = (
+			TABLE_HEADER.unpack_from(header, 0))
+		if magic != TABLE_MAGIC or page_size != PAGE_SIZE:
+			file.close()
+			raise ValueError('%r is not a table file' % path)
+		name, columns, _ = decode_schema(header, TABLE_HEADER.size)
+		table = DiskRelation(path, file, columns, name, page_count, row_count,
+								buffer_pool)
+		table.discard_unwritten_rows()
+		return table
+
+	def discard_unwritten_rows(self):
+		if self.page_count > 1:
+			self.load_tail()
+			first_row_id, count, free_offset = PAGE_HEADER.unpack_from(
+												self.tail, 0)
+			if first_row_id + count > self.row_count:
+				self.truncate_tail(self.row_count - first_row_id)
+				self.write_page(self.page_count - 1, self.tail)
+		self.file.truncate(self.page_count*PAGE_SIZE)
+
+	def write_header(self):
+		schema = encode_schema(self.name, self.columns)
+		header = TABLE_HEADER.pack(TABLE_MAGIC, PAGE_SIZE, self.page_count,
+									self.row_count, len(schema)) + schema
+		if len(header) > PAGE_SIZE:
+			raise ValueError('Schema of table %r is too large' % self.name)
+		os.pwrite(self.file.fileno(), header, 0)
+
+	def read_pages(self, page_number, count):
+		'''
+		Returns the contents of count consecutive pages. The last page is
+		taken from memory since it may not have been written yet.
+		'''
+		last_page = self.page_count - 1
+		if self.tail == None or page_number + count <= last_page:
+			return os.pread(self.file.fileno(), count*PAGE_SIZE,
+							page_number*PAGE_SIZE)
+		data = os.pread(self.file.fileno(), (last_page - page_number)*PAGE_SIZE,
+						page_number*PAGE_SIZE)
+		return data + self.tail
+
+	def write_page(self, page_number, page):
+		os.pwrite(self.file.fileno(), page, page_number*PAGE_SIZE)
+		self.discard_cached_pages(page_number)
+
+	def discard_cached_pages(self, first_page=0):
+		if self.buffer_pool != None:
+			self.buffer_pool.discard_file(self.file_id, first_page)
+
+	def pin_page(self, page_number, load=None, ring=None):
+		'''
+		Returns the buffer pool frame of a page, which must be unpinned once
+		its data is no longer used. load reads the page if it is not cached.
+		'''
+		if load == None:
+			load = lambda: self.read_pages(page_number, 1)
+		return self.buffer_pool.pin((self.file_id, page_number), load, ring)
+
+	def read_page(self, page_number, decode):
+		'''
+		Returns the result of calling decode with the contents of a page. The
+		last page is read from memory while rows are being added to it.
+		'''
+		if self.buffer_pool == None or (self.tail != None and
+				page_number == self.page_count - 1):
+			return decode(self.read_pages(page_number, 1))
+		frame = self.pin_page(page_number)
+		try:
+			return decode(frame.data)
+		finally:
+			self.buffer_pool.unpin(frame)
+
+	def load_tail(self):
+		if self.tail != None:
+			return
+		if self.page_count == 1:
+			self.tail = new_page(0)
+			self.page_count = 2
+			self.dirty = True
+		else:
+			self.tail = bytearray(self.read_pages(self.page_count - 1, 1))
+
+	def truncate_tail(self, row_count):
+		'Removes all but the first row_count rows from the last page.'
+		first_row_id = PAGE_HEADER.unpack_from(self.tail, 0)[0]
+		end = record_offset(self.tail, row_count)
+		self.tail[end:] = bytes(PAGE_SIZE - end)
+		PAGE_HEADER.pack_into(self.tail, 0, first_row_id, row_count, end)
+
+	def validate(self, values):
+		'''
+		Returns the values as a row of the relation or raises an exception if
+		they can not be inserted.
+		'''
+		if len(values) != len(self.columns):
+			raise TypeError("Wrong number of columns")
+		for value, column in zip(values, self.columns):
+			column.check_value_type(value)
+		row = tuple(values)
+		if len(self.codec.encode(row)) > PAGE_SIZE - PAGE_HEADER.size:
+			raise ValueError('Row is too large to store in a page')
+		return row
+
+	def insert(self, values):
+		self.append(self.validate(values))
+
+	def load(self, rows):
+		'''
+		Appends a list of rows which are already known to be valid, without
+		checking the types of their values.
+		'''
+		for row in rows:
+			self.append(row)
+
+	def append(self, row):
+		record = self.codec.encode(row)
+		if len(record) > PAGE_SIZE - PAGE_HEADER.size:
+			raise ValueError('Row is too large to store in a page')
+		self.version = next(relation.table_versions)
+		self.load_tail()
+		first_row_id, count, free_offset = PAGE_HEADER.unpack_from(self.tail, 0)
+		if free_offset + len(record) > PAGE_SIZE:
+			# Full pages are written immediately and never change again
+			self.write_page(self.page_count - 1, self.tail)
+			self.tail = new_page(self.row_count)
+			self.page_count += 1
+			first_row_id, count, free_offset = self.row_count, 0, (
+												PAGE_HEADER.size)
+		end = free_offset + len(record)
+		self.tail[free_offset:end] = record
+		PAGE_HEADER.pack_into(self.tail, 0, first_row_id, count + 1, end)
+		for index in self.indexes.values():
+			index.insert(self.row_count, row)
+		self.row_count += 1
+		self.dirty = True
+
+	def flush(self, sync=False):
+		'''
+		Writes the last page and then the header to the file. If sync is true,
+		the pages are flushed to stable storage before the header is written
+		and the header is flushed after, so the header never describes rows
+		that were not stored.
+		'''
+		if self.dirty:
+			if self.tail != None:
+				self.write_page(self.page_count - 1, self.tail)
+			if sync:
+				os.fsync(self.file.fileno())
+			self.write_header()
+			self.dirty = False
+		if sync:
+			os.fsync(self.file.fileno())
+
+	def first_row_id(self, page_number):
+		return self.read_page(page_number,
+			lambda page: PAGE_HEADER.unpack_from(page, 0)[0])
+
+	def find_page(self, row_id):
+		'Returns the number of the page holding the row.'
+		low, high = 1, self.page_count - 1
+		while low < high:
+			middle = (low + high + 1)//2
+			if self.first_row_id(middle) <= row_id:
+				low = middle
+			else:
+				high = middle - 1
+		return low
+
+	def get_row(self, row_id):
+		'Returns the row with the given position in insertion order.'
+		if row_id < 0 or row_id >= self.row_count:
+			raise IndexError('Row id %d out of range' % row_id)
+		def decode(page):
+			first_row_id = PAGE_HEADER.unpack_from(page, 0)[0]
+			offset = record_offset(page, row_id - first_row_id)
+			return self.codec.decode(page, offset)
+		return self.read_page(self.find_page(row_id), decode)
+
+	def truncate(self, row_count):
+		'Removes all rows after the first row_count rows.'
+		if row_count >= self.row_count:
+			return
+		self.version = next(relation.table_versions)
+		if self.indexes:
+			for row_id in range(self.row_count - 1, row_count - 1, -1):
+				row = self.get_row(row_id)
+				for index in self.indexes.values():
+					index.remove(row_id, row)
+		if row_count == 0:
+			self.page_count = 1
+			self.tail = None
+		else:
+			page_number = self.find_page(row_count - 1)
+			self.tail = bytearray(self.read_pages(page_number, 1))
+			self.page_count = page_number + 1
+			first_row_id = PAGE_HEADER.unpack_from(self.tail, 0)[0]
+			self.truncate_tail(row_count - first_row_id)
+		self.row_count = row_count
+		self.file.truncate(self.page_count*PAGE_SIZE)
+		self.discard_cached_pages(self.page_count - 1)
+		self.dirty = True
+
+	def __iter__(self):
+		if self.buffer_pool == None:
+			return self.scan(self.page_count)
+		return self.scan_buffered(self.page_count)
+
+	def decode_page(self, buffer, page_start=0):
+		first_row_id, row_count, free_offset = PAGE_HEADER.unpack_from(
+			buffer, page_start)
+		return self.codec.decode_records(buffer,
+			page_start + PAGE_HEADER.size, row_count)
+
+	def scan_buffered(self, page_count):
+		'''
+		Yields the rows in the first page_count pages, reading pages through
+		the buffer pool. Pages which are not cached are read SCAN_BUFFER_PAGES
+		at a time.
+		'''
+		ring = self.buffer_pool.scan_ring(page_count)
+		try:
+			page_number = 1
+			while page_number < page_count:
+				count = min(SCAN_BUFFER_PAGES, page_count - page_number)
+				buffer = None
+				for number in range(page_number, page_number + count):
+					if self.tail != None and number == self.page_count - 1:
+						yield from self.decode_page(self.tail)
+						continue
+					def load():
+						nonlocal buffer
+						if buffer == None:
+							buffer = self.read_pages(page_number, count)
+						start = (number - page_number)*PAGE_SIZE
+						return buffer[start:start + PAGE_SIZE]
+					frame = self.pin_page(number, load, ring)
+					try:
+						rows = self.decode_page(frame.data)
+					finally:
+						self.buffer_pool.unpin(frame)
+					yield from rows
+				page_number += count
+		finally:
+			if ring != None:
+				self.buffer_pool.release_ring(ring)
+
+	def scan(self, page_count):
+		'Yields the rows in the first page_count pages.'
+		page_number = 1
+		while page_number < page_count:
+			count = min(SCAN_BUFFER_PAGES, page_count - page_number)
+			buffer = self.read_pages(page_number, count)
+			for page_start in range(0, count*PAGE_SIZE, PAGE_SIZE):
+				first_row_id, row_count, free_offset = (
+					PAGE_HEADER.unpack_from(buffer, page_start))
+				yield from self.codec.decode_records(buffer,
+					page_start + PAGE_HEADER.size, row_count)
+			page_number += count
+
+	def close(self):
+		self.flush()
+		self.file.close()
+		self.discard_cached_pages()
+
+CATALOG_FILE = 'catalog.json'
+
+TABLE_FILE_SUFFIX = '.tbl'
+
+def table_file_name(table_name, lsn):
+	'''
+	Returns the name of the file of a table created by the log record with
+	the sequence number, so a table replacing another one never overwrites
+	its file.
+	'''
+	return '%s.%d%s' % (table_name, lsn, TABLE_FILE_SUFFIX)
+
+def is_table_file_name(file_name):
+	return file_name.endswith(TABLE_FILE_SUFFIX)
+
+def load_catalog(path, buffer_pool=None):
+	'''
+	Opens the tables listed in the catalog file of a database directory,
+	reading their pages through the buffer pool if one is given. Returns the
+	tables by name and the sequence number of the last log record whose
+	changes the table files contain.
+	'''
+	catalog_path = os.path.join(path, CATALOG_FILE)
+	if not os.path.exists(catalog_path):
+		return {}, 0
+	with open(catalog_path) as f:
+		entries = json.load(f)
+	catalog = {name: DiskRelation.open(os.path.join(path, file_name),
+										buffer_pool)
+				for name, file_name in entries['tables'].items()}
+	return catalog, entries.get('checkpoint_lsn', 0)
+
+def save_catalog(path, catalog, checkpoint_lsn=0):
+	'Atomically replaces the catalog file of a database directory.'
+	entries = {
+		'tables': {name: os.path.basename(table.path)
+					for name, table in catalog.items()},
+		'checkpoint_lsn': checkpoint_lsn,
+	}
+	catalog_path = os.path.join(path, CATALOG_FILE)
+	temporary_path = catalog_path + '.tmp'
+	with open(temporary_path, 'w') as f:
+		json.dump(entries, f)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(temporary_path, catalog_path)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+from relation import *
+from storage import *
+import bufferpool
+import index
+import os
+import shutil
+import tempfile
+import unittest
+
+class TestRowCodec(unittest.TestCase):
+	def setUp(self):
+		self.columns = [Column('a', int, index=0), Column('b', str, index=1),
+						Column('c', float, index=2), Column('d', bool, index=3)]
+		self.codec = RowCodec(self.columns)
+
+	def test_should_round_trip_rows(self):
+		for row in [(1, 'x', 1.5, True), (-2**63, '', -0.0, False),
+					(None, None, None, None), (3, 'héllo', None, True)]:
+			data = b'..' + self.codec.encode(row)
+			self.assertEqual(self.codec.decode(data, 2), row)
+
+	def test_should_reject_integers_too_large_to_store(self):
+		with self.assertRaisesRegex(ValueError, 'Can not store'):
+			self.codec.encode((2**63, 'x', 1.0, True))
+
+	def test_should_round_trip_schema(self):
+		name, columns, offset = decode_schema(
+			encode_schema('t', self.columns))
+		self.assertEqual(name, 't')
+		self.assertEqual([(c.name, c.type, c.nullable) for c in columns],
+			[(c.name, c.type, c.nullable) for c in self.columns])
+
+class TestDiskRelation(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 't.tbl')
+		self.table = DiskRelation.create(self.path,
+			[Column('a', int, False), Column('b', str)], 't')
+
+	def tearDown(self):
+		self.table.file.close()
+		shutil.rmtree(self.directory)
+
+	def insert_rows(self, count):
+		rows = [(i, None if i % 7 == 0 else 'row %d' % i)
+				for i in range(count)]
+		for row in rows:
+			self.table.insert(row)
+		return rows
+
+	def test_should_scan_rows_in_insertion_order(self):
+		rows = self.insert_rows(5000)
+		self.assertGreater(self.table.page_count, 3)
+		self.assertEqual(list(self.table), rows)
+
+	def test_should_read_rows_after_reopening(self):
+		rows = self.insert_rows(5000)
+		self.table.close()
+		self.table = DiskRelation.open(self.path)
+		self.assertEqual(self.table.name, 't')
+		self.assertEqual(self.table.row_count, 5000)
+		self.assertEqual(self.table.columns[0].nullable, False)
+		self.assertEqual(list(self.table), rows)
+
+	def test_should_append_to_last_page_after_reopening(self):
+		rows = self.insert_rows(10)
+		self.table.close()
+		self.table = DiskRelation.open(self.path)
+		self.table.insert((10, 'more'))
+		self.assertEqual(self.table.page_count, 2)
+		self.assertEqual(list(self.table), rows + [(10, 'more')])
+
+	def test_should_get_rows_by_id(self):
+		rows = self.insert_rows(5000)
+		for row_id in (0, 1, 999, 2500, 4999):
+			self.assertEqual(self.table.get_row(row_id), rows[row_id])
+		with self.assertRaises(IndexError):
+			self.table.get_row(5000)
+
+	def test_truncate_should_remove_rows_across_pages(self):
+		rows = self.insert_rows(5000)
+		self.table.truncate(1234)
+		self.assertEqual(self.table.row_count, 1234)
+		self.assertEqual(list(self.table), rows[:1234])
+		self.table.insert((-1, 'after'))
+		self.assertEqual(self.table.get_row(1234), (-1, 'after'))
+		self.table.truncate(0)
+		self.assertEqual(list(self.table), [])
+		self.assertEqual(os.path.getsize(self.path), PAGE_SIZE)
+
+	def test_truncate_should_remove_index_entries(self):
+		self.insert_rows(10)
+		hash_index = index.create_index('i', self.table, ['a'])
+		self.table.truncate(5)
+		self.assertEqual(hash_index.lookup((7,)), [])
+		self.assertEqual(hash_index.lookup((3,)), [3])
+
+	def test_should_reject_rows_larger_than_a_page(self):
+		with self.assertRaisesRegex(ValueError, 'too large'):
+			self.table.insert((1, 'x'*PAGE_SIZE))
+		self.assertEqual(self.table.row_count, 0)
+
+	def test_should_check_value_types(self):
+		with self.assertRaises(TypeError):
+			self.table.insert((None, 'x'))
+
+	def test_open_should_reject_other_files(self):
+		path = os.path.join(self.directory, 'other')
+		with open(path, 'wb') as f:
+			f.write(b'\0'*PAGE_SIZE)
+		with self.assertRaisesRegex(ValueError, 'not a table file'):
+			DiskRelation.open(path)
+
+class TestBufferedDiskRelation(TestDiskRelation):
+	'Runs the DiskRelation tests with pages read through a small buffer pool.'
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 't.tbl')
+		self.pool = bufferpool.BufferPool(16*PAGE_SIZE)
+		self.table = DiskRelation.create(self.path,
+			[Column('a', int, False), Column('b', str)], 't', self.pool)
+
+	def test_should_cache_pages_of_small_tables(self):
+		rows = self.insert_rows(1000)
+		self.table.flush()
+		self.table.tail = None
+		self.assertEqual(list(self.table), rows)
+		misses = self.pool.misses
+		self.assertEqual(list(self.table), rows)
+		self.assertEqual(self.pool.misses, misses)
+		self.assertGreater(self.pool.hits, 0)
+
+	def test_large_scans_should_not_evict_cached_pages(self):
+		rows = self.insert_rows(5000)
+		self.assertEqual(self.table.get_row(3), rows[3])
+		self.assertEqual(list(self.table), rows)
+		self.assertLessEqual(len(self.pool.frames), 16)
+		misses = self.pool.misses
+		self.assertEqual(self.table.get_row(3), rows[3])
+		self.assertEqual(self.pool.misses, misses)
+
+	def test_should_not_return_stale_pages(self):
+		self.insert_rows(1000)
+		self.table.flush()
+		self.table.tail = None
+		self.table.get_row(999)
+		self.table.truncate(500)
+		self.table.insert((-1, 'new'))
+		self.table.flush()
+		self.table.tail = None
+		self.assertEqual(self.table.get_row(500), (-1, 'new'))
+
+	def test_close_should_drop_cached_pages(self):
+		self.insert_rows(5000)
+		self.table.get_row(0)
+		self.table.close()
+		self.assertEqual(self.pool.statistics()['pages'], 0)
+
+class TestCatalog(unittest.TestCase):
+	def test_should_open_tables_listed_in_catalog(self):
+		directory = tempfile.mkdtemp()
+		try:
+			table = DiskRelation.create(os.path.join(directory, 't.tbl'),
+										[Column('a', int)], 't')
+			table.insert((1,))
+			table.close()
+			save_catalog(directory, {'t': table}, 7)
+			catalog, checkpoint_lsn = load_catalog(directory)
+			self.assertEqual(checkpoint_lsn, 7)
+			self.assertEqual(list(catalog), ['t'])
+			self.assertEqual(list(catalog['t']), [(1,)])
+			catalog['t'].close()
+		finally:
+			shutil.rmtree(directory)
+
+	def test_missing_catalog_should_be_empty(self):
+		directory = tempfile.mkdtemp()
+		try:
+			self.assertEqual(load_catalog(directory), ({}, 0))
+		finally:
+			shutil.rmtree(directory)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,186 @@
+import os
+import struct
+import threading
+import zlib
+
+import storage
+
+# Length of the payload, CRC-32 of the rest of the record, log sequence number
+# and record type
+RECORD_HEADER = struct.Struct('<IIQB')
+# Id of the first inserted row and the number of rows
+INSERT_HEADER = struct.Struct('<QI')
+
+LOG_FILE = 'wal.log'
+
+CREATE_TABLE = 1
+INSERT = 2
+
+class LogRecord:
+	def __init__(self, lsn, record_type, payload):
+		self.lsn = lsn
+		self.type = record_type
+		self.payload = payload
+
+# Offset of the part of a record covered by the checksum
+CHECKED_OFFSET = 8
+
+def encode_record(lsn, record_type, payload):
+	header = RECORD_HEADER.pack(len(payload), 0, lsn, record_type)
+	crc = zlib.crc32(header[CHECKED_OFFSET:] + payload)
+	return RECORD_HEADER.pack(len(payload), crc, lsn, record_type) + payload
+
+def create_table_payload(name, columns):
+	return storage.encode_schema(name, columns)
+
+def decode_create_table(payload):
+	'Returns the table name and columns of a CREATE_TABLE record.'
+	name, columns, _ = storage.decode_schema(payload)
+	return name, columns
+
+def insert_payload(table_name, first_row_id, rows, codec):
+	return b''.join([storage.encode_string(table_name),
+		INSERT_HEADER.pack(first_row_id, len(rows))] +
+		[codec.encode(row) for row in rows])
+
+def decode_insert(payload, tables):
+	'''
+	Returns the table name, first row id and rows of an INSERT record.
+	tables maps table names to tables.
+	'''
+	table_name, offset = storage.decode_string(payload, 0)
+	first_row_id, count = INSERT_HEADER.unpack_from(payload, offset)
+	rows = tables[table_name].codec.decode_records(payload,
+		offset + INSERT_HEADER.size, count)
+	return table_name, first_row_id, rows
+
+def read_records(path):
+	'''
+	Returns the complete records of a log file and the length of the valid
+	part of the file. Reading stops at the first record which is incomplete
+	or fails its checksum, which is what a crash while appending leaves.
+	'''
+	with open(path, 'rb') as f:
+		data = f.read()
+	records = []
+	offset = 0
+	while offset + RECORD_HEADER.size <= len(data):
+		length, crc, lsn, record_type = RECORD_HEADER.unpack_from(data, offset)
+		end = offset + RECORD_HEADER.size + length
+		if end > len(data):
+			break
+		if zlib.crc32(data[offset + CHECKED_OFFSET:end]) != crc:
+			break
+		records.append(LogRecord(lsn, record_type,
+			data[offset + RECORD_HEADER.size:end]))
+		offset = end
+	return records, offset
+
+class WriteAheadLog:
+	def __init__(self, path, next_lsn=1, group_commit=True):
+		'''
+		An append only log of changes. Records are appended by append and are
+		durable once commit returns.
+
+		With group commit, a committer which finds no flush in progress
+		becomes the leader and flushes every record appended so far with a
+		single fsync while other committers wait for it. Without group
+		commit, every commit does its own fsync.
+		'''
+		self.path = path
+		self.file = open(path, 'ab')
+		self.group_commit = group_commit
+		self.lock = threading.Lock()
+		self.flushed = threading.Condition(self.lock)
+		self.next_lsn = next_lsn
+		# Every record up to and including synced_lsn is durable
+		self.synced_lsn = next_lsn - 1
+		self.syncing = False
+		self.sync_count = 0
+
+	def append(self, record_type, payload):
+		'Appends a record and returns its log sequence number.'
+		with self.lock:
+			lsn = self.next_lsn
+			self.next_lsn += 1
+			self.file.write(encode_record(lsn, record_type, payload))
+			return lsn
+
+	def reserve_lsn(self):
+		'''
+		Returns a sequence number which no record will have, for naming the
+		files of tables created without a log record.
+		'''
+		with self.lock:
+			lsn = self.next_lsn
+			self.next_lsn += 1
+			return lsn
+
+	def sync(self):
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.sync_count += 1
+
+	def commit(self, lsn):
+		'Waits until the record with the log sequence number is durable.'
+		with self.lock:
+			if not self.group_commit:
+				self.sync()
+				self.synced_lsn = max(self.synced_lsn, lsn)
+				return
+			while self.synced_lsn < lsn:
+				if self.syncing:
+					self.flushed.wait()
+					continue
+				self.syncing = True
+				target = self.next_lsn - 1
+				self.file.flush()
+				self.lock.release()
+				try:
+					os.fsync(self.file.fileno())
+				finally:
+					self.lock.acquire()
+					self.syncing = False
+					self.flushed.notify_all()
+				self.sync_count += 1
+				self.synced_lsn = max(self.synced_lsn, target)
+
+	def reset(self):
+		'''
+		Empties the log once the changes it records are stored elsewhere.
+		Sequence numbers keep increasing.
+		'''
+		with self.lock:
+			while self.syncing:
+				self.flushed.wait()
+			self.file.truncate(0)
+			self.file.flush()
+			os.fsync(self.file.fileno())
+			self.synced_lsn = self.next_lsn - 1
+			self.flushed.notify_all()
+
+	def size(self):
+		with self.lock:
+			return self.file.tell()
+
+	def close(self):
+		self.file.close()
+
+class Checkpointer(threading.Thread):
+	def __init__(self, checkpoint, interval):
+		'''
+		Calls checkpoint every interval seconds in the background until
+		stopped.
+		'''
+		super().__init__(daemon=True)
+		self.checkpoint = checkpoint
+		self.interval = interval
+		self.stopped = threading.Event()
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			self.checkpoint()
+
+	def stop(self):
+		self.stopped.set()
+		self.join()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+from relation import Column
+from wal import *
+import storage
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+class TestRecords(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, LOG_FILE)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_should_read_appended_records(self):
+		log = WriteAheadLog(self.path)
+		log.append(CREATE_TABLE, b'first')
+		log.append(INSERT, b'')
+		log.close()
+		records, length = read_records(self.path)
+		self.assertEqual([(r.lsn, r.type, r.payload) for r in records],
+			[(1, CREATE_TABLE, b'first'), (2, INSERT, b'')])
+		self.assertEqual(length, os.path.getsize(self.path))
+
+	def test_should_stop_at_incomplete_record(self):
+		with open(self.path, 'wb') as f:
+			f.write(encode_record(1, INSERT, b'complete'))
+			f.write(encode_record(2, INSERT, b'incomplete')[:-1])
+		records, length = read_records(self.path)
+		self.assertEqual([r.lsn for r in records], [1])
+		self.assertEqual(length, len(encode_record(1, INSERT, b'complete')))
+
+	def test_should_stop_at_corrupt_record(self):
+		record = bytearray(encode_record(2, INSERT, b'payload'))
+		record[-1] ^= 1
+		with open(self.path, 'wb') as f:
+			f.write(encode_record(1, INSERT, b'payload'))
+			f.write(record)
+			f.write(encode_record(3, INSERT, b'payload'))
+		records, length = read_records(self.path)
+		self.assertEqual([r.lsn for r in records], [1])
+
+	def test_insert_payload_should_round_trip(self):
+		table = storage.DiskRelation.create(
+			os.path.join(self.directory, 't.tbl'),
+			[Column('a', int), Column('b', str)], 't')
+		rows = [(1, 'one'), (None, None)]
+		payload = insert_payload('t', 5, rows, table.codec)
+		self.assertEqual(decode_insert(payload, {'t': table}), ('t', 5, rows))
+		table.close()
+
+	def test_create_table_payload_should_round_trip(self):
+		name, columns = decode_create_table(create_table_payload('t',
+			[Column('a', int, False, 0)]))
+		self.assertEqual(name, 't')
+		self.assertEqual((columns[0].name, columns[0].type,
+			columns[0].nullable), ('a', int, False))
+
+class TestCommit(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, LOG_FILE)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_group_commit_should_sync_appended_records_together(self):
+		log = WriteAheadLog(self.path)
+		lsns = [log.append(INSERT, b'x') for i in range(3)]
+		log.commit(lsns[-1])
+		log.commit(lsns[0])
+		log.commit(lsns[1])
+		self.assertEqual(log.sync_count, 1)
+		self.assertEqual(log.synced_lsn, 3)
+		log.close()
+
+	def test_sync_per_commit_should_sync_every_commit(self):
+		log = WriteAheadLog(self.path, group_commit=False)
+		lsns = [log.append(INSERT, b'x') for i in range(3)]
+		for lsn in lsns:
+			log.commit(lsn)
+		self.assertEqual(log.sync_count, 3)
+		log.close()
+
+	def test_concurrent_commits_should_all_become_durable(self):
+		log = WriteAheadLog(self.path)
+		def commit_records():
+			for i in range(20):
+				log.commit(log.append(INSERT, b'x'))
+		threads = [threading.Thread(target=commit_records) for i in range(8)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(log.synced_lsn, 160)
+		self.assertLessEqual(log.sync_count, 160)
+		log.close()
+		self.assertEqual(len(read_records(self.path)[0]), 160)
+
+	def test_reset_should_empty_log_and_keep_numbering(self):
+		log = WriteAheadLog(self.path, next_lsn=10)
+		log.append(INSERT, b'x')
+		log.reset()
+		self.assertEqual(log.synced_lsn, 10)
+		self.assertEqual(log.append(INSERT, b'y'), 11)
+		log.close()
+		self.assertEqual([r.lsn for r in read_records(self.path)[0]], [11])
+
+class TestCheckpointer(unittest.TestCase):
+	def test_should_checkpoint_until_stopped(self):
+		called = threading.Event()
+		checkpointer = Checkpointer(called.set, 0.01)
+		checkpointer.start()
+		self.assertTrue(called.wait(5))
+		checkpointer.stop()
+		self.assertFalse(checkpointer.is_alive())
+
+if __name__ == '__main__':
+	unittest.main()